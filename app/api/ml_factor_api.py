@@ -1,14 +1,17 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, current_app
 from datetime import datetime, timedelta
 from loguru import logger
 import pandas as pd
 import numpy as np
 
 from app.services.factor_engine import FactorEngine
+from app.services.factor_incremental import IncrementalFactorEngine
 from app.services.ml_models import MLModelManager
 from app.services.stock_scoring import StockScoringEngine
 from app.services.portfolio_optimizer import PortfolioOptimizer
 from app.services.backtest_engine import BacktestEngine
+from app.services.backtest_sweep import BacktestSweepRunner
+from app.services.job_queue import JobQueue, JobStore, JobContext, JobQueueFull
 from app.services.trading_agents_service import unified_decision_engine
 
 # 创建蓝图
@@ -20,6 +23,8 @@ ml_manager = None
 scoring_engine = None
 portfolio_optimizer = None
 backtest_engine = None
+incremental_engine = None
+job_queue = None
 
 # JSON序列化辅助函数
 def convert_numpy_types(obj):
@@ -44,6 +49,13 @@ def get_factor_engine():
         factor_engine = FactorEngine()
     return factor_engine
 
+def get_incremental_engine():
+    """获取因子增量计算引擎实例（延迟初始化）"""
+    global incremental_engine
+    if incremental_engine is None:
+        incremental_engine = IncrementalFactorEngine(get_factor_engine())
+    return incremental_engine
+
 def get_ml_manager():
     """获取ML管理器实例（延迟初始化）"""
     global ml_manager
@@ -72,20 +84,75 @@ def get_backtest_engine():
         backtest_engine = BacktestEngine()
     return backtest_engine
 
+def get_job_queue():
+    """获取后台任务队列实例（延迟初始化）"""
+    global job_queue
+    if job_queue is None:
+        config = current_app.config
+        job_queue = JobQueue(
+            current_app._get_current_object(),
+            JobStore(config.get('JOB_STORE_PATH', 'data/jobs.db')),
+            max_workers=config.get('JOB_MAX_WORKERS', 2),
+            max_pending=config.get('JOB_MAX_PENDING', 20),
+            serializer=convert_numpy_types
+        )
+    return job_queue
+
+def _dispatch(job_type, work, data):
+    """请求参数 async=true 时提交后台任务并立即返回任务ID，否则同步执行"""
+    if data.get('async'):
+        try:
+            job_id = get_job_queue().submit(job_type, work, data)
+        except JobQueueFull as e:
+            return jsonify({'error': str(e)}), 429
+        return jsonify({
+            'success': True,
+            'job_id': job_id,
+            'status': 'pending',
+            'status_url': f'/api/ml-factor/jobs/{job_id}'
+        }), 202
+    
+    payload, status_code = work(data, JobContext())
+    return jsonify(payload), status_code
+
 
 @ml_factor_bp.route('/factors/calculate', methods=['POST'])
 def calculate_factors():
-    """计算因子值"""
+    """计算因子值（async=true 时提交后台任务）"""
     try:
         data = request.get_json()
         
         # 参数验证
+        if not data.get('trade_date'):
+            return jsonify({'error': '缺少交易日期参数'}), 400
+        
+        return _dispatch('factors.calculate', _calculate_factors_job, data)
+        
+    except Exception as e:
+        logger.error(f"计算因子失败: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+def _calculate_factors_job(data: dict, job: JobContext):
+    """计算因子值"""
+    try:
         trade_date = data.get('trade_date')
         factor_ids = data.get('factor_ids', [])
         ts_codes = data.get('ts_codes', [])
         
-        if not trade_date:
-            return jsonify({'error': '缺少交易日期参数'}), 400
+        # 增量模式：按因子水位只计算新到达的交易日
+        if data.get('mode') == 'incremental':
+            job.update(0.0, '增量计算因子')
+            result_df = get_incremental_engine().update(trade_date, ts_codes or None)
+            return {
+                'success': True,
+                'trade_date': trade_date,
+                'mode': 'incremental',
+                'results': {
+                    'total_calculated': len(result_df),
+                    'factor_stats': result_df.groupby('factor_id').size().to_dict() if not result_df.empty else {}
+                }
+            }, 200
         
         # 如果没有指定股票代码，获取所有股票
         if not ts_codes:
@@ -95,11 +162,19 @@ def calculate_factors():
         
         # 计算因子
         if factor_ids:
-            # 计算指定因子
+            # 计算指定因子，内置因子共享一次数据加载
             results = []
-            for factor_id in factor_ids:
+            builtin_ids = [f for f in factor_ids if f in get_factor_engine().builtin_factors]
+            shared_data = get_factor_engine().load_shared_data(builtin_ids, ts_codes, trade_date, trade_date) \
+                if builtin_ids else None
+            for i, factor_id in enumerate(factor_ids):
+                job.update(i / len(factor_ids), f"计算因子 {factor_id}")
                 try:
-                    result_df = get_factor_engine().calculate_factor(factor_id, ts_codes, trade_date, trade_date)
+                    # 共享数据只按内置因子的回看窗口加载，自定义因子自行规划数据
+                    result_df = get_factor_engine().calculate_factor(
+                        factor_id, ts_codes, trade_date, trade_date,
+                        data=shared_data if factor_id in builtin_ids else None
+                    )
                     if not result_df.empty:
                         # 保存因子值
                         save_success = get_factor_engine().save_factor_values(result_df)
@@ -122,6 +197,7 @@ def calculate_factors():
         else:
             # 计算所有因子
             try:
+                job.update(0.0, '计算全部因子')
                 result_df = get_factor_engine().calculate_all_factors(trade_date, ts_codes)
                 if not result_df.empty:
                     # 保存因子值
@@ -142,15 +218,16 @@ def calculate_factors():
             except Exception as e:
                 results = {'error': str(e)}
         
-        return jsonify({
+        return {
             'success': True,
             'trade_date': trade_date,
-            'results': results
-        })
+            'results': results,
+            'load_stats': get_factor_engine().last_load_stats
+        }, 200
         
     except Exception as e:
         logger.error(f"计算因子失败: {e}")
-        return jsonify({'error': str(e)}), 500
+        return {'error': str(e)}, 500
 
 
 @ml_factor_bp.route('/factors/custom', methods=['POST'])
@@ -246,26 +323,37 @@ def create_ml_model():
 
 @ml_factor_bp.route('/models/train', methods=['POST'])
 def train_ml_model():
-    """训练机器学习模型"""
+    """训练机器学习模型（async=true 时提交后台任务）"""
     try:
         data = request.get_json()
         
         # 参数验证
+        if not all([data.get('model_id'), data.get('start_date'), data.get('end_date')]):
+            return jsonify({'error': '缺少必需参数: model_id, start_date, end_date'}), 400
+        
+        return _dispatch('models.train', _train_model_job, data)
+        
+    except Exception as e:
+        logger.error(f"训练机器学习模型失败: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+def _train_model_job(data: dict, job: JobContext):
+    """训练机器学习模型"""
+    try:
         model_id = data.get('model_id')
         start_date = data.get('start_date')
         end_date = data.get('end_date')
         
-        if not all([model_id, start_date, end_date]):
-            return jsonify({'error': '缺少必需参数: model_id, start_date, end_date'}), 400
-        
         # 训练模型
+        job.update(0.0, f"训练模型 {model_id}")
         result = get_ml_manager().train_model(model_id, start_date, end_date)
         
         if result['success']:
             # 转换numpy类型为Python原生类型
             metrics = convert_numpy_types(result.get('metrics', {}))
             
-            return jsonify({
+            return {
                 'success': True,
                 'message': f"模型训练完成: {model_id}",
                 'metrics': metrics,
@@ -273,13 +361,13 @@ def train_ml_model():
                 'accuracy': f"{metrics.get('accuracy', 0.856) * 100:.1f}%" if isinstance(metrics.get('accuracy'), (int, float)) else '85.6%',
                 'loss': f"{metrics.get('loss', 0.142):.3f}" if isinstance(metrics.get('loss'), (int, float)) else '0.142',
                 'model_size': '2.3MB'  # 模拟数据
-            })
+            }, 200
         else:
-            return jsonify({'error': result['error']}), 500
+            return {'error': result['error']}, 500
         
     except Exception as e:
         logger.error(f"训练机器学习模型失败: {e}")
-        return jsonify({'error': str(e)}), 500
+        return {'error': str(e)}, 500
 
 
 @ml_factor_bp.route('/models/predict', methods=['POST'])
@@ -327,6 +415,48 @@ def predict_with_model():
         return jsonify({'error': str(e)}), 500
 
 
+@ml_factor_bp.route('/models/predict-batch', methods=['POST'])
+def predict_with_models():
+    """多个模型在同一因子截面上批量预测"""
+    try:
+        data = request.get_json()
+        
+        # 参数验证
+        model_ids = data.get('model_ids', [])
+        trade_date = data.get('trade_date')
+        ts_codes = data.get('ts_codes')
+        save_results = data.get('save_results', True)
+        
+        if not model_ids or not trade_date:
+            return jsonify({'error': '缺少必需参数: model_ids, trade_date'}), 400
+        
+        ml_manager = get_ml_manager()
+        batch = ml_manager.predict_batch(model_ids, trade_date, ts_codes)
+        
+        if not batch:
+            return jsonify({'error': '预测失败或无数据'}), 500
+        
+        results = {}
+        for model_id, predictions in batch.items():
+            results[model_id] = {
+                'count': len(predictions),
+                'saved': ml_manager.save_predictions(predictions) if save_results else False,
+                'predictions': convert_numpy_types(predictions.to_dict('records'))
+            }
+        
+        return jsonify({
+            'success': True,
+            'trade_date': trade_date,
+            'results': results,
+            'failed_models': [model_id for model_id in model_ids if model_id not in batch],
+            'model_cache': ml_manager.model_cache.stats()
+        })
+        
+    except Exception as e:
+        logger.error(f"批量模型预测失败: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
 @ml_factor_bp.route('/models/evaluate', methods=['POST'])
 def evaluate_model():
     """评估模型性能"""
@@ -628,15 +758,25 @@ def sector_analysis():
 
 @ml_factor_bp.route('/batch/calculate-and-score', methods=['POST'])
 def batch_calculate_and_score():
-    """批量计算因子并打分"""
+    """批量计算因子并打分（async=true 时提交后台任务）"""
     try:
         data = request.get_json()
         
         # 参数验证
-        trade_date = data.get('trade_date')
-        if not trade_date:
+        if not data.get('trade_date'):
             return jsonify({'error': '缺少交易日期参数'}), 400
         
+        return _dispatch('batch.calculate_and_score', _batch_calculate_and_score_job, data)
+        
+    except Exception as e:
+        logger.error(f"批量计算因子并打分失败: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+def _batch_calculate_and_score_job(data: dict, job: JobContext):
+    """批量计算因子并打分"""
+    try:
+        trade_date = data.get('trade_date')
         factor_list = data.get('factor_list', [])
         ts_codes = data.get('ts_codes')
         weights = data.get('weights', {})
@@ -646,7 +786,8 @@ def batch_calculate_and_score():
         # 步骤1: 计算因子
         if factor_list:
             factor_results = []
-            for factor_id in factor_list:
+            for i, factor_id in enumerate(factor_list):
+                job.update(0.8 * i / len(factor_list), f"计算因子 {factor_id}")
                 result = get_factor_engine().calculate_factor(factor_id, trade_date, ts_codes)
                 factor_results.append({
                     'factor_id': factor_id,
@@ -655,17 +796,19 @@ def batch_calculate_and_score():
                 })
         else:
             # 计算所有因子
+            job.update(0.0, '计算全部因子')
             factor_results = get_factor_engine().calculate_all_factors(trade_date, ts_codes)
         
         # 步骤2: 计算因子分数
+        job.update(0.8, '计算因子分数')
         factor_scores = get_scoring_engine().calculate_factor_scores(trade_date, factor_list, ts_codes)
         
         if factor_scores.empty:
-            return jsonify({
+            return {
                 'success': False,
                 'error': '未找到因子数据',
                 'factor_calculation': factor_results
-            }), 404
+            }, 404
         
         # 步骤3: 计算综合分数
         composite_scores = get_scoring_engine().calculate_composite_score(factor_scores, weights, method)
@@ -673,7 +816,7 @@ def batch_calculate_and_score():
         # 步骤4: 股票排名选择
         top_stocks = get_scoring_engine().rank_stocks(composite_scores, top_n)
         
-        return jsonify({
+        return {
             'success': True,
             'trade_date': trade_date,
             'factor_calculation': factor_results,
@@ -681,31 +824,45 @@ def batch_calculate_and_score():
             'total_stocks': len(composite_scores),
             'selected_stocks': len(top_stocks),
             'top_stocks': top_stocks
-        })
+        }, 200
         
     except Exception as e:
         logger.error(f"批量计算因子并打分失败: {e}")
-        return jsonify({'error': str(e)}), 500
+        return {'error': str(e)}, 500
 
 
 @ml_factor_bp.route('/batch/train-and-predict', methods=['POST'])
 def batch_train_and_predict():
-    """批量训练模型并预测"""
+    """批量训练模型并预测（async=true 时提交后台任务）"""
     try:
         data = request.get_json()
         
         # 参数验证
+        if not all([data.get('model_configs'), data.get('train_start_date'),
+                    data.get('train_end_date'), data.get('predict_date')]):
+            return jsonify({'error': '缺少必需参数'}), 400
+        
+        return _dispatch('batch.train_and_predict', _batch_train_and_predict_job, data)
+        
+    except Exception as e:
+        logger.error(f"批量训练模型并预测失败: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+def _batch_train_and_predict_job(data: dict, job: JobContext):
+    """批量训练模型并预测，每完成一个模型汇报一次阶段性结果"""
+    try:
         model_configs = data.get('model_configs', [])
         train_start_date = data.get('train_start_date')
         train_end_date = data.get('train_end_date')
         predict_date = data.get('predict_date')
         
-        if not all([model_configs, train_start_date, train_end_date, predict_date]):
-            return jsonify({'error': '缺少必需参数'}), 400
-        
         results = []
         
-        for config in model_configs:
+        for i, config in enumerate(model_configs):
+            if i > 0:
+                job.update(i / len(model_configs), f"已完成 {i}/{len(model_configs)} 个模型",
+                           partial_result={'results': convert_numpy_types(results)})
             try:
                 model_id = config['model_id']
                 
@@ -772,16 +929,16 @@ def batch_train_and_predict():
                     'error': str(e)
                 })
         
-        return jsonify({
+        return {
             'success': True,
             'train_period': f"{train_start_date} to {train_end_date}",
             'predict_date': predict_date,
             'results': results
-        })
+        }, 200
         
     except Exception as e:
         logger.error(f"批量训练模型并预测失败: {e}")
-        return jsonify({'error': str(e)}), 500
+        return {'error': str(e)}, 500
 
 
 @ml_factor_bp.route('/portfolio/optimize', methods=['POST'])
@@ -827,29 +984,44 @@ def optimize_portfolio():
 
 @ml_factor_bp.route('/portfolio/rebalance', methods=['POST'])
 def rebalance_portfolio():
-    """组合再平衡"""
+    """组合再平衡
+
+    给出 target_weights 时直接按目标权重生成交易指令；给出 expected_returns 时
+    以当前持仓为起点做带换手惩罚的均值-方差优化（turnover_penalty 默认取交易成本）。
+    """
     try:
         data = request.get_json()
         
         # 参数验证
         current_weights = data.get('current_weights')
         target_weights = data.get('target_weights')
+        expected_returns = data.get('expected_returns')
         
-        if not all([current_weights, target_weights]):
-            return jsonify({'error': '缺少必需参数: current_weights, target_weights'}), 400
+        if not current_weights or not (target_weights or expected_returns):
+            return jsonify({'error': '缺少必需参数: current_weights, target_weights 或 expected_returns'}), 400
         
         # 转换为pandas Series
         current_weights_series = pd.Series(current_weights)
-        target_weights_series = pd.Series(target_weights)
         
         transaction_cost = data.get('transaction_cost', 0.001)
         
         # 执行再平衡
-        result = get_portfolio_optimizer().rebalance_portfolio(
-            current_weights_series,
-            target_weights_series,
-            transaction_cost
-        )
+        if target_weights:
+            result = get_portfolio_optimizer().rebalance_portfolio(
+                current_weights_series,
+                pd.Series(target_weights),
+                transaction_cost
+            )
+        else:
+            risk_model = data.get('risk_model')
+            result = get_portfolio_optimizer().rebalance_with_turnover_penalty(
+                current_weights_series,
+                pd.Series(expected_returns),
+                pd.DataFrame(risk_model) if risk_model else None,
+                transaction_cost,
+                data.get('turnover_penalty'),
+                data.get('constraints')
+            )
         
         if 'error' in result:
             return jsonify({'error': result['error']}), 500
@@ -961,18 +1133,27 @@ def integrated_portfolio_selection():
 
 @ml_factor_bp.route('/backtest/run', methods=['POST'])
 def run_backtest():
-    """运行回测"""
+    """运行回测（async=true 时提交后台任务）"""
     try:
         data = request.get_json()
         
         # 参数验证
+        if not all([data.get('strategy_config'), data.get('start_date'), data.get('end_date')]):
+            return jsonify({'error': '缺少必需参数: strategy_config, start_date, end_date'}), 400
+        
+        return _dispatch('backtest.run', _run_backtest_job, data)
+        
+    except Exception as e:
+        logger.error(f"回测失败: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+def _run_backtest_job(data: dict, job: JobContext):
+    """运行回测"""
+    try:
         strategy_config = data.get('strategy_config')
         start_date = data.get('start_date')
         end_date = data.get('end_date')
-        
-        if not all([strategy_config, start_date, end_date]):
-            return jsonify({'error': '缺少必需参数: strategy_config, start_date, end_date'}), 400
-        
         initial_capital = data.get('initial_capital', 1000000.0)
         rebalance_frequency = data.get('rebalance_frequency', 'monthly')
         
@@ -982,16 +1163,116 @@ def run_backtest():
             start_date,
             end_date,
             initial_capital,
-            rebalance_frequency
+            rebalance_frequency,
+            progress_callback=job.update
         )
         
         if 'error' in result:
-            return jsonify({'error': result['error']}), 500
+            return {'error': result['error']}, 500
         
-        return jsonify(result)
+        return result, 200
         
     except Exception as e:
         logger.error(f"回测失败: {e}")
+        return {'error': str(e)}, 500
+
+
+@ml_factor_bp.route('/backtest/sweep', methods=['POST'])
+def sweep_backtest():
+    """回测参数扫描（async=true 时提交后台任务）"""
+    try:
+        data = request.get_json()
+        
+        # 参数验证
+        if not all([data.get('strategy_config'), data.get('start_date'), data.get('end_date')]):
+            return jsonify({'error': '缺少必需参数: strategy_config, start_date, end_date'}), 400
+        
+        if not isinstance(data.get('grid', {}), dict):
+            return jsonify({'error': 'grid 必须是 {参数名: 取值列表} 的字典'}), 400
+        
+        return _dispatch('backtest.sweep', _sweep_backtest_job, data)
+        
+    except Exception as e:
+        logger.error(f"回测参数扫描失败: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+def _sweep_backtest_job(data: dict, job: JobContext):
+    """回测参数扫描"""
+    try:
+        strategy_config = data.get('strategy_config')
+        start_date = data.get('start_date')
+        end_date = data.get('end_date')
+        grid = data.get('grid', {})
+        
+        job.update(0.0, '回测参数扫描')
+        runner = BacktestSweepRunner(get_backtest_engine(), max_workers=data.get('max_workers'))
+        result = runner.run(
+            strategy_config,
+            start_date,
+            end_date,
+            grid,
+            initial_capital=data.get('initial_capital', 1000000.0),
+            rebalance_frequency=data.get('rebalance_frequency', 'monthly'),
+            sort_by=data.get('sort_by', 'sharpe_ratio')
+        )
+        
+        if 'error' in result:
+            return {'error': result['error']}, 500
+        
+        return result, 200
+        
+    except ValueError as e:
+        return {'error': str(e)}, 400
+    except Exception as e:
+        logger.error(f"回测参数扫描失败: {e}")
+        return {'error': str(e)}, 500
+
+
+@ml_factor_bp.route('/jobs', methods=['GET'])
+def list_jobs():
+    """列出后台任务"""
+    try:
+        jobs = get_job_queue().list(
+            status=request.args.get('status'),
+            job_type=request.args.get('job_type'),
+            limit=request.args.get('limit', 50, type=int)
+        )
+        return jsonify({'success': True, 'jobs': jobs, 'count': len(jobs)})
+        
+    except Exception as e:
+        logger.error(f"获取任务列表失败: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+@ml_factor_bp.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """查询后台任务状态、进度和结果"""
+    try:
+        job = get_job_queue().get(job_id)
+        if job is None:
+            return jsonify({'error': f'任务不存在: {job_id}'}), 404
+        return jsonify({'success': True, 'job': job})
+        
+    except Exception as e:
+        logger.error(f"查询任务失败: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+@ml_factor_bp.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """取消后台任务"""
+    try:
+        queue = get_job_queue()
+        job = queue.get(job_id)
+        if job is None:
+            return jsonify({'error': f'任务不存在: {job_id}'}), 404
+        if not queue.cancel(job_id):
+            return jsonify({'error': f'任务已结束，状态: {job["status"]}'}), 409
+        return jsonify({'success': True, 'job_id': job_id, 'message': '已请求取消'})
+        
+    except Exception as e:
+        logger.error(f"取消任务失败: {e}")
         return jsonify({'error': str(e)}), 500
 
 
@@ -7,6 +7,7 @@ from flask import Blueprint, request, jsonify
 import logging
 
 from app.services.realtime_monitor_service import RealtimeMonitorService
+from app.services.live_bar_cache import get_live_bar_cache
 
 logger = logging.getLogger(__name__)
 
@@ -331,4 +332,14 @@ def get_market_stats():
         
     except Exception as e:
         logger.error(f"获取市场统计数据失败: {str(e)}")
-        return jsonify({'success': False, 'message': str(e)}) 
\ No newline at end of file
+        return jsonify({'success': False, 'message': str(e)}) 
+
+@realtime_monitor_bp.route('/bar-cache', methods=['GET'])
+def get_bar_cache_stats():
+    """获取实时K线缓存的命中率与内存占用"""
+    try:
+        return jsonify({'success': True, 'data': get_live_bar_cache().stats()})
+        
+    except Exception as e:
+        logger.error(f"获取K线缓存统计失败: {str(e)}")
+        return jsonify({'success': False, 'message': str(e)})
@@ -4,10 +4,10 @@
 """
 
 from flask import Blueprint, request, jsonify
-from datetime import datetime
 import logging
 
 from app.services.realtime_risk_manager import RealtimeRiskManager
+from app.services.incremental_risk import get_incremental_risk_manager
 from app.models.portfolio_position import PortfolioPosition
 from app.models.risk_alert import RiskAlert
 from app.extensions import db
@@ -344,6 +344,8 @@ def update_risk_thresholds():
         for key, value in data.items():
             if key in risk_manager.risk_thresholds:
                 risk_manager.risk_thresholds[key] = float(value)
+        # 增量风险的逐笔预警使用同一套阈值
+        get_incremental_risk_manager().risk_manager.risk_thresholds.update(risk_manager.risk_thresholds)
         
         return jsonify({
             'success': True,
@@ -402,54 +404,69 @@ def run_stress_test():
         if not portfolio_id:
             return jsonify({'success': False, 'message': '组合ID不能为空'})
         
-        if not scenarios:
-            # 默认压力测试场景
-            scenarios = [
-                {'name': '市场下跌10%', 'market_shock': -0.10},
-                {'name': '市场下跌20%', 'market_shock': -0.20},
-                {'name': '波动率上升50%', 'volatility_shock': 0.50},
-                {'name': '相关性上升至0.9', 'correlation_shock': 0.90}
-            ]
+        # 未给出场景时使用默认场景（市场下跌、波动率上升、相关性上升）
+        result = risk_manager.run_stress_test(portfolio_id, scenarios)
+        return jsonify(result)
         
-        # 获取组合持仓
-        positions = PortfolioPosition.get_portfolio_positions(portfolio_id)
+    except Exception as e:
+        logger.error(f"压力测试失败: {str(e)}")
+        return jsonify({'success': False, 'message': str(e)})
+
+
+@realtime_risk_bp.route('/incremental/track', methods=['POST'])
+def track_incremental_risk():
+    """开始跟踪组合的盘中增量风险（价格或持仓变化时即时更新并预警）"""
+    try:
+        data = request.get_json()
+        portfolio_id = data.get('portfolio_id')
+        
+        if not portfolio_id:
+            return jsonify({'success': False, 'message': '组合ID不能为空'})
         
-        if not positions:
+        manager = get_incremental_risk_manager()
+        if manager.track(portfolio_id) is None:
             return jsonify({'success': False, 'message': '组合中没有持仓数据'})
         
-        stress_results = []
-        
-        for scenario in scenarios:
-            scenario_result = {
-                'scenario_name': scenario['name'],
-                'original_value': sum(pos.market_value or 0 for pos in positions),
-                'stressed_value': 0,
-                'pnl_change': 0,
-                'pnl_percentage': 0
-            }
-            
-            # 简化的压力测试计算
-            if 'market_shock' in scenario:
-                shock = scenario['market_shock']
-                stressed_value = sum((pos.market_value or 0) * (1 + shock) for pos in positions)
-                scenario_result['stressed_value'] = stressed_value
-                scenario_result['pnl_change'] = stressed_value - scenario_result['original_value']
-                scenario_result['pnl_percentage'] = scenario_result['pnl_change'] / scenario_result['original_value'] * 100
-            
-            stress_results.append(scenario_result)
+        return jsonify({
+            'success': True,
+            'data': manager.snapshot(portfolio_id),
+            'message': '增量风险跟踪已启动'
+        })
+        
+    except Exception as e:
+        logger.error(f"启动增量风险跟踪失败: {str(e)}")
+        return jsonify({'success': False, 'message': str(e)})
+
+
+@realtime_risk_bp.route('/incremental/<portfolio_id>', methods=['GET'])
+def get_incremental_risk(portfolio_id):
+    """获取组合的增量风险快照，尚未跟踪时自动开始跟踪"""
+    try:
+        manager = get_incremental_risk_manager()
+        snapshot = manager.snapshot(portfolio_id)
+        if snapshot is None:
+            if manager.track(portfolio_id) is None:
+                return jsonify({'success': False, 'message': '组合中没有持仓数据'})
+            snapshot = manager.snapshot(portfolio_id)
         
         return jsonify({
             'success': True,
-            'data': {
-                'portfolio_id': portfolio_id,
-                'test_date': datetime.now().isoformat(),
-                'scenarios': stress_results,
-                'worst_case': min(stress_results, key=lambda x: x['pnl_percentage']),
-                'best_case': max(stress_results, key=lambda x: x['pnl_percentage'])
-            },
-            'message': f'压力测试完成，测试了 {len(scenarios)} 个场景'
+            'data': snapshot,
+            'message': '增量风险获取成功'
         })
         
     except Exception as e:
-        logger.error(f"压力测试失败: {str(e)}")
-        return jsonify({'success': False, 'message': str(e)}) 
\ No newline at end of file
+        logger.error(f"获取增量风险失败: {str(e)}")
+        return jsonify({'success': False, 'message': str(e)})
+
+
+@realtime_risk_bp.route('/incremental/<portfolio_id>', methods=['DELETE'])
+def untrack_incremental_risk(portfolio_id):
+    """停止跟踪组合的增量风险"""
+    try:
+        get_incremental_risk_manager().untrack(portfolio_id)
+        return jsonify({'success': True, 'message': '增量风险跟踪已停止'})
+        
+    except Exception as e:
+        logger.error(f"停止增量风险跟踪失败: {str(e)}")
+        return jsonify({'success': False, 'message': str(e)})
@@ -8,6 +8,7 @@ from datetime import datetime, timedelta
 import logging
 
 from app.services.realtime_trading_signal_engine import RealtimeTradingSignalEngine
+from app.services.signal_scanner import get_signal_scanner
 from app.models.trading_signal import TradingSignal
 
 logger = logging.getLogger(__name__)
@@ -283,6 +284,45 @@ def batch_generate_signals():
         return jsonify({'success': False, 'message': str(e)})
 
 
+@realtime_signals_bp.route('/scan', methods=['POST'])
+def scan_signals():
+    """全市场信号扫描（不传股票列表时扫描全部有数据的股票）"""
+    try:
+        data = request.get_json() or {}
+        stock_codes = data.get('stock_codes')
+        period_type = data.get('period_type', '1min')
+        strategies = data.get('strategies')
+        lookback_days = int(data.get('lookback_days', 5))
+        save = bool(data.get('save', True))
+        include_signals = bool(data.get('include_signals', False))
+        
+        result = get_signal_scanner().scan(
+            codes=stock_codes,
+            period_type=period_type,
+            strategies=strategies,
+            lookback_days=lookback_days,
+            save=save
+        )
+        
+        signals = result.pop('signals')
+        result['insufficient_data'] = len(result['insufficient_data'])
+        if include_signals:
+            result['signals'] = [
+                {**s, 'datetime': s['datetime'].isoformat(), 'expiry_time': s['expiry_time'].isoformat()}
+                for s in signals
+            ]
+        
+        return jsonify({
+            'success': True,
+            'data': result,
+            'message': f"扫描 {result['stocks_scanned']} 只股票，生成 {result['signals_generated']} 个信号"
+        })
+        
+    except Exception as e:
+        logger.error(f"信号扫描失败: {str(e)}")
+        return jsonify({'success': False, 'message': str(e)})
+
+
 @realtime_signals_bp.route('/update-status', methods=['POST'])
 def update_signal_status():
     """更新信号状态"""
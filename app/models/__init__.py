@@ -8,6 +8,7 @@ from .stock_cyq_perf import StockCyqPerf
 from .stock_business import StockBusiness
 from .factor_definition import FactorDefinition
 from .factor_values import FactorValues
+from .factor_watermark import FactorWatermark
 from .ml_model_definition import MLModelDefinition
 from .ml_predictions import MLPredictions
 from .stock_income_statement import StockIncomeStatement
@@ -26,6 +27,7 @@ __all__ = [
     'StockBusiness',
     'FactorDefinition',
     'FactorValues',
+    'FactorWatermark',
     'MLModelDefinition',
     'MLPredictions',
     'StockIncomeStatement',
@@ -0,0 +1,22 @@
+from app.extensions import db
+from sqlalchemy import Column, String, Date, DateTime
+from datetime import datetime
+
+class FactorWatermark(db.Model):
+    """因子增量计算水位表"""
+    __tablename__ = 'factor_watermark'
+    
+    factor_id = Column(String(50), primary_key=True, comment='因子ID')
+    last_trade_date = Column(Date, comment='最近已计算的交易日期')
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, comment='更新时间')
+    
+    def to_dict(self):
+        """转换为字典"""
+        return {
+            'factor_id': self.factor_id,
+            'last_trade_date': self.last_trade_date.isoformat() if self.last_trade_date else None,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+        }
+    
+    def __repr__(self):
+        return f'<FactorWatermark {self.factor_id} {self.last_trade_date}>'
@@ -0,0 +1,151 @@
+"""
+向量化回测核心
+一次性预加载回测区间内全部股票的收盘价和复权因子面板，持仓以 NumPy 股数向量表示。
+两次调仓之间持仓不变，整段交易日按矩阵运算逐日盯市；复权因子变化（送转、分红）
+折算为持股数的变化，因此可以直接使用未复权收盘价估值。
+"""
+
+import numpy as np
+import pandas as pd
+from typing import List, Dict, Any, Tuple, NamedTuple
+
+from app.services.panel_store import get_panel_store
+
+
+class PricePanel(NamedTuple):
+    """回测价格面板"""
+    dates: pd.DatetimeIndex
+    codes: List[str]
+    close: np.ndarray       # 前向填充后的收盘价，停牌日沿用最近价格
+    tradable: np.ndarray    # 当日是否有真实行情（停牌不可交易）
+    share_ratio: np.ndarray  # 当日复权因子 / 前一日复权因子，无复权数据时为 1
+
+    def code_index(self) -> Dict[str, int]:
+        return {code: i for i, code in enumerate(self.codes)}
+
+
+def load_price_panel(start_date: str, end_date: str) -> PricePanel:
+    """从面板存储加载回测区间的收盘价和复权因子"""
+    store = get_panel_store()
+    close = store.get_frame('close', None, start_date, end_date)
+    close = close.dropna(axis=1, how='all')
+
+    tradable = close.notna().to_numpy()
+    close_values = close.ffill().to_numpy(dtype='float64')
+
+    adj = store.get_frame('adj_factor', None, start_date, end_date)
+    share_ratio = np.ones_like(close_values)
+    if not adj.empty:
+        adj = adj.reindex(index=close.index, columns=close.columns).ffill().to_numpy(dtype='float64')
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = adj[1:] / adj[:-1]
+        share_ratio[1:] = np.where(np.isfinite(ratio) & (ratio > 0), ratio, 1.0)
+
+    return PricePanel(pd.DatetimeIndex(close.index), list(close.columns), close_values, tradable, share_ratio)
+
+
+def weights_to_vector(weights: Dict[str, float], code_index: Dict[str, int], n_codes: int) -> np.ndarray:
+    """把 {股票: 权重} 转成与面板列对齐的权重向量，面板中没有的股票忽略"""
+    vector = np.zeros(n_codes)
+    for ts_code, weight in weights.items():
+        i = code_index.get(ts_code)
+        if i is not None:
+            vector[i] = weight
+    return vector
+
+
+def simulate(panel: PricePanel, rebalances: List[Tuple[int, np.ndarray]],
+             initial_capital: float, transaction_cost: float = 0.001,
+             lot_size: int = 100) -> Dict[str, Any]:
+    """按调仓计划运行回测
+
+    Args:
+        panel: 价格面板
+        rebalances: [(交易日下标, 目标权重向量)]，按日期升序
+        initial_capital: 初始资金
+        transaction_cost: 双边交易成本比例
+        lot_size: 每手股数
+
+    Returns:
+        逐日的 total_value / cash / positions_value / daily_returns，
+        以及每次调仓后的持仓股数和换手率
+    """
+    n_days, n_codes = panel.close.shape
+    price = np.nan_to_num(panel.close)
+
+    shares = np.zeros(n_codes)
+    cash = float(initial_capital)
+    total_value = np.empty(n_days)
+    cash_series = np.empty(n_days)
+    positions = []
+    turnovers = []
+
+    # 每个调仓日开始一段持仓不变的区间，区间内整体向量化盯市
+    starts = [day for day, _ in rebalances]
+    bounds = [0] + starts + [n_days]
+    targets = dict(rebalances)
+    for seg_start, seg_end in zip(bounds[:-1], bounds[1:]):
+        if seg_start >= seg_end:
+            continue
+
+        if seg_start in targets:
+            # 调仓日先按复权变化调整持股，再按当日价格交易
+            shares = shares * panel.share_ratio[seg_start]
+            day_price = price[seg_start]
+            value = cash + float(shares @ day_price)
+            can_trade = panel.tradable[seg_start] & (day_price > 0)
+
+            target = shares.copy()
+            with np.errstate(divide='ignore', invalid='ignore'):
+                lots = np.floor(value * targets[seg_start] / day_price / lot_size) * lot_size
+            target[can_trade] = lots[can_trade]
+
+            trade = target - shares
+            trade_value = float(np.abs(trade) @ day_price)
+            cash -= float(trade @ day_price) + trade_value * transaction_cost
+            shares = target
+            turnovers.append(trade_value / value if value > 0 else 0.0)
+            positions.append(shares.copy())
+            first = seg_start + 1
+            total_value[seg_start] = cash + float(shares @ day_price)
+            cash_series[seg_start] = cash
+        else:
+            first = seg_start
+
+        if first < seg_end:
+            # 区间内持股数 = 调仓后股数 × 复权比例的累乘
+            scale = np.cumprod(panel.share_ratio[first:seg_end], axis=0)
+            segment_shares = shares * scale
+            total_value[first:seg_end] = cash + np.einsum('ij,ij->i', segment_shares, price[first:seg_end])
+            cash_series[first:seg_end] = cash
+            shares = segment_shares[-1]
+
+    previous = np.concatenate([[initial_capital], total_value[:-1]])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        daily_returns = np.where(previous != 0, total_value / previous - 1, 0.0)
+
+    return {
+        'total_value': total_value,
+        'cash': cash_series,
+        'positions_value': total_value - cash_series,
+        'daily_returns': daily_returns,
+        'positions': positions,
+        'turnover': turnovers,
+        'final_shares': shares
+    }
+
+
+def max_drawdown(values: np.ndarray) -> float:
+    """最大回撤"""
+    if len(values) == 0:
+        return 0.0
+    peaks = np.maximum.accumulate(values)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        drawdowns = np.where(peaks > 0, (peaks - values) / peaks, 0.0)
+    return float(drawdowns.max())
+
+
+def slice_panel(panel: PricePanel, start: int) -> PricePanel:
+    """截取从第 start 个交易日开始的面板（零拷贝视图），用于去掉风险模型的回看区间"""
+    return PricePanel(panel.dates[start:], panel.codes, panel.close[start:],
+                      panel.tradable[start:], panel.share_ratio[start:])
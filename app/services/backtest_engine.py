@@ -1,6 +1,6 @@
 import pandas as pd
 import numpy as np
-from typing import List, Dict, Any, Optional, Tuple
+from typing import List, Dict, Any, Optional, Callable
 from datetime import datetime, timedelta
 from loguru import logger
 import warnings
@@ -12,6 +12,9 @@ from app.services.factor_engine import FactorEngine
 from app.services.ml_models import MLModelManager
 from app.services.stock_scoring import StockScoringEngine
 from app.services.portfolio_optimizer import PortfolioOptimizer
+from app.services.factor_risk_model import get_risk_model_store
+from app.services.panel_store import get_panel_store
+from app.services.backtest_core import load_price_panel, simulate, weights_to_vector, max_drawdown
 
 
 class BacktestEngine:
@@ -50,7 +53,8 @@ class BacktestEngine:
     def run_backtest(self, strategy_config: Dict[str, Any], 
                     start_date: str, end_date: str,
                     initial_capital: float = 1000000.0,
-                    rebalance_frequency: str = 'monthly') -> Dict[str, Any]:
+                    rebalance_frequency: str = 'monthly',
+                    progress_callback: Optional[Callable[[float, str], None]] = None) -> Dict[str, Any]:
         """
         运行回测
         
@@ -60,6 +64,7 @@ class BacktestEngine:
             end_date: 结束日期
             initial_capital: 初始资金
             rebalance_frequency: 再平衡频率 ('daily', 'weekly', 'monthly')
+            progress_callback: 进度回调 (进度0~1, 说明)，每个调仓日调用一次
             
         Returns:
             回测结果
@@ -67,22 +72,24 @@ class BacktestEngine:
         try:
             logger.info(f"开始回测: {start_date} to {end_date}")
             
-            # 生成交易日期
-            trade_dates = self._generate_trade_dates(start_date, end_date, rebalance_frequency)
-            
-            # 初始化回测状态
-            portfolio_values = []
-            positions = {}
-            cash = initial_capital
-            total_value = initial_capital
-            
-            # 记录每日数据
-            daily_returns = []
-            daily_positions = []
-            daily_turnover = []
+            # 一次性预加载回测区间的价格面板
+            panel = load_price_panel(start_date, end_date)
+            if len(panel.dates) == 0:
+                return {'error': '回测区间内没有行情数据'}
+            code_index = panel.code_index()
             
-            for i, trade_date in enumerate(trade_dates):
-                logger.info(f"处理交易日: {trade_date}")
+            # 生成调仓日期，并逐个调仓日计算目标权重
+            trade_dates = self._generate_trade_dates(start_date, end_date, rebalance_frequency)
+            day_positions = panel.dates.get_indexer(pd.to_datetime(trade_dates))
+            
+            rebalances = []
+            rebalance_dates = []
+            for n, (trade_date, day) in enumerate(zip(trade_dates, day_positions)):
+                if progress_callback is not None:
+                    progress_callback(n / max(len(trade_dates), 1), f"处理调仓日: {trade_date}")
+                if day < 0:
+                    continue
+                logger.info(f"处理调仓日: {trade_date}")
                 
                 try:
                     # 获取当日选股结果
@@ -94,49 +101,44 @@ class BacktestEngine:
                     
                     # 组合优化
                     target_weights = self._get_target_weights(
-                        selected_stocks, strategy_config.get('optimization', {})
+                        selected_stocks, strategy_config.get('optimization', {}),
+                        trade_date=trade_date
                     )
                     
-                    # 计算当前持仓价值
-                    current_prices = self._get_current_prices(trade_date, list(positions.keys()))
-                    current_portfolio_value = self._calculate_portfolio_value(
-                        positions, current_prices, cash
-                    )
-                    
-                    # 执行再平衡
-                    new_positions, new_cash, turnover = self._rebalance_portfolio(
-                        positions, cash, target_weights, current_prices, 
-                        current_portfolio_value, strategy_config.get('transaction_cost', 0.001)
-                    )
-                    
-                    # 更新状态
-                    positions = new_positions
-                    cash = new_cash
-                    total_value = current_portfolio_value
-                    
-                    # 记录数据
-                    portfolio_values.append({
-                        'date': trade_date,
-                        'total_value': total_value,
-                        'cash': cash,
-                        'positions_value': total_value - cash
-                    })
-                    
-                    daily_positions.append(positions.copy())
-                    daily_turnover.append(turnover)
-                    
-                    # 计算日收益率
-                    if i > 0:
-                        daily_return = (total_value - portfolio_values[i-1]['total_value']) / portfolio_values[i-1]['total_value']
-                        daily_returns.append(daily_return)
+                    rebalances.append((int(day), weights_to_vector(target_weights, code_index, len(panel.codes))))
+                    rebalance_dates.append(trade_date)
                     
                 except Exception as e:
                     logger.error(f"处理交易日 {trade_date} 时出错: {e}")
                     continue
             
+            # 逐日盯市
+            simulation = simulate(panel, rebalances, initial_capital,
+                                  strategy_config.get('transaction_cost', 0.001))
+            
+            dates = [d.date() for d in panel.dates]
+            portfolio_values = [
+                {
+                    'date': trade_date,
+                    'total_value': float(total),
+                    'cash': float(cash),
+                    'positions_value': float(positions_value)
+                }
+                for trade_date, total, cash, positions_value in zip(
+                    dates, simulation['total_value'], simulation['cash'], simulation['positions_value']
+                )
+            ]
+            daily_returns = simulation['daily_returns'].tolist()
+            daily_positions = [
+                {panel.codes[i]: int(shares[i]) for i in np.flatnonzero(shares)}
+                for shares in simulation['positions']
+            ]
+            daily_turnover = simulation['turnover']
+            total_value = portfolio_values[-1]['total_value']
+            
             # 计算回测指标
             performance_metrics = self._calculate_performance_metrics(
-                portfolio_values, daily_returns, start_date, end_date
+                portfolio_values, daily_returns, start_date, end_date, initial_capital
             )
             
             # 获取基准收益
@@ -153,6 +155,7 @@ class BacktestEngine:
                 'daily_returns': daily_returns,
                 'daily_positions': daily_positions,
                 'daily_turnover': daily_turnover,
+                'rebalance_dates': rebalance_dates,
                 'performance_metrics': performance_metrics,
                 'benchmark_returns': benchmark_returns
             }
@@ -172,7 +175,16 @@ class BacktestEngine:
                 StockDailyHistory.trade_date <= end_date
             )
             all_dates = [row[0] for row in query.order_by(StockDailyHistory.trade_date)]
-            
+            return self.select_rebalance_dates(all_dates, frequency)
+                
+        except Exception as e:
+            logger.error(f"生成交易日期失败: {e}")
+            return []
+    
+    @staticmethod
+    def select_rebalance_dates(all_dates: List, frequency: str) -> List:
+        """从交易日序列中按频率选出调仓日（每周/每月第一个交易日）"""
+        try:
             if frequency == 'daily':
                 return all_dates
             elif frequency == 'weekly':
@@ -241,8 +253,13 @@ class BacktestEngine:
             return []
     
     def _get_target_weights(self, selected_stocks: List[Dict[str, Any]], 
-                          optimization_config: Dict[str, Any]) -> Dict[str, float]:
-        """获取目标权重"""
+                          optimization_config: Dict[str, Any],
+                          risk_model=None, trade_date=None) -> Dict[str, float]:
+        """获取目标权重
+
+        risk_model 可为协方差矩阵或因子风险模型；为空时取 trade_date 当日（不晚于该日）
+        的因子风险模型，避免使用未来数据，仍没有时由组合优化器自行估计。
+        """
         try:
             method = optimization_config.get('method', 'equal_weight')
             
@@ -257,8 +274,15 @@ class BacktestEngine:
                     for stock in selected_stocks
                 })
                 
+                if risk_model is None and trade_date is not None:
+                    try:
+                        risk_model = get_risk_model_store().get(trade_date)
+                    except Exception as e:
+                        logger.warning(f"获取 {trade_date} 因子风险模型失败: {e}")
+                
                 result = self._get_portfolio_optimizer().optimize_portfolio(
                     expected_returns,
+                    risk_model=risk_model,
                     method=method,
                     constraints=optimization_config.get('constraints')
                 )
@@ -282,93 +306,29 @@ class BacktestEngine:
             if not ts_codes:
                 return {}
             
-            query = db.session.query(
-                StockDailyHistory.ts_code,
-                StockDailyHistory.close
-            ).filter(
-                StockDailyHistory.trade_date == trade_date,
-                StockDailyHistory.ts_code.in_(ts_codes)
-            )
+            prices = get_panel_store().get('close', ts_codes, trade_date, trade_date)
+            if len(prices.dates) == 0:
+                return {}
             
-            return {row[0]: float(row[1]) for row in query}
+            row = prices.values[-1]
+            return {ts_code: float(price) for ts_code, price in zip(prices.codes, row)
+                    if not np.isnan(price)}
             
         except Exception as e:
             logger.error(f"获取当前价格失败: {e}")
             return {}
     
-    def _calculate_portfolio_value(self, positions: Dict[str, int], 
-                                 prices: Dict[str, float], cash: float) -> float:
-        """计算组合价值"""
-        try:
-            positions_value = sum(
-                positions.get(ts_code, 0) * prices.get(ts_code, 0)
-                for ts_code in positions.keys()
-            )
-            return positions_value + cash
-            
-        except Exception as e:
-            logger.error(f"计算组合价值失败: {e}")
-            return cash
-    
-    def _rebalance_portfolio(self, current_positions: Dict[str, int], 
-                           current_cash: float, target_weights: Dict[str, float],
-                           prices: Dict[str, float], total_value: float,
-                           transaction_cost: float) -> Tuple[Dict[str, int], float, float]:
-        """执行组合再平衡"""
-        try:
-            new_positions = {}
-            turnover = 0.0
-            
-            # 计算目标持仓
-            for ts_code, weight in target_weights.items():
-                if ts_code in prices and prices[ts_code] > 0:
-                    target_value = total_value * weight
-                    target_shares = int(target_value / prices[ts_code] / 100) * 100  # 按手数调整
-                    new_positions[ts_code] = target_shares
-            
-            # 计算交易成本和换手率
-            total_trade_value = 0.0
-            for ts_code in set(list(current_positions.keys()) + list(new_positions.keys())):
-                current_shares = current_positions.get(ts_code, 0)
-                new_shares = new_positions.get(ts_code, 0)
-                price = prices.get(ts_code, 0)
-                
-                if price > 0:
-                    trade_value = abs(new_shares - current_shares) * price
-                    total_trade_value += trade_value
-            
-            turnover = total_trade_value / total_value if total_value > 0 else 0
-            transaction_costs = total_trade_value * transaction_cost
-            
-            # 计算新的现金余额
-            new_cash = current_cash
-            for ts_code in set(list(current_positions.keys()) + list(new_positions.keys())):
-                current_shares = current_positions.get(ts_code, 0)
-                new_shares = new_positions.get(ts_code, 0)
-                price = prices.get(ts_code, 0)
-                
-                if price > 0:
-                    trade_value = (new_shares - current_shares) * price
-                    new_cash -= trade_value
-            
-            new_cash -= transaction_costs
-            
-            return new_positions, new_cash, turnover
-            
-        except Exception as e:
-            logger.error(f"组合再平衡失败: {e}")
-            return current_positions, current_cash, 0.0
-    
     def _calculate_performance_metrics(self, portfolio_values: List[Dict[str, Any]], 
                                      daily_returns: List[float],
-                                     start_date: str, end_date: str) -> Dict[str, Any]:
+                                     start_date: str, end_date: str,
+                                     initial_capital: float = None) -> Dict[str, Any]:
         """计算回测指标"""
         try:
             if not portfolio_values or not daily_returns:
                 return {}
             
             # 基本指标
-            initial_value = portfolio_values[0]['total_value']
+            initial_value = initial_capital or portfolio_values[0]['total_value']
             final_value = portfolio_values[-1]['total_value']
             total_return = (final_value - initial_value) / initial_value
             
@@ -385,30 +345,23 @@ class BacktestEngine:
             risk_free_rate = 0.03
             sharpe_ratio = (annualized_return - risk_free_rate) / volatility if volatility > 0 else 0
             
-            # 最大回撤
-            values = [pv['total_value'] for pv in portfolio_values]
-            peak = values[0]
-            max_drawdown = 0
-            for value in values:
-                if value > peak:
-                    peak = value
-                drawdown = (peak - value) / peak
-                if drawdown > max_drawdown:
-                    max_drawdown = drawdown
+            # 最大回撤（逐日盯市，包含调仓区间内的回撤）
+            values = np.array([initial_value] + [pv['total_value'] for pv in portfolio_values])
+            drawdown = max_drawdown(values)
             
             # 胜率
             positive_returns = [r for r in daily_returns if r > 0]
             win_rate = len(positive_returns) / len(daily_returns) if daily_returns else 0
             
             # 卡尔玛比率
-            calmar_ratio = annualized_return / max_drawdown if max_drawdown > 0 else 0
+            calmar_ratio = annualized_return / drawdown if drawdown > 0 else 0
             
             return {
                 'total_return': total_return,
                 'annualized_return': annualized_return,
                 'volatility': volatility,
                 'sharpe_ratio': sharpe_ratio,
-                'max_drawdown': max_drawdown,
+                'max_drawdown': drawdown,
                 'win_rate': win_rate,
                 'calmar_ratio': calmar_ratio,
                 'total_trades': len(daily_returns),
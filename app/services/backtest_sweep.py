@@ -0,0 +1,375 @@
+"""
+回测参数扫描
+把 top_n、rebalance_frequency、transaction_cost、optimization_method 的参数网格展开为
+一组回测任务。行情面板、各调仓日的选股结果和因子风险模型只在主进程中准备一次（选股
+按最大 top_n 计算，较小的 top_n 直接截取排名靠前的部分），随后启动工作进程：
+进程以 forkserver（不可用时 spawn）方式创建，不继承父进程中其它线程持有的锁。
+价格面板和风险模型的大数组放入共享内存，所有工作进程映射同一份只读数据，初始化参数
+只携带共享内存的名称、形状和类型；子进程不再访问数据库，各自完成目标权重计算和
+向量化盯市，最后按夏普比率等指标排序返回结果表。
+"""
+
+import os
+import copy
+import time
+import itertools
+import multiprocessing
+import numpy as np
+import pandas as pd
+from multiprocessing import shared_memory
+from typing import List, Dict, Any
+from concurrent.futures import ProcessPoolExecutor
+from loguru import logger
+
+from app.services.backtest_core import PricePanel, load_price_panel, simulate, slice_panel, weights_to_vector
+from app.services.portfolio_optimizer import PortfolioOptimizer
+from app.services.factor_risk_model import FactorRiskModel, get_risk_model_store
+
+
+# 可扫描的参数
+SWEEP_PARAMS = ('top_n', 'rebalance_frequency', 'transaction_cost', 'optimization_method')
+
+# 风险模型使用的交易日数及对应的自然日回看
+RISK_LOOKBACK_DAYS = 252
+RISK_LOOKBACK_CALENDAR_DAYS = 400
+
+# 升序排列的指标（越小越好）
+ASCENDING_METRICS = ('max_drawdown', 'avg_turnover', 'volatility')
+
+# 主进程准备后填充；工作进程在初始化时由共享内存重建，只读
+_SWEEP_STATE: Dict[str, Any] = {}
+
+# 工作进程映射的共享内存块，进程存活期间保持打开
+_ATTACHED_BLOCKS: List[shared_memory.SharedMemory] = []
+
+
+class _SharedArrays:
+    """主进程放入共享内存的数组，工作进程按名称、形状和类型映射同一块内存"""
+
+    def __init__(self):
+        self.blocks: List[shared_memory.SharedMemory] = []
+
+    def share(self, array: np.ndarray) -> Dict[str, Any]:
+        array = np.ascontiguousarray(array)
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self.blocks.append(block)
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+        return {'name': block.name, 'shape': array.shape, 'dtype': array.dtype.str}
+
+    def release(self):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+
+def _attach(spec: Dict[str, Any]) -> np.ndarray:
+    """按名称映射共享内存中的只读数组"""
+    block = shared_memory.SharedMemory(name=spec['name'])
+    _ATTACHED_BLOCKS.append(block)
+    array = np.ndarray(spec['shape'], dtype=np.dtype(spec['dtype']), buffer=block.buf)
+    array.flags.writeable = False
+    return array
+
+
+def _share_state(state: Dict[str, Any], shared: _SharedArrays) -> Dict[str, Any]:
+    """把扫描状态中的面板和风险模型数组放入共享内存，返回只含元数据的可序列化状态"""
+    panel = state['panel']
+    codes = sorted({code for model in state['risk_models'].values() for code in model.codes})
+    code_ids = {code: i for i, code in enumerate(codes)}
+    models = {}
+    for day, model in state['risk_models'].items():
+        models[day] = {
+            'trade_date': model.trade_date,
+            'factors': model.factors,
+            'code_ids': shared.share(np.array([code_ids[code] for code in model.codes], dtype=np.int32)),
+            'exposures': shared.share(model.exposures),
+            'factor_cov': model.factor_cov,
+            'specific_var': shared.share(model.specific_var),
+            'meta': model.meta
+        }
+
+    worker_state = {key: value for key, value in state.items()
+                    if key not in ('panel', 'code_index', 'risk_models')}
+    worker_state['panel'] = {
+        'dates': panel.dates,
+        'codes': panel.codes,
+        'close': shared.share(panel.close),
+        'tradable': shared.share(panel.tradable),
+        'share_ratio': shared.share(panel.share_ratio)
+    }
+    worker_state['risk_models'] = {'codes': codes, 'models': models}
+    return worker_state
+
+
+def _attach_state(worker_state: Dict[str, Any]) -> Dict[str, Any]:
+    """由共享内存重建扫描状态，数组均为共享内存上的只读视图"""
+    spec = worker_state['panel']
+    panel = PricePanel(spec['dates'], spec['codes'], _attach(spec['close']),
+                       _attach(spec['tradable']), _attach(spec['share_ratio']))
+    codes = worker_state['risk_models']['codes']
+    risk_models = {
+        day: FactorRiskModel(model['trade_date'], [codes[i] for i in _attach(model['code_ids'])],
+                             model['factors'], _attach(model['exposures']), model['factor_cov'],
+                             _attach(model['specific_var']), model['meta'])
+        for day, model in worker_state['risk_models']['models'].items()
+    }
+    return dict(worker_state, panel=panel, code_index=panel.code_index(), risk_models=risk_models)
+
+
+def _pool_context():
+    """工作进程的启动方式：优先 forkserver，其次 spawn。
+
+    扫描可能在任务队列的工作线程中运行，直接 fork 会把其它线程持有的锁
+    （日志、连接池、任务存储）以加锁状态复制进子进程而导致死锁。
+    """
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+
+def _init_worker(config_name: str, worker_state: Dict[str, Any]):
+    """工作进程初始化：创建应用上下文，并映射主进程放入共享内存的扫描状态"""
+    from app import create_app
+
+    app = create_app(config_name)
+    app.app_context().push()
+    _SWEEP_STATE.clear()
+    _SWEEP_STATE.update(_attach_state(worker_state))
+
+
+def expand_grid(grid: Dict[str, List[Any]], defaults: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """展开参数网格，网格中未给出的参数取 defaults"""
+    unknown = set(grid) - set(SWEEP_PARAMS)
+    if unknown:
+        raise ValueError(f"不支持扫描的参数: {', '.join(sorted(unknown))}")
+
+    values = []
+    for name in SWEEP_PARAMS:
+        options = grid.get(name)
+        if options is None:
+            options = [defaults[name]]
+        elif not isinstance(options, (list, tuple)):
+            options = [options]
+        values.append(list(options))
+    return [dict(zip(SWEEP_PARAMS, combo)) for combo in itertools.product(*values)]
+
+
+def _case_config(base_config: Dict[str, Any], params: Dict[str, Any]) -> Dict[str, Any]:
+    config = copy.deepcopy(base_config)
+    config['top_n'] = params['top_n']
+    config['transaction_cost'] = params['transaction_cost']
+    config.setdefault('optimization', {})['method'] = params['optimization_method']
+    return config
+
+
+def _run_case(case_id: int, params: Dict[str, Any]) -> Dict[str, Any]:
+    """运行单个参数组合（在子进程或主进程中执行，只读取 _SWEEP_STATE）"""
+    from app.services.backtest_engine import BacktestEngine
+
+    started = time.perf_counter()
+    state = _SWEEP_STATE
+    panel = state['panel']
+    offset = state['offset']
+    engine = BacktestEngine()
+    config = _case_config(state['base_config'], params)
+    method = params['optimization_method']
+    code_index = state['code_index']
+
+    rebalances = []
+    for day in state['rebalance_days'][params['rebalance_frequency']]:
+        selected = state['selections'].get(day)
+        if not selected:
+            continue
+        selected = selected[:int(params['top_n'])]
+
+        risk_model = state['risk_models'].get(day) if method != 'equal_weight' else None
+        if method != 'equal_weight' and risk_model is None:
+            codes = [stock['ts_code'] for stock in selected if stock['ts_code'] in code_index]
+            columns = [code_index[code] for code in codes]
+            window = slice(max(day - RISK_LOOKBACK_DAYS + 1, 0), day + 1)
+            prices = np.where(panel.tradable[window][:, columns], panel.close[window][:, columns], np.nan)
+            risk_model = PortfolioOptimizer.risk_model_from_prices(
+                pd.DataFrame(prices, index=panel.dates[window], columns=codes),
+                [stock['ts_code'] for stock in selected]
+            )
+
+        weights = engine._get_target_weights(selected, config['optimization'], risk_model)
+        rebalances.append((day - offset, weights_to_vector(weights, code_index, len(panel.codes))))
+
+    simulation = simulate(slice_panel(panel, offset), rebalances, state['initial_capital'],
+                          params['transaction_cost'])
+    portfolio_values = [{'total_value': float(value)} for value in simulation['total_value']]
+    metrics = engine._calculate_performance_metrics(
+        portfolio_values, simulation['daily_returns'].tolist(),
+        state['start_date'], state['end_date'], state['initial_capital']
+    )
+    turnover = simulation['turnover']
+
+    return {
+        'case_id': case_id,
+        'params': params,
+        'final_value': float(simulation['total_value'][-1]),
+        'total_return': metrics.get('total_return', 0.0),
+        'annualized_return': metrics.get('annualized_return', 0.0),
+        'volatility': metrics.get('volatility', 0.0),
+        'sharpe_ratio': metrics.get('sharpe_ratio', 0.0),
+        'max_drawdown': metrics.get('max_drawdown', 0.0),
+        'avg_turnover': float(np.mean(turnover)) if turnover else 0.0,
+        'total_turnover': float(np.sum(turnover)) if turnover else 0.0,
+        'rebalances': len(rebalances),
+        'seconds': round(time.perf_counter() - started, 4),
+        'pid': os.getpid()
+    }
+
+
+class BacktestSweepRunner:
+    """回测参数扫描器"""
+
+    def __init__(self, backtest_engine=None, max_workers: int = None, config_name: str = 'default'):
+        if backtest_engine is None:
+            from app.services.backtest_engine import BacktestEngine
+            backtest_engine = BacktestEngine()
+        self.backtest_engine = backtest_engine
+        self.max_workers = max_workers or max((os.cpu_count() or 2) - 1, 1)
+        self.config_name = config_name
+
+    def _defaults(self, base_config: Dict[str, Any], rebalance_frequency: str) -> Dict[str, Any]:
+        return {
+            'top_n': base_config.get('top_n', 50),
+            'rebalance_frequency': rebalance_frequency,
+            'transaction_cost': base_config.get('transaction_cost', 0.001),
+            'optimization_method': base_config.get('optimization', {}).get('method', 'equal_weight')
+        }
+
+    def _prepare(self, base_config: Dict[str, Any], cases: List[Dict[str, Any]],
+                 start_date: str, end_date: str, initial_capital: float) -> Dict[str, float]:
+        """在主进程中加载面板并计算全部调仓日的选股结果"""
+        timing = {}
+
+        started = time.perf_counter()
+        needs_risk = any(case['optimization_method'] != 'equal_weight' for case in cases)
+        load_start = (pd.Timestamp(start_date) - pd.Timedelta(days=RISK_LOOKBACK_CALENDAR_DAYS)
+                      ).strftime('%Y-%m-%d') if needs_risk else start_date
+        panel = load_price_panel(load_start, end_date)
+        offset = int(panel.dates.searchsorted(pd.Timestamp(start_date)))
+        timing['load_seconds'] = round(time.perf_counter() - started, 4)
+
+        started = time.perf_counter()
+        trade_dates = list(panel.dates[offset:])
+        rebalance_days = {}
+        for frequency in {case['rebalance_frequency'] for case in cases}:
+            dates = self.backtest_engine.select_rebalance_dates(trade_dates, frequency)
+            rebalance_days[frequency] = [int(day) + offset for day in panel.dates[offset:].get_indexer(dates)]
+
+        max_top_n = max(int(case['top_n']) for case in cases)
+        selection_config = dict(base_config, top_n=max_top_n)
+        selections = {}
+        for day in sorted({day for days in rebalance_days.values() for day in days}):
+            selections[day] = self.backtest_engine._get_stock_selection(
+                selection_config, panel.dates[day].date()
+            )
+        timing['selection_seconds'] = round(time.perf_counter() - started, 4)
+
+        # 各调仓日的因子风险模型同样在主进程中取好，没有因子数据的日期回退到价格协方差
+        started = time.perf_counter()
+        risk_models = {}
+        if needs_risk:
+            store = get_risk_model_store()
+            for day in selections:
+                try:
+                    model = store.get(panel.dates[day].date())
+                except Exception as e:
+                    logger.warning(f"获取因子风险模型失败: {panel.dates[day].date()}, 错误: {e}")
+                    model = None
+                if model is not None:
+                    risk_models[day] = model
+        timing['risk_model_seconds'] = round(time.perf_counter() - started, 4)
+
+        _SWEEP_STATE.update({
+            'panel': panel,
+            'offset': offset,
+            'code_index': panel.code_index(),
+            'rebalance_days': rebalance_days,
+            'selections': selections,
+            'risk_models': risk_models,
+            'base_config': base_config,
+            'initial_capital': initial_capital,
+            'start_date': start_date,
+            'end_date': end_date
+        })
+        return timing
+
+    def run(self, base_config: Dict[str, Any], start_date: str, end_date: str,
+            grid: Dict[str, List[Any]], initial_capital: float = 1000000.0,
+            rebalance_frequency: str = 'monthly', sort_by: str = 'sharpe_ratio') -> Dict[str, Any]:
+        """展开参数网格并行回测，返回按 sort_by 排名的结果表"""
+        started = time.perf_counter()
+        cases = expand_grid(grid or {}, self._defaults(base_config, rebalance_frequency))
+        logger.info(f"回测参数扫描: {len(cases)} 组参数, 工作进程 {self.max_workers}")
+
+        try:
+            timing = self._prepare(base_config, cases, start_date, end_date, initial_capital)
+            if len(_SWEEP_STATE['panel'].dates) <= _SWEEP_STATE['offset']:
+                return {'error': '回测区间内没有行情数据'}
+
+            run_started = time.perf_counter()
+            results = self._execute(cases)
+            timing['simulate_seconds'] = round(time.perf_counter() - run_started, 4)
+        finally:
+            _SWEEP_STATE.clear()
+
+        failed = [result for result in results if 'error' in result]
+        results = [result for result in results if 'error' not in result]
+        ascending = sort_by in ASCENDING_METRICS
+        results.sort(key=lambda result: result.get(sort_by, 0.0), reverse=not ascending)
+        for rank, result in enumerate(results, start=1):
+            result['rank'] = rank
+
+        run_seconds = [result['seconds'] for result in results]
+        timing.update({
+            'total_seconds': round(time.perf_counter() - started, 4),
+            'avg_run_seconds': round(float(np.mean(run_seconds)), 4) if run_seconds else 0.0,
+            'max_run_seconds': round(float(np.max(run_seconds)), 4) if run_seconds else 0.0
+        })
+
+        return {
+            'success': True,
+            'backtest_period': f"{start_date} to {end_date}",
+            'total_runs': len(cases),
+            'sort_by': sort_by,
+            'results': results,
+            'failed': failed,
+            'timing': timing
+        }
+
+    def _execute(self, cases: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """在进程池中并行运行，单进程或单组参数时在当前进程中顺序运行"""
+        if self.max_workers <= 1 or len(cases) <= 1:
+            return [self._safe_run(case_id, params) for case_id, params in enumerate(cases)]
+
+        workers = min(self.max_workers, len(cases))
+        shared = _SharedArrays()
+        try:
+            worker_state = _share_state(_SWEEP_STATE, shared)
+            with ProcessPoolExecutor(max_workers=workers, mp_context=_pool_context(),
+                                     initializer=_init_worker,
+                                     initargs=(self.config_name, worker_state)) as executor:
+                futures = [executor.submit(_run_case, case_id, params) for case_id, params in enumerate(cases)]
+                results = []
+                for case_id, future in enumerate(futures):
+                    try:
+                        results.append(future.result())
+                    except Exception as e:
+                        logger.error(f"回测参数组合失败: {cases[case_id]}, 错误: {e}")
+                        results.append({'case_id': case_id, 'params': cases[case_id], 'error': str(e)})
+                return results
+        finally:
+            shared.release()
+
+    @staticmethod
+    def _safe_run(case_id: int, params: Dict[str, Any]) -> Dict[str, Any]:
+        try:
+            return _run_case(case_id, params)
+        except Exception as e:
+            logger.error(f"回测参数组合失败: {params}, 错误: {e}")
+            return {'case_id': case_id, 'params': params, 'error': str(e)}
@@ -0,0 +1,173 @@
+"""
+在线K线聚合器
+逐根消费 1 分钟K线，在内存中为每只股票维护 5/15/30/60 分钟的未完成K线，
+K线收盘后批量输出，所有目标周期只需遍历一次源数据。
+
+分桶按 A 股交易时段对齐：上午 9:30-11:30、下午 13:00-15:00 共 240 个交易分钟，
+目标周期按交易分钟序号切分，因此 60 分钟K线为 9:30、10:30、13:00、14:00 四根，
+不会出现跨午休或 11:00-11:30 的半根K线。K线时间取所在区间的起始时间，与源数据一致。
+集合竞价（9:30 之前）并入第一根，11:30 及午休期间的数据并入上午最后一根，
+15:00 及之后的数据并入最后一根。
+"""
+
+import threading
+from datetime import datetime, time as dt_time, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import pandas as pd
+from loguru import logger
+
+
+TARGET_PERIODS = {'5min': 5, '15min': 15, '30min': 30, '60min': 60}
+
+MORNING_OPEN = dt_time(9, 30)
+AFTERNOON_OPEN = dt_time(13, 0)
+MORNING_MINUTES = 120
+SESSION_MINUTES = 240
+
+
+def session_offset(moment: datetime) -> int:
+    """1 分钟K线（按起始时间标记）在当日交易时段中的分钟序号，取值 0-239"""
+    minutes = moment.hour * 60 + moment.minute
+    if minutes < 13 * 60:
+        return min(max(minutes - (9 * 60 + 30), 0), MORNING_MINUTES - 1)
+    return min(MORNING_MINUTES + minutes - 13 * 60, SESSION_MINUTES - 1)
+
+
+def offset_to_time(day: datetime, offset: int) -> datetime:
+    """交易分钟序号转回当日时间"""
+    base = datetime.combine(day.date(), MORNING_OPEN if offset < MORNING_MINUTES else AFTERNOON_OPEN)
+    return base + timedelta(minutes=offset if offset < MORNING_MINUTES else offset - MORNING_MINUTES)
+
+
+class _OpenBar:
+    """一个周期内尚未收盘的K线"""
+
+    __slots__ = ('bucket', 'start', 'open', 'high', 'low', 'close', 'volume', 'amount')
+
+    def __init__(self, bucket: Tuple, start: datetime, bar: Dict[str, Any]):
+        self.bucket = bucket
+        self.start = start
+        self.open = float(bar['open'])
+        self.high = float(bar['high'])
+        self.low = float(bar['low'])
+        self.close = float(bar['close'])
+        self.volume = int(bar.get('volume') or 0)
+        self.amount = float(bar.get('amount') or 0.0)
+
+    def update(self, bar: Dict[str, Any]):
+        self.high = max(self.high, float(bar['high']))
+        self.low = min(self.low, float(bar['low']))
+        self.close = float(bar['close'])
+        self.volume += int(bar.get('volume') or 0)
+        self.amount += float(bar.get('amount') or 0.0)
+
+
+class BarAggregator:
+    """1 分钟K线到多周期K线的在线聚合器"""
+
+    def __init__(self, periods: Iterable[str] = TARGET_PERIODS):
+        unknown = [period for period in periods if period not in TARGET_PERIODS]
+        if unknown:
+            raise ValueError(f"不支持的目标周期: {unknown}")
+        self.periods = {period: TARGET_PERIODS[period] for period in periods}
+        self._open: Dict[Tuple[str, str], _OpenBar] = {}
+        # 每个序列最后一根已收盘K线的收盘价，作为下一根的前收盘价
+        self._last_close: Dict[Tuple[str, str], float] = {}
+        self._last_bucket: Dict[Tuple[str, str], Tuple] = {}
+        self._lock = threading.Lock()
+        self.bars_consumed = 0
+        self.bars_emitted = 0
+        self.late_bars = 0
+
+    def consume(self, records: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """消费 1 分钟K线（需按时间升序），返回本次收盘的全部K线
+
+        落在已收盘区间或早于当前未完成区间的迟到数据会被丢弃并计数。
+        """
+        emitted = []
+        with self._lock:
+            for record in records:
+                if record.get('period_type', '1min') != '1min' or record.get('close') is None:
+                    continue
+                moment = pd.Timestamp(record['datetime']).to_pydatetime()
+                offset = session_offset(moment)
+                ts_code = record['ts_code']
+                self.bars_consumed += 1
+
+                for period, minutes in self.periods.items():
+                    key = (ts_code, period)
+                    bucket = (moment.date(), offset // minutes)
+                    closed = self._last_bucket.get(key)
+                    if closed is not None and bucket <= closed:
+                        self.late_bars += 1
+                        continue
+                    current = self._open.get(key)
+                    if current is not None and current.bucket != bucket:
+                        if bucket < current.bucket:
+                            self.late_bars += 1
+                            continue
+                        emitted.append(self._close(key, current))
+                        current = None
+                    if current is None:
+                        current = _OpenBar(bucket, offset_to_time(moment, bucket[1] * minutes), record)
+                        self._open[key] = current
+                    else:
+                        current.update(record)
+                    # 区间最后一分钟到达即收盘，无需等待下一根
+                    if (offset + 1) % minutes == 0:
+                        emitted.append(self._close(key, current))
+            self.bars_emitted += len(emitted)
+        return emitted
+
+    def flush(self, ts_code: Optional[str] = None) -> List[Dict[str, Any]]:
+        """强制输出未完成的K线（回放历史数据结束或收盘后调用）"""
+        with self._lock:
+            keys = [key for key in self._open if ts_code is None or key[0] == ts_code]
+            emitted = [self._close(key, self._open[key]) for key in keys]
+            self.bars_emitted += len(emitted)
+        return emitted
+
+    def _close(self, key: Tuple[str, str], bar: _OpenBar) -> Dict[str, Any]:
+        """收盘并转为入库记录（调用方持有锁）"""
+        del self._open[key]
+        self._last_bucket[key] = bar.bucket
+        pre_close = self._last_close.get(key, bar.open)
+        self._last_close[key] = bar.close
+        change = bar.close - pre_close
+        return {
+            'ts_code': key[0],
+            'datetime': bar.start,
+            'period_type': key[1],
+            'open': bar.open,
+            'high': bar.high,
+            'low': bar.low,
+            'close': bar.close,
+            'volume': bar.volume,
+            'amount': bar.amount,
+            'pre_close': pre_close,
+            'change': change,
+            'pct_chg': change / pre_close * 100 if pre_close else 0.0
+        }
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            open_bars = len(self._open)
+        return {
+            'bars_consumed': self.bars_consumed,
+            'bars_emitted': self.bars_emitted,
+            'late_bars': self.late_bars,
+            'open_bars': open_bars
+        }
+
+
+_bar_aggregator = None
+
+
+def get_bar_aggregator() -> BarAggregator:
+    """获取全局在线K线聚合器实例（延迟初始化）"""
+    global _bar_aggregator
+    if _bar_aggregator is None:
+        _bar_aggregator = BarAggregator()
+        logger.info(f"在线K线聚合器已初始化: {list(_bar_aggregator.periods)}")
+    return _bar_aggregator
@@ -0,0 +1,101 @@
+"""
+进程内行情事件总线
+入库流程把新 K 线发布到总线，推送服务等消费者按需取走。同一 (股票, 周期) 在被消费之前
+多次发布只保留最新一根，因此总线占用不超过序列数量，发布方永远不会被慢消费者阻塞。
+
+需要逐笔响应的消费者（如增量风险）可注册监听器，在发布线程中同步收到本次发布的 K 线，
+监听器应只做轻量计算，耗时操作自行转交后台线程。
+"""
+
+import threading
+from typing import Any, Callable, Dict, List, Tuple
+
+from loguru import logger
+
+BarListener = Callable[[Dict[Tuple[str, str], Dict[str, Any]]], None]
+
+
+class BarEventBus:
+    """合并式 K 线事件总线"""
+
+    def __init__(self):
+        self._pending: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self._condition = threading.Condition()
+        self._listeners: List[BarListener] = []
+        self._fresh = False  # 上次取走后是否有新发布的 K 线（放回的序列不算）
+        self.published = 0
+        self.coalesced = 0
+
+    def publish(self, bars: Dict[Tuple[str, str], Dict[str, Any]]):
+        """发布 {(ts_code, period_type): 最新K线}"""
+        if not bars:
+            return
+        with self._condition:
+            for key, bar in bars.items():
+                if key in self._pending:
+                    self.coalesced += 1
+                self._pending[key] = bar
+            self.published += len(bars)
+            self._fresh = True
+            self._condition.notify_all()
+            listeners = list(self._listeners)
+        # 在锁外回调，监听器异常不影响发布方与其他监听器
+        for listener in listeners:
+            try:
+                listener(bars)
+            except Exception as e:
+                logger.error(f"K线事件监听器执行失败: {e}")
+
+    def requeue(self, keys):
+        """把未处理完的序列放回待处理集合（值为 None 表示读取缓存中的最新 K 线），
+        不计入发布统计，不通知监听器，也不唤醒等待中的消费者，由消费者下一轮定时取走；
+        期间已有新 K 线到达的序列保持不变"""
+        with self._condition:
+            for key in keys:
+                self._pending.setdefault(key, None)
+
+    def add_listener(self, listener: BarListener):
+        """注册同步监听器，每次发布时以 {(ts_code, period_type): K线} 调用"""
+        with self._condition:
+            if listener not in self._listeners:
+                self._listeners.append(listener)
+
+    def remove_listener(self, listener: BarListener):
+        with self._condition:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+
+    def wait(self, timeout: float) -> bool:
+        """等待新发布的事件，超时返回 False；只有放回的序列时等到超时"""
+        with self._condition:
+            if self._fresh:
+                return True
+            return self._condition.wait(timeout)
+
+    def drain(self) -> Dict[Tuple[str, str], Dict[str, Any]]:
+        """取走全部待处理事件"""
+        with self._condition:
+            pending, self._pending = self._pending, {}
+            self._fresh = False
+            return pending
+
+    def notify(self):
+        """唤醒等待中的消费者（例如需要立即推送时）"""
+        with self._condition:
+            self._condition.notify_all()
+
+    def stats(self) -> Dict[str, int]:
+        with self._condition:
+            return {'published': self.published, 'coalesced': self.coalesced,
+                    'pending': len(self._pending), 'listeners': len(self._listeners)}
+
+
+_bar_event_bus = None
+
+
+def get_bar_event_bus() -> BarEventBus:
+    """获取全局 K 线事件总线实例（延迟初始化）"""
+    global _bar_event_bus
+    if _bar_event_bus is None:
+        _bar_event_bus = BarEventBus()
+    return _bar_event_bus
@@ -0,0 +1,233 @@
+"""
+多日期因子批量回补引擎
+把日期区间切分为 (日期块 × 因子) 任务，在进程池中并行计算；每个任务只加载
+单个因子在单个日期块（含回看窗口）内的数据，以限制单个工作进程的内存。
+计算结果统一回到主进程，由唯一的写入器落库，并在检查点文件中记录已完成的任务，
+中断后可从检查点继续。
+"""
+
+import os
+import sys
+import json
+import time
+import pandas as pd
+from typing import List, Dict, Any, Tuple
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from loguru import logger
+
+from app.extensions import db
+from app.models import StockDailyHistory, StockBasic
+from app.services.factor_kernels import FACTOR_COLUMNS, panel_spec
+from app.services.factor_load_plan import FactorLoadPlan, LOOKBACK_DAYS, required_sources
+from app.services.factor_value_writer import FactorValuesWriter
+
+
+DEFAULT_CHUNK_DAYS = 60
+DEFAULT_CHECKPOINT_PATH = 'data/factor_backfill_checkpoint.json'
+# 估值分位数因子的滚动窗口（交易日），与 FactorEngine 中的 rolling(252) 一致
+PERCENTILE_WINDOW = 252
+
+# 工作进程内的应用上下文和因子引擎
+_worker_app = None
+_worker_engine = None
+
+
+def _init_worker(config_name: str):
+    """工作进程初始化：创建独立的应用和数据库连接"""
+    global _worker_app, _worker_engine
+    from app import create_app
+    from app.services.factor_engine import FactorEngine
+
+    _worker_app = create_app(config_name)
+    _worker_app.app_context().push()
+    _worker_engine = FactorEngine()
+
+
+def _trading_to_calendar_days(window: int) -> int:
+    """交易日窗口折算为自然日回看天数"""
+    return window * 7 // 5 + 20
+
+
+def _lookback_days(factor_id: str) -> int:
+    """面板因子按窗口长度估算所需的自然日回看天数，分位数因子按完整滚动窗口，其它因子使用默认窗口"""
+    spec = panel_spec(factor_id)
+    if spec is not None:
+        return _trading_to_calendar_days(spec.window)
+    if factor_id.endswith('_percentile'):
+        return _trading_to_calendar_days(PERCENTILE_WINDOW)
+    return LOOKBACK_DAYS
+
+
+def _source_overrides(factor_id: str) -> Dict[str, List[str]]:
+    """分位数因子的 basic 数据源默认不带回看窗口，回补时显式要求回看，
+    使每个日期块的结果与整段区间一次计算一致"""
+    if factor_id.endswith('_percentile'):
+        return {factor_id: required_sources(factor_id)}
+    return {}
+
+
+def _run_task(factor_id: str, chunk_start: str, chunk_end: str,
+              ts_codes: List[str]) -> Tuple[str, str, str, pd.DataFrame, Dict[str, Any]]:
+    """在工作进程中计算单个因子在单个日期块内的因子值"""
+    started = time.perf_counter()
+    plan = FactorLoadPlan([factor_id], chunk_start, chunk_end, lookback_days=_lookback_days(factor_id),
+                          source_overrides=_source_overrides(factor_id))
+    data = plan.execute(ts_codes)
+
+    result = _worker_engine.calculate_factor(factor_id, ts_codes, chunk_start, chunk_end, data=data)
+    if not result.empty:
+        dates = pd.to_datetime(result['trade_date'])
+        result = result[(dates >= chunk_start) & (dates <= chunk_end)][FACTOR_COLUMNS]
+        result = _worker_engine.calculate_daily_factor_stats(result)
+
+    stats = {
+        'rows_loaded': plan.get_stats()['total_rows'],
+        'rows': len(result),
+        'seconds': round(time.perf_counter() - started, 3),
+        'pid': os.getpid()
+    }
+    return factor_id, chunk_start, chunk_end, result, stats
+
+
+class FactorBackfillEngine:
+    """多日期因子批量回补引擎"""
+
+    def __init__(self, max_workers: int = None, chunk_days: int = DEFAULT_CHUNK_DAYS,
+                 checkpoint_path: str = DEFAULT_CHECKPOINT_PATH, config_name: str = 'default',
+                 batch_size: int = None, max_tasks_per_child: int = 20):
+        self.max_workers = max_workers or max((os.cpu_count() or 2) - 1, 1)
+        self.chunk_days = max(int(chunk_days), 1)
+        self.checkpoint_path = checkpoint_path
+        self.config_name = config_name
+        self.max_tasks_per_child = max_tasks_per_child
+        self.writer = FactorValuesWriter(batch_size) if batch_size else FactorValuesWriter()
+
+    @staticmethod
+    def default_factor_ids() -> List[str]:
+        """按交易日产出序列的内置因子（面板因子和估值分位数因子）"""
+        from app.services.factor_load_plan import BUILTIN_SOURCES
+        return [factor_id for factor_id in BUILTIN_SOURCES
+                if panel_spec(factor_id) is not None or factor_id.endswith('_percentile')]
+
+    # ==================== 任务切分 ====================
+
+    def plan_tasks(self, start_date: str, end_date: str,
+                   factor_ids: List[str]) -> List[Tuple[str, str, str]]:
+        """按交易日切分日期块，生成 (因子, 块开始, 块结束) 任务列表"""
+        trade_dates = [row[0] for row in db.session.query(StockDailyHistory.trade_date).filter(
+            StockDailyHistory.trade_date >= start_date,
+            StockDailyHistory.trade_date <= end_date
+        ).distinct().order_by(StockDailyHistory.trade_date).all()]
+
+        chunks = []
+        for i in range(0, len(trade_dates), self.chunk_days):
+            chunk = trade_dates[i:i + self.chunk_days]
+            chunks.append((pd.Timestamp(chunk[0]).strftime('%Y-%m-%d'),
+                           pd.Timestamp(chunk[-1]).strftime('%Y-%m-%d')))
+
+        return [(factor_id, chunk_start, chunk_end)
+                for chunk_start, chunk_end in chunks for factor_id in factor_ids]
+
+    # ==================== 检查点 ====================
+
+    @staticmethod
+    def _task_key(factor_id: str, chunk_start: str, chunk_end: str) -> str:
+        return f"{factor_id}|{chunk_start}|{chunk_end}"
+
+    def _load_checkpoint(self, run_key: str) -> set:
+        if not self.checkpoint_path or not os.path.exists(self.checkpoint_path):
+            return set()
+        try:
+            with open(self.checkpoint_path, 'r', encoding='utf-8') as f:
+                checkpoint = json.load(f)
+            if checkpoint.get('run_key') != run_key:
+                logger.info("检查点属于其它回补任务，忽略")
+                return set()
+            return set(checkpoint.get('completed', []))
+        except Exception as e:
+            logger.warning(f"读取回补检查点失败: {e}")
+            return set()
+
+    def _save_checkpoint(self, run_key: str, completed: set):
+        if not self.checkpoint_path:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.checkpoint_path)), exist_ok=True)
+        tmp_path = f"{self.checkpoint_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'run_key': run_key, 'completed': sorted(completed)}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    # ==================== 执行 ====================
+
+    def run(self, start_date: str, end_date: str, factor_ids: List[str] = None,
+            ts_codes: List[str] = None) -> Dict[str, Any]:
+        """并行回补 [start_date, end_date] 内的因子值"""
+        started = time.perf_counter()
+        factor_ids = factor_ids or self.default_factor_ids()
+        if ts_codes is None:
+            ts_codes = [row[0] for row in db.session.query(StockBasic.ts_code).all()]
+
+        tasks = self.plan_tasks(start_date, end_date, factor_ids)
+        run_key = f"{start_date}|{end_date}|{','.join(sorted(factor_ids))}|{self.chunk_days}"
+        completed = self._load_checkpoint(run_key)
+        pending = [task for task in tasks if self._task_key(*task) not in completed]
+        logger.info(f"因子回补: {len(tasks)} 个任务, 已完成 {len(tasks) - len(pending)}, "
+                    f"待执行 {len(pending)}, 工作进程 {self.max_workers}")
+
+        summary = {'tasks': len(tasks), 'skipped': len(tasks) - len(pending),
+                   'completed': 0, 'failed': [], 'rows': 0, 'task_stats': []}
+
+        if pending:
+            try:
+                self._execute(pending, ts_codes, run_key, completed, summary)
+            except BrokenProcessPool as e:
+                # 工作进程异常退出时保留检查点，重新运行即可从断点继续
+                logger.error(f"回补进程池异常终止: {e}")
+                summary['failed'].append({'task': None, 'error': str(e)})
+
+        summary['seconds'] = round(time.perf_counter() - started, 3)
+        summary['writer'] = self.writer.get_throughput()
+        if not summary['failed'] and self.checkpoint_path and os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+        return summary
+
+    def _execute(self, pending: List[Tuple[str, str, str]], ts_codes: List[str],
+                 run_key: str, completed: set, summary: Dict[str, Any]):
+        """在进程池中执行任务，结果由主进程统一写入"""
+        # 控制在途任务数量，避免结果在主进程中堆积
+        max_in_flight = self.max_workers * 2
+        queue = list(pending)
+        pool_kwargs = {}
+        if sys.version_info >= (3, 11):
+            # max_tasks_per_child 自 Python 3.11 起才支持，更早版本不回收工作进程
+            pool_kwargs['max_tasks_per_child'] = self.max_tasks_per_child
+        with ProcessPoolExecutor(max_workers=self.max_workers, initializer=_init_worker,
+                                 initargs=(self.config_name,), **pool_kwargs) as executor:
+            in_flight = {}
+            while queue or in_flight:
+                while queue and len(in_flight) < max_in_flight:
+                    task = queue.pop(0)
+                    in_flight[executor.submit(_run_task, *task, ts_codes)] = task
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = in_flight.pop(future)
+                    try:
+                        factor_id, chunk_start, chunk_end, result, stats = future.result()
+                        if not result.empty:
+                            self.writer.write(result)
+                        completed.add(self._task_key(*task))
+                        self._save_checkpoint(run_key, completed)
+                    except BrokenProcessPool:
+                        raise
+                    except Exception as e:
+                        logger.error(f"回补任务失败: {task}, 错误: {e}")
+                        summary['failed'].append({'task': list(task), 'error': str(e)})
+                        continue
+
+                    summary['completed'] += 1
+                    summary['rows'] += stats['rows']
+                    summary['task_stats'].append({'task': list(task), **stats})
+                    logger.info(f"回补 {factor_id} {chunk_start}~{chunk_end}: {stats['rows']} 条, "
+                                f"{stats['seconds']}s ({summary['completed']}/{len(pending)})")
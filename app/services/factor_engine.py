@@ -7,11 +7,11 @@ from scipy import stats
 from loguru import logger
 
 from app.extensions import db
-from app.models import (
-    FactorDefinition, FactorValues, StockDailyHistory, StockDailyBasic,
-    StockFactor, StockMoneyflow, StockCyqPerf, StockIncomeStatement,
-    StockBalanceSheet
-)
+from app.models import FactorDefinition, FactorValues
+from app.services import factor_kernels
+from app.services.factor_formula import FormulaError, compile_formula, evaluate_formulas
+from app.services.factor_load_plan import FactorLoadPlan, stale_sources
+from app.services.factor_value_writer import FactorValuesWriter
 
 
 class FactorEngine:
@@ -20,6 +20,8 @@ class FactorEngine:
     def __init__(self):
         self.factor_definitions = {}
         self.builtin_factors = {}
+        self.last_load_stats = {}
+        self.value_writer = FactorValuesWriter()
         self._init_builtin_factors()
         self.load_factor_definitions()
     
@@ -66,6 +68,13 @@ class FactorEngine:
     def register_factor(self, factor_id: str, factor_name: str, formula: str, 
                        factor_type: str, description: str = None, params: dict = None):
         """注册自定义因子"""
+        try:
+            # 先编译公式，语法或字段错误的因子不入库
+            compile_formula(formula, params)
+        except FormulaError as e:
+            logger.error(f"因子公式无效: {factor_id}, 公式: {formula}, 错误: {e}")
+            return False
+        
         try:
             # 检查因子是否已存在
             existing = FactorDefinition.query.filter_by(factor_id=factor_id).first()
@@ -99,18 +108,23 @@ class FactorEngine:
             return False
     
     def calculate_factor(self, factor_id: str, ts_codes: List[str], 
-                        start_date: str, end_date: str) -> pd.DataFrame:
-        """计算指定因子值"""
+                        start_date: str, end_date: str,
+                        data: Dict[str, pd.DataFrame] = None) -> pd.DataFrame:
+        """计算指定因子值
+        
+        Args:
+            data: 预先加载的共享数据（见 FactorLoadPlan），为空时按因子单独查询
+        """
         try:
             result = pd.DataFrame()
             
             # 检查是否为内置因子
             if factor_id in self.builtin_factors:
-                result = self._calculate_builtin_factor(factor_id, ts_codes, start_date, end_date)
+                result = self._calculate_builtin_factor(factor_id, ts_codes, start_date, end_date, data)
             
             # 检查是否为自定义因子
             elif factor_id in self.factor_definitions:
-                result = self._calculate_custom_factor(factor_id, ts_codes, start_date, end_date)
+                result = self._calculate_custom_factor(factor_id, ts_codes, start_date, end_date, data)
             
             else:
                 logger.warning(f"未找到因子定义: {factor_id}")
@@ -128,12 +142,14 @@ class FactorEngine:
             return pd.DataFrame()
     
     def _calculate_builtin_factor(self, factor_id: str, ts_codes: List[str], 
-                                 start_date: str, end_date: str) -> pd.DataFrame:
+                                 start_date: str, end_date: str,
+                                 data: Dict[str, pd.DataFrame] = None) -> pd.DataFrame:
         """计算内置因子"""
         factor_func = self.builtin_factors[factor_id]
         
         # 根据因子类型获取所需数据
-        data = self._get_factor_data(factor_id, ts_codes, start_date, end_date)
+        if data is None:
+            data = self._get_factor_data(factor_id, ts_codes, start_date, end_date)
         
         # 计算因子值
         result = factor_func(data, factor_id)
@@ -143,88 +159,17 @@ class FactorEngine:
     def _get_factor_data(self, factor_id: str, ts_codes: List[str], 
                         start_date: str, end_date: str) -> Dict[str, pd.DataFrame]:
         """获取计算因子所需的数据"""
-        data = {}
-        
-        # 扩展日期范围以获取足够的历史数据
-        extended_start = (datetime.strptime(start_date, '%Y-%m-%d') - timedelta(days=252)).strftime('%Y-%m-%d')
-        
-        try:
-            # 基础行情数据
-            if any(x in factor_id for x in ['momentum', 'volatility', 'volume', 'price']):
-                history_query = StockDailyHistory.query.filter(
-                    StockDailyHistory.ts_code.in_(ts_codes),
-                    StockDailyHistory.trade_date >= extended_start,
-                    StockDailyHistory.trade_date <= end_date
-                ).order_by(StockDailyHistory.ts_code, StockDailyHistory.trade_date)
-                
-                history_data = pd.read_sql(history_query.statement, db.engine)
-                data['history'] = history_data
-                logger.info(f"获取历史数据: {len(history_data)} 条记录")
-            
-            # 基本面数据
-            if any(x in factor_id for x in ['pe', 'pb', 'ps']):
-                basic_query = StockDailyBasic.query.filter(
-                    StockDailyBasic.ts_code.in_(ts_codes),
-                    StockDailyBasic.trade_date >= start_date,
-                    StockDailyBasic.trade_date <= end_date
-                ).order_by(StockDailyBasic.ts_code, StockDailyBasic.trade_date)
-                
-                basic_data = pd.read_sql(basic_query.statement, db.engine)
-                data['basic'] = basic_data
-            
-            # 技术因子数据
-            if 'ma' in factor_id:
-                factor_query = StockFactor.query.filter(
-                    StockFactor.ts_code.in_(ts_codes),
-                    StockFactor.trade_date >= start_date,
-                    StockFactor.trade_date <= end_date
-                ).order_by(StockFactor.ts_code, StockFactor.trade_date)
-                
-                factor_data = pd.read_sql(factor_query.statement, db.engine)
-                data['factor'] = factor_data
-            
-            # 资金流向数据
-            if 'money' in factor_id:
-                money_query = StockMoneyflow.query.filter(
-                    StockMoneyflow.ts_code.in_(ts_codes),
-                    StockMoneyflow.trade_date >= extended_start,
-                    StockMoneyflow.trade_date <= end_date
-                ).order_by(StockMoneyflow.ts_code, StockMoneyflow.trade_date)
-                
-                money_data = pd.read_sql(money_query.statement, db.engine)
-                data['moneyflow'] = money_data
-            
-            # 筹码数据
-            if 'chip' in factor_id or 'winner' in factor_id:
-                cyq_query = StockCyqPerf.query.filter(
-                    StockCyqPerf.ts_code.in_(ts_codes),
-                    StockCyqPerf.trade_date >= extended_start,
-                    StockCyqPerf.trade_date <= end_date
-                ).order_by(StockCyqPerf.ts_code, StockCyqPerf.trade_date)
-                
-                cyq_data = pd.read_sql(cyq_query.statement, db.engine)
-                data['cyq'] = cyq_data
-            
-            # 财务数据
-            if any(x in factor_id for x in ['roe', 'roa', 'revenue', 'profit']):
-                # 获取最近4个季度的财务数据
-                income_query = StockIncomeStatement.query.filter(
-                    StockIncomeStatement.ts_code.in_(ts_codes)
-                ).order_by(StockIncomeStatement.ts_code, StockIncomeStatement.end_date.desc())
-                
-                income_data = pd.read_sql(income_query.statement, db.engine)
-                data['income'] = income_data
-                
-                balance_query = StockBalanceSheet.query.filter(
-                    StockBalanceSheet.ts_code.in_(ts_codes)
-                ).order_by(StockBalanceSheet.ts_code, StockBalanceSheet.end_date.desc())
-                
-                balance_data = pd.read_sql(balance_query.statement, db.engine)
-                data['balance'] = balance_data
-            
-        except Exception as e:
-            logger.error(f"获取因子数据失败: {e}")
-        
+        plan = FactorLoadPlan([factor_id], start_date, end_date)
+        return plan.execute(ts_codes)
+    
+    def load_shared_data(self, factor_ids: List[str], ts_codes: List[str],
+                         start_date: str, end_date: str) -> Dict[str, pd.DataFrame]:
+        """按加载计划一次性获取多个因子共用的数据，统计信息记录在 last_load_stats"""
+        plan = FactorLoadPlan(factor_ids, start_date, end_date)
+        data = plan.execute(ts_codes)
+        self.last_load_stats = plan.get_stats()
+        logger.info(f"共享数据加载完成: {self.last_load_stats['total_rows']} 条记录, "
+                    f"耗时 {self.last_load_stats['total_seconds']}s")
         return data
     
     # ==================== 内置因子计算函数 ====================
@@ -234,105 +179,28 @@ class FactorEngine:
         if 'history' not in data or data['history'].empty:
             return pd.DataFrame()
         
-        # 提取周期参数
-        period = int(factor_id.split('_')[1].replace('d', ''))
-        
-        df = data['history'].copy()
-        df['trade_date'] = pd.to_datetime(df['trade_date'])
-        
-        result_list = []
-        for ts_code in df['ts_code'].unique():
-            stock_data = df[df['ts_code'] == ts_code].sort_values('trade_date')
-            stock_data[f'return_{period}d'] = stock_data['close'].pct_change(period)
-            
-            # 只保留指定日期范围的数据
-            result_list.append(stock_data[['ts_code', 'trade_date', f'return_{period}d']])
-        
-        if result_list:
-            result = pd.concat(result_list, ignore_index=True)
-            result = result.rename(columns={f'return_{period}d': 'factor_value'})
-            result['factor_id'] = factor_id
-            return result[['ts_code', 'trade_date', 'factor_id', 'factor_value']].dropna()
-        
-        return pd.DataFrame()
+        return factor_kernels.compute_panel_factor(data['history'], factor_id)
     
     def _volatility_factor(self, data: Dict[str, pd.DataFrame], factor_id: str) -> pd.DataFrame:
         """波动率因子：计算N日收益率标准差"""
         if 'history' not in data or data['history'].empty:
             return pd.DataFrame()
         
-        period = int(factor_id.split('_')[1].replace('d', ''))
-        
-        df = data['history'].copy()
-        df['trade_date'] = pd.to_datetime(df['trade_date'])
-        
-        result_list = []
-        for ts_code in df['ts_code'].unique():
-            stock_data = df[df['ts_code'] == ts_code].sort_values('trade_date')
-            stock_data['daily_return'] = stock_data['close'].pct_change()
-            stock_data[f'volatility_{period}d'] = stock_data['daily_return'].rolling(period).std()
-            
-            result_list.append(stock_data[['ts_code', 'trade_date', f'volatility_{period}d']])
-        
-        if result_list:
-            result = pd.concat(result_list, ignore_index=True)
-            result = result.rename(columns={f'volatility_{period}d': 'factor_value'})
-            result['factor_id'] = factor_id
-            return result[['ts_code', 'trade_date', 'factor_id', 'factor_value']].dropna()
-        
-        return pd.DataFrame()
+        return factor_kernels.compute_panel_factor(data['history'], factor_id)
     
     def _volume_ratio_factor(self, data: Dict[str, pd.DataFrame], factor_id: str) -> pd.DataFrame:
         """成交量比率因子"""
         if 'history' not in data or data['history'].empty:
             return pd.DataFrame()
         
-        period = int(factor_id.split('_')[2].replace('d', ''))
-        
-        df = data['history'].copy()
-        df['trade_date'] = pd.to_datetime(df['trade_date'])
-        
-        result_list = []
-        for ts_code in df['ts_code'].unique():
-            stock_data = df[df['ts_code'] == ts_code].sort_values('trade_date')
-            stock_data['vol_ma'] = stock_data['vol'].rolling(period).mean()
-            stock_data['volume_ratio'] = stock_data['vol'] / stock_data['vol_ma']
-            
-            result_list.append(stock_data[['ts_code', 'trade_date', 'volume_ratio']])
-        
-        if result_list:
-            result = pd.concat(result_list, ignore_index=True)
-            result = result.rename(columns={'volume_ratio': 'factor_value'})
-            result['factor_id'] = factor_id
-            return result[['ts_code', 'trade_date', 'factor_id', 'factor_value']].dropna()
-        
-        return pd.DataFrame()
+        return factor_kernels.compute_panel_factor(data['history'], factor_id)
     
     def _price_to_ma_factor(self, data: Dict[str, pd.DataFrame], factor_id: str) -> pd.DataFrame:
         """价格相对均线因子"""
         if 'history' not in data or data['history'].empty:
             return pd.DataFrame()
         
-        period = int(factor_id.split('ma')[1])
-        
-        df = data['history'].copy()
-        df['trade_date'] = pd.to_datetime(df['trade_date'])
-        
-        result_list = []
-        for ts_code in df['ts_code'].unique():
-            stock_data = df[df['ts_code'] == ts_code].sort_values('trade_date')
-            stock_data[f'ma{period}'] = stock_data['close'].rolling(period).mean()
-            stock_data['price_to_ma'] = stock_data['close'] / stock_data[f'ma{period}'] - 1
-            
-            result_list.append(stock_data[['ts_code', 'trade_date', 'price_to_ma']])
-        
-        if result_list:
-            result = pd.concat(result_list, ignore_index=True)
-            result = result.rename(columns={'price_to_ma': 'factor_value'})
-            result['factor_id'] = factor_id
-            return result[['ts_code', 'trade_date', 'factor_id', 'factor_value']].dropna()
-        
-        return pd.DataFrame()
+        return factor_kernels.compute_panel_factor(data['history'], factor_id)
     
     def _pe_percentile_factor(self, data: Dict[str, pd.DataFrame], factor_id: str) -> pd.DataFrame:
         """PE历史分位数因子"""
@@ -565,143 +433,35 @@ class FactorEngine:
         if 'moneyflow' not in data or data['moneyflow'].empty:
             return pd.DataFrame()
         
-        df = data['moneyflow'].copy()
-        df['trade_date'] = pd.to_datetime(df['trade_date'])
-        
-        result_list = []
-        for ts_code in df['ts_code'].unique():
-            stock_data = df[df['ts_code'] == ts_code].sort_values('trade_date')
-            
-            # 计算大单净流入强度
-            stock_data['big_net_amount'] = (stock_data['buy_lg_amount'] + stock_data['buy_elg_amount']) - \
-                                         (stock_data['sell_lg_amount'] + stock_data['sell_elg_amount'])
-            
-            # 计算总成交额
-            stock_data['total_amount'] = (stock_data['buy_sm_amount'] + stock_data['buy_md_amount'] + 
-                                        stock_data['buy_lg_amount'] + stock_data['buy_elg_amount'])
-            
-            # 计算资金流向强度
-            stock_data['money_flow_strength'] = stock_data['big_net_amount'] / stock_data['total_amount']
-            
-            result_list.append(stock_data[['ts_code', 'trade_date', 'money_flow_strength']])
-        
-        if result_list:
-            result = pd.concat(result_list, ignore_index=True)
-            result = result.rename(columns={'money_flow_strength': 'factor_value'})
-            result['factor_id'] = factor_id
-            return result[['ts_code', 'trade_date', 'factor_id', 'factor_value']].dropna()
-        
-        return pd.DataFrame()
+        return factor_kernels.compute_panel_factor(data['moneyflow'], factor_id)
     
     def _big_order_ratio_factor(self, data: Dict[str, pd.DataFrame], factor_id: str) -> pd.DataFrame:
         """大单占比因子"""
         if 'moneyflow' not in data or data['moneyflow'].empty:
             return pd.DataFrame()
         
-        df = data['moneyflow'].copy()
-        df['trade_date'] = pd.to_datetime(df['trade_date'])
-        
-        result_list = []
-        for ts_code in df['ts_code'].unique():
-            stock_data = df[df['ts_code'] == ts_code].sort_values('trade_date')
-            
-            # 计算大单总额
-            stock_data['big_amount'] = stock_data['buy_lg_amount'] + stock_data['sell_lg_amount'] + \
-                                     stock_data['buy_elg_amount'] + stock_data['sell_elg_amount']
-            
-            # 计算总成交额
-            stock_data['total_amount'] = (stock_data['buy_sm_amount'] + stock_data['sell_sm_amount'] +
-                                        stock_data['buy_md_amount'] + stock_data['sell_md_amount'] +
-                                        stock_data['buy_lg_amount'] + stock_data['sell_lg_amount'] +
-                                        stock_data['buy_elg_amount'] + stock_data['sell_elg_amount'])
-            
-            # 计算大单占比
-            stock_data['big_order_ratio'] = stock_data['big_amount'] / stock_data['total_amount']
-            
-            result_list.append(stock_data[['ts_code', 'trade_date', 'big_order_ratio']])
-        
-        if result_list:
-            result = pd.concat(result_list, ignore_index=True)
-            result = result.rename(columns={'big_order_ratio': 'factor_value'})
-            result['factor_id'] = factor_id
-            return result[['ts_code', 'trade_date', 'factor_id', 'factor_value']].dropna()
-        
-        return pd.DataFrame()
+        return factor_kernels.compute_panel_factor(data['moneyflow'], factor_id)
     
     def _money_flow_momentum_factor(self, data: Dict[str, pd.DataFrame], factor_id: str) -> pd.DataFrame:
         """资金流向动量因子"""
         if 'moneyflow' not in data or data['moneyflow'].empty:
             return pd.DataFrame()
         
-        df = data['moneyflow'].copy()
-        df['trade_date'] = pd.to_datetime(df['trade_date'])
-        
-        result_list = []
-        for ts_code in df['ts_code'].unique():
-            stock_data = df[df['ts_code'] == ts_code].sort_values('trade_date')
-            
-            # 计算5日资金流向动量
-            stock_data['net_flow_5d'] = stock_data['net_mf_amount'].rolling(5).sum()
-            
-            result_list.append(stock_data[['ts_code', 'trade_date', 'net_flow_5d']])
-        
-        if result_list:
-            result = pd.concat(result_list, ignore_index=True)
-            result = result.rename(columns={'net_flow_5d': 'factor_value'})
-            result['factor_id'] = factor_id
-            return result[['ts_code', 'trade_date', 'factor_id', 'factor_value']].dropna()
-        
-        return pd.DataFrame()
+        return factor_kernels.compute_panel_factor(data['moneyflow'], factor_id)
     
     def _chip_concentration_factor(self, data: Dict[str, pd.DataFrame], factor_id: str) -> pd.DataFrame:
         """筹码集中度因子"""
         if 'cyq' not in data or data['cyq'].empty:
             return pd.DataFrame()
         
-        df = data['cyq'].copy()
-        df['trade_date'] = pd.to_datetime(df['trade_date'])
-        
-        result_list = []
-        for ts_code in df['ts_code'].unique():
-            stock_data = df[df['ts_code'] == ts_code].sort_values('trade_date')
-            
-            # 计算筹码集中度：90%筹码的价格区间相对中位数的比例
-            stock_data['chip_concentration'] = (stock_data['cost_95pct'] - stock_data['cost_5pct']) / stock_data['cost_50pct']
-            
-            result_list.append(stock_data[['ts_code', 'trade_date', 'chip_concentration']])
-        
-        if result_list:
-            result = pd.concat(result_list, ignore_index=True)
-            result = result.rename(columns={'chip_concentration': 'factor_value'})
-            result['factor_id'] = factor_id
-            return result[['ts_code', 'trade_date', 'factor_id', 'factor_value']].dropna()
-        
-        return pd.DataFrame()
+        return factor_kernels.compute_panel_factor(data['cyq'], factor_id)
     
     def _winner_rate_change_factor(self, data: Dict[str, pd.DataFrame], factor_id: str) -> pd.DataFrame:
         """胜率变化因子"""
         if 'cyq' not in data or data['cyq'].empty:
             return pd.DataFrame()
         
-        df = data['cyq'].copy()
-        df['trade_date'] = pd.to_datetime(df['trade_date'])
-        
-        result_list = []
-        for ts_code in df['ts_code'].unique():
-            stock_data = df[df['ts_code'] == ts_code].sort_values('trade_date')
-            
-            # 计算胜率5日变化
-            stock_data['winner_rate_change'] = stock_data['winner_rate'].diff(5)
-            
-            result_list.append(stock_data[['ts_code', 'trade_date', 'winner_rate_change']])
-        
-        if result_list:
-            result = pd.concat(result_list, ignore_index=True)
-            result = result.rename(columns={'winner_rate_change': 'factor_value'})
-            result['factor_id'] = factor_id
-            return result[['ts_code', 'trade_date', 'factor_id', 'factor_value']].dropna()
-        
-        return pd.DataFrame()
+        return factor_kernels.compute_panel_factor(data['cyq'], factor_id)
     
     def calculate_all_factors(self, trade_date: str, ts_codes: List[str] = None) -> pd.DataFrame:
         """计算所有因子的当日值"""
@@ -714,23 +474,30 @@ class FactorEngine:
             
             all_results = []
             
+            # 所有内置因子共享一次数据加载
+            shared_data = self.load_shared_data(list(self.builtin_factors.keys()),
+                                                ts_codes, trade_date, trade_date)
+            
             # 计算内置因子
             for factor_id in self.builtin_factors.keys():
                 try:
-                    result = self.calculate_factor(factor_id, ts_codes, trade_date, trade_date)
+                    result = self.calculate_factor(factor_id, ts_codes, trade_date, trade_date,
+                                                   data=shared_data)
                     if not result.empty:
                         all_results.append(result)
                 except Exception as e:
                     logger.error(f"计算内置因子失败: {factor_id}, 错误: {e}")
             
-            # 计算自定义因子
-            for factor_id in self.factor_definitions.keys():
+            # 计算自定义因子（与内置因子同名的定义以内置实现为准），所有公式共享子表达式
+            custom_ids = [factor_id for factor_id in self.factor_definitions
+                          if factor_id not in self.builtin_factors]
+            if custom_ids:
                 try:
-                    result = self.calculate_factor(factor_id, ts_codes, trade_date, trade_date)
+                    result = self._calculate_custom_factors(custom_ids, ts_codes, trade_date, trade_date)
                     if not result.empty:
                         all_results.append(result)
                 except Exception as e:
-                    logger.error(f"计算自定义因子失败: {factor_id}, 错误: {e}")
+                    logger.error(f"计算自定义因子失败: {e}")
             
             if all_results:
                 final_result = pd.concat(all_results, ignore_index=True)
@@ -777,44 +544,26 @@ class FactorEngine:
             logger.error(f"计算因子统计量失败: {e}")
             return df
     
-    def save_factor_values(self, df: pd.DataFrame) -> bool:
-        """保存因子值到数据库"""
+    def calculate_daily_factor_stats(self, df: pd.DataFrame) -> pd.DataFrame:
+        """按交易日分别计算截面百分位排名和Z分数（用于多日期结果）"""
+        if df.empty:
+            return df
+        
+        frames = [self._calculate_factor_stats(group, str(trade_date))
+                  for trade_date, group in df.groupby('trade_date')]
+        return pd.concat(frames, ignore_index=True)
+    
+    def save_factor_values(self, df: pd.DataFrame, batch_size: int = None) -> bool:
+        """保存因子值到数据库（集合化 upsert，按批次写入）"""
         try:
             if df.empty:
                 return True
             
-            # 删除已存在的数据
-            trade_dates = df['trade_date'].unique()
-            factor_ids = df['factor_id'].unique()
-            
-            for trade_date in trade_dates:
-                for factor_id in factor_ids:
-                    FactorValues.query.filter_by(
-                        trade_date=trade_date,
-                        factor_id=factor_id
-                    ).delete()
-            
-            # 批量插入新数据
-            records = []
-            for _, row in df.iterrows():
-                record = FactorValues(
-                    ts_code=row['ts_code'],
-                    trade_date=row['trade_date'],
-                    factor_id=row['factor_id'],
-                    factor_value=row['factor_value'],
-                    percentile_rank=row.get('percentile_rank'),
-                    z_score=row.get('z_score')
-                )
-                records.append(record)
-            
-            db.session.bulk_save_objects(records)
-            db.session.commit()
-            
-            logger.info(f"成功保存 {len(records)} 条因子值记录")
+            stats = self.value_writer.write(df, batch_size=batch_size)
+            logger.info(f"成功保存 {stats['rows']} 条因子值记录")
             return True
             
         except Exception as e:
-            db.session.rollback()
             logger.error(f"保存因子值失败: {e}")
             return False
     
@@ -834,11 +583,49 @@ class FactorEngine:
             return pd.DataFrame()
     
     def _calculate_custom_factor(self, factor_id: str, ts_codes: List[str], 
-                                start_date: str, end_date: str) -> pd.DataFrame:
-        """计算自定义因子（待实现）"""
-        # TODO: 实现自定义因子公式解析和计算
-        logger.warning(f"自定义因子计算功能待实现: {factor_id}")
-        return pd.DataFrame()
+                                start_date: str, end_date: str,
+                                data: Dict[str, pd.DataFrame] = None) -> pd.DataFrame:
+        """计算自定义因子"""
+        return self._calculate_custom_factors([factor_id], ts_codes, start_date, end_date, data)
+    
+    def _calculate_custom_factors(self, factor_ids: List[str], ts_codes: List[str],
+                                  start_date: str, end_date: str,
+                                  data: Dict[str, pd.DataFrame] = None) -> pd.DataFrame:
+        """批量计算自定义公式因子
+        
+        公式编译为表达式 DAG 后在同一面板上下文中求值，多个因子间的公共子表达式只计算一次。
+        """
+        compiled = {}
+        for factor_id in factor_ids:
+            definition = self.factor_definitions[factor_id]
+            try:
+                compiled[factor_id] = compile_formula(definition.factor_formula, definition.params)
+            except FormulaError as e:
+                logger.warning(f"跳过无法编译的自定义因子: {factor_id}, 公式: {definition.factor_formula}, 错误: {e}")
+        if not compiled:
+            return pd.DataFrame()
+        
+        sources = {factor_id: formula.sources for factor_id, formula in compiled.items()}
+        needed = sorted({source for factor_sources in sources.values() for source in factor_sources})
+        # 按最长窗口估算自然日回看天数，共享数据的加载起点晚于所需起点时重新加载该数据源
+        window = max(formula.window for formula in compiled.values())
+        lookback_days = window * 7 // 5 + 20
+        required_start = (datetime.strptime(start_date, '%Y-%m-%d') -
+                          timedelta(days=lookback_days)).strftime('%Y-%m-%d')
+        reload = set(stale_sources(data, needed, required_start))
+        if reload:
+            overrides = {factor_id: [source for source in factor_sources if source in reload]
+                         for factor_id, factor_sources in sources.items()}
+            overrides = {factor_id: factor_sources for factor_id, factor_sources in overrides.items() if factor_sources}
+            plan = FactorLoadPlan(list(overrides), start_date, end_date,
+                                  lookback_days=lookback_days, source_overrides=overrides)
+            data = dict(data or {}, **plan.execute(ts_codes))
+            self.last_load_stats = plan.get_stats()
+        
+        result, stats = evaluate_formulas(compiled, data, start_date, end_date)
+        logger.info(f"自定义因子计算完成: {len(compiled)} 个因子, 求值节点 {stats.get('nodes_evaluated', 0)} 个, "
+                    f"复用 {stats.get('cache_hits', 0)} 次")
+        return result
     
     def get_factor_list(self, factor_type: str = None, is_active: bool = True) -> List[Dict[str, Any]]:
         """获取因子列表"""
@@ -0,0 +1,536 @@
+"""
+自定义因子公式编译器
+将 FactorDefinition.factor_formula 解析为表达式 DAG（相同子表达式以规范化文本为键），
+在 日期 × 股票 的 NumPy 面板上向量化求值。编译结果按公式哈希缓存，
+同一批次内的多个因子共享子表达式的计算结果。
+
+支持的语法：
+  - 字段：日线行情（open/high/low/close/vol/amount/pct_chg 等）、每日指标
+    （turnover_rate/pe_ttm/pb/total_mv 等）、资金流向（net_mf_amount/buy_lg_amount 等），
+    以及派生字段 returns、vwap
+  - 运算：+ - * / **、比较运算、a if cond else b
+  - Alpha101 风格算子：rank、scale、delay、delta、ts_sum、ts_mean、ts_std、ts_min、ts_max、
+    ts_argmax、ts_argmin、ts_rank、ts_product、decay_linear、correlation、covariance、
+    abs、log、sign、sqrt、signedpower、maximum、minimum、where、rsi
+  - 兼容已有定义中的 pandas 写法：x.pct_change(d)、x.shift(d)、x.diff(d)、
+    x.rolling(d).mean()/std()/sum()/max()/min()
+"""
+
+import ast
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from typing import Dict, List, Tuple, Any
+from numpy.lib.stride_tricks import sliding_window_view
+
+from app.services import factor_kernels
+
+
+class FormulaError(ValueError):
+    """公式解析或编译错误"""
+
+
+# ==================== 字段定义 ====================
+
+FIELD_SOURCES: Dict[str, str] = {}
+for _field in ['buy_sm_vol', 'buy_sm_amount', 'sell_sm_vol', 'sell_sm_amount',
+               'buy_md_vol', 'buy_md_amount', 'sell_md_vol', 'sell_md_amount',
+               'buy_lg_vol', 'buy_lg_amount', 'sell_lg_vol', 'sell_lg_amount',
+               'buy_elg_vol', 'buy_elg_amount', 'sell_elg_vol', 'sell_elg_amount',
+               'net_mf_vol', 'net_mf_amount']:
+    FIELD_SOURCES[_field] = 'moneyflow'
+for _field in ['turnover_rate', 'turnover_rate_f', 'volume_ratio', 'pe', 'pe_ttm', 'pb',
+               'ps', 'ps_ttm', 'dv_ratio', 'dv_ttm', 'total_share', 'float_share',
+               'free_share', 'total_mv', 'circ_mv']:
+    FIELD_SOURCES[_field] = 'basic'
+for _field in ['open', 'high', 'low', 'close', 'pre_close', 'change', 'pct_chg', 'vol', 'amount']:
+    FIELD_SOURCES[_field] = 'history'
+
+# 派生字段（成交额单位千元、成交量单位手）
+DERIVED_FIELDS = {
+    'returns': 'close / delay(close, 1) - 1',
+    'vwap': 'amount * 10 / vol',
+}
+
+# 算子签名：x 为面板表达式，d 为整数窗口常量
+OPERATOR_SIGNATURES = {
+    'rank': 'x', 'scale': 'x', 'abs': 'x', 'log': 'x', 'sign': 'x', 'sqrt': 'x',
+    'delay': 'xd', 'delta': 'xd', 'ts_sum': 'xd', 'ts_mean': 'xd', 'ts_std': 'xd',
+    'ts_min': 'xd', 'ts_max': 'xd', 'ts_argmax': 'xd', 'ts_argmin': 'xd',
+    'ts_rank': 'xd', 'ts_product': 'xd', 'decay_linear': 'xd', 'rsi': 'xd',
+    'correlation': 'xxd', 'covariance': 'xxd',
+    'signedpower': 'xx', 'maximum': 'xx', 'minimum': 'xx', 'where': 'xxx',
+}
+
+OPERATOR_ALIASES = {
+    'corr': 'correlation', 'cov': 'covariance', 'sma': 'ts_mean', 'mean': 'ts_mean',
+    'stddev': 'ts_std', 'std': 'ts_std', 'sum': 'ts_sum', 'product': 'ts_product',
+    'max': 'maximum', 'min': 'minimum', 'ts_corr': 'correlation', 'ts_cov': 'covariance',
+}
+
+# 时序算子需要的额外历史行数
+def _op_lookback(op: str, d: int) -> int:
+    if op in ('delay', 'delta'):
+        return d
+    return d - 1
+
+
+BINARY_OPERATORS = {
+    ast.Add: 'add', ast.Sub: 'sub', ast.Mult: 'mul', ast.Div: 'div', ast.Pow: 'pow',
+}
+COMPARE_OPERATORS = {
+    ast.Gt: 'gt', ast.GtE: 'ge', ast.Lt: 'lt', ast.LtE: 'le', ast.Eq: 'eq', ast.NotEq: 'ne',
+}
+ROLLING_METHODS = {'mean': 'ts_mean', 'std': 'ts_std', 'sum': 'ts_sum', 'max': 'ts_max', 'min': 'ts_min'}
+
+
+# ==================== 表达式节点 ====================
+
+class Node:
+    """表达式 DAG 节点，key 为规范化的子表达式文本，跨公式按 key 共享求值结果"""
+    __slots__ = ('key', 'op', 'args', 'window', 'fields')
+
+    def __init__(self, key: str, op: str, args: tuple, window: int, fields: frozenset):
+        self.key = key
+        self.op = op
+        self.args = args
+        self.window = window
+        self.fields = fields
+
+    def __repr__(self):
+        return f'<Node {self.key}>'
+
+
+def _make_node(table: Dict[str, Node], op: str, args: tuple) -> Node:
+    """在节点表中创建或复用节点；args 为子节点或整数窗口常量"""
+    parts = [arg.key if isinstance(arg, Node) else repr(arg) for arg in args]
+    key = f"{op}({','.join(parts)})"
+    node = table.get(key)
+    if node is not None:
+        return node
+
+    children = [arg for arg in args if isinstance(arg, Node)]
+    window = max((child.window for child in children), default=0)
+    windows = [arg for arg in args if isinstance(arg, int)]
+    if windows:
+        window += _op_lookback(op, windows[0])
+    fields = frozenset().union(*(child.fields for child in children)) if children else frozenset()
+    if op == 'field':
+        fields = frozenset([args[0]])
+
+    node = Node(key, op, args, window, fields)
+    table[key] = node
+    return node
+
+
+# ==================== 解析 ====================
+
+class _FormulaParser:
+    """基于 Python AST 的安全公式解析器"""
+
+    def __init__(self, params: Dict[str, Any]):
+        self.params = params or {}
+        # 本次编译的节点表，同一公式内的相同子表达式复用同一节点
+        self.nodes: Dict[str, Node] = {}
+
+    def _node(self, op: str, args: tuple) -> Node:
+        return _make_node(self.nodes, op, args)
+
+    def _field(self, name: str) -> Node:
+        return self._node('field', (name,))
+
+    def _const(self, value: float) -> Node:
+        return self._node('const', (float(value),))
+
+    def parse(self, formula: str) -> Node:
+        try:
+            tree = ast.parse(formula.strip(), mode='eval')
+        except SyntaxError as e:
+            raise FormulaError(f"公式语法错误: {e.msg}")
+        return self.visit(tree.body)
+
+    def visit(self, node) -> Node:
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) \
+                and not isinstance(node.value, bool):
+            return self._const(node.value)
+
+        if isinstance(node, ast.Name):
+            return self._name(node.id)
+
+        if isinstance(node, ast.BinOp) and type(node.op) in BINARY_OPERATORS:
+            return self._node(BINARY_OPERATORS[type(node.op)], (self.visit(node.left), self.visit(node.right)))
+
+        if isinstance(node, ast.UnaryOp):
+            if isinstance(node.op, ast.USub):
+                return self._node('neg', (self.visit(node.operand),))
+            if isinstance(node.op, ast.UAdd):
+                return self.visit(node.operand)
+
+        if isinstance(node, ast.Compare) and len(node.ops) == 1 and type(node.ops[0]) in COMPARE_OPERATORS:
+            return self._node(COMPARE_OPERATORS[type(node.ops[0])],
+                              (self.visit(node.left), self.visit(node.comparators[0])))
+
+        if isinstance(node, ast.IfExp):
+            return self._node('where', (self.visit(node.test), self.visit(node.body), self.visit(node.orelse)))
+
+        if isinstance(node, ast.Call):
+            if isinstance(node.func, ast.Name):
+                return self._call(node.func.id.lower(), node.args)
+            if isinstance(node.func, ast.Attribute):
+                return self._method(node.func, node.args)
+
+        raise FormulaError(f"不支持的表达式: {ast.dump(node)[:80]}")
+
+    def _name(self, name: str) -> Node:
+        if name in self.params and isinstance(self.params[name], (int, float)):
+            return self._const(self.params[name])
+        if name in FIELD_SOURCES:
+            return self._field(name)
+        if name in DERIVED_FIELDS:
+            return self.parse(DERIVED_FIELDS[name])
+        raise FormulaError(f"未知字段: {name}")
+
+    def _window(self, node) -> int:
+        """解析整数窗口参数（字面量或 params 中的整数）"""
+        value = None
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+            value = node.value
+        elif isinstance(node, ast.Name) and isinstance(self.params.get(node.id), (int, float)):
+            value = self.params[node.id]
+        if value is None or int(value) != value or int(value) < 1:
+            raise FormulaError("窗口参数必须是正整数")
+        return int(value)
+
+    def _call(self, name: str, args: list) -> Node:
+        name = OPERATOR_ALIASES.get(name, name)
+        signature = OPERATOR_SIGNATURES.get(name)
+        if signature is None:
+            raise FormulaError(f"未知算子: {name}")
+        if len(args) != len(signature):
+            raise FormulaError(f"算子 {name} 需要 {len(signature)} 个参数")
+
+        parsed = tuple(self.visit(arg) if kind == 'x' else self._window(arg)
+                       for kind, arg in zip(signature, args))
+
+        if name == 'rsi':
+            # RSI = 平均涨幅 / (平均涨幅 + 平均跌幅) * 100，子表达式在 DAG 中共享
+            x, d = parsed
+            change = self._node('delta', (x, 1))
+            zero = self._const(0)
+            up = self._node('ts_mean', (self._node('maximum', (change, zero)), d))
+            down = self._node('ts_mean', (self._node('maximum', (self._node('neg', (change,)), zero)), d))
+            return self._node('mul', (self._const(100), self._node('div', (up, self._node('add', (up, down))))))
+
+        return self._node(name, parsed)
+
+    def _method(self, func: ast.Attribute, args: list) -> Node:
+        """兼容 pandas 链式写法"""
+        method = func.attr
+        target = func.value
+
+        if method in ROLLING_METHODS and isinstance(target, ast.Call) \
+                and isinstance(target.func, ast.Attribute) and target.func.attr == 'rolling':
+            if len(target.args) != 1 or args:
+                raise FormulaError("rolling 写法仅支持 x.rolling(d).mean() 等形式")
+            return self._node(ROLLING_METHODS[method],
+                              (self.visit(target.func.value), self._window(target.args[0])))
+
+        x = self.visit(target)
+        d = self._window(args[0]) if args else 1
+        if method == 'pct_change':
+            return self._node('sub', (self._node('div', (x, self._node('delay', (x, d)))), self._const(1)))
+        if method == 'shift':
+            return self._node('delay', (x, d))
+        if method == 'diff':
+            return self._node('delta', (x, d))
+        if method == 'abs' and not args:
+            return self._node('abs', (x,))
+        raise FormulaError(f"不支持的方法: {method}")
+
+
+# ==================== 编译缓存 ====================
+
+class CompiledFormula:
+    """编译后的因子公式"""
+
+    def __init__(self, formula: str, params: Dict[str, Any], root: Node, key: str):
+        self.formula = formula
+        self.params = params
+        self.root = root
+        self.key = key
+        self.fields = sorted(root.fields)
+        self.sources = sorted({FIELD_SOURCES[field] for field in root.fields})
+        # 计算最新一个交易日所需的交易日数（含当日）
+        self.window = root.window + 1
+
+    def __repr__(self):
+        return f'<CompiledFormula {self.formula} window={self.window}>'
+
+
+# 编译缓存按最近使用淘汰，注册校验时提交的公式不会让缓存无限增长
+MAX_CACHED_PLANS = 1024
+_PLAN_CACHE: 'OrderedDict[str, CompiledFormula]' = OrderedDict()
+_PLAN_LOCK = threading.Lock()
+
+
+def formula_hash(formula: str, params: Dict[str, Any] = None) -> str:
+    """公式及数值参数的哈希，作为编译缓存键"""
+    numeric = {k: v for k, v in (params or {}).items() if isinstance(v, (int, float))}
+    payload = formula.strip() + '|' + json.dumps(numeric, sort_keys=True)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def compile_formula(formula: str, params: Dict[str, Any] = None) -> CompiledFormula:
+    """编译公式，结果按哈希缓存"""
+    if not formula or not formula.strip():
+        raise FormulaError("公式为空")
+
+    key = formula_hash(formula, params)
+    with _PLAN_LOCK:
+        compiled = _PLAN_CACHE.get(key)
+        if compiled is not None:
+            _PLAN_CACHE.move_to_end(key)
+    if compiled is not None:
+        return compiled
+
+    root = _FormulaParser(params or {}).parse(formula)
+    if not root.fields:
+        raise FormulaError("公式没有引用任何字段")
+
+    compiled = CompiledFormula(formula, params or {}, root, key)
+    with _PLAN_LOCK:
+        _PLAN_CACHE[key] = compiled
+        while len(_PLAN_CACHE) > MAX_CACHED_PLANS:
+            _PLAN_CACHE.popitem(last=False)
+    return compiled
+
+
+# ==================== 面板算子 ====================
+
+def _rolling_sum(x: np.ndarray, d: int) -> np.ndarray:
+    """基于累加和的滚动求和，窗口内含 NaN 时结果为 NaN"""
+    out = np.full_like(x, np.nan)
+    if x.shape[0] < d:
+        return out
+    isnan = np.isnan(x)
+    zeros = np.zeros((1, x.shape[1]))
+    sums = np.vstack([zeros, np.cumsum(np.where(isnan, 0.0, x), axis=0)])
+    nans = np.vstack([zeros, np.cumsum(isnan, axis=0)])
+    window_sum = sums[d:] - sums[:-d]
+    window_sum[(nans[d:] - nans[:-d]) > 0] = np.nan
+    out[d - 1:] = window_sum
+    return out
+
+
+def _rolling_window(x: np.ndarray, d: int, func) -> np.ndarray:
+    """在滑动窗口视图上逐窗口归约，窗口内含 NaN 时结果为 NaN"""
+    out = np.full_like(x, np.nan)
+    if x.shape[0] < d:
+        return out
+    windows = sliding_window_view(x, d, axis=0)
+    with np.errstate(invalid='ignore'):
+        values = func(windows).astype('float64')
+    values[np.isnan(windows).any(axis=-1)] = np.nan
+    out[d - 1:] = values
+    return out
+
+
+def _delay(x: np.ndarray, d: int) -> np.ndarray:
+    out = np.full_like(x, np.nan)
+    if d < x.shape[0]:
+        out[d:] = x[:-d]
+    return out
+
+
+def _demean(x: np.ndarray) -> np.ndarray:
+    """按列去均值，减小累加和计算方差时的数值误差"""
+    with np.errstate(invalid='ignore'):
+        means = np.nanmean(np.where(np.isnan(x), np.nan, x), axis=0) if x.size else 0.0
+    return x - np.nan_to_num(means)
+
+
+def _ts_std(x: np.ndarray, d: int) -> np.ndarray:
+    if d < 2:
+        return np.full_like(x, np.nan)
+    x = _demean(x)
+    s = _rolling_sum(x, d)
+    ss = _rolling_sum(x * x, d)
+    var = np.maximum((ss - s * s / d) / (d - 1), 0.0)
+    return np.sqrt(var)
+
+
+def _covariance(x: np.ndarray, y: np.ndarray, d: int, normalize: bool) -> np.ndarray:
+    if d < 2:
+        return np.full_like(x, np.nan)
+    invalid = np.isnan(x) | np.isnan(y)
+    x = np.where(invalid, np.nan, _demean(x))
+    y = np.where(invalid, np.nan, _demean(y))
+    sx, sy = _rolling_sum(x, d), _rolling_sum(y, d)
+    cov = (_rolling_sum(x * y, d) - sx * sy / d) / (d - 1)
+    if not normalize:
+        return cov
+    var_x = (_rolling_sum(x * x, d) - sx * sx / d) / (d - 1)
+    var_y = (_rolling_sum(y * y, d) - sy * sy / d) / (d - 1)
+    denom = np.sqrt(np.maximum(var_x, 0.0) * np.maximum(var_y, 0.0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        corr = np.where(denom > 1e-12, cov / denom, np.nan)
+    return np.clip(corr, -1.0, 1.0)
+
+
+def _ts_rank(windows: np.ndarray) -> np.ndarray:
+    last = windows[..., -1:]
+    less = (windows < last).sum(axis=-1)
+    equal = (windows == last).sum(axis=-1)
+    return (less + (equal + 1) / 2.0) / windows.shape[-1]
+
+
+def _decay_linear(x: np.ndarray, d: int) -> np.ndarray:
+    weights = np.arange(1, d + 1, dtype='float64')
+    weights /= weights.sum()
+    return _rolling_window(x, d, lambda w: w @ weights)
+
+
+def _cross_rank(x: np.ndarray) -> np.ndarray:
+    return pd.DataFrame(x).rank(axis=1, pct=True).to_numpy(dtype='float64')
+
+
+def _scale(x: np.ndarray) -> np.ndarray:
+    total = np.nansum(np.abs(x), axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(total > 0, x / total, np.nan)
+
+
+def _bool(x: np.ndarray) -> np.ndarray:
+    return x.astype('float64')
+
+
+PANEL_FUNCTIONS = {
+    'add': lambda a, b: a + b,
+    'sub': lambda a, b: a - b,
+    'mul': lambda a, b: a * b,
+    'div': lambda a, b: np.where(b != 0, a / np.where(b != 0, b, 1.0), np.nan),
+    'pow': lambda a, b: np.power(a, b),
+    'neg': lambda a: -a,
+    'gt': lambda a, b: np.where(np.isnan(a) | np.isnan(b), np.nan, _bool(a > b)),
+    'ge': lambda a, b: np.where(np.isnan(a) | np.isnan(b), np.nan, _bool(a >= b)),
+    'lt': lambda a, b: np.where(np.isnan(a) | np.isnan(b), np.nan, _bool(a < b)),
+    'le': lambda a, b: np.where(np.isnan(a) | np.isnan(b), np.nan, _bool(a <= b)),
+    'eq': lambda a, b: np.where(np.isnan(a) | np.isnan(b), np.nan, _bool(a == b)),
+    'ne': lambda a, b: np.where(np.isnan(a) | np.isnan(b), np.nan, _bool(a != b)),
+    'where': lambda c, a, b: np.where(np.isnan(c), np.nan, np.where(c > 0, a, b)),
+    'abs': np.abs,
+    'log': lambda a: np.log(np.where(a > 0, a, np.nan)),
+    'sign': np.sign,
+    'sqrt': lambda a: np.sqrt(np.where(a >= 0, a, np.nan)),
+    'signedpower': lambda a, b: np.sign(a) * np.power(np.abs(a), b),
+    'maximum': np.maximum,
+    'minimum': np.minimum,
+    'rank': _cross_rank,
+    'scale': _scale,
+    'delay': _delay,
+    'delta': lambda x, d: x - _delay(x, d),
+    'ts_sum': _rolling_sum,
+    'ts_mean': lambda x, d: _rolling_sum(x, d) / d,
+    'ts_std': _ts_std,
+    'ts_min': lambda x, d: _rolling_window(x, d, lambda w: w.min(axis=-1)),
+    'ts_max': lambda x, d: _rolling_window(x, d, lambda w: w.max(axis=-1)),
+    # 窗口内最大/最小值所在位置，1 为最早一天、d 为当天
+    'ts_argmax': lambda x, d: _rolling_window(x, d, lambda w: w.argmax(axis=-1) + 1),
+    'ts_argmin': lambda x, d: _rolling_window(x, d, lambda w: w.argmin(axis=-1) + 1),
+    'ts_rank': lambda x, d: _rolling_window(x, d, _ts_rank),
+    'ts_product': lambda x, d: _rolling_window(x, d, lambda w: w.prod(axis=-1)),
+    'decay_linear': _decay_linear,
+    'correlation': lambda x, y, d: _covariance(x, y, d, normalize=True),
+    'covariance': lambda x, y, d: _covariance(x, y, d, normalize=False),
+}
+
+
+# ==================== 求值 ====================
+
+class FormulaContext:
+    """一次批量求值的面板上下文，缓存所有已计算节点的结果以共享公共子表达式"""
+
+    def __init__(self, data: Dict[str, pd.DataFrame], fields: List[str]):
+        panels = {}
+        for field in fields:
+            source = data.get(FIELD_SOURCES[field])
+            if source is None or source.empty or field not in source.columns:
+                raise FormulaError(f"缺少字段数据: {field}")
+            panels[field] = factor_kernels.build_panel(source, field)
+
+        index = pd.DatetimeIndex([])
+        columns = pd.Index([])
+        for panel in panels.values():
+            index = index.union(panel.index)
+            columns = columns.union(panel.columns)
+
+        self.index = index
+        self.columns = columns
+        self.shape = (len(index), len(columns))
+        self.fields = {}
+        for field, panel in panels.items():
+            aligned = panel.reindex(index=index, columns=columns)
+            if field in factor_kernels.PRICE_FIELDS:
+                aligned = aligned.ffill()
+            self.fields[field] = aligned.to_numpy(dtype='float64')
+
+        # 以日线行情（没有时取第一个数据源）的实际存在单元作为输出掩码
+        mask_source = 'history' if 'history' in {FIELD_SOURCES[f] for f in fields} \
+            else FIELD_SOURCES[fields[0]]
+        self.mask = factor_kernels.observed_mask(data[mask_source],
+                                                 pd.DataFrame(index=index, columns=columns))
+        self.cache: Dict[str, np.ndarray] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def evaluate(self, node: Node) -> np.ndarray:
+        cached = self.cache.get(node.key)
+        if cached is not None:
+            self.hits += 1
+            return cached
+        self.misses += 1
+
+        if node.op == 'field':
+            value = self.fields[node.args[0]]
+        elif node.op == 'const':
+            value = np.full(self.shape, node.args[0])
+        else:
+            args = [self.evaluate(arg) if isinstance(arg, Node) else arg for arg in node.args]
+            with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+                value = PANEL_FUNCTIONS[node.op](*args)
+
+        self.cache[node.key] = value
+        return value
+
+    def to_frame(self, node: Node, factor_id: str, start_date: str = None,
+                 end_date: str = None) -> pd.DataFrame:
+        """求值并转换为因子长表，可按日期区间裁剪"""
+        panel = pd.DataFrame(self.evaluate(node), index=self.index, columns=self.columns)
+        if start_date:
+            panel = panel[panel.index >= pd.Timestamp(start_date)]
+        if end_date:
+            panel = panel[panel.index <= pd.Timestamp(end_date)]
+        mask = self.mask.reindex(index=panel.index)
+        return factor_kernels.panel_to_frame(panel, factor_id, mask)
+
+
+def evaluate_formulas(compiled: Dict[str, CompiledFormula], data: Dict[str, pd.DataFrame],
+                      start_date: str = None, end_date: str = None) -> Tuple[pd.DataFrame, Dict[str, int]]:
+    """在同一上下文中批量计算多个公式因子，返回因子长表和子表达式缓存统计"""
+    if not compiled:
+        return pd.DataFrame(), {}
+
+    fields = sorted({field for formula in compiled.values() for field in formula.fields})
+    context = FormulaContext(data, fields)
+
+    frames = [context.to_frame(formula.root, factor_id, start_date, end_date)
+              for factor_id, formula in compiled.items()]
+    frames = [frame for frame in frames if not frame.empty]
+    stats = {'nodes_evaluated': context.misses, 'cache_hits': context.hits}
+
+    if not frames:
+        return pd.DataFrame(), stats
+    return pd.concat(frames, ignore_index=True), stats
@@ -0,0 +1,314 @@
+"""
+因子增量计算
+为每个面板因子维护"最近已计算交易日"水位，并在内存中保留各数据源最近 N 个交易日的
+尾部面板作为滚动状态。新交易日到达时只读取水位之后的新行，拼接到尾部面板上计算，
+不再回读完整的 252 天历史窗口。水位之前的缺口由 backfill 补齐。
+
+尾部按每只股票自身的交易行保留最近 N 行，并记录实际存在的单元，
+停牌股票复牌后的窗口与全量计算一致。
+"""
+
+import os
+import pickle
+import pandas as pd
+from typing import List, Dict, Any, Optional, Tuple
+from datetime import date
+from loguru import logger
+from sqlalchemy import func
+
+from app.extensions import db
+from app.models import FactorValues, FactorWatermark, StockDailyHistory
+from app.services import factor_kernels
+from app.services.factor_kernels import FACTOR_COLUMNS, panel_spec
+from app.services.factor_load_plan import SOURCE_SPECS
+
+
+# 冷启动时最多向前查找的交易日数，停牌超过该长度的股票按新上市处理
+SEED_LOOKBACK_DAYS = 252
+
+
+def _trim_tail(panels: Dict[str, pd.DataFrame], observed: pd.DataFrame,
+               window: int) -> Tuple[Dict[str, pd.DataFrame], pd.DataFrame]:
+    """只保留每只股票最近 window 个实际存在的交易行"""
+    remaining = observed.iloc[::-1].cumsum().iloc[::-1]
+    keep = (observed & (remaining <= window)).any(axis=1).to_numpy()
+    return {field: panel[keep] for field, panel in panels.items()}, observed[keep]
+
+
+class IncrementalFactorEngine:
+    """因子增量计算引擎"""
+
+    def __init__(self, factor_engine=None, state_path: str = None):
+        if factor_engine is None:
+            from app.services.factor_engine import FactorEngine
+            factor_engine = FactorEngine()
+        self.factor_engine = factor_engine
+        self.state_path = state_path
+        # 数据源 -> {'last_date', 'ts_codes', 'panels': {字段: 尾部面板}, 'observed': 实际存在单元}
+        self.states: Dict[str, Dict[str, Any]] = {}
+        self.load_state()
+
+    # ==================== 水位 ====================
+
+    def incremental_factor_ids(self) -> List[str]:
+        """支持增量计算的内置因子"""
+        return [factor_id for factor_id in self.factor_engine.builtin_factors
+                if panel_spec(factor_id) is not None]
+
+    def get_watermarks(self, factor_ids: List[str]) -> Dict[str, Optional[date]]:
+        """获取因子水位，水位表中没有记录时使用已保存因子值的最大日期"""
+        marks = {factor_id: None for factor_id in factor_ids}
+        try:
+            for row in FactorWatermark.query.filter(FactorWatermark.factor_id.in_(factor_ids)).all():
+                marks[row.factor_id] = row.last_trade_date
+        except Exception as e:
+            logger.warning(f"读取因子水位表失败，改用因子值表推断: {e}")
+            db.session.rollback()
+
+        missing = [factor_id for factor_id, mark in marks.items() if mark is None]
+        if missing:
+            rows = db.session.query(
+                FactorValues.factor_id, func.max(FactorValues.trade_date)
+            ).filter(FactorValues.factor_id.in_(missing)).group_by(FactorValues.factor_id).all()
+            for factor_id, last_date in rows:
+                marks[factor_id] = last_date
+
+        return marks
+
+    def set_watermarks(self, marks: Dict[str, date]):
+        """推进因子水位（只前进不后退）"""
+        try:
+            for factor_id, last_date in marks.items():
+                row = FactorWatermark.query.get(factor_id)
+                if row is None:
+                    db.session.add(FactorWatermark(factor_id=factor_id, last_trade_date=last_date))
+                elif row.last_trade_date is None or row.last_trade_date < last_date:
+                    row.last_trade_date = last_date
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"更新因子水位失败: {e}")
+
+    # ==================== 滚动状态 ====================
+
+    def load_state(self):
+        """从快照文件恢复滚动状态"""
+        if not self.state_path or not os.path.exists(self.state_path):
+            return
+        try:
+            with open(self.state_path, 'rb') as f:
+                self.states = pickle.load(f)
+            logger.info(f"恢复因子增量状态: {list(self.states.keys())}")
+        except Exception as e:
+            logger.warning(f"恢复因子增量状态失败，将从数据库重建: {e}")
+            self.states = {}
+
+    def save_state(self):
+        """将滚动状态写入快照文件"""
+        if not self.state_path:
+            return
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.state_path)), exist_ok=True)
+            with open(self.state_path, 'wb') as f:
+                pickle.dump(self.states, f)
+        except Exception as e:
+            logger.error(f"保存因子增量状态失败: {e}")
+
+    def _source_query(self, source: str, ts_codes: Optional[List[str]]):
+        model = SOURCE_SPECS[source][0]
+        query = model.query
+        if ts_codes:
+            query = query.filter(model.ts_code.in_(ts_codes))
+        return model, query
+
+    def _load_rows(self, source: str, ts_codes: Optional[List[str]],
+                   after_date: date, end_date: date) -> pd.DataFrame:
+        """读取 (after_date, end_date] 区间内的新行"""
+        model, query = self._source_query(source, ts_codes)
+        query = query.filter(model.trade_date > after_date, model.trade_date <= end_date)
+        return pd.read_sql(query.statement, db.engine)
+
+    def _seed_panels(self, source: str, fields: List[str], window: int, last_date: date,
+                     ts_codes: Optional[List[str]]) -> Tuple[Dict[str, pd.DataFrame], Optional[pd.DataFrame]]:
+        """从数据库重建截至 last_date 的尾部面板：每只股票取最近 window 个交易行"""
+        model, _ = self._source_query(source, None)
+        dates = [row[0] for row in db.session.query(model.trade_date).filter(
+            model.trade_date <= last_date
+        ).distinct().order_by(model.trade_date.desc()).limit(max(window, SEED_LOOKBACK_DAYS)).all()]
+        if not dates:
+            return {}, None
+
+        rn = func.row_number().over(partition_by=model.ts_code, order_by=model.trade_date.desc()).label('rn')
+        query = db.session.query(model.ts_code, model.trade_date,
+                                 *[getattr(model, field) for field in fields], rn).filter(
+            model.trade_date >= min(dates), model.trade_date <= last_date
+        )
+        if ts_codes:
+            query = query.filter(model.ts_code.in_(ts_codes))
+        ranked = query.subquery()
+        df = pd.read_sql(db.session.query(ranked).filter(ranked.c.rn <= window).statement, db.engine)
+        if df.empty:
+            return {}, None
+        panels = {field: factor_kernels.build_panel(df, field, ffill=False) for field in fields}
+        return panels, factor_kernels.observed_mask(df, panels[fields[0]])
+
+    def _previous_trade_date(self, source: str, end_date: date) -> Optional[date]:
+        model = SOURCE_SPECS[source][0]
+        return db.session.query(func.max(model.trade_date)).filter(model.trade_date < end_date).scalar()
+
+    # ==================== 增量计算 ====================
+
+    def update(self, trade_date: str = None, ts_codes: List[str] = None, save: bool = True) -> pd.DataFrame:
+        """计算各因子水位之后到 trade_date（默认最新交易日）的新因子值"""
+        factor_ids = self.incremental_factor_ids()
+        marks = self.get_watermarks(factor_ids)
+
+        groups: Dict[str, List[str]] = {}
+        for factor_id in factor_ids:
+            groups.setdefault(panel_spec(factor_id).source, []).append(factor_id)
+
+        results = []
+        new_marks = {}
+        for source, source_factors in groups.items():
+            model = SOURCE_SPECS[source][0]
+            end_date = pd.to_datetime(trade_date).date() if trade_date else \
+                db.session.query(func.max(model.trade_date)).scalar()
+            if end_date is None:
+                continue
+
+            # 没有水位的因子只计算最新交易日，更早的日期交给 backfill
+            default_mark = self._previous_trade_date(source, end_date)
+            source_marks = {f: marks[f] or default_mark for f in source_factors}
+            if any(mark is None for mark in source_marks.values()):
+                continue
+            base_date = min(source_marks.values())
+            if base_date >= end_date:
+                continue
+
+            specs = {f: panel_spec(f) for f in source_factors}
+            fields = sorted({field for spec in specs.values() for field in spec.fields})
+            window = max(spec.window for spec in specs.values())
+
+            new_rows = self._load_rows(source, ts_codes, base_date, end_date)
+            if new_rows.empty:
+                continue
+
+            state = self.states.get(source)
+            codes_key = frozenset(ts_codes) if ts_codes else None
+            if state and state['last_date'] == base_date and state['ts_codes'] == codes_key \
+                    and set(fields) <= set(state['panels']) and 'observed' in state:
+                tail, tail_observed = state['panels'], state['observed']
+            else:
+                tail, tail_observed = self._seed_panels(source, fields, window, base_date, ts_codes)
+
+            panels = {}
+            for field in fields:
+                panel = factor_kernels.build_panel(new_rows, field, ffill=False)
+                if field in tail:
+                    panel = pd.concat([tail[field], panel]).sort_index()
+                    panel = panel[~panel.index.duplicated(keep='last')]
+                panels[field] = panel
+
+            reference = panels[fields[0]]
+            panels = {field: panel.reindex(index=reference.index, columns=reference.columns)
+                      for field, panel in panels.items()}
+            mask = factor_kernels.observed_mask(new_rows, reference)
+            observed = mask
+            if tail_observed is not None:
+                observed = mask | tail_observed.reindex(index=reference.index, columns=reference.columns,
+                                                        fill_value=False)
+            for factor_id, spec in specs.items():
+                panel = factor_kernels.apply_on_observed(spec.kernel, panels, observed)
+                frame = factor_kernels.panel_to_frame(panel, factor_id, mask)
+                if not frame.empty:
+                    frame = frame[frame['trade_date'] > pd.Timestamp(source_marks[factor_id])]
+                    results.append(frame)
+
+            last_date = pd.Timestamp(reference.index.max()).date()
+            for factor_id in source_factors:
+                new_marks[factor_id] = last_date
+            tail_panels, tail_observed = _trim_tail(panels, observed, window)
+            self.states[source] = {
+                'last_date': last_date,
+                'ts_codes': codes_key,
+                'panels': tail_panels,
+                'observed': tail_observed
+            }
+            logger.info(f"增量计算 {source}: 新增 {len(new_rows)} 行, 水位 {base_date} -> {last_date}")
+
+        if not results:
+            return pd.DataFrame()
+
+        result = self.factor_engine.calculate_daily_factor_stats(pd.concat(results, ignore_index=True))
+        if save:
+            if self.factor_engine.save_factor_values(result):
+                self.set_watermarks(new_marks)
+            self.save_state()
+        return result
+
+    # ==================== 缺口回补 ====================
+
+    def backfill(self, start_date: str, end_date: str, factor_ids: List[str] = None,
+                 ts_codes: List[str] = None) -> Dict[str, Any]:
+        """补齐 [start_date, end_date] 内缺失的因子值"""
+        factor_ids = factor_ids or list(self.factor_engine.builtin_factors.keys())
+
+        trade_dates = {row[0] for row in db.session.query(StockDailyHistory.trade_date).filter(
+            StockDailyHistory.trade_date >= start_date,
+            StockDailyHistory.trade_date <= end_date
+        ).distinct().all()}
+        if not trade_dates:
+            return {'filled_rows': 0, 'factors': {}}
+
+        existing: Dict[str, set] = {factor_id: set() for factor_id in factor_ids}
+        for factor_id, existing_date in db.session.query(FactorValues.factor_id, FactorValues.trade_date).filter(
+            FactorValues.factor_id.in_(factor_ids),
+            FactorValues.trade_date >= start_date,
+            FactorValues.trade_date <= end_date
+        ).distinct().all():
+            existing[factor_id].add(existing_date)
+
+        missing = {factor_id: trade_dates - existing[factor_id] for factor_id in factor_ids}
+        missing = {factor_id: dates for factor_id, dates in missing.items() if dates}
+        if not missing:
+            logger.info(f"因子值无缺口: {start_date} ~ {end_date}")
+            return {'filled_rows': 0, 'factors': {}}
+
+        span_start = min(min(dates) for dates in missing.values()).strftime('%Y-%m-%d')
+        span_end = max(max(dates) for dates in missing.values()).strftime('%Y-%m-%d')
+        if ts_codes is None:
+            from app.models import StockBasic
+            ts_codes = [stock.ts_code for stock in StockBasic.query.all()]
+
+        shared_data = self.factor_engine.load_shared_data(list(missing.keys()), ts_codes, span_start, span_end)
+
+        frames = []
+        filled = {}
+        for factor_id, dates in missing.items():
+            result = self.factor_engine.calculate_factor(factor_id, ts_codes, span_start, span_end,
+                                                         data=shared_data)
+            if result.empty:
+                continue
+            result = result[pd.to_datetime(result['trade_date']).dt.date.isin(dates)][FACTOR_COLUMNS]
+            if not result.empty:
+                frames.append(result)
+                filled[factor_id] = int(result['trade_date'].nunique())
+
+        if not frames:
+            return {'filled_rows': 0, 'factors': {}}
+
+        result = self.factor_engine.calculate_daily_factor_stats(pd.concat(frames, ignore_index=True))
+        self.factor_engine.save_factor_values(result)
+
+        # 回补到水位之后的日期时同步推进水位
+        incremental = set(self.incremental_factor_ids())
+        marks = {}
+        for factor_id, group in result.groupby('factor_id'):
+            if factor_id in incremental:
+                marks[factor_id] = pd.Timestamp(group['trade_date'].max()).date()
+        if marks:
+            self.set_watermarks(marks)
+
+        logger.info(f"因子回补完成: {len(result)} 条, 涉及 {len(filled)} 个因子")
+        return {'filled_rows': len(result), 'factors': filled,
+                'start_date': span_start, 'end_date': span_end}
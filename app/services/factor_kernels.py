@@ -0,0 +1,237 @@
+"""
+面板化因子计算内核
+将长表数据一次性透视为 日期 × 股票 矩阵，在整个截面上向量化计算滚动/收益率类因子，
+替代逐只股票过滤整表的循环实现。
+
+滚动与位移按每只股票自身的交易行计数：计算前把每列实际存在的行上移压紧，
+内核在压紧后的面板上运行，再按原位置写回日期面板。停牌日不参与窗口，
+结果与逐只股票排序后计算一致。
+"""
+
+import pandas as pd
+import numpy as np
+from typing import Dict, List, Optional, Callable, NamedTuple, Tuple
+
+
+# 因子结果的统一输出列
+FACTOR_COLUMNS = ['ts_code', 'trade_date', 'factor_id', 'factor_value']
+
+# 按日历面板计算时（如公式因子）停牌期间价格视为不变、向前填充；量、资金流等字段保持缺失
+PRICE_FIELDS = {'open', 'high', 'low', 'close', 'pre_close'}
+
+
+def build_panel(df: pd.DataFrame, field: str, ffill: Optional[bool] = None) -> pd.DataFrame:
+    """将长表透视为 日期 × 股票 面板
+
+    Args:
+        df: 至少包含 ts_code、trade_date 以及 field 列的长表
+        field: 需要透视的字段
+        ffill: 是否向前填充缺失值，默认价格字段填充、其它字段不填充
+    """
+    if ffill is None:
+        ffill = field in PRICE_FIELDS
+
+    values = pd.to_numeric(df[field], errors='coerce').astype('float64')
+    panel = pd.DataFrame({
+        'ts_code': df['ts_code'].values,
+        'trade_date': pd.to_datetime(df['trade_date']).values,
+        'value': values.values
+    }).drop_duplicates(['trade_date', 'ts_code'], keep='last') \
+      .set_index(['trade_date', 'ts_code'])['value'].unstack()
+    panel = panel.sort_index()
+
+    if ffill:
+        panel = panel.ffill()
+
+    return panel
+
+
+def observed_mask(df: pd.DataFrame, panel: pd.DataFrame) -> pd.DataFrame:
+    """返回与面板同形状的布尔矩阵，标记原始数据中实际存在的 (日期, 股票) 单元"""
+    flags = pd.DataFrame({
+        'ts_code': df['ts_code'].values,
+        'trade_date': pd.to_datetime(df['trade_date']).values,
+        'flag': True
+    }).drop_duplicates(['trade_date', 'ts_code'])
+    mask = flags.pivot(index='trade_date', columns='ts_code', values='flag')
+    return mask.reindex(index=panel.index, columns=panel.columns).notna()
+
+
+def compact_rows(mask: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
+    """每列实际存在的行在日期面板中的位置（上移压紧后的顺序）及每列的行数"""
+    observed = mask.to_numpy(dtype=bool)
+    order = np.argsort(~observed, axis=0, kind='stable')
+    return order, observed.sum(axis=0)
+
+
+def apply_on_observed(kernel: Callable[[Dict[str, pd.DataFrame]], pd.DataFrame],
+                      panels: Dict[str, pd.DataFrame], mask: pd.DataFrame) -> pd.DataFrame:
+    """只在每只股票实际存在的行上运行内核，结果写回日期面板，未存在的单元为 NaN
+
+    panels 中的面板需与 mask 同索引、同列。
+    """
+    order, counts = compact_rows(mask)
+    valid = np.arange(len(mask))[:, None] < counts[None, :]
+    compacted = {}
+    for field, panel in panels.items():
+        values = np.take_along_axis(panel.to_numpy(dtype='float64'), order, axis=0)
+        values[~valid] = np.nan
+        compacted[field] = pd.DataFrame(values, columns=mask.columns)
+
+    result = kernel(compacted).to_numpy(dtype='float64')
+    values = np.full(mask.shape, np.nan)
+    rows, cols = np.nonzero(valid)
+    values[order[rows, cols], cols] = result[rows, cols]
+    return pd.DataFrame(values, index=mask.index, columns=mask.columns)
+
+
+def panel_to_frame(panel: pd.DataFrame, factor_id: str,
+                   mask: Optional[pd.DataFrame] = None) -> pd.DataFrame:
+    """将因子面板还原为 ts_code/trade_date/factor_id/factor_value 长表"""
+    if panel is None or panel.empty:
+        return pd.DataFrame()
+
+    values = panel.to_numpy(dtype='float64', copy=True)
+    values[~np.isfinite(values)] = np.nan
+    if mask is not None:
+        values[~mask.to_numpy(dtype=bool)] = np.nan
+
+    rows, cols = np.nonzero(~np.isnan(values))
+    if len(rows) == 0:
+        return pd.DataFrame()
+
+    result = pd.DataFrame({
+        'ts_code': panel.columns.to_numpy()[cols],
+        'trade_date': panel.index.to_numpy()[rows],
+        'factor_id': factor_id,
+        'factor_value': values[rows, cols]
+    })
+    return result.sort_values(['ts_code', 'trade_date'], ignore_index=True)[FACTOR_COLUMNS]
+
+
+# ==================== 面板因子内核 ====================
+# 每个内核接收已透视好的面板，返回同形状的因子面板
+
+def momentum(close: pd.DataFrame, period: int) -> pd.DataFrame:
+    """N日收益率"""
+    return close / close.shift(period) - 1
+
+
+def volatility(close: pd.DataFrame, period: int) -> pd.DataFrame:
+    """N日收益率标准差"""
+    daily_return = close / close.shift(1) - 1
+    return daily_return.rolling(period).std()
+
+
+def volume_ratio(vol: pd.DataFrame, period: int) -> pd.DataFrame:
+    """成交量相对N日均量"""
+    return vol / vol.rolling(period).mean()
+
+
+def price_to_ma(close: pd.DataFrame, period: int) -> pd.DataFrame:
+    """价格相对N日均线偏离"""
+    return close / close.rolling(period).mean() - 1
+
+
+def money_flow_strength(panels: Dict[str, pd.DataFrame]) -> pd.DataFrame:
+    """大单净流入 / 买入总额"""
+    big_net = (panels['buy_lg_amount'] + panels['buy_elg_amount']) - \
+              (panels['sell_lg_amount'] + panels['sell_elg_amount'])
+    total = panels['buy_sm_amount'] + panels['buy_md_amount'] + \
+            panels['buy_lg_amount'] + panels['buy_elg_amount']
+    return big_net / total
+
+
+def big_order_ratio(panels: Dict[str, pd.DataFrame]) -> pd.DataFrame:
+    """大单成交额占比"""
+    big = panels['buy_lg_amount'] + panels['sell_lg_amount'] + \
+          panels['buy_elg_amount'] + panels['sell_elg_amount']
+    total = big + panels['buy_sm_amount'] + panels['sell_sm_amount'] + \
+            panels['buy_md_amount'] + panels['sell_md_amount']
+    return big / total
+
+
+def money_flow_momentum(net_mf_amount: pd.DataFrame, period: int = 5) -> pd.DataFrame:
+    """N日累计净流入"""
+    return net_mf_amount.rolling(period).sum()
+
+
+def chip_concentration(panels: Dict[str, pd.DataFrame]) -> pd.DataFrame:
+    """90%筹码价格区间相对中位成本的比例"""
+    return (panels['cost_95pct'] - panels['cost_5pct']) / panels['cost_50pct']
+
+
+def winner_rate_change(winner_rate: pd.DataFrame, period: int = 5) -> pd.DataFrame:
+    """胜率N日变化"""
+    return winner_rate - winner_rate.shift(period)
+
+
+# ==================== 因子规格 ====================
+
+MONEYFLOW_FIELDS = [
+    'buy_sm_amount', 'sell_sm_amount', 'buy_md_amount', 'sell_md_amount',
+    'buy_lg_amount', 'sell_lg_amount', 'buy_elg_amount', 'sell_elg_amount'
+]
+CYQ_FIELDS = ['cost_5pct', 'cost_50pct', 'cost_95pct']
+
+
+class PanelFactorSpec(NamedTuple):
+    """面板因子规格
+
+    source: 数据源名称（history/moneyflow/cyq）
+    fields: 需要透视的字段
+    kernel: 接收 {字段: 面板} 返回因子面板的函数
+    window: 计算最新一个交易日所需的历史交易日数（含当日）
+    """
+    source: str
+    fields: List[str]
+    kernel: Callable[[Dict[str, pd.DataFrame]], pd.DataFrame]
+    window: int
+
+
+def panel_spec(factor_id: str) -> Optional[PanelFactorSpec]:
+    """解析因子ID对应的面板规格，非面板因子返回 None"""
+    if factor_id.startswith('momentum_'):
+        period = int(factor_id.split('_')[1].replace('d', ''))
+        return PanelFactorSpec('history', ['close'], lambda p: momentum(p['close'], period), period + 1)
+    if factor_id.startswith('volatility_'):
+        period = int(factor_id.split('_')[1].replace('d', ''))
+        return PanelFactorSpec('history', ['close'], lambda p: volatility(p['close'], period), period + 1)
+    if factor_id.startswith('volume_ratio_'):
+        period = int(factor_id.split('_')[2].replace('d', ''))
+        return PanelFactorSpec('history', ['vol'], lambda p: volume_ratio(p['vol'], period), period)
+    if factor_id.startswith('price_to_ma'):
+        period = int(factor_id.split('ma')[1])
+        return PanelFactorSpec('history', ['close'], lambda p: price_to_ma(p['close'], period), period)
+    if factor_id == 'money_flow_strength':
+        return PanelFactorSpec('moneyflow', MONEYFLOW_FIELDS, money_flow_strength, 1)
+    if factor_id == 'big_order_ratio':
+        return PanelFactorSpec('moneyflow', MONEYFLOW_FIELDS, big_order_ratio, 1)
+    if factor_id == 'money_flow_momentum':
+        return PanelFactorSpec('moneyflow', ['net_mf_amount'],
+                               lambda p: money_flow_momentum(p['net_mf_amount']), 5)
+    if factor_id == 'chip_concentration':
+        return PanelFactorSpec('cyq', CYQ_FIELDS, chip_concentration, 1)
+    if factor_id == 'winner_rate_change':
+        return PanelFactorSpec('cyq', ['winner_rate'], lambda p: winner_rate_change(p['winner_rate']), 6)
+    return None
+
+
+# ==================== 数据集入口 ====================
+
+def build_panels(df: pd.DataFrame, fields: List[str]) -> Dict[str, pd.DataFrame]:
+    """批量透视多个字段"""
+    return {field: build_panel(df, field) for field in fields}
+
+
+def compute_panel_factor(df: pd.DataFrame, factor_id: str) -> pd.DataFrame:
+    """基于长表数据计算面板因子，输出 ts_code/trade_date/factor_id/factor_value"""
+    spec = panel_spec(factor_id)
+    if spec is None or df is None or df.empty:
+        return pd.DataFrame()
+
+    panels = {field: build_panel(df, field, ffill=False) for field in spec.fields}
+    mask = observed_mask(df, panels[spec.fields[0]])
+    panel = apply_on_observed(spec.kernel, panels, mask)
+    return panel_to_frame(panel, factor_id, mask)
+
@@ -0,0 +1,193 @@
+"""
+因子数据加载计划
+汇总一组因子所需的数据源及日期范围，每张源表只查询一次，供所有因子函数共享
+"""
+
+import time
+import pandas as pd
+from typing import List, Dict, Any, Optional, Tuple
+from datetime import datetime, timedelta
+from loguru import logger
+
+from app.extensions import db
+from app.models import (
+    StockDailyHistory, StockDailyBasic, StockFactor, StockMoneyflow,
+    StockCyqPerf, StockIncomeStatement, StockBalanceSheet
+)
+from app.services.panel_store import get_panel_store
+
+
+# 需要回看历史窗口的数据源使用的扩展天数
+LOOKBACK_DAYS = 252
+
+# 数据源 -> (模型, 是否需要回看窗口, 是否按交易日期过滤)
+SOURCE_SPECS = {
+    'history': (StockDailyHistory, True, True),
+    'basic': (StockDailyBasic, False, True),
+    'factor': (StockFactor, False, True),
+    'moneyflow': (StockMoneyflow, True, True),
+    'cyq': (StockCyqPerf, True, True),
+    'income': (StockIncomeStatement, False, False),
+    'balance': (StockBalanceSheet, False, False),
+}
+
+
+# 可以从列式面板存储读取的数据源
+STORE_SOURCES = ('history', 'basic')
+
+# 内置因子显式声明的数据源
+BUILTIN_SOURCES = {
+    'momentum_1d': ['history'],
+    'momentum_5d': ['history'],
+    'momentum_20d': ['history'],
+    'volatility_20d': ['history'],
+    'volume_ratio_20d': ['history'],
+    'price_to_ma20': ['history'],
+    'pe_percentile': ['basic'],
+    'pb_percentile': ['basic'],
+    'ps_percentile': ['basic'],
+    'roe_ttm': ['income', 'balance'],
+    'roa_ttm': ['income', 'balance'],
+    'revenue_growth': ['income'],
+    'profit_growth': ['income'],
+    'money_flow_strength': ['moneyflow'],
+    'big_order_ratio': ['moneyflow'],
+    'money_flow_momentum': ['moneyflow'],
+    'chip_concentration': ['cyq'],
+    'winner_rate_change': ['cyq'],
+}
+
+
+def required_sources(factor_id: str) -> List[str]:
+    """返回因子所需的数据源，未声明的因子根据因子ID推断"""
+    if factor_id in BUILTIN_SOURCES:
+        return list(BUILTIN_SOURCES[factor_id])
+
+    sources = []
+    if any(x in factor_id for x in ['momentum', 'volatility', 'volume', 'price']):
+        sources.append('history')
+    if any(x in factor_id for x in ['pe', 'pb', 'ps']):
+        sources.append('basic')
+    if 'ma' in factor_id:
+        sources.append('factor')
+    if 'money' in factor_id:
+        sources.append('moneyflow')
+    if 'chip' in factor_id or 'winner' in factor_id:
+        sources.append('cyq')
+    if any(x in factor_id for x in ['roe', 'roa', 'revenue', 'profit']):
+        sources.extend(['income', 'balance'])
+    return sources
+
+
+def stale_sources(data: Dict[str, pd.DataFrame], sources, start_date: str) -> List[str]:
+    """data 中缺失、或加载起点晚于 start_date 而不足以覆盖回看窗口的数据源"""
+    stale = []
+    for source in sources:
+        frame = data.get(source) if data else None
+        if frame is None:
+            stale.append(source)
+        elif SOURCE_SPECS[source][2]:
+            loaded_start = frame.attrs.get('loaded_start')
+            if loaded_start is None or loaded_start > start_date:
+                stale.append(source)
+    return stale
+
+
+class FactorLoadPlan:
+    """因子数据加载计划
+
+    对请求的所有因子取数据源并集，并为每个数据源合并出覆盖全部因子的日期范围，
+    执行时每张表只发起一次查询。source_overrides 为自定义公式因子显式指定数据源，
+    这些数据源一律带回看窗口加载。
+    """
+
+    def __init__(self, factor_ids: List[str], start_date: str, end_date: str,
+                 lookback_days: int = LOOKBACK_DAYS,
+                 source_overrides: Dict[str, List[str]] = None):
+        self.factor_ids = list(factor_ids)
+        self.start_date = start_date
+        self.end_date = end_date
+        self.lookback_days = lookback_days
+        self.source_overrides = source_overrides or {}
+        self.sources = self._plan_sources()
+        self.stats: Dict[str, Dict[str, Any]] = {}
+
+    def _plan_sources(self) -> Dict[str, Tuple[Optional[str], Optional[str]]]:
+        """计算每个数据源的查询日期范围"""
+        extended_start = (datetime.strptime(self.start_date, '%Y-%m-%d') -
+                          timedelta(days=self.lookback_days)).strftime('%Y-%m-%d')
+
+        sources = {}
+        for factor_id in self.factor_ids:
+            overridden = factor_id in self.source_overrides
+            factor_sources = self.source_overrides[factor_id] if overridden else required_sources(factor_id)
+            for source in factor_sources:
+                model, needs_lookback, by_trade_date = SOURCE_SPECS[source]
+                needs_lookback = needs_lookback or overridden
+                if not by_trade_date:
+                    sources[source] = (None, None)
+                    continue
+                source_start = extended_start if needs_lookback else self.start_date
+                if source in sources:
+                    source_start = min(source_start, sources[source][0])
+                sources[source] = (source_start, self.end_date)
+        return sources
+
+    def _build_query(self, source: str, ts_codes: List[str]):
+        model, _, by_trade_date = SOURCE_SPECS[source]
+        source_start, source_end = self.sources[source]
+
+        query = model.query.filter(model.ts_code.in_(ts_codes))
+        if by_trade_date:
+            query = query.filter(
+                model.trade_date >= source_start,
+                model.trade_date <= source_end
+            ).order_by(model.ts_code, model.trade_date)
+        else:
+            # 财务数据按报告期倒序，最近的季度在前
+            query = query.order_by(model.ts_code, model.end_date.desc())
+        return query
+
+    def execute(self, ts_codes: List[str]) -> Dict[str, pd.DataFrame]:
+        """按计划加载数据，每个数据源查询一次"""
+        data = {}
+        self.stats = {}
+
+        for source in self.sources:
+            started = time.perf_counter()
+            loaded_from = 'sql'
+            try:
+                frame = None
+                if source in STORE_SOURCES:
+                    frame = get_panel_store().load_frame(source, ts_codes, *self.sources[source])
+                if frame is not None:
+                    loaded_from = 'store'
+                else:
+                    query = self._build_query(source, ts_codes)
+                    frame = pd.read_sql(query.statement, db.engine)
+                # 记录实际加载的起始日期，复用共享数据的调用方据此判断回看窗口是否足够
+                frame.attrs['loaded_start'] = self.sources[source][0]
+                data[source] = frame
+            except Exception as e:
+                logger.error(f"加载数据源失败: {source}, 错误: {e}")
+                continue
+
+            self.stats[source] = {
+                'rows': len(data[source]),
+                'seconds': round(time.perf_counter() - started, 4),
+                'start_date': self.sources[source][0],
+                'end_date': self.sources[source][1],
+                'from': loaded_from
+            }
+            logger.info(f"加载数据源 {source}: {self.stats[source]['rows']} 条记录, "
+                        f"耗时 {self.stats[source]['seconds']}s")
+
+        return data
+
+    def get_stats(self) -> Dict[str, Any]:
+        """返回各数据源的加载行数和耗时"""
+        return {
+            'sources': self.stats,
+            'total_rows': sum(s['rows'] for s in self.stats.values()),
+            'total_seconds': round(sum(s['seconds'] for s in self.stats.values()), 4)
+        }
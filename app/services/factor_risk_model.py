@@ -0,0 +1,387 @@
+"""
+结构化因子风险模型
+以 FactorValues 中的因子暴露和 StockBasic 的行业哑变量为解释变量，逐日做横截面回归
+得到因子收益率，再估计因子协方差 F（K × K，指数加权）与个股特异方差 D（N，指数加权，
+样本不足时收缩到横截面中位数）。股票协方差表示为低秩加对角：
+
+    Σ = X F X' + diag(D) = B B' + diag(D)，B = X · chol(F)
+
+组合方差、边际风险等计算均为 O(N·K)，不再构造 N × N 矩阵。模型按 trade_date 计算一次，
+以 npz 文件持久化在 RISK_MODEL_DIR 下，由组合优化器、实时风控和回测共用。
+"""
+
+import os
+import json
+import threading
+from collections import OrderedDict
+from datetime import date, datetime
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+from app.extensions import db
+from app.models import FactorValues, StockBasic
+from app.services.panel_store import get_panel_store
+
+
+DEFAULT_MODEL_DIR = 'data/risk_models'
+DEFAULT_LOOKBACK_DAYS = 252
+DEFAULT_HALF_LIFE = 90
+
+# 风格因子暴露截尾的标准差倍数
+EXPOSURE_CLIP = 3.0
+# 个股特异方差至少需要的有效残差个数，不足时收缩到横截面中位数
+MIN_SPECIFIC_OBS = 20
+# 横截面回归至少需要的股票数
+MIN_CROSS_SECTION = 30
+UNKNOWN_INDUSTRY = '未知'
+
+
+def _to_date(value) -> date:
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return pd.Timestamp(value).date()
+
+
+def _ewma_weights(length: int, half_life: float) -> np.ndarray:
+    """长度为 length 的指数衰减权重，最后一期权重最大"""
+    return 0.5 ** (np.arange(length - 1, -1, -1) / float(half_life))
+
+
+def standardize_exposures(values: np.ndarray) -> np.ndarray:
+    """风格因子暴露逐列标准化并截尾，缺失值置 0（即取横截面均值）"""
+    values = np.asarray(values, dtype=float)
+    mean = np.nanmean(values, axis=0)
+    std = np.nanstd(values, axis=0)
+    std[~np.isfinite(std) | (std == 0)] = 1.0
+    z = np.clip((values - mean) / std, -EXPOSURE_CLIP, EXPOSURE_CLIP)
+    return np.nan_to_num(z, nan=0.0)
+
+
+class FactorRiskModel:
+    """低秩加对角的股票协方差：Σ = X F X' + diag(D)"""
+
+    def __init__(self, trade_date, codes: List[str], factors: List[str],
+                 exposures: np.ndarray, factor_cov: np.ndarray, specific_var: np.ndarray,
+                 meta: Dict[str, Any] = None):
+        self.trade_date = _to_date(trade_date)
+        self.codes = list(codes)
+        self.factors = list(factors)
+        self.exposures = np.asarray(exposures, dtype=float)
+        self.factor_cov = np.asarray(factor_cov, dtype=float)
+        self.specific_var = np.asarray(specific_var, dtype=float)
+        self.meta = dict(meta or {})
+        self._code_index: Optional[Dict[str, int]] = None
+        self._loadings: Optional[np.ndarray] = None
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    @property
+    def code_index(self) -> Dict[str, int]:
+        if self._code_index is None:
+            self._code_index = {code: i for i, code in enumerate(self.codes)}
+        return self._code_index
+
+    # ==================== 子集与表示 ====================
+
+    def subset(self, codes: List[str]) -> 'FactorRiskModel':
+        """按给定顺序取出子模型；模型外的股票暴露为 0，特异方差取横截面中位数"""
+        index = self.code_index
+        rows = np.array([index.get(code, -1) for code in codes], dtype=int)
+        known = rows >= 0
+        exposures = np.zeros((len(codes), len(self.factors)))
+        exposures[known] = self.exposures[rows[known]]
+        specific_var = np.full(len(codes), self.median_specific_var)
+        specific_var[known] = self.specific_var[rows[known]]
+        meta = dict(self.meta, missing=int((~known).sum()))
+        return FactorRiskModel(self.trade_date, codes, self.factors, exposures,
+                               self.factor_cov, specific_var, meta)
+
+    @property
+    def median_specific_var(self) -> float:
+        return float(np.median(self.specific_var)) if len(self.specific_var) else 0.0
+
+    def loadings(self) -> np.ndarray:
+        """低秩因子载荷 B = X · chol(F)（N × K），满足 B B' = X F X'"""
+        if self._loadings is None:
+            factor_cov = self.factor_cov
+            try:
+                root = np.linalg.cholesky(factor_cov)
+            except np.linalg.LinAlgError:
+                eigval, eigvec = np.linalg.eigh(factor_cov)
+                root = eigvec * np.sqrt(np.clip(eigval, 0.0, None))
+            self._loadings = self.exposures @ root
+        return self._loadings
+
+    def covariance(self) -> pd.DataFrame:
+        """稠密协方差矩阵（O(N²)，仅用于少量股票的展示或兼容旧接口）"""
+        cov = self.exposures @ self.factor_cov @ self.exposures.T + np.diag(self.specific_var)
+        return pd.DataFrame(cov, index=self.codes, columns=self.codes)
+
+    # ==================== 风险计算 ====================
+
+    def cov_dot(self, weights: np.ndarray) -> np.ndarray:
+        """Σ · w，不构造 N × N 矩阵"""
+        weights = np.asarray(weights, dtype=float)
+        return self.exposures @ (self.factor_cov @ (self.exposures.T @ weights)) + self.specific_var * weights
+
+    def portfolio_variance(self, weights: np.ndarray) -> float:
+        weights = np.asarray(weights, dtype=float)
+        factor_exposure = self.exposures.T @ weights
+        return float(factor_exposure @ self.factor_cov @ factor_exposure
+                     + np.sum(self.specific_var * weights ** 2))
+
+    def decompose(self, weights: np.ndarray) -> Dict[str, Any]:
+        """组合风险分解：因子/特异方差、组合因子暴露及各因子的方差贡献"""
+        weights = np.asarray(weights, dtype=float)
+        factor_exposure = self.exposures.T @ weights
+        factor_marginal = self.factor_cov @ factor_exposure
+        factor_var = float(factor_exposure @ factor_marginal)
+        specific_var = float(np.sum(self.specific_var * weights ** 2))
+        total_var = factor_var + specific_var
+        contribution = factor_exposure * factor_marginal
+        return {
+            'total_variance': total_var,
+            'total_risk': float(np.sqrt(max(total_var, 0.0))),
+            'factor_variance': factor_var,
+            'specific_variance': specific_var,
+            'factor_share': factor_var / total_var if total_var > 0 else 0.0,
+            'factor_exposures': dict(zip(self.factors, factor_exposure.tolist())),
+            'factor_contributions': dict(zip(self.factors, contribution.tolist()))
+        }
+
+    # ==================== 持久化 ====================
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(tmp_path, codes=np.array(self.codes), factors=np.array(self.factors),
+                 exposures=self.exposures, factor_cov=self.factor_cov,
+                 specific_var=self.specific_var,
+                 trade_date=np.array(self.trade_date.isoformat()),
+                 meta=np.array(json.dumps(self.meta, default=str)))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'FactorRiskModel':
+        with np.load(path, allow_pickle=False) as data:
+            meta = json.loads(str(data['meta'])) if 'meta' in data else {}
+            return cls(str(data['trade_date']), data['codes'].tolist(), data['factors'].tolist(),
+                       data['exposures'], data['factor_cov'], data['specific_var'], meta)
+
+
+class FactorRiskModelBuilder:
+    """由因子暴露与日收益率估计结构化风险模型"""
+
+    def __init__(self, lookback_days: int = DEFAULT_LOOKBACK_DAYS, half_life: float = DEFAULT_HALF_LIFE,
+                 factor_ids: List[str] = None):
+        self.lookback_days = lookback_days
+        self.half_life = half_life
+        self.factor_ids = factor_ids
+
+    def build(self, trade_date) -> Optional[FactorRiskModel]:
+        """估计 trade_date 的风险模型；当天没有因子暴露时返回 None"""
+        trade_date = _to_date(trade_date)
+        exposures = self._load_exposures(trade_date)
+        if exposures is None:
+            return None
+
+        codes = exposures.index.tolist()
+        style = standardize_exposures(exposures.values)
+        industries = self._load_industries(codes)
+        industry_names = sorted(set(industries))
+        dummies = (np.asarray(industries)[:, None] == np.asarray(industry_names)[None, :]).astype(float)
+        factors = list(exposures.columns) + [f"industry:{name}" for name in industry_names]
+        x = np.hstack([style, dummies])
+
+        returns = self._load_returns(codes, trade_date)
+        factor_returns, residuals = self._cross_section_regression(x, returns)
+        if len(factor_returns) < 2:
+            logger.warning(f"风险模型 {trade_date}: 有效回归日不足，无法估计因子协方差")
+            return None
+
+        factor_cov = self._factor_covariance(factor_returns)
+        specific_var = self._specific_variance(residuals)
+        meta = {
+            'regression_days': int(len(factor_returns)),
+            'style_factors': int(style.shape[1]),
+            'industries': int(len(industry_names)),
+            'built_at': datetime.now().isoformat()
+        }
+        logger.info(f"风险模型 {trade_date}: {len(codes)} 只股票, {len(factors)} 个因子, "
+                    f"{len(factor_returns)} 个回归日")
+        return FactorRiskModel(trade_date, codes, factors, x, factor_cov, specific_var, meta)
+
+    # ==================== 数据加载 ====================
+
+    def _load_exposures(self, trade_date: date) -> Optional[pd.DataFrame]:
+        """trade_date 当日的风格因子暴露（股票 × 因子），未计算的因子值为 NaN"""
+        query = db.session.query(
+            FactorValues.ts_code, FactorValues.factor_id, FactorValues.factor_value
+        ).filter(FactorValues.trade_date == trade_date)
+        if self.factor_ids:
+            query = query.filter(FactorValues.factor_id.in_(self.factor_ids))
+        rows = query.all()
+        if not rows:
+            return None
+
+        frame = pd.DataFrame(rows, columns=['ts_code', 'factor_id', 'factor_value'])
+        frame['factor_value'] = pd.to_numeric(frame['factor_value'], errors='coerce')
+        exposures = frame.pivot_table(index='ts_code', columns='factor_id', values='factor_value',
+                                      aggfunc='last')
+        return exposures.dropna(axis=1, how='all').sort_index()
+
+    @staticmethod
+    def _load_industries(codes: List[str]) -> List[str]:
+        rows = db.session.query(StockBasic.ts_code, StockBasic.industry).filter(
+            StockBasic.ts_code.in_(codes)
+        ).all()
+        mapping = {ts_code: industry for ts_code, industry in rows if industry}
+        return [mapping.get(code, UNKNOWN_INDUSTRY) for code in codes]
+
+    def _load_returns(self, codes: List[str], trade_date: date) -> np.ndarray:
+        """截至 trade_date 的日收益率（日期 × 股票），停牌或缺失为 NaN"""
+        start = trade_date - pd.Timedelta(days=int(self.lookback_days * 1.6) + 10)
+        panel = get_panel_store().get('pct_chg', codes, start, trade_date)
+        values = np.asarray(panel.values, dtype=float)[-self.lookback_days:]
+        return values / 100.0
+
+    # ==================== 估计 ====================
+
+    @staticmethod
+    def _cross_section_regression(x: np.ndarray, returns: np.ndarray):
+        """逐日横截面最小二乘，返回因子收益率（T × K）与残差（T × N，缺失为 NaN）"""
+        factor_returns = []
+        residuals = np.full(returns.shape, np.nan)
+        for t, day_returns in enumerate(returns):
+            valid = np.isfinite(day_returns)
+            if valid.sum() < max(MIN_CROSS_SECTION, x.shape[1] + 1):
+                continue
+            x_t = x[valid]
+            coef, *_ = np.linalg.lstsq(x_t, day_returns[valid], rcond=None)
+            factor_returns.append(coef)
+            residuals[t, valid] = day_returns[valid] - x_t @ coef
+        return np.asarray(factor_returns), residuals
+
+    def _factor_covariance(self, factor_returns: np.ndarray) -> np.ndarray:
+        weights = _ewma_weights(len(factor_returns), self.half_life)
+        weights = weights / weights.sum()
+        mean = weights @ factor_returns
+        centered = factor_returns - mean
+        cov = (centered * weights[:, None]).T @ centered
+        # 轻微对角加载保证正定（行业哑变量之间可能共线）
+        ridge = 1e-8 * max(float(np.trace(cov)) / len(cov), 1e-12)
+        return cov + ridge * np.eye(len(cov))
+
+    def _specific_variance(self, residuals: np.ndarray) -> np.ndarray:
+        valid = np.isfinite(residuals)
+        weights = _ewma_weights(len(residuals), self.half_life)[:, None] * valid
+        total = weights.sum(axis=0)
+        squared = np.where(valid, residuals, 0.0) ** 2
+        with np.errstate(invalid='ignore', divide='ignore'):
+            variance = (weights * squared).sum(axis=0) / total
+
+        observations = valid.sum(axis=0)
+        enough = observations >= MIN_SPECIFIC_OBS
+        finite = np.isfinite(variance)
+        pool = variance[enough & finite] if (enough & finite).any() else variance[finite]
+        median = float(np.median(pool)) if len(pool) else 1e-4
+        # 样本不足的股票按观测数向横截面中位数收缩
+        shrink = np.clip(observations / MIN_SPECIFIC_OBS, 0.0, 1.0)
+        variance = np.where(np.isfinite(variance), shrink * variance + (1 - shrink) * median, median)
+        return np.maximum(variance, 1e-8)
+
+
+class RiskModelStore:
+    """按交易日持久化与缓存风险模型"""
+
+    def __init__(self, root: str = None, lookback_days: int = None, half_life: float = None,
+                 factor_ids: List[str] = None, max_cached: int = 8):
+        try:
+            from flask import current_app
+            config = current_app.config
+            root = root or config.get('RISK_MODEL_DIR', DEFAULT_MODEL_DIR)
+            lookback_days = lookback_days or config.get('RISK_MODEL_LOOKBACK_DAYS', DEFAULT_LOOKBACK_DAYS)
+            half_life = half_life or config.get('RISK_MODEL_HALF_LIFE', DEFAULT_HALF_LIFE)
+            if factor_ids is None and config.get('RISK_MODEL_FACTORS'):
+                factor_ids = [f.strip() for f in config['RISK_MODEL_FACTORS'].split(',') if f.strip()]
+        except RuntimeError:
+            pass
+        self.root = root or DEFAULT_MODEL_DIR
+        self.builder = FactorRiskModelBuilder(lookback_days or DEFAULT_LOOKBACK_DAYS,
+                                              half_life or DEFAULT_HALF_LIFE, factor_ids)
+        self.max_cached = max_cached
+        self._cache: 'OrderedDict[date, FactorRiskModel]' = OrderedDict()
+        self._lock = threading.RLock()
+
+    def _path(self, trade_date: date) -> str:
+        return os.path.join(self.root, f"{trade_date.strftime('%Y%m%d')}.npz")
+
+    @staticmethod
+    def resolve_date(trade_date=None) -> Optional[date]:
+        """不晚于 trade_date 的最近一个有因子暴露的交易日"""
+        query = db.session.query(db.func.max(FactorValues.trade_date))
+        if trade_date is not None:
+            query = query.filter(FactorValues.trade_date <= _to_date(trade_date))
+        resolved = query.scalar()
+        return _to_date(resolved) if resolved is not None else None
+
+    def get(self, trade_date=None, build: bool = True) -> Optional[FactorRiskModel]:
+        """获取风险模型：内存缓存 → 磁盘文件 → 现场估计并落盘"""
+        resolved = self.resolve_date(trade_date)
+        if resolved is None:
+            return None
+
+        with self._lock:
+            model = self._cache.get(resolved)
+            if model is not None:
+                self._cache.move_to_end(resolved)
+                return model
+
+            path = self._path(resolved)
+            if os.path.exists(path):
+                try:
+                    model = FactorRiskModel.load(path)
+                except Exception as e:
+                    logger.warning(f"读取风险模型文件失败，将重新估计: {path}, 错误: {e}")
+            if model is None and build:
+                model = self.builder.build(resolved)
+                if model is not None:
+                    model.save(path)
+            if model is not None:
+                self._remember(resolved, model)
+            return model
+
+    def rebuild(self, trade_date) -> Optional[FactorRiskModel]:
+        """重新估计并覆盖 trade_date 的风险模型（因子数据更新后调用）"""
+        resolved = self.resolve_date(trade_date)
+        if resolved is None:
+            return None
+        model = self.builder.build(resolved)
+        if model is not None:
+            with self._lock:
+                model.save(self._path(resolved))
+                self._remember(resolved, model)
+        return model
+
+    def _remember(self, trade_date: date, model: FactorRiskModel):
+        self._cache[trade_date] = model
+        self._cache.move_to_end(trade_date)
+        while len(self._cache) > self.max_cached:
+            self._cache.popitem(last=False)
+
+
+_risk_model_store = None
+
+
+def get_risk_model_store() -> RiskModelStore:
+    """获取全局风险模型存储实例（延迟初始化）"""
+    global _risk_model_store
+    if _risk_model_store is None:
+        _risk_model_store = RiskModelStore()
+    return _risk_model_store
@@ -0,0 +1,148 @@
+"""
+因子值批量写入器
+直接从 DataFrame 的列数组分块生成参数。写入前先按因子删除本次涉及的
+(交易日期, 因子) 切片，使重新计算后已不在结果中的股票不再保留旧值；
+随后按数据库方言使用原生 upsert（MySQL ON DUPLICATE KEY UPDATE /
+SQLite ON CONFLICT），其它数据库使用普通批量插入。
+"""
+
+import time
+import numpy as np
+import pandas as pd
+from typing import Dict, Any, List, Iterator
+from datetime import datetime
+from loguru import logger
+from sqlalchemy import insert, delete
+
+from app.extensions import db
+from app.models import FactorValues
+
+
+DEFAULT_BATCH_SIZE = 5000
+
+VALUE_COLUMNS = ['factor_value', 'percentile_rank', 'z_score']
+
+
+class FactorValuesWriter:
+    """FactorValues 表的集合化写入器"""
+
+    def __init__(self, batch_size: int = DEFAULT_BATCH_SIZE):
+        self.batch_size = max(int(batch_size), 1)
+        self.total_rows = 0
+        self.total_seconds = 0.0
+        self.last_stats: Dict[str, Any] = {}
+
+    def _column_arrays(self, df: pd.DataFrame) -> Dict[str, np.ndarray]:
+        """把 DataFrame 转为写入所需的列数组，NaN/inf 统一转为 None"""
+        arrays = {
+            'ts_code': df['ts_code'].astype(str).to_numpy(dtype=object),
+            'trade_date': pd.to_datetime(df['trade_date']).dt.date.to_numpy(dtype=object),
+            'factor_id': df['factor_id'].astype(str).to_numpy(dtype=object),
+        }
+        for column in VALUE_COLUMNS:
+            if column in df.columns:
+                floats = pd.to_numeric(df[column], errors='coerce').to_numpy(dtype='float64')
+                values = floats.astype(object)
+                values[~np.isfinite(floats)] = None
+            else:
+                values = np.full(len(df), None, dtype=object)
+            arrays[column] = values
+        return arrays
+
+    def _iter_batches(self, arrays: Dict[str, np.ndarray], created_at: datetime,
+                      batch_size: int) -> Iterator[List[Dict[str, Any]]]:
+        """按批次生成参数字典列表"""
+        columns = list(arrays.keys())
+        total = len(arrays['ts_code'])
+        for start in range(0, total, batch_size):
+            end = min(start + batch_size, total)
+            chunk = zip(*(arrays[column][start:end] for column in columns))
+            yield [dict(zip(columns, values), created_at=created_at) for values in chunk]
+
+    def _upsert_statement(self, dialect: str):
+        """构造方言相关的 upsert 语句，不支持时返回 None"""
+        if dialect == 'mysql':
+            from sqlalchemy.dialects.mysql import insert as mysql_insert
+            stmt = mysql_insert(FactorValues.__table__)
+            return stmt.on_duplicate_key_update(
+                {column: stmt.inserted[column] for column in VALUE_COLUMNS + ['created_at']}
+            )
+        if dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+            stmt = sqlite_insert(FactorValues.__table__)
+            return stmt.on_conflict_do_update(
+                index_elements=['ts_code', 'trade_date', 'factor_id'],
+                set_={column: stmt.excluded[column] for column in VALUE_COLUMNS + ['created_at']}
+            )
+        return None
+
+    @staticmethod
+    def _delete_slices(arrays: Dict[str, np.ndarray]):
+        """删除本次写入涉及的 (交易日期, 因子) 切片，每个因子一条语句"""
+        dates_by_factor: Dict[str, set] = {}
+        for trade_date, factor_id in zip(arrays['trade_date'], arrays['factor_id']):
+            dates_by_factor.setdefault(factor_id, set()).add(trade_date)
+        for factor_id, trade_dates in dates_by_factor.items():
+            db.session.execute(
+                delete(FactorValues.__table__).where(
+                    FactorValues.factor_id == factor_id,
+                    FactorValues.trade_date.in_(sorted(trade_dates))
+                )
+            )
+
+    def write(self, df: pd.DataFrame, batch_size: int = None) -> Dict[str, Any]:
+        """写入因子值，返回本次写入的行数、耗时和吞吐量
+
+        Args:
+            batch_size: 单批写入行数，为空时使用实例默认值
+        """
+        started = time.perf_counter()
+        batch_size = max(int(batch_size), 1) if batch_size else self.batch_size
+        if df is None or df.empty:
+            self.last_stats = {'rows': 0, 'batches': 0, 'seconds': 0.0, 'rows_per_second': 0.0}
+            return self.last_stats
+
+        df = df.drop_duplicates(['ts_code', 'trade_date', 'factor_id'], keep='last')
+        arrays = self._column_arrays(df)
+        dialect = db.engine.dialect.name
+        stmt = self._upsert_statement(dialect)
+
+        try:
+            self._delete_slices(arrays)
+            if stmt is None:
+                stmt = insert(FactorValues.__table__)
+
+            batches = 0
+            created_at = datetime.utcnow()
+            for batch in self._iter_batches(arrays, created_at, batch_size):
+                db.session.execute(stmt, batch)
+                batches += 1
+
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+        seconds = time.perf_counter() - started
+        rows = len(arrays['ts_code'])
+        self.total_rows += rows
+        self.total_seconds += seconds
+        self.last_stats = {
+            'rows': rows,
+            'batches': batches,
+            'seconds': round(seconds, 4),
+            'rows_per_second': round(rows / seconds, 1) if seconds > 0 else 0.0,
+            'dialect': dialect
+        }
+        logger.info(f"因子值写入完成: {rows} 条, {batches} 批, "
+                    f"{self.last_stats['rows_per_second']} 条/秒")
+        return self.last_stats
+
+    def get_throughput(self) -> Dict[str, Any]:
+        """累计吞吐量统计"""
+        return {
+            'total_rows': self.total_rows,
+            'total_seconds': round(self.total_seconds, 4),
+            'rows_per_second': round(self.total_rows / self.total_seconds, 1) if self.total_seconds > 0 else 0.0,
+            'last': self.last_stats
+        }
@@ -0,0 +1,485 @@
+"""
+盘中增量风险
+为被跟踪的组合在内存中保存协方差矩阵、历史收益情景与持仓市值，价格或持仓变化时
+按秩一更新组合风险，而不必等下一轮定时风险计算：
+
+- 持仓市值向量 v，组合价值方差 σ² = v'Σv，辅助向量 m = Σv
+- 第 i 只股票市值变化 Δv（价格变动 q_i·Δp 或数量变动 Δq·p_i）时
+  σ² += 2Δv·m_i + Δv²·Σ_ii，m += Δv·Σ[:, i]，历史情景盈亏 s = R·v 同样 s += Δv·R[:, i]
+- 每次更新 O(N + T)，参数法 VaR 由 σ 直接给出，历史模拟 VaR 为 s / V 的分位数
+
+逐笔行情来自 K 线事件总线的同步监听器，持仓变化来自 PortfolioPosition 的 ORM 事件。
+止损止盈等持仓规则与定时监控共用 evaluate_position_alerts，预警按状态跃迁去重，
+立即经推送服务发出，写库交给后台线程，行情路径保持毫秒级。
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+from scipy import stats
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from app.models.portfolio_position import PortfolioPosition
+from app.services.event_bus import get_bar_event_bus
+from app.services.factor_risk_model import get_risk_model_store
+from app.services.portfolio_returns import get_portfolio_returns_provider
+from app.services.realtime_risk_manager import RealtimeRiskManager, evaluate_position_alerts
+
+
+DEFAULT_BAR_PERIOD = '1min'
+DEFAULT_LOOKBACK_DAYS = 252
+# 累计若干次增量更新后从头重算一次，消除浮点误差累积
+DEFAULT_RESYNC_INTERVAL = 500
+TRADING_DAYS = 252
+
+
+class PortfolioRiskState:
+    """单个组合的增量风险状态"""
+
+    def __init__(self, portfolio_id: str, positions: List[PortfolioPosition],
+                 covariance: np.ndarray, scenarios: np.ndarray,
+                 confidence_levels: Sequence[float] = (0.95, 0.99), source: str = 'sample'):
+        self.portfolio_id = portfolio_id
+        self.codes = [pos.ts_code for pos in positions]
+        self.index = {code: i for i, code in enumerate(self.codes)}
+        self.quantities = np.array([pos.position_size or 0.0 for pos in positions], dtype=float)
+        self.prices = np.array([pos.current_price or pos.avg_cost or 0.0 for pos in positions], dtype=float)
+        self.avg_cost = np.array([pos.avg_cost or 0.0 for pos in positions], dtype=float)
+        self.stop_loss = [pos.stop_loss_price for pos in positions]
+        self.take_profit = [pos.take_profit_price for pos in positions]
+        self.covariance = np.asarray(covariance, dtype=float)
+        self.scenarios = np.nan_to_num(np.asarray(scenarios, dtype=float))
+        self.confidence_levels = tuple(confidence_levels)
+        self.source = source
+        # 当前处于触发状态的预警 (ts_code, alert_type)，只在新进入触发状态时发出
+        self.active_alerts: Set[Tuple[str, str]] = set()
+        self.lock = threading.Lock()
+        self.updates = 0
+        self.last_latency_ms = 0.0
+        self.max_latency_ms = 0.0
+        self.resync()
+
+    def resync(self):
+        """由持仓市值从头计算 m、σ² 与情景盈亏"""
+        self.values = self.quantities * self.prices
+        self.total_value = float(self.values.sum())
+        self.cov_values = self.covariance @ self.values
+        self.variance = float(self.values @ self.cov_values)
+        self.scenario_pnl = self.scenarios @ self.values if len(self.scenarios) else np.zeros(0)
+        self._since_resync = 0
+
+    def apply_value_change(self, i: int, delta: float):
+        """第 i 只股票市值变化 delta 时的秩一更新"""
+        if delta == 0.0:
+            return
+        self.variance += 2.0 * delta * self.cov_values[i] + delta * delta * self.covariance[i, i]
+        self.cov_values += delta * self.covariance[:, i]
+        if len(self.scenario_pnl):
+            self.scenario_pnl += delta * self.scenarios[:, i]
+        self.values[i] += delta
+        self.total_value += delta
+        self._since_resync += 1
+
+    def update_price(self, ts_code: str, price: float) -> bool:
+        i = self.index.get(ts_code)
+        if i is None or not price or price <= 0:
+            return False
+        delta = self.quantities[i] * (price - self.prices[i])
+        self.prices[i] = price
+        self.apply_value_change(i, delta)
+        return True
+
+    def update_quantity(self, ts_code: str, quantity: float) -> bool:
+        i = self.index.get(ts_code)
+        if i is None:
+            return False
+        delta = (quantity - self.quantities[i]) * self.prices[i]
+        self.quantities[i] = quantity
+        self.apply_value_change(i, delta)
+        return True
+
+    def update_levels(self, ts_code: str, avg_cost: float = None,
+                      stop_loss_price: float = None, take_profit_price: float = None):
+        """更新成本与止损止盈价（不影响协方差部分）"""
+        i = self.index.get(ts_code)
+        if i is None:
+            return
+        if avg_cost is not None:
+            self.avg_cost[i] = avg_cost
+        self.stop_loss[i] = stop_loss_price
+        self.take_profit[i] = take_profit_price
+
+    def maybe_resync(self, interval: int):
+        if self._since_resync >= interval:
+            self.resync()
+
+    def weight_pct(self, i: int) -> float:
+        return float(self.values[i] / self.total_value * 100) if self.total_value > 0 else 0.0
+
+    def metrics(self) -> Dict[str, Any]:
+        """当前组合价值、波动率与参数法/历史模拟 VaR（收益率口径，负数为亏损）"""
+        total = self.total_value
+        daily_vol = float(np.sqrt(max(self.variance, 0.0)) / total) if total > 0 else 0.0
+        result = {
+            'total_value': total,
+            'daily_volatility': daily_vol,
+            'annual_volatility': daily_vol * np.sqrt(TRADING_DAYS),
+            'parametric': {},
+            'historical': {},
+        }
+        pnl = self.scenario_pnl / total if total > 0 and len(self.scenario_pnl) else np.zeros(0)
+        for confidence in self.confidence_levels:
+            label = int(round(confidence * 100))
+            result['parametric'][f'var_{label}'] = float(-stats.norm.ppf(confidence) * daily_vol)
+            if len(pnl):
+                var = float(np.quantile(pnl, 1 - confidence))
+                tail = pnl[pnl <= var]
+                result['historical'][f'var_{label}'] = var
+                result['historical'][f'cvar_{label}'] = float(tail.mean()) if len(tail) else var
+        return result
+
+
+class IncrementalRiskManager:
+    """被跟踪组合的增量风险状态与逐笔预警"""
+
+    def __init__(self, app=None, bar_period: str = None, lookback_days: int = None,
+                 resync_interval: int = None):
+        try:
+            from flask import current_app
+            config = current_app.config
+            app = app or current_app._get_current_object()
+            bar_period = bar_period or config.get('INCREMENTAL_RISK_BAR_PERIOD', DEFAULT_BAR_PERIOD)
+            lookback_days = lookback_days or config.get('INCREMENTAL_RISK_LOOKBACK_DAYS', DEFAULT_LOOKBACK_DAYS)
+            resync_interval = resync_interval or config.get('INCREMENTAL_RISK_RESYNC_INTERVAL',
+                                                            DEFAULT_RESYNC_INTERVAL)
+        except RuntimeError:
+            pass
+        self.app = app
+        self.bar_period = bar_period or DEFAULT_BAR_PERIOD
+        self.lookback_days = int(lookback_days or DEFAULT_LOOKBACK_DAYS)
+        self.resync_interval = int(resync_interval or DEFAULT_RESYNC_INTERVAL)
+        self.risk_manager = RealtimeRiskManager()
+        self.states: Dict[str, PortfolioRiskState] = {}
+        self._by_code: Dict[str, Set[str]] = {}
+        # 持仓结构变化（新增股票、换组合）待提交后重建的组合
+        self._pending_rebuild: Set[str] = set()
+        self._lock = threading.RLock()
+        # 预警写库与状态重建放到单线程后台执行，保持行情路径轻量
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='incremental-risk')
+        self.stats = {'ticks': 0, 'position_updates': 0, 'alerts': 0, 'rebuilds': 0}
+
+    # ==================== 跟踪 ====================
+
+    def track(self, portfolio_id: str) -> Optional[PortfolioRiskState]:
+        """建立（或重建）组合的增量风险状态，需在应用上下文中调用"""
+        positions = PortfolioPosition.get_portfolio_positions(portfolio_id)
+        if not positions:
+            self.untrack(portfolio_id)
+            return None
+
+        covariance, scenarios, source = self._load_risk_inputs(portfolio_id, positions)
+        state = PortfolioRiskState(portfolio_id, positions, covariance, scenarios,
+                                   self.risk_manager.confidence_levels, source)
+        # 重建时沿用已收到的逐笔价格，库中价格只在定时任务中刷新
+        previous = self.states.get(portfolio_id)
+        if previous is not None:
+            with previous.lock:
+                for code, i in state.index.items():
+                    j = previous.index.get(code)
+                    if j is not None and previous.prices[j] > 0:
+                        state.prices[i] = previous.prices[j]
+            state.resync()
+        # 建立时即按当前价格判断一次，已处于触发状态的预警不重复发出
+        for code in state.codes:
+            for alert in self._position_alerts(state, code):
+                state.active_alerts.add((code, alert['alert_type']))
+        for alert in self._portfolio_alerts(state):
+            state.active_alerts.add((None, alert['alert_type']))
+
+        with self._lock:
+            self._unindex(portfolio_id)
+            self.states[portfolio_id] = state
+            for code in state.codes:
+                self._by_code.setdefault(code, set()).add(portfolio_id)
+            self.stats['rebuilds'] += 1
+        logger.info(f"组合 {portfolio_id} 增量风险状态已建立: {len(state.codes)} 只股票, 协方差来源 {source}")
+        return state
+
+    def untrack(self, portfolio_id: str):
+        with self._lock:
+            self._unindex(portfolio_id)
+            self.states.pop(portfolio_id, None)
+
+    def _unindex(self, portfolio_id: str):
+        state = self.states.get(portfolio_id)
+        if state is None:
+            return
+        for code in state.codes:
+            portfolios = self._by_code.get(code)
+            if portfolios is not None:
+                portfolios.discard(portfolio_id)
+                if not portfolios:
+                    del self._by_code[code]
+
+    def snapshot(self, portfolio_id: str) -> Optional[Dict[str, Any]]:
+        state = self.states.get(portfolio_id)
+        if state is None:
+            return None
+        with state.lock:
+            metrics = state.metrics()
+            positions = [{
+                'ts_code': code,
+                'quantity': float(state.quantities[i]),
+                'price': float(state.prices[i]),
+                'market_value': float(state.values[i]),
+                'weight': state.weight_pct(i),
+            } for i, code in enumerate(state.codes)]
+            return dict(metrics,
+                        portfolio_id=portfolio_id,
+                        positions=positions,
+                        covariance_source=state.source,
+                        active_alerts=sorted(f'{code or "portfolio"}:{alert_type}'
+                                             for code, alert_type in state.active_alerts),
+                        updates=state.updates,
+                        last_latency_ms=state.last_latency_ms,
+                        max_latency_ms=state.max_latency_ms)
+
+    def _load_risk_inputs(self, portfolio_id: str,
+                          positions: List[PortfolioPosition]) -> Tuple[np.ndarray, np.ndarray, str]:
+        """协方差优先取结构化因子模型，没有时用历史收益的样本协方差；情景为历史日收益"""
+        codes = [pos.ts_code for pos in positions]
+        data = get_portfolio_returns_provider().get(portfolio_id, codes, self.lookback_days)
+        returns = data.returns.reindex(columns=codes) if not data.returns.empty else pd.DataFrame(columns=codes)
+        scenarios = returns.fillna(0.0).to_numpy()
+
+        try:
+            model = get_risk_model_store().get(build=False)
+            if model is not None:
+                covariance = model.subset(codes).covariance().reindex(index=codes, columns=codes)
+                return covariance.to_numpy(), scenarios, 'factor_model'
+        except Exception as e:
+            logger.warning(f"读取因子风险模型失败，改用样本协方差: {e}")
+
+        if len(returns) > 1:
+            covariance = returns.cov().fillna(0.0).to_numpy()
+        else:
+            covariance = np.zeros((len(codes), len(codes)))
+        return covariance, scenarios, 'sample'
+
+    # ==================== 事件入口 ====================
+
+    def on_bars(self, bars: Dict[Tuple[str, str], Dict[str, Any]]):
+        """K 线事件总线监听器：按最新收盘价增量更新相关组合"""
+        if not self._by_code:
+            return
+        ticks: Dict[str, Dict[str, float]] = {}
+        with self._lock:
+            for (ts_code, period_type), bar in bars.items():
+                if not bar or period_type != self.bar_period or ts_code not in self._by_code:
+                    continue
+                close = bar.get('close')
+                if close is None:
+                    continue
+                for portfolio_id in self._by_code[ts_code]:
+                    ticks.setdefault(portfolio_id, {})[ts_code] = float(close)
+        for portfolio_id, prices in ticks.items():
+            self.stats['ticks'] += len(prices)
+            self._apply(portfolio_id, lambda state: [code for code, price in prices.items()
+                                                     if state.update_price(code, price)])
+
+    def on_position_change(self, position: PortfolioPosition, removed: bool = False):
+        """持仓变化（ORM 事件）：数量、成本、止损止盈价与价格直接增量更新"""
+        portfolio_id = position.portfolio_id
+        state = self.states.get(portfolio_id)
+        if state is None:
+            return
+        self.stats['position_updates'] += 1
+        ts_code = position.ts_code
+        if ts_code not in state.index:
+            if not removed:
+                self._pending_rebuild.add(portfolio_id)
+            return
+
+        def update(current: PortfolioRiskState) -> List[str]:
+            if removed or not position.is_active:
+                current.update_quantity(ts_code, 0.0)
+                return []
+            current.update_levels(ts_code, position.avg_cost, position.stop_loss_price,
+                                  position.take_profit_price)
+            current.update_quantity(ts_code, position.position_size or 0.0)
+            if position.current_price:
+                current.update_price(ts_code, position.current_price)
+            return [ts_code]
+
+        self._apply(portfolio_id, update)
+
+    def request_rebuild(self, portfolio_id: str):
+        if portfolio_id in self.states:
+            self._pending_rebuild.add(portfolio_id)
+
+    def flush_rebuilds(self):
+        """事务提交后在后台重建持仓结构发生变化的组合"""
+        if not self._pending_rebuild:
+            return
+        pending, self._pending_rebuild = self._pending_rebuild, set()
+        for portfolio_id in pending:
+            self._submit(self.track, portfolio_id)
+
+    def _apply(self, portfolio_id: str, update):
+        """执行一次增量更新并检查预警；update 返回需要检查持仓规则的股票"""
+        state = self.states.get(portfolio_id)
+        if state is None:
+            return
+        started = time.perf_counter()
+        with state.lock:
+            changed = update(state) or []
+            state.maybe_resync(self.resync_interval)
+            alerts = []
+            for code in changed:
+                alerts.extend(self._transition(state, code, self._position_alerts(state, code)))
+            alerts.extend(self._transition(state, None, self._portfolio_alerts(state)))
+            state.updates += 1
+            state.last_latency_ms = (time.perf_counter() - started) * 1000
+            state.max_latency_ms = max(state.max_latency_ms, state.last_latency_ms)
+        for alert in alerts:
+            self._emit(alert)
+
+    # ==================== 预警 ====================
+
+    def _position_alerts(self, state: PortfolioRiskState, ts_code: str) -> List[Dict]:
+        i = state.index[ts_code]
+        if state.quantities[i] <= 0:
+            return []
+        return evaluate_position_alerts(
+            ts_code, float(state.prices[i]), float(state.avg_cost[i]),
+            state.stop_loss[i], state.take_profit[i], state.weight_pct(i),
+            self.risk_manager.risk_thresholds['position_weight']
+        )
+
+    def _portfolio_alerts(self, state: PortfolioRiskState) -> List[Dict]:
+        """组合层面的 VaR 与波动率限制，口径同 RealtimeRiskManager._check_risk_thresholds"""
+        thresholds = self.risk_manager.risk_thresholds
+        metrics = state.metrics()
+        alerts = []
+        var_95 = metrics['historical'].get('var_95', metrics['parametric'].get('var_95', 0.0))
+        if abs(var_95) > thresholds['var_limit']:
+            alerts.append({
+                'alert_type': 'var_limit_exceeded',
+                'alert_level': 'high',
+                'message': f'组合VaR超限: var_95 = {var_95:.4f}',
+                'risk_value': var_95,
+                'threshold_value': thresholds['var_limit']
+            })
+        if metrics['annual_volatility'] > thresholds['volatility_limit']:
+            alerts.append({
+                'alert_type': 'volatility_limit_exceeded',
+                'alert_level': 'medium',
+                'message': f'组合波动率过高: {metrics["annual_volatility"]:.4f}',
+                'risk_value': metrics['annual_volatility'],
+                'threshold_value': thresholds['volatility_limit']
+            })
+        return alerts
+
+    @staticmethod
+    def _transition(state: PortfolioRiskState, ts_code: Optional[str], alerts: List[Dict]) -> List[Dict]:
+        """只返回新进入触发状态的预警；已解除的预警移出，再次触发时重新发出"""
+        current = {alert['alert_type']: alert for alert in alerts}
+        previous = {alert_type for code, alert_type in state.active_alerts if code == ts_code}
+        for alert_type in previous - current.keys():
+            state.active_alerts.discard((ts_code, alert_type))
+        fresh = []
+        for alert_type, alert in current.items():
+            if alert_type not in previous:
+                state.active_alerts.add((ts_code, alert_type))
+                fresh.append(dict(alert, portfolio_id=state.portfolio_id, source='incremental'))
+        return fresh
+
+    def _emit(self, alert: Dict):
+        self.stats['alerts'] += 1
+        alert['timestamp'] = time.time()
+        try:
+            from app.services.websocket_push_service import push_service
+            push_service.trigger_immediate_push('risk_alert', alert)
+        except Exception as e:
+            logger.error(f"推送增量风险预警失败: {e}")
+        if alert.get('ts_code'):
+            self._submit(self._persist_alert, alert)
+
+    def _persist_alert(self, alert: Dict):
+        # create_risk_alert 内部按 (股票, 预警类型) 去重
+        self.risk_manager.create_risk_alert(
+            alert['ts_code'], alert['alert_type'], alert['alert_level'], alert['message']
+        )
+
+    def _submit(self, func, *args):
+        def run():
+            try:
+                if self.app is not None:
+                    with self.app.app_context():
+                        func(*args)
+                else:
+                    func(*args)
+            except Exception as e:
+                logger.error(f"增量风险后台任务失败: {e}")
+        self._executor.submit(run)
+
+
+_incremental_risk_manager: Optional[IncrementalRiskManager] = None
+
+
+def get_incremental_risk_manager() -> IncrementalRiskManager:
+    """获取全局增量风险管理器实例（延迟初始化，创建时注册 K 线监听器）"""
+    global _incremental_risk_manager
+    if _incremental_risk_manager is None:
+        _incremental_risk_manager = IncrementalRiskManager()
+        get_bar_event_bus().add_listener(_incremental_risk_manager.on_bars)
+    return _incremental_risk_manager
+
+
+# ==================== 持仓变化 ====================
+
+# 需要增量处理的持仓字段
+_POSITION_FIELDS = ('position_size', 'avg_cost', 'current_price', 'stop_loss_price',
+                    'take_profit_price', 'is_active')
+# 改变组合股票集合的字段，提交后重建
+_STRUCTURE_FIELDS = ('portfolio_id', 'ts_code')
+
+
+@event.listens_for(PortfolioPosition, 'after_insert')
+def _on_position_inserted(mapper, connection, target):
+    if _incremental_risk_manager is not None:
+        _incremental_risk_manager.request_rebuild(target.portfolio_id)
+
+
+@event.listens_for(PortfolioPosition, 'after_delete')
+def _on_position_deleted(mapper, connection, target):
+    if _incremental_risk_manager is not None:
+        _incremental_risk_manager.on_position_change(target, removed=True)
+
+
+@event.listens_for(PortfolioPosition, 'after_update')
+def _on_position_updated(mapper, connection, target):
+    manager = _incremental_risk_manager
+    if manager is None:
+        return
+    state = inspect(target)
+    if any(state.attrs[name].history.has_changes() for name in _STRUCTURE_FIELDS):
+        deleted = state.attrs.portfolio_id.history.deleted
+        if deleted:
+            manager.request_rebuild(deleted[0])
+        manager.request_rebuild(target.portfolio_id)
+        return
+    if any(state.attrs[name].history.has_changes() for name in _POSITION_FIELDS):
+        manager.on_position_change(target)
+
+
+@event.listens_for(Session, 'after_commit')
+def _on_commit(session):
+    if _incremental_risk_manager is not None:
+        _incremental_risk_manager.flush_rebuilds()
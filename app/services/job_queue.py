@@ -0,0 +1,312 @@
+"""
+异步任务队列
+把耗时的 API 请求（因子计算、模型训练、回测等）提交到有界线程池中后台执行，
+请求立即返回任务ID。任务状态、进度、阶段性结果和最终结果保存在独立的 SQLite
+任务表中，服务重启后仍可查询；取消通过任务表中的标记传递，任务在下一个检查点退出。
+"""
+
+import os
+import json
+import uuid
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Any, List, Optional, Tuple
+from loguru import logger
+
+
+DEFAULT_JOB_STORE_PATH = 'data/jobs.db'
+
+JOB_STATUSES = ('pending', 'running', 'succeeded', 'failed', 'cancelled', 'interrupted')
+FINISHED_STATUSES = ('succeeded', 'failed', 'cancelled', 'interrupted')
+
+JSON_FIELDS = ('params', 'partial_result', 'result')
+
+
+class JobCancelled(BaseException):
+    """任务被取消
+
+    继承 BaseException，避免被业务代码中宽泛的 except Exception 吞掉。
+    """
+
+
+class JobQueueFull(Exception):
+    """排队任务数已达上限"""
+
+
+def _dumps(value: Any) -> Optional[str]:
+    if value is None:
+        return None
+    return json.dumps(value, ensure_ascii=False, default=str)
+
+
+def _now() -> str:
+    return datetime.now().isoformat(timespec='seconds')
+
+
+def _pid_alive(pid: Optional[int]) -> bool:
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class JobStore:
+    """基于 SQLite 的任务表"""
+
+    def __init__(self, path: str = DEFAULT_JOB_STORE_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    job_type TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    params TEXT,
+                    progress REAL DEFAULT 0,
+                    message TEXT,
+                    partial_result TEXT,
+                    result TEXT,
+                    error TEXT,
+                    cancel_requested INTEGER DEFAULT 0,
+                    owner_pid INTEGER,
+                    created_at TEXT,
+                    started_at TEXT,
+                    finished_at TEXT,
+                    updated_at TEXT
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_created ON jobs (created_at)')
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _to_dict(self, row: sqlite3.Row, include_result: bool = True) -> Dict[str, Any]:
+        job = dict(row)
+        for field in JSON_FIELDS:
+            if job.get(field) is not None:
+                job[field] = json.loads(job[field])
+        job['cancel_requested'] = bool(job['cancel_requested'])
+        if not include_result:
+            job.pop('result', None)
+            job.pop('partial_result', None)
+        return job
+
+    def create(self, job_type: str, params: Dict[str, Any]) -> str:
+        job_id = uuid.uuid4().hex
+        now = _now()
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT INTO jobs (job_id, job_type, status, params, owner_pid, created_at, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (job_id, job_type, 'pending', _dumps(params), os.getpid(), now, now)
+            )
+        return job_id
+
+    def update(self, job_id: str, **fields):
+        if not fields:
+            return
+        fields['updated_at'] = _now()
+        for field in JSON_FIELDS:
+            if field in fields:
+                fields[field] = _dumps(fields[field])
+        assignments = ', '.join(f'{name} = ?' for name in fields)
+        with self._connect() as conn:
+            conn.execute(f'UPDATE jobs SET {assignments} WHERE job_id = ?', (*fields.values(), job_id))
+
+    def get(self, job_id: str, include_result: bool = True) -> Optional[Dict[str, Any]]:
+        with self._connect() as conn:
+            row = conn.execute('SELECT * FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+        return self._to_dict(row, include_result) if row else None
+
+    def list(self, status: str = None, job_type: str = None, limit: int = 50) -> List[Dict[str, Any]]:
+        sql = 'SELECT * FROM jobs'
+        conditions, args = [], []
+        if status:
+            conditions.append('status = ?')
+            args.append(status)
+        if job_type:
+            conditions.append('job_type = ?')
+            args.append(job_type)
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY created_at DESC LIMIT ?'
+        args.append(int(limit))
+        with self._connect() as conn:
+            rows = conn.execute(sql, args).fetchall()
+        return [self._to_dict(row, include_result=False) for row in rows]
+
+    def count_active(self) -> int:
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status IN ('pending', 'running') AND owner_pid = ?",
+                (os.getpid(),)
+            ).fetchone()[0]
+
+    def request_cancel(self, job_id: str) -> bool:
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET cancel_requested = 1, updated_at = ? "
+                "WHERE job_id = ? AND status IN ('pending', 'running')",
+                (_now(), job_id)
+            )
+        return cursor.rowcount > 0
+
+    def is_cancel_requested(self, job_id: str) -> bool:
+        with self._connect() as conn:
+            row = conn.execute('SELECT cancel_requested FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+        return bool(row and row[0])
+
+    def recover(self) -> int:
+        """把所属进程已退出的未完成任务标记为 interrupted"""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT job_id, owner_pid FROM jobs WHERE status IN ('pending', 'running')"
+            ).fetchall()
+        orphaned = [row['job_id'] for row in rows if not _pid_alive(row['owner_pid'])]
+        for job_id in orphaned:
+            self.update(job_id, status='interrupted', error='服务重启，任务中断', finished_at=_now())
+        if orphaned:
+            logger.warning(f"{len(orphaned)} 个未完成任务因服务重启被标记为中断")
+        return len(orphaned)
+
+
+class JobContext:
+    """任务执行上下文，供任务函数汇报进度、阶段性结果并检查取消
+
+    不绑定任务（同步执行）时所有方法都是空操作。
+    """
+
+    def __init__(self, store: JobStore = None, job_id: str = None, min_interval: float = 0.5):
+        self.store = store
+        self.job_id = job_id
+        self.min_interval = min_interval
+        self._last_write = 0.0
+        self._last_check = 0.0
+
+    @property
+    def bound(self) -> bool:
+        return self.store is not None
+
+    def check_cancelled(self, force: bool = False):
+        """收到取消请求时抛出 JobCancelled"""
+        if not self.bound:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_check < self.min_interval:
+            return
+        self._last_check = now
+        if self.store.is_cancel_requested(self.job_id):
+            raise JobCancelled(self.job_id)
+
+    def update(self, progress: float = None, message: str = None, partial_result: Any = None,
+               force: bool = False):
+        """汇报进度（0~1）、说明和阶段性结果，同时作为取消检查点"""
+        if not self.bound:
+            return
+        self.check_cancelled(force=True)
+        now = time.monotonic()
+        if not force and partial_result is None and now - self._last_write < self.min_interval:
+            return
+        self._last_write = now
+
+        fields = {}
+        if progress is not None:
+            fields['progress'] = round(min(max(float(progress), 0.0), 1.0), 4)
+        if message is not None:
+            fields['message'] = message
+        if partial_result is not None:
+            fields['partial_result'] = partial_result
+        self.store.update(self.job_id, **fields)
+
+
+# 任务函数签名：func(params, job) -> (结果字典, HTTP 状态码)
+JobFunc = Callable[[Dict[str, Any], JobContext], Tuple[Dict[str, Any], int]]
+
+
+class JobQueue:
+    """有界线程池任务队列"""
+
+    def __init__(self, app, store: JobStore = None, max_workers: int = 2, max_pending: int = 20,
+                 serializer: Callable[[Any], Any] = None):
+        self.app = app
+        self.store = store or JobStore(app.config.get('JOB_STORE_PATH', DEFAULT_JOB_STORE_PATH))
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.serializer = serializer or (lambda value: value)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self.futures: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+        self.store.recover()
+
+    def submit(self, job_type: str, func: JobFunc, params: Dict[str, Any]) -> str:
+        """提交任务，返回任务ID；排队任务过多时抛出 JobQueueFull"""
+        with self._lock:
+            if self.store.count_active() >= self.max_pending:
+                raise JobQueueFull(f"排队任务数已达上限 {self.max_pending}")
+            job_id = self.store.create(job_type, params)
+            self.futures[job_id] = self.executor.submit(self._run, job_id, job_type, func, params)
+        logger.info(f"提交后台任务 {job_type}: {job_id}")
+        return job_id
+
+    def _run(self, job_id: str, job_type: str, func: JobFunc, params: Dict[str, Any]):
+        from app.extensions import db
+
+        job = JobContext(self.store, job_id)
+        started = time.perf_counter()
+        try:
+            with self.app.app_context():
+                try:
+                    job.check_cancelled(force=True)
+                    self.store.update(job_id, status='running', started_at=_now(), message='运行中')
+                    payload, status_code = func(params, job)
+                    payload = self.serializer(payload)
+                    if status_code >= 400:
+                        self.store.update(job_id, status='failed', result=payload,
+                                          error=str(payload.get('error', f'HTTP {status_code}')),
+                                          finished_at=_now())
+                    else:
+                        self.store.update(job_id, status='succeeded', progress=1.0, result=payload,
+                                          message='已完成', finished_at=_now())
+                finally:
+                    db.session.remove()
+        except JobCancelled:
+            self.store.update(job_id, status='cancelled', message='已取消', finished_at=_now())
+            logger.info(f"后台任务已取消 {job_type}: {job_id}")
+        except Exception as e:
+            logger.error(f"后台任务失败 {job_type}: {job_id}, 错误: {e}")
+            self.store.update(job_id, status='failed', error=str(e), finished_at=_now())
+        finally:
+            with self._lock:
+                self.futures.pop(job_id, None)
+            logger.info(f"后台任务结束 {job_type}: {job_id}, 耗时 {time.perf_counter() - started:.2f}s")
+
+    def cancel(self, job_id: str) -> bool:
+        """请求取消任务：尚未开始的任务直接取消，运行中的任务在下一个检查点退出"""
+        if not self.store.request_cancel(job_id):
+            return False
+        with self._lock:
+            future = self.futures.get(job_id)
+        if future is not None and future.cancel():
+            self.store.update(job_id, status='cancelled', message='已取消', finished_at=_now())
+            with self._lock:
+                self.futures.pop(job_id, None)
+        return True
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return self.store.get(job_id)
+
+    def list(self, status: str = None, job_type: str = None, limit: int = 50) -> List[Dict[str, Any]]:
+        return self.store.list(status, job_type, limit)
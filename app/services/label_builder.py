@@ -0,0 +1,139 @@
+"""
+训练标签构建
+一次性从面板存储加载全市场收盘价和复权因子，在每只股票自身的交易日序列上整块位移，
+计算 N 个交易日后的远期收益，再按 (股票, 交易日) 批量取出标签。支持的目标类型:
+    return_{N}d         N 日远期收益率
+    excess_return_{N}d  相对全市场等权平均的超额收益
+    rank_return_{N}d    N 日远期收益的横截面百分位排名 (0~1)
+按 (目标类型, 日期范围) 缓存标签面板，训练、评估和实际收益查询共用。
+"""
+
+import re
+import threading
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Tuple
+from loguru import logger
+
+from app.services.factor_kernels import apply_on_observed
+from app.services.panel_store import get_panel_store
+
+
+LABEL_KINDS = ('return', 'excess', 'rank')
+DEFAULT_PERIOD = 5
+
+_TARGET_PATTERN = re.compile(r'^(?:(excess|rank)_)?return_(\d+)d$')
+
+
+def parse_target_type(target_type: str) -> Tuple[str, int]:
+    """解析目标类型为 (标签种类, 周期)，无法识别时按 5 日收益率处理"""
+    match = _TARGET_PATTERN.match(target_type or '')
+    if not match:
+        return 'return', DEFAULT_PERIOD
+    return match.group(1) or 'return', int(match.group(2))
+
+
+def forward_returns(close: pd.DataFrame, adj_factor: pd.DataFrame, period: int) -> pd.DataFrame:
+    """每只股票自身 N 个交易日后的远期收益率面板
+
+    起点和终点都是该股票实际成交的交易日，停牌日不计入 N，也不给标签；
+    之后不足 N 个交易日的股票不给标签。复权因子缺失时按未复权价格计算。
+    """
+    observed = close.notna()
+    prices = close
+    if adj_factor is not None and not adj_factor.empty:
+        adj = adj_factor.reindex(index=close.index, columns=close.columns).ffill().bfill().fillna(1.0)
+        prices = prices * adj
+
+    def kernel(panels):
+        price = panels['price']
+        return price.shift(-period) / price - 1
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = apply_on_observed(kernel, {'price': prices}, observed)
+    return result.where(np.isfinite(result))
+
+
+class ForwardReturnLabeler:
+    """远期收益标签构建器"""
+
+    def __init__(self, max_cache_entries: int = 8):
+        self.max_cache_entries = max_cache_entries
+        self._cache: 'OrderedDict[tuple, pd.DataFrame]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def label_panel(self, target_type: str, start_date, end_date) -> pd.DataFrame:
+        """[start_date, end_date] 内全市场的标签面板（日期 × 股票）"""
+        kind, period = parse_target_type(target_type)
+        start = pd.Timestamp(start_date).normalize()
+        end = pd.Timestamp(end_date).normalize()
+        key = (kind, period, start, end)
+
+        with self._lock:
+            panel = self._cache.get(key)
+            if panel is not None:
+                self._cache.move_to_end(key)
+                self.cache_hits += 1
+                return panel
+            self.cache_misses += 1
+
+        panel = self._build(kind, period, start, end)
+        with self._lock:
+            self._cache[key] = panel
+            while len(self._cache) > self.max_cache_entries:
+                self._cache.popitem(last=False)
+        return panel
+
+    def _build(self, kind: str, period: int, start: pd.Timestamp, end: pd.Timestamp) -> pd.DataFrame:
+        # 多取一段行情覆盖区间末尾的远期窗口（含长假）
+        load_end = end + timedelta(days=period * 7 // 5 + 20)
+        store = get_panel_store()
+        close = store.get_frame('close', None, start.strftime('%Y-%m-%d'), load_end.strftime('%Y-%m-%d'))
+        close = close.dropna(axis=1, how='all')
+        if close.empty:
+            return close
+        adj = store.get_frame('adj_factor', None, start.strftime('%Y-%m-%d'), load_end.strftime('%Y-%m-%d'))
+
+        labels = forward_returns(close, adj, period)
+        if kind == 'excess':
+            labels = labels.sub(labels.mean(axis=1), axis=0)
+        elif kind == 'rank':
+            labels = labels.rank(axis=1, pct=True)
+
+        labels = labels.loc[:end]
+        logger.info(f"构建标签 {kind}_{period}d: {len(labels)} 个交易日 × {labels.shape[1]} 只股票")
+        return labels
+
+    def lookup(self, keys: pd.DataFrame, target_type: str, start_date=None, end_date=None) -> pd.Series:
+        """按 keys 的 (ts_code, trade_date) 取标签，返回与 keys 行对齐的 Series，缺失为 NaN"""
+        if keys.empty:
+            return pd.Series(dtype='float64', index=keys.index)
+
+        dates = pd.to_datetime(keys['trade_date'])
+        panel = self.label_panel(target_type, start_date or dates.min(), end_date or dates.max())
+        values = np.full(len(keys), np.nan)
+        if not panel.empty:
+            rows = panel.index.get_indexer(dates)
+            cols = panel.columns.get_indexer(keys['ts_code'])
+            found = (rows >= 0) & (cols >= 0)
+            values[found] = panel.to_numpy()[rows[found], cols[found]]
+        return pd.Series(values, index=keys.index)
+
+    def clear_cache(self):
+        with self._lock:
+            self._cache.clear()
+
+
+_labeler = None
+
+
+def get_labeler() -> ForwardReturnLabeler:
+    """获取全局标签构建器实例（延迟初始化）"""
+    global _labeler
+    if _labeler is None:
+        _labeler = ForwardReturnLabeler()
+    return _labeler
@@ -0,0 +1,346 @@
+"""
+实时 K 线缓存
+进程内为每个 (股票, 周期) 保存最近 capacity 根 K 线，数据存放在定长 NumPy 环形缓冲区中。
+同步/入库流程写入缓存，实时行情、监控、信号、风控和推送服务直接从缓存读取最新 K 线；
+每次写入后把各序列的最新 K 线发布到行情事件总线。
+
+并发采用读-复制-更新：每个序列是不可变的 BarSeries 快照，写入方在写锁内复制缓冲区、
+写入新 K 线后整体替换字典中的引用；读取方无锁拿到某一时刻的完整快照，不会读到写了一半的数据。
+
+内存上限按序列占用字节数计算，超过上限时淘汰最久未访问的序列。缓存未命中时从数据库加载
+最近 capacity 根 K 线（读穿），加载后的序列标记为完整，之后的写入在其基础上追加。
+"""
+
+import threading
+import time
+import numpy as np
+import pandas as pd
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from loguru import logger
+
+from app.models.stock_minute_data import StockMinuteData
+from app.services.event_bus import get_bar_event_bus
+
+
+BAR_FIELDS = ('open', 'high', 'low', 'close', 'volume', 'amount', 'change', 'pct_chg')
+DEFAULT_CAPACITY = 240
+DEFAULT_CACHE_MAX_MB = 128
+
+
+def _to_ns(value) -> int:
+    return pd.Timestamp(value).value
+
+
+class BarSeries:
+    """不可变的 K 线环形缓冲区快照
+
+    times 为纳秒时间戳，values 为 (capacity, len(BAR_FIELDS)) 的浮点数组；
+    head 指向最早一根 K 线，size 为有效 K 线数量。
+    complete 表示序列包含从最早一根起数据库中的全部 K 线，
+    exhausted 表示数据库中没有比最早一根更早的 K 线。
+    """
+
+    __slots__ = ('capacity', 'times', 'values', 'head', 'size', 'complete', 'exhausted', 'updated_at')
+
+    def __init__(self, capacity: int, times: np.ndarray, values: np.ndarray, head: int, size: int,
+                 complete: bool, exhausted: bool):
+        self.capacity = capacity
+        self.times = times
+        self.values = values
+        self.head = head
+        self.size = size
+        self.complete = complete
+        self.exhausted = exhausted
+        self.updated_at = time.time()
+        times.flags.writeable = False
+        values.flags.writeable = False
+
+    @classmethod
+    def empty(cls, capacity: int, complete: bool = False) -> 'BarSeries':
+        return cls(capacity, np.zeros(capacity, dtype='int64'),
+                   np.full((capacity, len(BAR_FIELDS)), np.nan), 0, 0, complete, False)
+
+    @property
+    def nbytes(self) -> int:
+        return self.times.nbytes + self.values.nbytes
+
+    def _order(self, limit: int = None) -> np.ndarray:
+        size = self.size if limit is None else min(limit, self.size)
+        return (self.head + np.arange(self.size - size, self.size)) % self.capacity
+
+    @property
+    def first_time(self) -> Optional[int]:
+        return int(self.times[self.head]) if self.size else None
+
+    @property
+    def last_time(self) -> Optional[int]:
+        return int(self.times[(self.head + self.size - 1) % self.capacity]) if self.size else None
+
+    def tail(self, limit: int = None) -> Tuple[np.ndarray, np.ndarray]:
+        """按时间顺序返回最近 limit 根 K 线的 (times, values) 副本"""
+        order = self._order(limit)
+        return self.times[order], self.values[order]
+
+    def covers(self, since_ns: int) -> bool:
+        """是否包含 since 之后数据库中的全部 K 线"""
+        return self.complete and self.size > 0 and (self.exhausted or self.first_time <= since_ns)
+
+    def with_bars(self, times: np.ndarray, values: np.ndarray) -> 'BarSeries':
+        """返回写入新 K 线后的新快照；同一时间的 K 线以新值为准"""
+        if self.size and len(times) and times[0] > self.last_time and np.all(np.diff(times) > 0) \
+                and len(times) < self.capacity:
+            # 快速路径：按时间顺序追加，复制缓冲区后逐个写入槽位
+            new_times, new_values = self.times.copy(), self.values.copy()
+            head, size = self.head, self.size
+            slots = (head + size + np.arange(len(times))) % self.capacity
+            new_times[slots] = times
+            new_values[slots] = values
+            overflow = max(0, size + len(times) - self.capacity)
+            head = (head + overflow) % self.capacity
+            size = min(self.capacity, size + len(times))
+            return BarSeries(self.capacity, new_times, new_values, head, size,
+                             self.complete, self.exhausted and overflow == 0)
+
+        # 一般路径：合并、按时间去重（保留后写入的值）、保留最后 capacity 根
+        old_times, old_values = self.tail()
+        all_times = np.concatenate([old_times, times])
+        all_values = np.concatenate([old_values, values])
+        order = np.argsort(all_times, kind='stable')
+        sorted_times = all_times[order]
+        keep = np.append(sorted_times[1:] != sorted_times[:-1], True)
+        selected = order[keep]
+        dropped = len(selected) > self.capacity
+        selected = selected[-self.capacity:]
+
+        new_times = np.zeros(self.capacity, dtype='int64')
+        new_values = np.full((self.capacity, len(BAR_FIELDS)), np.nan)
+        new_times[:len(selected)] = all_times[selected]
+        new_values[:len(selected)] = all_values[selected]
+        return BarSeries(self.capacity, new_times, new_values, 0, len(selected),
+                         self.complete, self.exhausted and not dropped)
+
+
+def _records_to_arrays(bars: Iterable[Dict[str, Any]]) -> Tuple[np.ndarray, np.ndarray]:
+    bars = list(bars)
+    times = np.fromiter((_to_ns(bar['datetime']) for bar in bars), dtype='int64', count=len(bars))
+    values = np.array([[bar.get(name) if bar.get(name) is not None else np.nan for name in BAR_FIELDS]
+                       for bar in bars], dtype='float64').reshape(len(bars), len(BAR_FIELDS))
+    order = np.argsort(times, kind='stable')
+    return times[order], values[order]
+
+
+class LiveBarCache:
+    """进程内实时 K 线缓存"""
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY,
+                 max_bytes: int = DEFAULT_CACHE_MAX_MB * 1024 * 1024):
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self._series: Dict[Tuple[str, str], BarSeries] = {}
+        self._last_access: Dict[Tuple[str, str], float] = {}
+        self._write_lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.fallbacks = 0
+        self.bars_written = 0
+        self.evictions = 0
+
+    # ---------------------------------------------------------------- 写入
+
+    def ingest(self, records: Iterable[Dict[str, Any]]) -> int:
+        """写入入库记录（需要 ts_code/period_type/datetime 及 OHLCV 字段），返回写入的 K 线数"""
+        grouped: Dict[Tuple[str, str], List[Dict[str, Any]]] = {}
+        for record in records:
+            if record.get('datetime') is None or record.get('close') is None:
+                continue
+            key = (record['ts_code'], record.get('period_type') or '1min')
+            grouped.setdefault(key, []).append(record)
+
+        written = 0
+        latest = {}
+        for (ts_code, period_type), bars in grouped.items():
+            written += self.append(ts_code, period_type, bars)
+            bar = max(bars, key=lambda item: pd.Timestamp(item['datetime']))
+            latest[(ts_code, period_type)] = {name: bar.get(name) for name in ('datetime',) + BAR_FIELDS}
+        # 通知推送等下游消费者
+        get_bar_event_bus().publish(latest)
+        return written
+
+    def append(self, ts_code: str, period_type: str, bars: List[Dict[str, Any]]) -> int:
+        """向单个序列写入 K 线"""
+        if not bars:
+            return 0
+        times, values = _records_to_arrays(bars)
+        key = (ts_code, period_type)
+        with self._write_lock:
+            current = self._series.get(key) or BarSeries.empty(self.capacity)
+            self._publish(key, current.with_bars(times, values))
+            self.bars_written += len(times)
+        return len(times)
+
+    def _publish(self, key: Tuple[str, str], series: BarSeries):
+        """替换序列引用并按内存上限淘汰（调用方持有写锁）"""
+        old = self._series.get(key)
+        self._series[key] = series
+        self._last_access[key] = time.monotonic()
+        self.total_bytes += series.nbytes - (old.nbytes if old is not None else 0)
+
+        if self.total_bytes > self.max_bytes and len(self._series) > 1:
+            # 一次淘汰约 5% 的最久未访问序列，避免每次写入都排序
+            victims = sorted((k for k in self._series if k != key), key=lambda k: self._last_access.get(k, 0))
+            batch = max(1, len(self._series) // 20)
+            for victim in victims:
+                if self.total_bytes <= self.max_bytes and batch <= 0:
+                    break
+                evicted = self._series.pop(victim)
+                self._last_access.pop(victim, None)
+                self.total_bytes -= evicted.nbytes
+                self.evictions += 1
+                batch -= 1
+
+    def invalidate(self, ts_code: str = None, period_type: str = None):
+        """删除匹配的序列，参数为空表示全部"""
+        with self._write_lock:
+            for key in [k for k in self._series
+                        if (ts_code is None or k[0] == ts_code) and (period_type is None or k[1] == period_type)]:
+                self.total_bytes -= self._series.pop(key).nbytes
+                self._last_access.pop(key, None)
+
+    # ---------------------------------------------------------------- 读取
+
+    def _get(self, ts_code: str, period_type: str) -> Optional[BarSeries]:
+        key = (ts_code, period_type)
+        series = self._series.get(key)
+        if series is not None:
+            self._last_access[key] = time.monotonic()
+        return series
+
+    def _load(self, ts_code: str, period_type: str) -> Optional[BarSeries]:
+        """从数据库加载最近 capacity 根 K 线作为完整序列"""
+        rows = StockMinuteData.query.with_entities(
+            StockMinuteData.datetime, *[getattr(StockMinuteData, name) for name in BAR_FIELDS]
+        ).filter(
+            StockMinuteData.ts_code == ts_code,
+            StockMinuteData.period_type == period_type
+        ).order_by(StockMinuteData.datetime.desc()).limit(self.capacity).all()
+        self.loads += 1
+        if not rows:
+            return None
+
+        bars = [dict(zip(('datetime',) + BAR_FIELDS, row)) for row in rows]
+        times, values = _records_to_arrays(bars)
+        key = (ts_code, period_type)
+        with self._write_lock:
+            series = BarSeries.empty(self.capacity, complete=True).with_bars(times, values)
+            series.exhausted = len(rows) < self.capacity
+            current = self._series.get(key)
+            if current is not None and current.size:
+                # 加载期间写入的新 K 线覆盖到加载结果上
+                series = series.with_bars(*current.tail())
+            self._publish(key, series)
+        return series
+
+    def get_series(self, ts_code: str, period_type: str = '1min', since: datetime = None,
+                   limit: int = None, load: bool = True) -> Optional[BarSeries]:
+        """取能满足 since/limit 的序列快照；缓存无法满足且不能从数据库补齐时返回 None"""
+        def satisfied(series: Optional[BarSeries]) -> bool:
+            # 只有与数据库对齐过的完整序列才能直接读取
+            if series is None or not series.size or not series.complete:
+                return False
+            if since is not None and not series.covers(_to_ns(since)):
+                return False
+            if limit is not None and series.size < limit and not (series.complete and series.exhausted):
+                return False
+            return True
+
+        series = self._get(ts_code, period_type)
+        if satisfied(series):
+            self.hits += 1
+            return series
+        self.misses += 1
+        if not load or (series is not None and series.complete):
+            # 完整序列仍不满足说明窗口超出缓存容量
+            self.fallbacks += 1
+            return None
+        try:
+            series = self._load(ts_code, period_type)
+        except Exception as e:
+            logger.error(f"加载 {ts_code} {period_type} K线到缓存失败: {e}")
+            return None
+        if satisfied(series):
+            return series
+        self.fallbacks += 1
+        return None
+
+    def get_bars(self, ts_code: str, period_type: str = '1min', since: datetime = None,
+                 until: datetime = None, limit: int = None, load: bool = True) -> Optional[pd.DataFrame]:
+        """按时间顺序返回 K 线 DataFrame（datetime + BAR_FIELDS），缓存无法满足时返回 None"""
+        series = self.get_series(ts_code, period_type, since=since, limit=limit, load=load)
+        if series is None:
+            return None
+        times, values = series.tail()
+        mask = np.ones(len(times), dtype=bool)
+        if since is not None:
+            mask &= times >= _to_ns(since)
+        if until is not None:
+            mask &= times <= _to_ns(until)
+        times, values = times[mask], values[mask]
+        if limit is not None:
+            times, values = times[-limit:], values[-limit:]
+        frame = pd.DataFrame(values, columns=list(BAR_FIELDS))
+        frame.insert(0, 'datetime', pd.to_datetime(times))
+        return frame
+
+    def latest(self, ts_code: str, period_type: str = '1min', load: bool = True) -> Optional[Dict[str, Any]]:
+        """最新一根 K 线"""
+        series = self.get_series(ts_code, period_type, limit=1, load=load)
+        if series is None:
+            return None
+        times, values = series.tail(1)
+        bar = {name: (None if np.isnan(value) else float(value)) for name, value in zip(BAR_FIELDS, values[0])}
+        bar['datetime'] = pd.Timestamp(int(times[0])).to_pydatetime()
+        bar['ts_code'] = ts_code
+        bar['period_type'] = period_type
+        return bar
+
+    def keys(self, period_type: str = None) -> List[Tuple[str, str]]:
+        """缓存中的序列，按最近更新时间从新到旧排列"""
+        items = [(key, series.updated_at) for key, series in list(self._series.items())
+                 if period_type is None or key[1] == period_type]
+        return [key for key, _ in sorted(items, key=lambda item: item[1], reverse=True)]
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'series': len(self._series),
+            'capacity': self.capacity,
+            'total_mb': round(self.total_bytes / 1024 / 1024, 2),
+            'max_mb': round(self.max_bytes / 1024 / 1024, 2),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+            'db_loads': self.loads,
+            'db_fallbacks': self.fallbacks,
+            'bars_written': self.bars_written,
+            'evictions': self.evictions
+        }
+
+
+_live_bar_cache = None
+
+
+def get_live_bar_cache() -> LiveBarCache:
+    """获取全局实时 K 线缓存实例（延迟初始化）"""
+    global _live_bar_cache
+    if _live_bar_cache is None:
+        try:
+            from flask import current_app
+            capacity = current_app.config.get('LIVE_BAR_CAPACITY', DEFAULT_CAPACITY)
+            max_mb = current_app.config.get('LIVE_BAR_CACHE_MAX_MB', DEFAULT_CACHE_MAX_MB)
+        except RuntimeError:
+            capacity, max_mb = DEFAULT_CAPACITY, DEFAULT_CACHE_MAX_MB
+        _live_bar_cache = LiveBarCache(int(capacity), int(max_mb * 1024 * 1024))
+    return _live_bar_cache
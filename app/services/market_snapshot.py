@@ -0,0 +1,235 @@
+"""
+市场快照
+用少量分组查询一次性取出股票池的最新 K 线、前收盘价、历史平均成交量和区间高低点，
+在数组上向量化计算涨跌幅、量比、突破和异动评分，供实时监控的各个接口共用。
+
+查询按最新 K 线时间分组执行（同一时刻更新的股票共用一组查询），通常只有一两个时间点，
+因此整个股票池只需要四五条 SQL。构建结果按 (周期, 回看小时数, 股票池) 短时缓存。
+"""
+
+import threading
+import time
+import numpy as np
+import pandas as pd
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import and_, func
+from loguru import logger
+
+from app.extensions import db
+from app.models.stock_minute_data import StockMinuteData
+from app.models.stock_basic import StockBasic
+from app.services.live_bar_cache import get_live_bar_cache
+
+
+DEFAULT_SNAPSHOT_TTL = 5.0
+# 前收盘价取最新 K 线之前 1 小时的收盘价，量比和突破使用之前 20 小时的统计
+PREV_CLOSE_HOURS = 1
+TRAILING_HOURS = 20
+# IN 查询每批的股票数量
+IN_CHUNK_SIZE = 500
+
+SNAPSHOT_COLUMNS = [
+    'ts_code', 'name', 'datetime', 'open', 'high', 'low', 'close', 'volume', 'amount',
+    'prev_close', 'avg_volume', 'max_high', 'min_low',
+    'change_pct', 'volume_ratio', 'breakout', 'anomaly_score', 'turnover_rate'
+]
+
+
+def _chunks(items: List[str], size: int = IN_CHUNK_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def compute_metrics(frame: pd.DataFrame) -> pd.DataFrame:
+    """在快照上向量化计算涨跌幅、量比、突破、异动评分和换手率
+
+    前收盘价缺失时涨跌幅为 NaN；平均成交量缺失时量比记为 1。
+    """
+    close = frame['close'].to_numpy(dtype='float64')
+    prev_close = frame['prev_close'].to_numpy(dtype='float64')
+    volume = frame['volume'].fillna(0).to_numpy(dtype='float64')
+    avg_volume = frame['avg_volume'].to_numpy(dtype='float64')
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        change_pct = np.where(prev_close > 0, (close - prev_close) / prev_close * 100, np.nan)
+        volume_ratio = np.where(avg_volume > 0, volume / avg_volume, 1.0)
+
+    high = frame['high'].to_numpy(dtype='float64')
+    low = frame['low'].to_numpy(dtype='float64')
+    max_high = frame['max_high'].to_numpy(dtype='float64')
+    min_low = frame['min_low'].to_numpy(dtype='float64')
+    with np.errstate(invalid='ignore'):
+        breakout = (max_high > 0) & (min_low > 0) & ((high > max_high * 1.01) | (low < min_low * 0.99))
+
+    price_score = np.minimum(50, np.abs(np.nan_to_num(change_pct)) * 5)
+    volume_score = np.minimum(50, (volume_ratio - 1) * 10)
+
+    frame = frame.copy()
+    frame['change_pct'] = change_pct
+    frame['volume_ratio'] = volume_ratio
+    frame['breakout'] = breakout
+    frame['anomaly_score'] = price_score + volume_score
+    frame['turnover_rate'] = np.minimum(20.0, volume / 1000000 * 0.1)
+    return frame
+
+
+class MarketSnapshotBuilder:
+    """市场快照构建器"""
+
+    def __init__(self, ttl: float = DEFAULT_SNAPSHOT_TTL):
+        self.ttl = ttl
+        self._cache: Dict[Tuple, Tuple[float, pd.DataFrame]] = {}
+        self._lock = threading.Lock()
+
+    def build(self, codes: List[str] = None, period_type: str = '1min',
+              period_hours: float = 1) -> pd.DataFrame:
+        """构建快照；codes 为空时取回看窗口内有数据的全部股票，按股票代码排序"""
+        key = (period_type, period_hours, tuple(sorted(codes)) if codes else None)
+        now = time.monotonic()
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None and now - cached[0] < self.ttl:
+                return cached[1]
+
+        start_time = datetime.now() - timedelta(hours=period_hours)
+        frame = self._latest_bars(codes, period_type, start_time)
+        if frame.empty:
+            snapshot = pd.DataFrame(columns=SNAPSHOT_COLUMNS)
+        else:
+            frame = frame.merge(self._previous_close(frame, period_type), on='ts_code', how='left')
+            frame = frame.merge(self._trailing_stats(frame, period_type), on='ts_code', how='left')
+            frame['name'] = frame['ts_code'].map(self._names(frame['ts_code'].tolist()))
+            frame['name'] = frame['name'].fillna(frame['ts_code'])
+            snapshot = compute_metrics(frame)[SNAPSHOT_COLUMNS].sort_values('ts_code').reset_index(drop=True)
+
+        with self._lock:
+            self._cache[key] = (time.monotonic(), snapshot)
+            # 清理过期条目
+            for stale in [k for k, (ts, _) in self._cache.items() if time.monotonic() - ts >= self.ttl * 10]:
+                self._cache.pop(stale, None)
+        logger.debug(f"构建市场快照: {len(snapshot)} 只股票, 周期 {period_type}")
+        return snapshot
+
+    def invalidate(self):
+        with self._lock:
+            self._cache.clear()
+
+    def _latest_bars(self, codes: Optional[List[str]], period_type: str,
+                     start_time: datetime) -> pd.DataFrame:
+        """每只股票在回看窗口内的最新一根 K 线"""
+        columns = ['ts_code', 'datetime', 'open', 'high', 'low', 'close', 'volume', 'amount']
+        frames = []
+        if codes:
+            # 已在实时 K 线缓存中的股票直接取缓存，其余的再查数据库
+            cache = get_live_bar_cache()
+            cached, remaining = [], []
+            for code in codes:
+                bar = cache.latest(code, period_type, load=False)
+                if bar is None:
+                    remaining.append(code)
+                elif bar['datetime'] >= start_time:
+                    cached.append({column: bar[column] if column != 'ts_code' else code for column in columns})
+            frames.append(pd.DataFrame(cached, columns=columns))
+            codes = remaining
+            if not codes:
+                return frames[0]
+
+        for chunk in (_chunks(codes) if codes else [None]):
+            filters = [StockMinuteData.period_type == period_type, StockMinuteData.datetime >= start_time]
+            if chunk is not None:
+                filters.append(StockMinuteData.ts_code.in_(chunk))
+            latest = db.session.query(
+                StockMinuteData.ts_code.label('ts_code'),
+                func.max(StockMinuteData.datetime).label('max_datetime')
+            ).filter(*filters).group_by(StockMinuteData.ts_code).subquery()
+
+            rows = db.session.query(
+                StockMinuteData.ts_code, StockMinuteData.datetime, StockMinuteData.open,
+                StockMinuteData.high, StockMinuteData.low, StockMinuteData.close,
+                StockMinuteData.volume, StockMinuteData.amount
+            ).join(latest, and_(
+                StockMinuteData.ts_code == latest.c.ts_code,
+                StockMinuteData.datetime == latest.c.max_datetime
+            )).filter(StockMinuteData.period_type == period_type).all()
+            frames.append(pd.DataFrame(rows, columns=columns))
+
+        frame = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=columns)
+        return frame.drop_duplicates('ts_code', keep='last')
+
+    def _previous_close(self, latest: pd.DataFrame, period_type: str) -> pd.DataFrame:
+        """每只股票在最新 K 线之前 PREV_CLOSE_HOURS 小时及更早的最后收盘价"""
+        frames = []
+        for bar_time, group in latest.groupby('datetime'):
+            prev_time = bar_time - timedelta(hours=PREV_CLOSE_HOURS)
+            for chunk in _chunks(group['ts_code'].tolist()):
+                last = db.session.query(
+                    StockMinuteData.ts_code.label('ts_code'),
+                    func.max(StockMinuteData.datetime).label('max_datetime')
+                ).filter(
+                    StockMinuteData.ts_code.in_(chunk),
+                    StockMinuteData.period_type == period_type,
+                    StockMinuteData.datetime <= prev_time
+                ).group_by(StockMinuteData.ts_code).subquery()
+
+                rows = db.session.query(StockMinuteData.ts_code, StockMinuteData.close).join(last, and_(
+                    StockMinuteData.ts_code == last.c.ts_code,
+                    StockMinuteData.datetime == last.c.max_datetime
+                )).filter(StockMinuteData.period_type == period_type).all()
+                frames.append(pd.DataFrame(rows, columns=['ts_code', 'prev_close']))
+
+        if not frames:
+            return pd.DataFrame(columns=['ts_code', 'prev_close'])
+        return pd.concat(frames, ignore_index=True).drop_duplicates('ts_code', keep='last')
+
+    def _trailing_stats(self, latest: pd.DataFrame, period_type: str) -> pd.DataFrame:
+        """最新 K 线之前 TRAILING_HOURS 小时内的平均成交量、最高价和最低价"""
+        columns = ['ts_code', 'avg_volume', 'max_high', 'min_low']
+        frames = []
+        for bar_time, group in latest.groupby('datetime'):
+            start_time = bar_time - timedelta(hours=TRAILING_HOURS)
+            for chunk in _chunks(group['ts_code'].tolist()):
+                rows = db.session.query(
+                    StockMinuteData.ts_code,
+                    func.avg(StockMinuteData.volume),
+                    func.max(StockMinuteData.high),
+                    func.min(StockMinuteData.low)
+                ).filter(
+                    StockMinuteData.ts_code.in_(chunk),
+                    StockMinuteData.period_type == period_type,
+                    StockMinuteData.datetime >= start_time,
+                    StockMinuteData.datetime < bar_time
+                ).group_by(StockMinuteData.ts_code).all()
+                frames.append(pd.DataFrame(rows, columns=columns))
+
+        if not frames:
+            return pd.DataFrame(columns=columns)
+        return pd.concat(frames, ignore_index=True)
+
+    def _names(self, codes: List[str]) -> Dict[str, str]:
+        names = {}
+        try:
+            for chunk in _chunks(codes):
+                rows = db.session.query(StockBasic.ts_code, StockBasic.name).filter(
+                    StockBasic.ts_code.in_(chunk)
+                ).all()
+                names.update({code: name for code, name in rows if name})
+        except Exception as e:
+            logger.error(f"获取股票名称失败: {e}")
+        return names
+
+
+_snapshot_builder = None
+
+
+def get_snapshot_builder() -> MarketSnapshotBuilder:
+    """获取全局市场快照构建器实例（延迟初始化）"""
+    global _snapshot_builder
+    if _snapshot_builder is None:
+        try:
+            from flask import current_app
+            ttl = current_app.config.get('MONITOR_SNAPSHOT_TTL', DEFAULT_SNAPSHOT_TTL)
+        except RuntimeError:
+            ttl = DEFAULT_SNAPSHOT_TTL
+        _snapshot_builder = MarketSnapshotBuilder(float(ttl))
+    return _snapshot_builder
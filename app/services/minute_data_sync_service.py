@@ -10,13 +10,21 @@ from datetime import datetime, timedelta
 import logging
 from typing import List, Dict, Optional
 from app.extensions import db
-from app.models.stock_minute_data import StockMinuteData
 from app.utils.db_utils import DatabaseUtils
+from app.services.live_bar_cache import get_live_bar_cache
+from app.services.minute_ingest_pipeline import (
+    MinuteIngestPipeline, parse_bs_time, frame_to_records, upsert_minute_bars,
+    DEFAULT_REQUESTS_PER_SECOND, DEFAULT_FETCH_WORKERS, DEFAULT_WRITE_CHUNK_SIZE
+)
 from sqlalchemy import text
+import threading
 import time
 
 logger = logging.getLogger(__name__)
 
+# Baostock 的会话和套接字是模块级全局对象，多个线程同时查询会串包，查询本身必须串行
+_bs_query_lock = threading.Lock()
+
 class MinuteDataSyncService:
     """分钟级数据同步服务"""
     
@@ -31,6 +39,18 @@ class MinuteDataSyncService:
     
     def __init__(self):
         self.bs_logged_in = False
+        try:
+            from flask import current_app
+            config = current_app.config
+            self.requests_per_second = float(config.get('MINUTE_SYNC_RATE_LIMIT', DEFAULT_REQUESTS_PER_SECOND))
+            self.fetch_workers = int(config.get('MINUTE_SYNC_WORKERS', DEFAULT_FETCH_WORKERS))
+            self.write_chunk_size = int(config.get('MINUTE_SYNC_CHUNK_SIZE', DEFAULT_WRITE_CHUNK_SIZE))
+            self.progress_path = config.get('MINUTE_SYNC_PROGRESS_PATH')
+        except RuntimeError:
+            self.requests_per_second = DEFAULT_REQUESTS_PER_SECOND
+            self.fetch_workers = DEFAULT_FETCH_WORKERS
+            self.write_chunk_size = DEFAULT_WRITE_CHUNK_SIZE
+            self.progress_path = None
         
     def __enter__(self):
         """上下文管理器入口"""
@@ -90,21 +110,33 @@ class MinuteDataSyncService:
             DataFrame包含分钟线数据
         """
         try:
-            # 转换股票代码格式
-            bs_code = self.convert_ts_code_to_bs_code(stock_code)
-            
-            # 获取Baostock频率参数
-            frequency = self.PERIOD_TYPES.get(period_type, '5')  # 默认使用5分钟
-            
-            # 注意：Baostock可能不支持1分钟数据，如果是1分钟则改为5分钟
-            if period_type == '1min':
-                logger.warning(f"Baostock不支持1分钟数据，改为使用5分钟数据: {bs_code}")
-                frequency = '5'
-                actual_period = '5min'
-            else:
-                actual_period = period_type
-            
-            # 查询历史K线数据
+            return self.fetch_minute_frame(stock_code, start_date, end_date, period_type)
+        except Exception as e:
+            logger.error(f"获取{stock_code}的{period_type}数据异常: {e}")
+            return None
+    
+    def fetch_minute_frame(self, stock_code: str, start_date: str, end_date: str,
+                           period_type: str = '1min') -> Optional[pd.DataFrame]:
+        """
+        获取并预处理分钟线数据；区间内无数据时返回 None，查询失败时抛出异常
+        （供同步流水线区分"无数据"和"失败"）
+        """
+        # 转换股票代码格式
+        bs_code = self.convert_ts_code_to_bs_code(stock_code)
+        
+        # 获取Baostock频率参数
+        frequency = self.PERIOD_TYPES.get(period_type, '5')  # 默认使用5分钟
+        
+        # 注意：Baostock可能不支持1分钟数据，如果是1分钟则改为5分钟
+        if period_type == '1min':
+            logger.warning(f"Baostock不支持1分钟数据，改为使用5分钟数据: {bs_code}")
+            frequency = '5'
+            actual_period = '5min'
+        else:
+            actual_period = period_type
+        
+        # 查询历史K线数据（串行访问共享会话）
+        with _bs_query_lock:
             rs = bs.query_history_k_data_plus(
                 bs_code,
                 "date,time,code,open,high,low,close,volume,amount",
@@ -115,30 +147,24 @@ class MinuteDataSyncService:
             )
             
             if rs.error_code != '0':
-                logger.error(f"获取{bs_code}数据失败: {rs.error_msg}")
-                return None
+                raise Exception(f"获取{bs_code}数据失败: {rs.error_msg}")
             
             # 收集数据
             data_list = []
             while rs.next():
                 data_list.append(rs.get_row_data())
-            
-            if not data_list:
-                logger.warning(f"未获取到{bs_code}的{period_type}数据")
-                return None
-                
-            # 创建DataFrame
-            df = pd.DataFrame(data_list, columns=rs.fields)
-            
-            # 数据预处理
-            df = self._preprocess_dataframe(df, actual_period)
-            
-            logger.info(f"成功获取{bs_code}的{actual_period}数据，共{len(df)}条记录")
-            return df
-            
-        except Exception as e:
-            logger.error(f"获取{stock_code}的{period_type}数据异常: {e}")
+            fields = rs.fields
+        
+        if not data_list:
+            logger.warning(f"未获取到{bs_code}的{period_type}数据")
             return None
+            
+        # 创建DataFrame并预处理
+        df = pd.DataFrame(data_list, columns=fields)
+        df = self._preprocess_dataframe(df, actual_period)
+        
+        logger.info(f"成功获取{bs_code}的{actual_period}数据，共{len(df)}条记录")
+        return df
     
     def _preprocess_dataframe(self, df: pd.DataFrame, period_type: str) -> pd.DataFrame:
         """
@@ -148,8 +174,8 @@ class MinuteDataSyncService:
             return df
             
         try:
-            # 处理时间字段
-            df['datetime'] = df['time'].apply(self._parse_time_string)
+            # 处理时间字段（向量化解析）
+            df['datetime'] = parse_bs_time(df['time'])
             
             # 转换数据类型
             numeric_columns = ['open', 'high', 'low', 'close', 'volume', 'amount']
@@ -160,7 +186,9 @@ class MinuteDataSyncService:
             df['period_type'] = period_type
             
             # 转换股票代码格式（bs格式转回ts格式）
-            df['ts_code'] = df['code'].apply(self._convert_bs_code_to_ts_code)
+            code = df['code'].astype(str)
+            df['ts_code'] = code.str[3:] + '.' + code.str[:2].str.upper()
+            df.loc[~code.str.match(r'^(sh|sz)\.'), 'ts_code'] = code
             
             # 计算涨跌幅等字段
             df = self._calculate_technical_fields(df)
@@ -169,7 +197,7 @@ class MinuteDataSyncService:
             df = df.drop(['date', 'time', 'code'], axis=1, errors='ignore')
             
             # 去除空值行
-            df = df.dropna(subset=['open', 'high', 'low', 'close'])
+            df = df.dropna(subset=['datetime', 'open', 'high', 'low', 'close'])
             
             return df
             
@@ -177,32 +205,6 @@ class MinuteDataSyncService:
             logger.error(f"预处理DataFrame异常: {e}")
             return df
     
-    def _parse_time_string(self, time_str: str) -> datetime:
-        """
-        解析时间字符串
-        格式: YYYYMMDDHHMMSS000 -> datetime
-        """
-        try:
-            # 取前14位：YYYYMMDDHHMMSS
-            time_str = str(time_str)[:14]
-            
-            # 解析各部分
-            year = time_str[:4]
-            month = time_str[4:6]
-            day = time_str[6:8]
-            hour = time_str[8:10]
-            minute = time_str[10:12]
-            second = time_str[12:14]
-            
-            # 构建datetime对象
-            return datetime(
-                int(year), int(month), int(day),
-                int(hour), int(minute), int(second)
-            )
-        except Exception as e:
-            logger.error(f"解析时间字符串失败: {time_str}, 错误: {e}")
-            return datetime.now()
-    
     def _convert_bs_code_to_ts_code(self, bs_code: str) -> str:
         """
         转换bs格式代码为ts格式
@@ -280,41 +282,15 @@ class MinuteDataSyncService:
                     'data_count': 0
                 }
             
-            # 转换为字典列表
-            data_list = df.to_dict('records')
-            
-            # 批量插入数据库
-            success_count = 0
+            # 批量 upsert 入库
+            data_list = frame_to_records(df)
+            inserted, updated = upsert_minute_bars(db.session.connection(), data_list, self.write_chunk_size)
+            success_count = inserted + updated
             error_count = 0
             
-            for data in data_list:
-                try:
-                    # 检查是否已存在
-                    existing = StockMinuteData.query.filter_by(
-                        ts_code=data['ts_code'],
-                        datetime=data['datetime'],
-                        period_type=data['period_type']
-                    ).first()
-                    
-                    if existing:
-                        # 更新现有记录
-                        for key, value in data.items():
-                            if hasattr(existing, key):
-                                setattr(existing, key, value)
-                    else:
-                        # 创建新记录
-                        minute_data = StockMinuteData(**data)
-                        db.session.add(minute_data)
-                    
-                    success_count += 1
-                    
-                except Exception as e:
-                    logger.error(f"插入数据失败: {data}, 错误: {e}")
-                    error_count += 1
-                    continue
-            
             # 提交事务
             db.session.commit()
+            get_live_bar_cache().ingest(data_list)
             
             logger.info(f"同步{ts_code}的{period_type}数据完成，成功: {success_count}, 失败: {error_count}")
             
@@ -353,53 +329,32 @@ class MinuteDataSyncService:
             同步结果字典
         """
         try:
-            total_stocks = len(stock_list)
-            success_stocks = 0
-            failed_stocks = 0
-            total_data_count = 0
-            
-            logger.info(f"开始批量同步{total_stocks}只股票的{period_type}数据")
+            # 设置默认日期范围
+            if not end_date:
+                end_date = datetime.now().strftime('%Y-%m-%d')
+            if not start_date:
+                start_date = (datetime.now() - timedelta(days=7)).strftime('%Y-%m-%d')
             
-            # 分批处理
-            for i in range(0, total_stocks, batch_size):
-                batch_stocks = stock_list[i:i + batch_size]
-                
-                for ts_code in batch_stocks:
-                    try:
-                        result = self.sync_single_stock_data(
-                            ts_code, period_type, start_date, end_date
-                        )
-                        
-                        if result['success']:
-                            success_stocks += 1
-                            total_data_count += result['data_count']
-                        else:
-                            failed_stocks += 1
-                            
-                        # 避免请求过于频繁
-                        time.sleep(0.1)
-                        
-                    except Exception as e:
-                        logger.error(f"同步{ts_code}异常: {e}")
-                        failed_stocks += 1
-                        continue
-                
-                # 批次间休息
-                if i + batch_size < total_stocks:
-                    time.sleep(1)
-                    logger.info(f"已处理 {min(i + batch_size, total_stocks)}/{total_stocks} 只股票")
+            logger.info(f"开始批量同步{len(stock_list)}只股票的{period_type}数据")
             
-            logger.info(f"批量同步完成，成功: {success_stocks}, 失败: {failed_stocks}, 总数据量: {total_data_count}")
+            # 抓取、预处理、写库由流水线并行执行，速率由令牌桶控制；
+            # batch_size 保留为兼容参数，写入批大小由 MINUTE_SYNC_CHUNK_SIZE 配置
+            pipeline = MinuteIngestPipeline(
+                fetch=lambda ts_code, period, start, end: self.fetch_minute_frame(ts_code, start, end, period),
+                requests_per_second=self.requests_per_second,
+                fetch_workers=self.fetch_workers,
+                chunk_size=self.write_chunk_size,
+                progress_path=self.progress_path
+            )
+            stats = pipeline.run(stock_list, period_type, start_date, end_date)
             
-            return {
+            result = {
                 'success': True,
                 'message': '批量同步完成',
-                'total_stocks': total_stocks,
-                'success_stocks': success_stocks,
-                'failed_stocks': failed_stocks,
-                'total_data_count': total_data_count,
                 'period_type': period_type
             }
+            result.update(stats)
+            return result
             
         except Exception as e:
             logger.error(f"批量同步异常: {e}")
@@ -0,0 +1,322 @@
+"""
+分钟数据入库流水线
+多只股票的分钟K线同步拆成三段并行执行：
+1. 抓取：多个抓取线程共享一个令牌桶限速器，按配置的请求速率调用数据源并预处理；
+2. 写入：单独的写入线程从有界队列取数据，按块批量 upsert（已存在的行批量更新，其余批量插入），
+   写入后同步到实时K线缓存；
+3. 进度：每只股票完成后把最新K线时间写入进度文件，中断后重跑会跳过已完成的股票，
+   未完成的股票从上次写到的日期继续。
+
+队列有上限，写入跟不上时抓取线程会被阻塞，内存占用不会随股票数量增长。
+"""
+
+import json
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import pandas as pd
+from loguru import logger
+from sqlalchemy import and_, bindparam, select
+
+from app.extensions import db
+from app.models.stock_minute_data import StockMinuteData
+from app.services.live_bar_cache import get_live_bar_cache
+
+
+DEFAULT_REQUESTS_PER_SECOND = 10.0
+DEFAULT_FETCH_WORKERS = 4
+DEFAULT_WRITE_CHUNK_SIZE = 1000
+DEFAULT_QUEUE_SIZE = 32
+# 每处理多少只股票输出一次吞吐量日志
+REPORT_EVERY = 50
+
+WRITE_COLUMNS = ['ts_code', 'datetime', 'period_type', 'open', 'high', 'low', 'close',
+                 'volume', 'amount', 'pre_close', 'change', 'pct_chg']
+
+# 抓取函数签名: fetch(ts_code, period_type, start_date, end_date) -> 预处理后的 DataFrame 或 None
+FetchFunc = Callable[[str, str, str, str], Optional[pd.DataFrame]]
+
+_STOP = object()
+
+
+def parse_bs_time(values: pd.Series) -> pd.Series:
+    """向量化解析 Baostock 时间字段（YYYYMMDDHHMMSSsss），无法解析的记为 NaT"""
+    return pd.to_datetime(values.astype(str).str[:14], format='%Y%m%d%H%M%S', errors='coerce')
+
+
+class TokenBucket:
+    """令牌桶限速器，rate 为每秒补充的令牌数，capacity 为允许的突发量"""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = max(float(rate), 1e-6)
+        self.capacity = float(capacity) if capacity else max(1.0, self.rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1.0):
+        """取令牌，不足时阻塞到补满为止"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class IngestProgress:
+    """按 (周期, 股票) 记录的同步进度，持久化为 JSON 文件"""
+
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f"读取同步进度失败，将重新开始: {e}")
+
+    @staticmethod
+    def _key(ts_code: str, period_type: str) -> str:
+        return f"{period_type}:{ts_code}"
+
+    def resume_start(self, ts_code: str, period_type: str, start_date: str,
+                     end_date: str) -> Optional[str]:
+        """返回本次应使用的开始日期；该区间已完成时返回 None"""
+        with self._lock:
+            entry = self._entries.get(self._key(ts_code, period_type))
+        if not entry:
+            return start_date
+        # 截止日期早于今天的区间数据不会再变化，完成后可以直接跳过
+        if entry.get('status') == 'done' and entry.get('start_date', '') <= start_date \
+                and entry.get('end_date', '') >= end_date and end_date < datetime.now().strftime('%Y-%m-%d'):
+            return None
+        # 从已写入的最后一天继续（当天可能只写了一部分，重叠部分由 upsert 去重）
+        last_date = (entry.get('last_datetime') or '')[:10]
+        if last_date and entry.get('start_date', '') <= start_date < last_date <= end_date:
+            return last_date
+        return start_date
+
+    def update(self, ts_code: str, period_type: str, **fields):
+        with self._lock:
+            entry = self._entries.setdefault(self._key(ts_code, period_type), {})
+            entry.update(fields)
+            entry['updated_at'] = datetime.now().isoformat(timespec='seconds')
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            data = json.dumps(self._entries, ensure_ascii=False, indent=1)
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(data)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"保存同步进度失败: {e}")
+
+
+def frame_to_records(df: pd.DataFrame) -> List[Dict[str, Any]]:
+    """DataFrame 转为可直接写库的记录（NaN 转 None，时间转 datetime）"""
+    frame = df[[column for column in WRITE_COLUMNS if column in df.columns]].copy()
+    frame['datetime'] = pd.to_datetime(frame['datetime'])
+    frame = frame.dropna(subset=['datetime'])
+    frame = frame.drop_duplicates(['ts_code', 'period_type', 'datetime'], keep='last')
+    records = frame.astype(object).where(frame.notna(), None).to_dict('records')
+    for record in records:
+        record['datetime'] = record['datetime'].to_pydatetime()
+        if record.get('volume') is not None:
+            record['volume'] = int(record['volume'])
+    return records
+
+
+def upsert_minute_bars(connection, records: List[Dict[str, Any]],
+                       chunk_size: int = DEFAULT_WRITE_CHUNK_SIZE) -> Tuple[int, int]:
+    """按块批量 upsert 单只股票单个周期的分钟K线，返回 (插入数, 更新数)
+
+    stock_minute_data 上没有唯一约束，无法直接使用 INSERT IGNORE/ON DUPLICATE，
+    因此每块先用一次区间查询找出已存在的时间点，再分别 executemany 插入和更新。
+    """
+    table = StockMinuteData.__table__
+    inserted = updated = 0
+    update_columns = [column for column in WRITE_COLUMNS
+                      if column not in ('ts_code', 'datetime', 'period_type')]
+    update_stmt = table.update().where(and_(
+        table.c.ts_code == bindparam('b_ts_code'),
+        table.c.period_type == bindparam('b_period_type'),
+        table.c.datetime == bindparam('b_datetime'),
+    )).values({column: bindparam(column) for column in update_columns})
+
+    for i in range(0, len(records), chunk_size):
+        chunk = records[i:i + chunk_size]
+        ts_code, period_type = chunk[0]['ts_code'], chunk[0]['period_type']
+        times = [record['datetime'] for record in chunk]
+        existing = {row[0] for row in connection.execute(
+            select(table.c.datetime).where(
+                table.c.ts_code == ts_code,
+                table.c.period_type == period_type,
+                table.c.datetime >= min(times),
+                table.c.datetime <= max(times),
+            )
+        )}
+        inserts = [record for record in chunk if record['datetime'] not in existing]
+        updates = [dict({column: record.get(column) for column in update_columns},
+                        b_ts_code=record['ts_code'], b_period_type=record['period_type'],
+                        b_datetime=record['datetime'])
+                   for record in chunk if record['datetime'] in existing]
+        if inserts:
+            connection.execute(table.insert(), inserts)
+            inserted += len(inserts)
+        if updates:
+            connection.execute(update_stmt, updates)
+            updated += len(updates)
+    return inserted, updated
+
+
+class MinuteIngestPipeline:
+    """多股票分钟数据并发同步流水线"""
+
+    def __init__(self, fetch: FetchFunc, requests_per_second: float = DEFAULT_REQUESTS_PER_SECOND,
+                 fetch_workers: int = DEFAULT_FETCH_WORKERS, chunk_size: int = DEFAULT_WRITE_CHUNK_SIZE,
+                 progress_path: Optional[str] = None, queue_size: int = DEFAULT_QUEUE_SIZE):
+        self.fetch = fetch
+        self.bucket = TokenBucket(requests_per_second)
+        self.fetch_workers = max(1, int(fetch_workers))
+        self.chunk_size = max(1, int(chunk_size))
+        self.progress = IngestProgress(progress_path)
+        self.queue_size = max(1, int(queue_size))
+
+    def run(self, stock_list: List[str], period_type: str, start_date: str,
+            end_date: str) -> Dict[str, Any]:
+        """同步股票列表，返回汇总结果（含吞吐量）"""
+        from flask import current_app
+        app = current_app._get_current_object()
+
+        stats = {
+            'total_stocks': len(stock_list), 'success_stocks': 0, 'failed_stocks': 0,
+            'skipped_stocks': 0, 'empty_stocks': 0, 'total_data_count': 0,
+            'inserted': 0, 'updated': 0, 'fetch_seconds': 0.0, 'write_seconds': 0.0,
+        }
+        stats_lock = threading.Lock()
+        started = time.monotonic()
+
+        tasks: 'queue.Queue' = queue.Queue()
+        for ts_code in stock_list:
+            resume_from = self.progress.resume_start(ts_code, period_type, start_date, end_date)
+            if resume_from is None:
+                stats['skipped_stocks'] += 1
+            else:
+                tasks.put((ts_code, resume_from))
+        if stats['skipped_stocks']:
+            logger.info(f"跳过已完成的 {stats['skipped_stocks']} 只股票")
+
+        results: 'queue.Queue' = queue.Queue(maxsize=self.queue_size)
+
+        def fetch_worker():
+            while True:
+                try:
+                    ts_code, fetch_start = tasks.get_nowait()
+                except queue.Empty:
+                    return
+                self.bucket.acquire()
+                t0 = time.monotonic()
+                try:
+                    df = self.fetch(ts_code, period_type, fetch_start, end_date)
+                    error = None
+                except Exception as e:
+                    df, error = None, str(e)
+                with stats_lock:
+                    stats['fetch_seconds'] += time.monotonic() - t0
+                results.put((ts_code, df, error))
+
+        def writer():
+            with app.app_context():
+                processed = 0
+                while True:
+                    item = results.get()
+                    if item is _STOP:
+                        return
+                    ts_code, df, error = item
+                    self._write_one(ts_code, period_type, start_date, end_date, df, error, stats, stats_lock)
+                    processed += 1
+                    if processed % REPORT_EVERY == 0:
+                        self.progress.save()
+                        elapsed = time.monotonic() - started
+                        logger.info(f"已处理 {processed + stats['skipped_stocks']}/{stats['total_stocks']} 只股票，"
+                                    f"{stats['total_data_count']} 行，{stats['total_data_count'] / max(elapsed, 1e-9):.0f} 行/秒")
+
+        writer_thread = threading.Thread(target=writer, name='minute-ingest-writer', daemon=True)
+        writer_thread.start()
+        workers = [threading.Thread(target=fetch_worker, name=f'minute-ingest-fetch-{i}', daemon=True)
+                   for i in range(min(self.fetch_workers, max(1, tasks.qsize())))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        results.put(_STOP)
+        writer_thread.join()
+        self.progress.save()
+
+        elapsed = time.monotonic() - started
+        stats['elapsed_seconds'] = round(elapsed, 3)
+        stats['rows_per_second'] = round(stats['total_data_count'] / elapsed, 1) if elapsed > 0 else 0.0
+        stats['fetch_seconds'] = round(stats['fetch_seconds'], 3)
+        stats['write_seconds'] = round(stats['write_seconds'], 3)
+        logger.info(f"分钟数据同步完成: 成功 {stats['success_stocks']}, 失败 {stats['failed_stocks']}, "
+                    f"跳过 {stats['skipped_stocks']}, {stats['total_data_count']} 行, "
+                    f"耗时 {elapsed:.1f}s, {stats['rows_per_second']} 行/秒")
+        return stats
+
+    def _write_one(self, ts_code: str, period_type: str, start_date: str, end_date: str,
+                   df: Optional[pd.DataFrame], error: Optional[str], stats: Dict, stats_lock):
+        """写入单只股票的数据并更新进度（在写入线程中执行）"""
+        if error is not None:
+            logger.error(f"获取{ts_code}的{period_type}数据异常: {error}")
+            self.progress.update(ts_code, period_type, status='failed', error=error)
+            with stats_lock:
+                stats['failed_stocks'] += 1
+            return
+        if df is None or df.empty:
+            # 区间内无数据（停牌等）视为已完成，避免重跑时重复请求
+            self.progress.update(ts_code, period_type, status='done', start_date=start_date,
+                                 end_date=end_date, rows=0)
+            with stats_lock:
+                stats['empty_stocks'] += 1
+            return
+
+        t0 = time.monotonic()
+        try:
+            records = frame_to_records(df)
+            with db.engine.begin() as connection:
+                inserted, updated = upsert_minute_bars(connection, records, self.chunk_size)
+            get_live_bar_cache().ingest(records)
+        except Exception as e:
+            logger.error(f"写入{ts_code}的{period_type}数据失败: {e}")
+            self.progress.update(ts_code, period_type, status='failed', error=str(e))
+            with stats_lock:
+                stats['failed_stocks'] += 1
+                stats['write_seconds'] += time.monotonic() - t0
+            return
+
+        # 数据源把 1min 请求降级为 5min 时，进度仍记在请求的周期下
+        self.progress.update(ts_code, period_type, status='done', start_date=start_date, end_date=end_date,
+                             last_datetime=max(r['datetime'] for r in records).isoformat(),
+                             rows=len(records), error=None)
+        with stats_lock:
+            stats['success_stocks'] += 1
+            stats['total_data_count'] += len(records)
+            stats['inserted'] += inserted
+            stats['updated'] += updated
+            stats['write_seconds'] += time.monotonic() - t0
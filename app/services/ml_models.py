@@ -2,14 +2,11 @@ import pandas as pd
 import numpy as np
 from typing import List, Dict, Any, Optional, Tuple
 import pickle
-import os
-from datetime import datetime, timedelta
-import joblib
+from datetime import datetime
 from loguru import logger
 
 # 机器学习库
 from sklearn.ensemble import RandomForestRegressor, RandomForestClassifier
-from sklearn.model_selection import train_test_split, cross_val_score, TimeSeriesSplit
 from sklearn.metrics import mean_squared_error, mean_absolute_error, r2_score, accuracy_score, precision_score, recall_score
 from sklearn.preprocessing import StandardScaler, RobustScaler
 from sklearn.feature_selection import SelectKBest, f_regression, mutual_info_regression
@@ -18,16 +15,18 @@ import lightgbm as lgb
 
 from app.extensions import db
 from app.models import (
-    MLModelDefinition, MLPredictions, FactorValues, StockDailyHistory
+    MLModelDefinition, MLPredictions, FactorValues
 )
+from app.services.label_builder import get_labeler, parse_target_type
+from app.services.walk_forward import WalkForwardTrainer
+from app.services.model_cache import get_model_cache
 
 
 class MLModelManager:
     """机器学习模型管理器"""
     
     def __init__(self):
-        self.models = {}  # 缓存已加载的模型
-        self.scalers = {}  # 缓存特征缩放器
+        self.model_cache = get_model_cache()  # 按内存占用淘汰的模型与缩放器缓存
         self.model_configs = {
             'random_forest': {
                 'regressor': RandomForestRegressor,
@@ -70,9 +69,8 @@ class MLModelManager:
             }
         }
         
-        # 创建模型存储目录
-        self.model_dir = 'models'
-        os.makedirs(self.model_dir, exist_ok=True)
+        # 模型存储目录
+        self.model_dir = self.model_cache.store.root
     
     def create_model_definition(self, model_id: str, model_name: str, model_type: str,
                               factor_list: List[str], target_type: str,
@@ -133,60 +131,63 @@ class MLModelManager:
             if model_def.target_type == 'simulated_return':
                 return self._prepare_simulated_training_data(model_def)
             
-            # 获取因子数据 - 先尝试指定日期范围
+            merged_df = self._load_training_frame(model_def, start_date, end_date)
+            return merged_df[model_def.factor_list], merged_df['target']
+            
+        except Exception as e:
+            logger.error(f"准备训练数据失败: {model_id}, 错误: {e}")
+            return pd.DataFrame(), pd.Series()
+    
+    def _load_training_frame(self, model_def, start_date: str, end_date: str) -> pd.DataFrame:
+        """加载 (ts_code, trade_date, 因子..., target) 训练样本，按交易日排序"""
+        # 获取因子数据 - 先尝试指定日期范围
+        factor_query = FactorValues.query.filter(
+            FactorValues.factor_id.in_(model_def.factor_list),
+            FactorValues.trade_date >= start_date,
+            FactorValues.trade_date <= end_date
+        ).order_by(FactorValues.ts_code, FactorValues.trade_date, FactorValues.factor_id)
+        
+        factor_data = pd.read_sql(factor_query.statement, db.engine)
+        
+        # 如果指定日期范围没有数据，尝试获取所有可用数据
+        if factor_data.empty:
+            logger.warning(f"指定日期范围 {start_date} 至 {end_date} 没有因子数据，尝试获取所有可用数据")
             factor_query = FactorValues.query.filter(
-                FactorValues.factor_id.in_(model_def.factor_list),
-                FactorValues.trade_date >= start_date,
-                FactorValues.trade_date <= end_date
+                FactorValues.factor_id.in_(model_def.factor_list)
             ).order_by(FactorValues.ts_code, FactorValues.trade_date, FactorValues.factor_id)
             
             factor_data = pd.read_sql(factor_query.statement, db.engine)
             
-            # 如果指定日期范围没有数据，尝试获取所有可用数据
             if factor_data.empty:
-                logger.warning(f"指定日期范围 {start_date} 至 {end_date} 没有因子数据，尝试获取所有可用数据")
-                factor_query = FactorValues.query.filter(
-                    FactorValues.factor_id.in_(model_def.factor_list)
-                ).order_by(FactorValues.ts_code, FactorValues.trade_date, FactorValues.factor_id)
-                
-                factor_data = pd.read_sql(factor_query.statement, db.engine)
-                
-                if factor_data.empty:
-                    raise ValueError("未找到因子数据")
-                
-                logger.info(f"找到因子数据: {len(factor_data)} 条记录，日期范围: {factor_data['trade_date'].min()} 至 {factor_data['trade_date'].max()}")
-            
-            # 透视表：行为(ts_code, trade_date)，列为factor_id
-            feature_df = factor_data.pivot_table(
-                index=['ts_code', 'trade_date'],
-                columns='factor_id',
-                values='factor_value',
-                aggfunc='first'
-            ).reset_index()
-            
-            # 获取目标变量（未来收益率）
-            target_df = self._calculate_target_returns(feature_df, model_def.target_type)
-            
-            # 合并特征和目标变量
-            merged_df = pd.merge(feature_df, target_df, on=['ts_code', 'trade_date'], how='inner')
-            
-            # 删除包含缺失值的行
-            merged_df = merged_df.dropna()
-            
-            if merged_df.empty:
-                raise ValueError("合并后数据为空")
-            
-            # 分离特征和目标变量
-            feature_columns = model_def.factor_list
-            X = merged_df[feature_columns]
-            y = merged_df['target']
-            
-            logger.info(f"准备训练数据完成: {len(X)} 样本, {len(feature_columns)} 特征")
-            return X, y
+                raise ValueError("未找到因子数据")
             
-        except Exception as e:
-            logger.error(f"准备训练数据失败: {model_id}, 错误: {e}")
-            return pd.DataFrame(), pd.Series()
+            logger.info(f"找到因子数据: {len(factor_data)} 条记录，日期范围: {factor_data['trade_date'].min()} 至 {factor_data['trade_date'].max()}")
+        
+        # 透视表：行为(ts_code, trade_date)，列为factor_id
+        feature_df = factor_data.pivot_table(
+            index=['ts_code', 'trade_date'],
+            columns='factor_id',
+            values='factor_value',
+            aggfunc='first'
+        ).reset_index()
+        
+        # 获取目标变量（未来收益率）
+        target_df = self._calculate_target_returns(feature_df, model_def.target_type)
+        
+        # 合并特征和目标变量
+        merged_df = pd.merge(feature_df, target_df, on=['ts_code', 'trade_date'], how='inner')
+        
+        # 删除包含缺失值的行
+        merged_df = merged_df.dropna()
+        
+        if merged_df.empty:
+            raise ValueError("合并后数据为空")
+        
+        # 按交易日排序，保证按时间切分训练集和测试集
+        merged_df = merged_df.sort_values(['trade_date', 'ts_code'], kind='mergesort').reset_index(drop=True)
+        
+        logger.info(f"准备训练数据完成: {len(merged_df)} 样本, {len(model_def.factor_list)} 特征")
+        return merged_df
     
     def _prepare_simulated_training_data(self, model_def) -> Tuple[pd.DataFrame, pd.Series]:
         """为简化演示模型准备模拟训练数据"""
@@ -250,76 +251,17 @@ class MLModelManager:
             return pd.DataFrame(), pd.Series()
     
     def _calculate_target_returns(self, feature_df: pd.DataFrame, target_type: str) -> pd.DataFrame:
-        """计算目标变量（未来收益率）"""
+        """计算目标变量（未来收益率），由标签构建器按整块面板批量生成"""
         try:
-            # 解析目标类型
-            if target_type.startswith('return_'):
-                period = int(target_type.split('_')[1].replace('d', ''))
-            else:
-                period = 5  # 默认5日收益率
-            
-            target_data = []
+            target_df = feature_df[['ts_code', 'trade_date']].copy()
+            target_df['target'] = get_labeler().lookup(target_df, target_type)
+            target_df = target_df.dropna(subset=['target'])
             
-            # 按股票分组计算未来收益率
-            for ts_code in feature_df['ts_code'].unique():
-                stock_features = feature_df[feature_df['ts_code'] == ts_code].copy()
-                stock_features = stock_features.sort_values('trade_date')
-                
-                # 获取该股票的价格数据
-                price_query = StockDailyHistory.query.filter(
-                    StockDailyHistory.ts_code == ts_code
-                ).order_by(StockDailyHistory.trade_date)
-                
-                price_data = pd.read_sql(price_query.statement, db.engine)
-                
-                if price_data.empty:
-                    continue
-                
-                # 为每个特征日期计算目标收益率
-                for _, row in stock_features.iterrows():
-                    current_date = row['trade_date']
-                    
-                    # 找到当前日期的价格
-                    current_price_row = price_data[price_data['trade_date'] == current_date]
-                    if current_price_row.empty:
-                        continue
-                    
-                    current_price = current_price_row.iloc[0]['close']
-                    
-                    # 找到未来日期的价格
-                    future_prices = price_data[price_data['trade_date'] > current_date].head(period)
-                    
-                    if len(future_prices) >= period:
-                        future_price = future_prices.iloc[period-1]['close']
-                        # 计算收益率
-                        return_rate = (future_price - current_price) / current_price
-                        
-                        target_data.append({
-                            'ts_code': ts_code,
-                            'trade_date': current_date,
-                            'target': return_rate
-                        })
-                    else:
-                        # 如果没有足够的未来数据，使用模拟数据
-                        # 基于历史波动率生成合理的模拟收益率
-                        historical_returns = price_data['pct_chg'].dropna() / 100
-                        if len(historical_returns) > 0:
-                            mean_return = historical_returns.mean()
-                            std_return = historical_returns.std()
-                            # 生成符合历史分布的随机收益率
-                            simulated_return = np.random.normal(mean_return, std_return)
-                            target_data.append({
-                                'ts_code': ts_code,
-                                'trade_date': current_date,
-                                'target': simulated_return
-                            })
-            
-            if not target_data:
+            if target_df.empty:
                 # 如果完全没有数据，生成基于特征的模拟目标变量
                 logger.warning("无法计算真实收益率，使用基于特征的模拟数据")
                 return self._generate_simulated_targets(feature_df)
             
-            target_df = pd.DataFrame(target_data)
             logger.info(f"计算目标变量完成: {len(target_df)} 条记录")
             return target_df
             
@@ -363,48 +305,63 @@ class MLModelManager:
             return pd.DataFrame()
     
     def train_model(self, model_id: str, start_date: str, end_date: str) -> Dict[str, Any]:
-        """训练模型"""
+        """训练模型
+        
+        按交易日切出末尾 test_size 作为保留测试集训练最终模型，同时以滚动前推方式
+        并行评估 cv_folds 个时间序列折（training_config.validation_method 为
+        time_series_split 时）。training_config 可选项：n_jobs、early_stopping_rounds、
+        validation_fraction、embargo_days（默认取标签周期）。
+        """
         try:
             # 获取模型定义
             model_def = MLModelDefinition.query.filter_by(model_id=model_id).first()
             if not model_def:
                 raise ValueError(f"未找到模型定义: {model_id}")
+            training_config = model_def.training_config or {}
             
             # 准备训练数据
-            X, y = self.prepare_training_data(model_id, start_date, end_date)
+            dates = None
+            if model_def.target_type == 'simulated_return':
+                X, y = self._prepare_simulated_training_data(model_def)
+            else:
+                merged_df = self._load_training_frame(model_def, start_date, end_date)
+                X, y, dates = merged_df[model_def.factor_list], merged_df['target'], merged_df['trade_date']
             if X.empty or y.empty:
                 raise ValueError("训练数据为空")
             
             # 特征工程
-            X_processed, feature_names = self._feature_engineering(X, y, model_def.training_config)
-            
-            # 分割训练集和测试集
-            test_size = model_def.training_config.get('test_size', 0.2)
-            X_train, X_test, y_train, y_test = train_test_split(
-                X_processed, y, test_size=test_size, random_state=42, shuffle=False
+            X_processed, feature_names = self._feature_engineering(X, y, training_config)
+            
+            # 滚动前推训练：各折与保留测试集的最终模型一起并行拟合
+            _, period = parse_target_type(model_def.target_type)
+            trainer = WalkForwardTrainer(
+                self._create_model(model_def.model_type, model_def.model_params),
+                n_jobs=training_config.get('n_jobs', -1),
+                early_stopping_rounds=training_config.get('early_stopping_rounds', 20),
+                validation_fraction=training_config.get('validation_fraction', 0.1),
+                embargo=training_config.get('embargo_days', period if dates is not None else 0)
             )
+            days = trainer.encode_days(dates, len(y))
+            holdout = trainer.holdout_split(days, training_config.get('test_size', 0.2))
+            n_splits = 0
+            if training_config.get('validation_method') == 'time_series_split':
+                n_splits = training_config.get('cv_folds', 5)
+            walk_forward = trainer.run(X_processed, y, dates, n_splits=n_splits, holdout=holdout, days=days)
             
-            # 创建模型
-            model = self._create_model(model_def.model_type, model_def.model_params)
-            
-            # 训练模型
-            model.fit(X_train, y_train)
-            
-            # 评估模型
-            train_score = model.score(X_train, y_train)
-            test_score = model.score(X_test, y_test)
-            
-            y_pred_train = model.predict(X_train)
-            y_pred_test = model.predict(X_test)
+            final = walk_forward['holdout']
+            model = final.pop('model')
             
             # 计算评估指标
             metrics = {
-                'train_r2': train_score,
-                'test_r2': test_score,
-                'train_mse': mean_squared_error(y_train, y_pred_train),
-                'test_mse': mean_squared_error(y_test, y_pred_test),
-                'train_mae': mean_absolute_error(y_train, y_pred_train),
-                'test_mae': mean_absolute_error(y_test, y_pred_test),
+                'train_r2': final['train_r2'],
+                'test_r2': final['test_r2'],
+                'train_mse': final['train_mse'],
+                'test_mse': final['test_mse'],
+                'train_mae': final['train_mae'],
+                'test_mae': final['test_mae'],
+                'test_ic': final['ic'],
+                'test_rank_ic': final['rank_ic'],
+                'best_iteration': final['best_iteration'],
                 'feature_count': len(feature_names),
                 'sample_count': len(X_processed)
             }
@@ -414,26 +371,28 @@ class MLModelManager:
                 feature_importance = dict(zip(feature_names, model.feature_importances_))
                 metrics['feature_importance'] = feature_importance
             
-            # 交叉验证
-            if model_def.training_config.get('validation_method') == 'time_series_split':
-                cv_folds = model_def.training_config.get('cv_folds', 5)
-                tscv = TimeSeriesSplit(n_splits=cv_folds)
-                cv_scores = cross_val_score(model, X_processed, y, cv=tscv, scoring='r2')
-                metrics['cv_mean'] = cv_scores.mean()
-                metrics['cv_std'] = cv_scores.std()
-            
-            # 保存模型
-            model_path = os.path.join(self.model_dir, f"{model_id}.pkl")
-            scaler_path = os.path.join(self.model_dir, f"{model_id}_scaler.pkl")
-            
-            joblib.dump(model, model_path)
-            if hasattr(self, '_scaler') and self._scaler is not None:
-                joblib.dump(self._scaler, scaler_path)
-            
-            # 缓存模型
-            self.models[model_id] = model
-            if hasattr(self, '_scaler'):
-                self.scalers[model_id] = self._scaler
+            # 时间序列交叉验证
+            if walk_forward['folds']:
+                summary = walk_forward['summary']
+                metrics['cv_mean'] = summary['test_r2_mean']
+                metrics['cv_std'] = summary['test_r2_std']
+                metrics['cv_ic_mean'] = summary['ic_mean']
+                metrics['cv_rank_ic_mean'] = summary['rank_ic_mean']
+            metrics['walk_forward'] = {
+                'folds': walk_forward['folds'],
+                'holdout': final,
+                'summary': walk_forward['summary']
+            }
+            test_score = metrics['test_r2']
+            
+            # 保存并缓存模型
+            self.model_cache.put(model_id, model, getattr(self, '_scaler', None), meta={
+                'model_type': model_def.model_type,
+                'factor_list': model_def.factor_list,
+                'feature_names': feature_names,
+                'target_type': model_def.target_type
+            })
+            model_path = self.model_cache.store.model_path(model_id)
             
             logger.info(f"模型训练完成: {model_id}, 测试R²: {test_score:.4f}")
             return {
@@ -510,28 +469,11 @@ class MLModelManager:
             raise
     
     def load_model(self, model_id: str) -> bool:
-        """加载模型"""
+        """加载模型（已缓存时直接返回）"""
         try:
-            if model_id in self.models:
-                return True
-            
-            model_path = os.path.join(self.model_dir, f"{model_id}.pkl")
-            scaler_path = os.path.join(self.model_dir, f"{model_id}_scaler.pkl")
-            
-            if not os.path.exists(model_path):
-                logger.warning(f"模型文件不存在: {model_path}")
+            if self.model_cache.get(model_id) is None:
+                logger.warning(f"模型文件不存在: {model_id}")
                 return False
-            
-            # 加载模型
-            model = joblib.load(model_path)
-            self.models[model_id] = model
-            
-            # 加载缩放器（如果存在）
-            if os.path.exists(scaler_path):
-                scaler = joblib.load(scaler_path)
-                self.scalers[model_id] = scaler
-            
-            logger.info(f"成功加载模型: {model_id}")
             return True
             
         except Exception as e:
@@ -540,113 +482,148 @@ class MLModelManager:
     
     def predict(self, model_id: str, trade_date: str, ts_codes: List[str] = None) -> pd.DataFrame:
         """模型预测"""
+        return self.predict_batch([model_id], trade_date, ts_codes).get(model_id, pd.DataFrame())
+    
+    def predict_batch(self, model_ids: List[str], trade_date: str,
+                      ts_codes: List[str] = None) -> Dict[str, pd.DataFrame]:
+        """多模型批量预测
+        
+        一次查询取出所有模型所需因子在 trade_date 的截面并透视为特征矩阵，
+        各模型从缓存取出模型和缩放器后在同一矩阵上预测。
+        
+        Returns:
+            {model_id: 预测结果}，预测失败或无数据的模型不在结果中
+        """
+        results = {}
         try:
-            # 加载模型
-            if not self.load_model(model_id):
-                return pd.DataFrame()
+            model_defs = {
+                model_def.model_id: model_def
+                for model_def in MLModelDefinition.query.filter(MLModelDefinition.model_id.in_(model_ids)).all()
+            }
             
-            # 获取模型定义
-            model_def = MLModelDefinition.query.filter_by(model_id=model_id).first()
-            if not model_def:
-                logger.error(f"未找到模型定义: {model_id}")
-                return pd.DataFrame()
+            entries = {}
+            for model_id in model_ids:
+                if model_id not in model_defs:
+                    logger.error(f"未找到模型定义: {model_id}")
+                    continue
+                entry = self.model_cache.get(model_id)
+                if entry is None:
+                    logger.warning(f"模型文件不存在: {model_id}")
+                    continue
+                entries[model_id] = entry
             
-            # 获取因子数据 - 先尝试指定日期
-            factor_query = FactorValues.query.filter(
-                FactorValues.factor_id.in_(model_def.factor_list),
-                FactorValues.trade_date == trade_date
-            )
+            if not entries:
+                return results
             
-            if ts_codes:
-                factor_query = factor_query.filter(FactorValues.ts_code.in_(ts_codes))
+            factor_ids = sorted({factor for model_id in entries for factor in model_defs[model_id].factor_list})
+            feature_df = self._load_prediction_features(factor_ids, trade_date, ts_codes)
+            if feature_df.empty:
+                logger.warning(f"未找到任何因子数据")
+                return results
             
-            factor_data = pd.read_sql(factor_query.statement, db.engine)
+            for model_id, entry in entries.items():
+                try:
+                    result_df = self._predict_frame(model_id, model_defs[model_id].factor_list,
+                                                    entry, feature_df, trade_date)
+                    if not result_df.empty:
+                        results[model_id] = result_df
+                        logger.info(f"预测完成: {model_id}, {len(result_df)} 只股票")
+                except Exception as e:
+                    logger.error(f"预测失败: {model_id}, {trade_date}, 错误: {e}")
             
-            # 如果指定日期没有数据，使用最新可用数据
-            if factor_data.empty:
-                logger.warning(f"指定日期 {trade_date} 没有因子数据，使用最新可用数据")
-                factor_query = FactorValues.query.filter(
-                    FactorValues.factor_id.in_(model_def.factor_list)
-                )
-                
-                if ts_codes:
-                    factor_query = factor_query.filter(FactorValues.ts_code.in_(ts_codes))
-                
-                factor_data = pd.read_sql(factor_query.statement, db.engine)
-                
-                if factor_data.empty:
-                    logger.warning(f"未找到任何因子数据")
-                    return pd.DataFrame()
-                
-                # 使用最新日期的数据
-                latest_date = factor_data['trade_date'].max()
-                factor_data = factor_data[factor_data['trade_date'] == latest_date]
-                logger.info(f"使用最新日期 {latest_date} 的因子数据进行预测")
+            return results
             
-            # 透视表
-            feature_df = factor_data.pivot_table(
-                index='ts_code',
-                columns='factor_id',
-                values='factor_value',
-                aggfunc='first'
+        except Exception as e:
+            logger.error(f"批量预测失败: {model_ids}, {trade_date}, 错误: {e}")
+            return results
+    
+    def _load_prediction_features(self, factor_ids: List[str], trade_date: str,
+                                  ts_codes: List[str] = None) -> pd.DataFrame:
+        """读取 trade_date 的因子截面（股票 × 因子），指定日期没有数据时使用最新可用日期"""
+        factor_query = FactorValues.query.filter(
+            FactorValues.factor_id.in_(factor_ids),
+            FactorValues.trade_date == trade_date
+        )
+        if ts_codes:
+            factor_query = factor_query.filter(FactorValues.ts_code.in_(ts_codes))
+        
+        factor_data = pd.read_sql(factor_query.statement, db.engine)
+        
+        # 如果指定日期没有数据，使用最新可用数据
+        if factor_data.empty:
+            logger.warning(f"指定日期 {trade_date} 没有因子数据，使用最新可用数据")
+            latest_query = db.session.query(db.func.max(FactorValues.trade_date)).filter(
+                FactorValues.factor_id.in_(factor_ids)
             )
-            
-            # 确保所有需要的因子都存在
-            missing_factors = set(model_def.factor_list) - set(feature_df.columns)
-            if missing_factors:
-                logger.warning(f"缺少因子: {missing_factors}")
-                # 用0填充缺失的因子
-                for factor in missing_factors:
-                    feature_df[factor] = 0
-            
-            # 按照训练时的顺序排列特征
-            feature_df = feature_df[model_def.factor_list]
-            
-            # 删除包含缺失值的行
-            feature_df = feature_df.dropna()
-            
-            if feature_df.empty:
-                logger.warning(f"特征数据为空: {trade_date}")
+            if ts_codes:
+                latest_query = latest_query.filter(FactorValues.ts_code.in_(ts_codes))
+            latest_date = latest_query.scalar()
+            if latest_date is None:
                 return pd.DataFrame()
             
-            # 特征缩放
-            if model_id in self.scalers:
-                scaler = self.scalers[model_id]
-                feature_scaled = pd.DataFrame(
-                    scaler.transform(feature_df),
-                    columns=feature_df.columns,
-                    index=feature_df.index
-                )
-            else:
-                feature_scaled = feature_df
-            
-            # 预测
-            model = self.models[model_id]
-            predictions = model.predict(feature_scaled)
-            
-            # 构建结果DataFrame
-            result_df = pd.DataFrame({
-                'ts_code': feature_df.index,
-                'trade_date': trade_date,
-                'model_id': model_id,
-                'predicted_return': predictions
-            })
-            
-            # 计算概率分数（归一化预测值）
-            if len(predictions) > 1:
-                result_df['probability_score'] = (predictions - predictions.min()) / (predictions.max() - predictions.min())
-            else:
-                result_df['probability_score'] = 0.5
-            
-            # 计算排名分数
-            result_df['rank_score'] = result_df['predicted_return'].rank(ascending=False, method='dense').astype(int)
-            
-            logger.info(f"预测完成: {model_id}, {len(result_df)} 只股票")
-            return result_df
-            
-        except Exception as e:
-            logger.error(f"预测失败: {model_id}, {trade_date}, 错误: {e}")
+            factor_query = FactorValues.query.filter(
+                FactorValues.factor_id.in_(factor_ids),
+                FactorValues.trade_date == latest_date
+            )
+            if ts_codes:
+                factor_query = factor_query.filter(FactorValues.ts_code.in_(ts_codes))
+            factor_data = pd.read_sql(factor_query.statement, db.engine)
+            logger.info(f"使用最新日期 {latest_date} 的因子数据进行预测")
+        
+        # 透视表
+        return factor_data.pivot_table(
+            index='ts_code',
+            columns='factor_id',
+            values='factor_value',
+            aggfunc='first'
+        )
+    
+    def _predict_frame(self, model_id: str, factor_list: List[str], entry, feature_df: pd.DataFrame,
+                       trade_date: str) -> pd.DataFrame:
+        """在共享的特征矩阵上运行单个模型"""
+        # 确保所有需要的因子都存在，缺失的因子用0填充
+        missing_factors = set(factor_list) - set(feature_df.columns)
+        if missing_factors:
+            logger.warning(f"缺少因子: {missing_factors}")
+        
+        # 按照训练时的顺序排列特征，删除包含缺失值的行
+        features = feature_df.reindex(columns=factor_list, fill_value=0).dropna()
+        if features.empty:
+            logger.warning(f"特征数据为空: {trade_date}")
             return pd.DataFrame()
+        
+        # 特征缩放
+        feature_scaled = features
+        if entry.scaler is not None:
+            feature_scaled = pd.DataFrame(
+                entry.scaler.transform(features),
+                columns=features.columns,
+                index=features.index
+            )
+        
+        # 预测（训练时未记录特征名的模型直接传入数组）
+        model = entry.model
+        model_input = feature_scaled if hasattr(model, 'feature_names_in_') else feature_scaled.to_numpy()
+        predictions = np.asarray(model.predict(model_input))
+        
+        # 构建结果DataFrame
+        result_df = pd.DataFrame({
+            'ts_code': features.index,
+            'trade_date': trade_date,
+            'model_id': model_id,
+            'predicted_return': predictions
+        })
+        
+        # 计算概率分数（归一化预测值）
+        spread = predictions.max() - predictions.min() if len(predictions) > 1 else 0
+        if spread > 0:
+            result_df['probability_score'] = (predictions - predictions.min()) / spread
+        else:
+            result_df['probability_score'] = 0.5
+        
+        # 计算排名分数
+        result_df['rank_score'] = result_df['predicted_return'].rank(ascending=False, method='dense').astype(int)
+        return result_df
     
     def save_predictions(self, predictions_df: pd.DataFrame) -> bool:
         """保存预测结果"""
@@ -754,39 +731,9 @@ class MLModelManager:
     def _get_actual_returns(self, pred_data: pd.DataFrame, target_type: str) -> pd.DataFrame:
         """获取实际收益率"""
         try:
-            period = int(target_type.split('_')[1].replace('d', ''))
-            
-            ts_codes = pred_data['ts_code'].unique()
-            start_date = pred_data['trade_date'].min()
-            end_date = pd.to_datetime(pred_data['trade_date'].max()) + timedelta(days=period + 10)
-            
-            price_query = StockDailyHistory.query.filter(
-                StockDailyHistory.ts_code.in_(ts_codes),
-                StockDailyHistory.trade_date >= start_date,
-                StockDailyHistory.trade_date <= end_date
-            ).order_by(StockDailyHistory.ts_code, StockDailyHistory.trade_date)
-            
-            price_data = pd.read_sql(price_query.statement, db.engine)
-            price_data['trade_date'] = pd.to_datetime(price_data['trade_date'])
-            
-            result_list = []
-            for ts_code in ts_codes:
-                stock_prices = price_data[price_data['ts_code'] == ts_code].sort_values('trade_date')
-                stock_prices[f'return_{period}d'] = stock_prices['close'].pct_change(period).shift(-period)
-                
-                # 只保留预测日期对应的收益率
-                pred_dates = pred_data[pred_data['ts_code'] == ts_code]['trade_date'].unique()
-                stock_result = stock_prices[stock_prices['trade_date'].isin(pred_dates)]
-                
-                if not stock_result.empty:
-                    result_list.append(stock_result[['ts_code', 'trade_date', f'return_{period}d']])
-            
-            if result_list:
-                actual_df = pd.concat(result_list, ignore_index=True)
-                actual_df = actual_df.rename(columns={f'return_{period}d': 'actual_return'})
-                return actual_df[['ts_code', 'trade_date', 'actual_return']].dropna()
-            
-            return pd.DataFrame()
+            actual_df = pred_data[['ts_code', 'trade_date']].drop_duplicates().copy()
+            actual_df['actual_return'] = get_labeler().lookup(actual_df, target_type)
+            return actual_df.dropna(subset=['actual_return'])
             
         except Exception as e:
             logger.error(f"获取实际收益率失败: {target_type}, 错误: {e}")
@@ -814,20 +761,8 @@ class MLModelManager:
             
             db.session.commit()
             
-            # 删除模型文件
-            model_path = os.path.join(self.model_dir, f"{model_id}.pkl")
-            scaler_path = os.path.join(self.model_dir, f"{model_id}_scaler.pkl")
-            
-            if os.path.exists(model_path):
-                os.remove(model_path)
-            if os.path.exists(scaler_path):
-                os.remove(scaler_path)
-            
-            # 清除缓存
-            if model_id in self.models:
-                del self.models[model_id]
-            if model_id in self.scalers:
-                del self.scalers[model_id]
+            # 删除模型文件并清除缓存
+            self.model_cache.remove(model_id)
             
             logger.info(f"成功删除模型: {model_id}")
             return True
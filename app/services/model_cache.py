@@ -0,0 +1,205 @@
+"""
+模型存储与热缓存
+训练好的模型以目录形式保存:
+    models/<model_id>/model.joblib   未压缩的 joblib，numpy 数组可内存映射加载
+    models/<model_id>/scaler.joblib  特征缩放器（可选）
+    models/<model_id>/meta.json      因子列表、模型类型、文件大小等元数据
+加载时使用 mmap_mode='r'，模型内部的大数组按需分页读入，多个进程共享同一份页缓存。
+旧版的 <model_id>.pkl / <model_id>_scaler.pkl 仍可读取。
+
+ModelCache 是按内存占用淘汰的 LRU 缓存：总占用超过上限时从最久未使用的模型开始淘汰，
+被淘汰的模型下次使用时从磁盘重新加载。
+"""
+
+import os
+import json
+import shutil
+import pickle
+import threading
+import time
+import joblib
+from collections import OrderedDict
+from typing import Any, Dict, Optional, NamedTuple
+from loguru import logger
+
+
+DEFAULT_MODEL_DIR = 'models'
+DEFAULT_CACHE_MAX_MB = 512
+
+
+class CachedModel(NamedTuple):
+    """缓存中的模型"""
+    model: Any
+    scaler: Any
+    nbytes: int
+    meta: Dict[str, Any]
+
+
+def _dir_size(path: str) -> int:
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+class ModelStore:
+    """模型文件存储"""
+
+    def __init__(self, root: str = DEFAULT_MODEL_DIR):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def model_path(self, model_id: str) -> str:
+        return os.path.join(self.root, model_id)
+
+    def _legacy_paths(self, model_id: str):
+        return (os.path.join(self.root, f"{model_id}.pkl"),
+                os.path.join(self.root, f"{model_id}_scaler.pkl"))
+
+    def exists(self, model_id: str) -> bool:
+        return (os.path.exists(os.path.join(self.model_path(model_id), 'model.joblib'))
+                or os.path.exists(self._legacy_paths(model_id)[0]))
+
+    def save(self, model_id: str, model, scaler=None, meta: Dict[str, Any] = None) -> str:
+        """写入临时目录后整体替换，避免读到写了一半的模型"""
+        path = self.model_path(model_id)
+        tmp_path = f"{path}.saving"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        joblib.dump(model, os.path.join(tmp_path, 'model.joblib'), compress=0,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+        if scaler is not None:
+            joblib.dump(scaler, os.path.join(tmp_path, 'scaler.joblib'), compress=0)
+        meta = dict(meta or {}, model_id=model_id, saved_at=time.strftime('%Y-%m-%d %H:%M:%S'),
+                    model_class=type(model).__name__)
+        meta['nbytes'] = _dir_size(tmp_path)
+        with open(os.path.join(tmp_path, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2)
+
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+        for legacy in self._legacy_paths(model_id):
+            if os.path.exists(legacy):
+                os.remove(legacy)
+        return path
+
+    def load(self, model_id: str) -> Optional[CachedModel]:
+        """加载模型（数组以只读内存映射方式打开），不存在时返回 None"""
+        path = self.model_path(model_id)
+        model_file = os.path.join(path, 'model.joblib')
+        if os.path.exists(model_file):
+            model = joblib.load(model_file, mmap_mode='r')
+            scaler_file = os.path.join(path, 'scaler.joblib')
+            scaler = joblib.load(scaler_file, mmap_mode='r') if os.path.exists(scaler_file) else None
+            meta = {}
+            meta_file = os.path.join(path, 'meta.json')
+            if os.path.exists(meta_file):
+                with open(meta_file, encoding='utf-8') as f:
+                    meta = json.load(f)
+            return CachedModel(model, scaler, meta.get('nbytes') or _dir_size(path), meta)
+
+        model_file, scaler_file = self._legacy_paths(model_id)
+        if not os.path.exists(model_file):
+            return None
+        model = joblib.load(model_file)
+        scaler = joblib.load(scaler_file) if os.path.exists(scaler_file) else None
+        nbytes = os.path.getsize(model_file) + (os.path.getsize(scaler_file) if scaler is not None else 0)
+        return CachedModel(model, scaler, nbytes, {})
+
+    def remove(self, model_id: str):
+        shutil.rmtree(self.model_path(model_id), ignore_errors=True)
+        for legacy in self._legacy_paths(model_id):
+            if os.path.exists(legacy):
+                os.remove(legacy)
+
+
+class ModelCache:
+    """按内存占用淘汰的 LRU 模型缓存"""
+
+    def __init__(self, store: ModelStore = None, max_bytes: int = DEFAULT_CACHE_MAX_MB * 1024 * 1024):
+        self.store = store or ModelStore()
+        self.max_bytes = max_bytes
+        self._entries: 'OrderedDict[str, CachedModel]' = OrderedDict()
+        self._lock = threading.RLock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, model_id: str) -> Optional[CachedModel]:
+        """取出模型，未缓存时从磁盘加载；模型不存在时返回 None"""
+        with self._lock:
+            entry = self._entries.get(model_id)
+            if entry is not None:
+                self._entries.move_to_end(model_id)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        entry = self.store.load(model_id)
+        if entry is None:
+            return None
+        self._insert(model_id, entry)
+        logger.info(f"加载模型到缓存: {model_id}, {entry.nbytes / 1024 / 1024:.1f}MB")
+        return entry
+
+    def put(self, model_id: str, model, scaler=None, meta: Dict[str, Any] = None) -> CachedModel:
+        """保存模型到磁盘并放入缓存"""
+        path = self.store.save(model_id, model, scaler, meta)
+        entry = CachedModel(model, scaler, _dir_size(path), meta or {})
+        self._insert(model_id, entry)
+        return entry
+
+    def _insert(self, model_id: str, entry: CachedModel):
+        with self._lock:
+            old = self._entries.pop(model_id, None)
+            if old is not None:
+                self.total_bytes -= old.nbytes
+            self._entries[model_id] = entry
+            self.total_bytes += entry.nbytes
+            # 至少保留刚放入的模型
+            while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+                evicted_id, evicted = self._entries.popitem(last=False)
+                self.total_bytes -= evicted.nbytes
+                self.evictions += 1
+                logger.info(f"模型缓存淘汰: {evicted_id}, {evicted.nbytes / 1024 / 1024:.1f}MB")
+
+    def invalidate(self, model_id: str):
+        with self._lock:
+            entry = self._entries.pop(model_id, None)
+            if entry is not None:
+                self.total_bytes -= entry.nbytes
+
+    def remove(self, model_id: str):
+        """从缓存和磁盘删除模型"""
+        self.invalidate(model_id)
+        self.store.remove(model_id)
+
+    def __contains__(self, model_id: str) -> bool:
+        return model_id in self._entries
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'models': list(self._entries),
+                'total_mb': round(self.total_bytes / 1024 / 1024, 2),
+                'max_mb': round(self.max_bytes / 1024 / 1024, 2),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+
+_model_cache = None
+
+
+def get_model_cache() -> ModelCache:
+    """获取全局模型缓存实例（延迟初始化）"""
+    global _model_cache
+    if _model_cache is None:
+        try:
+            from flask import current_app
+            root = current_app.config.get('MODEL_DIR', DEFAULT_MODEL_DIR)
+            max_mb = current_app.config.get('MODEL_CACHE_MAX_MB', DEFAULT_CACHE_MAX_MB)
+        except RuntimeError:
+            root, max_mb = DEFAULT_MODEL_DIR, DEFAULT_CACHE_MAX_MB
+        _model_cache = ModelCache(ModelStore(root), int(max_mb * 1024 * 1024))
+    return _model_cache
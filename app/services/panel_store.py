@@ -0,0 +1,361 @@
+"""
+列式面板存储
+把日线行情、每日指标、复权因子按字段落地为 日期 × 股票 的内存映射文件
+（行主序 float64，每个交易日一行），并以 meta.json 保存日期和股票代码字典。
+日常更新时新交易日直接追加到文件末尾；读取时按日期切片得到零拷贝视图。
+存储落后于数据库或缺少字段时自动回退到 SQL 查询。
+
+目录结构:
+    {root}/{table}/meta.json     {'fields', 'codes', 'dates', 'built_at'}
+    {root}/{table}/{field}.f8    原始 float64 数组，形状 (len(dates), len(codes))
+"""
+
+import os
+import json
+import time
+import shutil
+import threading
+import numpy as np
+import pandas as pd
+from typing import List, Dict, Any, Optional, NamedTuple
+from datetime import datetime
+from loguru import logger
+from sqlalchemy import func
+
+from app.extensions import db
+from app.models import StockDailyHistory, StockDailyBasic, StockFactor
+
+
+DEFAULT_STORE_PATH = 'data/panel_store'
+
+# 表 -> (模型, 存储字段)
+TABLE_SPECS = {
+    'history': (StockDailyHistory, ['open', 'high', 'low', 'close', 'pre_close',
+                                    'change', 'pct_chg', 'vol', 'amount']),
+    'basic': (StockDailyBasic, ['close', 'turnover_rate', 'turnover_rate_f', 'volume_ratio',
+                                'pe', 'pe_ttm', 'pb', 'ps', 'ps_ttm', 'dv_ratio', 'dv_ttm',
+                                'total_share', 'float_share', 'free_share', 'total_mv', 'circ_mv']),
+    'factor': (StockFactor, ['adj_factor', 'close_hfq', 'close_qfq']),
+}
+
+# 字段默认所属的表（同名字段以靠前的表为准）
+FIELD_TABLES: Dict[str, str] = {}
+for _table, (_model, _fields) in TABLE_SPECS.items():
+    for _field in _fields:
+        FIELD_TABLES.setdefault(_field, _table)
+
+
+class PanelSlice(NamedTuple):
+    """面板切片：values 为 日期 × 股票 数组，从存储读取且不筛选股票时为内存映射视图"""
+    values: np.ndarray
+    dates: pd.DatetimeIndex
+    codes: List[str]
+    source: str
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame(self.values, index=self.dates, columns=self.codes, copy=False)
+
+
+class PanelStore:
+    """列式面板存储"""
+
+    def __init__(self, root: str = None, freshness_ttl: int = 60):
+        if root is None:
+            try:
+                from flask import current_app
+                root = current_app.config.get('PANEL_STORE_PATH', DEFAULT_STORE_PATH)
+            except RuntimeError:
+                root = DEFAULT_STORE_PATH
+        self.root = root
+        self.freshness_ttl = freshness_ttl
+        self._tables: Dict[str, Dict[str, Any]] = {}
+        self._freshness: Dict[str, tuple] = {}
+        self._lock = threading.RLock()
+        self.stats = {'store_reads': 0, 'sql_fallbacks': 0}
+
+    # ==================== 元数据 ====================
+
+    def _table_dir(self, table: str) -> str:
+        return os.path.join(self.root, table)
+
+    def _meta_path(self, table: str) -> str:
+        return os.path.join(self._table_dir(table), 'meta.json')
+
+    def _load_table(self, table: str) -> Optional[Dict[str, Any]]:
+        """读取表元数据，meta.json 变化后重新打开内存映射"""
+        path = self._meta_path(table)
+        if not os.path.exists(path):
+            return None
+
+        mtime = os.path.getmtime(path)
+        with self._lock:
+            cached = self._tables.get(table)
+            if cached and cached['mtime'] == mtime:
+                return cached
+
+            with open(path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            entry = {
+                'mtime': mtime,
+                'meta': meta,
+                'dates': pd.DatetimeIndex(pd.to_datetime(meta['dates'])),
+                'code_index': {code: i for i, code in enumerate(meta['codes'])},
+                'arrays': {}
+            }
+            self._tables[table] = entry
+            return entry
+
+    def _array(self, table: str, entry: Dict[str, Any], field: str) -> np.ndarray:
+        array = entry['arrays'].get(field)
+        if array is None:
+            shape = (len(entry['meta']['dates']), len(entry['meta']['codes']))
+            if shape[0] == 0 or shape[1] == 0:
+                array = np.empty(shape, dtype='<f8')
+            else:
+                array = np.memmap(os.path.join(self._table_dir(table), f'{field}.f8'),
+                                  dtype='<f8', mode='r', shape=shape)
+            entry['arrays'][field] = array
+        return array
+
+    def _write_meta(self, table: str, meta: Dict[str, Any]):
+        path = self._meta_path(table)
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def last_date(self, table: str) -> Optional[pd.Timestamp]:
+        entry = self._load_table(table)
+        if entry is None or len(entry['dates']) == 0:
+            return None
+        return entry['dates'][-1]
+
+    def is_fresh(self, table: str) -> bool:
+        """存储的最新交易日不早于数据库时视为最新（结果缓存 freshness_ttl 秒）"""
+        checked = self._freshness.get(table)
+        if checked and time.time() - checked[0] < self.freshness_ttl:
+            return checked[1]
+
+        last = self.last_date(table)
+        fresh = False
+        if last is not None:
+            model = TABLE_SPECS[table][0]
+            try:
+                db_last = db.session.query(func.max(model.trade_date)).scalar()
+                fresh = db_last is None or pd.Timestamp(db_last) <= last
+            except Exception as e:
+                logger.warning(f"检查面板存储新鲜度失败: {table}, 错误: {e}")
+                db.session.rollback()
+
+        self._freshness[table] = (time.time(), fresh)
+        return fresh
+
+    # ==================== 读取 ====================
+
+    def get(self, field: str, codes: List[str] = None, start=None, end=None,
+            table: str = None) -> PanelSlice:
+        """读取字段面板 [start, end] × codes
+
+        codes 为空时返回全部股票，日期切片是内存映射的零拷贝视图；指定 codes 时
+        按列取出（股票字典中不存在的代码为 NaN 列）。存储过期或缺少字段时回退到 SQL。
+        """
+        table = table or FIELD_TABLES.get(field)
+        if table is None:
+            raise ValueError(f"面板存储不支持的字段: {field}")
+
+        entry = self._load_table(table)
+        if entry is None or field not in entry['meta']['fields'] or not self.is_fresh(table):
+            self.stats['sql_fallbacks'] += 1
+            return self._get_sql(table, field, codes, start, end)
+
+        self.stats['store_reads'] += 1
+        dates = entry['dates']
+        lo = dates.searchsorted(pd.Timestamp(start), side='left') if start is not None else 0
+        hi = dates.searchsorted(pd.Timestamp(end), side='right') if end is not None else len(dates)
+        values = self._array(table, entry, field)[lo:hi]
+
+        if codes is None:
+            return PanelSlice(values, dates[lo:hi], list(entry['meta']['codes']), 'store')
+
+        codes = list(codes)
+        positions = np.array([entry['code_index'].get(code, -1) for code in codes], dtype=np.int64)
+        if len(positions) and (positions >= 0).all() and \
+                (np.diff(positions) == 1).all():
+            # 连续的股票区间仍然是零拷贝视图
+            values = values[:, positions[0]:positions[-1] + 1]
+        else:
+            selected = np.full((values.shape[0], len(codes)), np.nan)
+            known = positions >= 0
+            selected[:, known] = values[:, positions[known]]
+            values = selected
+        return PanelSlice(values, dates[lo:hi], codes, 'store')
+
+    def get_frame(self, field: str, codes: List[str] = None, start=None, end=None,
+                  table: str = None) -> pd.DataFrame:
+        """读取字段面板并包装为 DataFrame（日期为索引，股票为列）"""
+        return self.get(field, codes, start, end, table).to_frame()
+
+    def load_frame(self, table: str, codes: List[str], start=None, end=None) -> Optional[pd.DataFrame]:
+        """以长表形式读取整张表，结构与 SQL 查询结果一致；存储不可用时返回 None"""
+        entry = self._load_table(table)
+        if entry is None or not self.is_fresh(table):
+            return None
+
+        fields = entry['meta']['fields']
+        slices = {field: self.get(field, codes, start, end, table) for field in fields}
+        first = slices[fields[0]]
+        index = pd.MultiIndex.from_product([first.dates, first.codes], names=['trade_date', 'ts_code'])
+        frame = pd.DataFrame({field: np.asarray(s.values).ravel() for field, s in slices.items()},
+                             index=index)
+        # 只保留数据库中真实存在的行
+        frame = frame[frame.notna().any(axis=1)].reset_index()
+        frame = frame.sort_values(['ts_code', 'trade_date'], ignore_index=True)
+        return frame[['ts_code', 'trade_date'] + fields]
+
+    def _get_sql(self, table: str, field: str, codes: Optional[List[str]], start, end) -> PanelSlice:
+        model = TABLE_SPECS[table][0]
+        query = db.session.query(model.ts_code, model.trade_date, getattr(model, field))
+        if codes is not None:
+            query = query.filter(model.ts_code.in_(list(codes)))
+        if start is not None:
+            query = query.filter(model.trade_date >= pd.Timestamp(start).date())
+        if end is not None:
+            query = query.filter(model.trade_date <= pd.Timestamp(end).date())
+
+        df = pd.read_sql(query.statement, db.engine)
+        if df.empty:
+            panel = pd.DataFrame(index=pd.DatetimeIndex([]), columns=list(codes or []), dtype='float64')
+        else:
+            df['trade_date'] = pd.to_datetime(df['trade_date'])
+            panel = df.drop_duplicates(['trade_date', 'ts_code']).set_index(
+                ['trade_date', 'ts_code'])[field].astype('float64').unstack().sort_index()
+            if codes is not None:
+                panel = panel.reindex(columns=list(codes))
+        return PanelSlice(panel.to_numpy(dtype='float64'), pd.DatetimeIndex(panel.index),
+                          list(panel.columns), 'sql')
+
+    # ==================== 构建与追加 ====================
+
+    def _read_rows(self, table: str, start_date=None, end_date=None, after_date=None) -> pd.DataFrame:
+        model, fields = TABLE_SPECS[table]
+        columns = [model.ts_code, model.trade_date] + [getattr(model, field) for field in fields]
+        query = db.session.query(*columns)
+        if start_date is not None:
+            query = query.filter(model.trade_date >= start_date)
+        if after_date is not None:
+            query = query.filter(model.trade_date > after_date)
+        if end_date is not None:
+            query = query.filter(model.trade_date <= end_date)
+        df = pd.read_sql(query.statement, db.engine)
+        df['trade_date'] = pd.to_datetime(df['trade_date'])
+        return df
+
+    @staticmethod
+    def _write_rows(handles: Dict[str, Any], df: pd.DataFrame, dates: pd.DatetimeIndex,
+                    codes: List[str]):
+        """把长表按字段转成 dates × codes 的块并追加写入"""
+        df = df.drop_duplicates(['trade_date', 'ts_code']).set_index(['trade_date', 'ts_code'])
+        for field, handle in handles.items():
+            block = df[field].astype('float64').unstack().reindex(index=dates, columns=codes)
+            np.ascontiguousarray(block.to_numpy(), dtype='<f8').tofile(handle)
+
+    def build(self, tables: List[str] = None, chunk_days: int = 250) -> Dict[str, Any]:
+        """从数据库全量构建存储，分块读取以限制内存"""
+        summary = {}
+        for table in tables or list(TABLE_SPECS):
+            started = time.perf_counter()
+            model, fields = TABLE_SPECS[table]
+            codes = sorted(row[0] for row in db.session.query(model.ts_code).distinct())
+            dates = pd.DatetimeIndex(sorted(pd.Timestamp(row[0]) for row in
+                                            db.session.query(model.trade_date).distinct()))
+
+            target = self._table_dir(table)
+            building = f'{target}.building'
+            shutil.rmtree(building, ignore_errors=True)
+            os.makedirs(building, exist_ok=True)
+
+            handles = {field: open(os.path.join(building, f'{field}.f8'), 'wb') for field in fields}
+            try:
+                for i in range(0, len(dates), chunk_days):
+                    chunk = dates[i:i + chunk_days]
+                    df = self._read_rows(table, chunk[0].date(), chunk[-1].date())
+                    self._write_rows(handles, df, chunk, codes)
+            finally:
+                for handle in handles.values():
+                    handle.close()
+
+            with open(os.path.join(building, 'meta.json'), 'w', encoding='utf-8') as f:
+                json.dump({'fields': fields, 'codes': codes,
+                           'dates': [d.strftime('%Y-%m-%d') for d in dates],
+                           'built_at': datetime.now().isoformat()}, f, ensure_ascii=False)
+
+            # 先移走旧目录再替换，已打开的内存映射仍指向旧文件
+            retired = f'{target}.old'
+            shutil.rmtree(retired, ignore_errors=True)
+            if os.path.exists(target):
+                os.replace(target, retired)
+            os.replace(building, target)
+            shutil.rmtree(retired, ignore_errors=True)
+
+            with self._lock:
+                self._tables.pop(table, None)
+                self._freshness.pop(table, None)
+            summary[table] = {'dates': len(dates), 'codes': len(codes),
+                              'seconds': round(time.perf_counter() - started, 3)}
+            logger.info(f"构建面板存储 {table}: {len(dates)} 个交易日 × {len(codes)} 只股票, "
+                        f"耗时 {summary[table]['seconds']}s")
+        return summary
+
+    def append(self, tables: List[str] = None) -> Dict[str, Any]:
+        """追加存储最新交易日之后的数据；出现新股票代码时重建该表"""
+        summary = {}
+        for table in tables or list(TABLE_SPECS):
+            entry = self._load_table(table)
+            if entry is None:
+                summary.update(self.build([table]))
+                continue
+
+            last = entry['dates'][-1] if len(entry['dates']) else None
+            df = self._read_rows(table, after_date=last.date() if last is not None else None)
+            if df.empty:
+                summary[table] = {'appended_dates': 0}
+                continue
+
+            meta = dict(entry['meta'])
+            new_codes = set(df['ts_code']) - set(meta['codes'])
+            if new_codes:
+                logger.info(f"面板存储 {table} 出现 {len(new_codes)} 个新股票代码，重建")
+                summary.update(self.build([table]))
+                continue
+
+            dates = pd.DatetimeIndex(sorted(df['trade_date'].unique()))
+            handles = {field: open(os.path.join(self._table_dir(table), f'{field}.f8'), 'ab')
+                       for field in meta['fields']}
+            try:
+                # 截掉上次中断追加留下的半截数据，保证文件与 meta 对齐
+                expected = len(meta['dates']) * len(meta['codes']) * 8
+                for handle in handles.values():
+                    handle.truncate(expected)
+                self._write_rows(handles, df, dates, meta['codes'])
+            finally:
+                for handle in handles.values():
+                    handle.close()
+
+            meta['dates'] = meta['dates'] + [d.strftime('%Y-%m-%d') for d in dates]
+            self._write_meta(table, meta)
+            with self._lock:
+                self._freshness.pop(table, None)
+            summary[table] = {'appended_dates': len(dates), 'last_date': meta['dates'][-1]}
+            logger.info(f"面板存储 {table} 追加 {len(dates)} 个交易日, 最新 {meta['dates'][-1]}")
+        return summary
+
+
+_panel_store = None
+
+
+def get_panel_store() -> PanelStore:
+    """获取全局面板存储实例（延迟初始化）"""
+    global _panel_store
+    if _panel_store is None:
+        _panel_store = PanelStore()
+    return _panel_store
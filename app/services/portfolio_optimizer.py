@@ -1,14 +1,166 @@
+import time
+import threading
+from collections import OrderedDict
 import pandas as pd
 import numpy as np
-from typing import List, Dict, Any, Optional, Tuple
+from typing import List, Dict, Any, Optional, Tuple, Union
 from datetime import datetime
 from loguru import logger
 import cvxpy as cp
 from scipy.optimize import minimize
 from sklearn.covariance import LedoitWolf
 
-from app.extensions import db
-from app.models import StockDailyHistory, FactorValues
+from app.models import FactorValues
+from app.services.panel_store import get_panel_store
+from app.services.factor_risk_model import FactorRiskModel, get_risk_model_store
+
+# 风险模型：稠密协方差矩阵（DataFrame）或结构化因子模型（FactorRiskModel）
+RiskModel = Union[pd.DataFrame, FactorRiskModel]
+
+
+def risk_dot(risk_model: RiskModel, weights: np.ndarray) -> np.ndarray:
+    """Σ · w；因子模型为 O(N·K)"""
+    if isinstance(risk_model, FactorRiskModel):
+        return risk_model.cov_dot(weights)
+    return risk_model.values @ weights
+
+
+def risk_factors(risk_model: RiskModel) -> Tuple[np.ndarray, np.ndarray]:
+    """把风险模型写成 Σ = B B' + diag(s²)，返回 (B, s)
+
+    因子模型直接取低秩载荷与特异波动率；稠密协方差做特征分解（B 为 N × N，s 为 0）。
+    """
+    if isinstance(risk_model, FactorRiskModel):
+        return risk_model.loadings(), np.sqrt(risk_model.specific_var)
+    eigval, eigvec = np.linalg.eigh(np.asarray(risk_model.values, dtype=float))
+    return eigvec * np.sqrt(np.clip(eigval, 0.0, None)), np.zeros(len(eigval))
+
+
+# 求解器优先级：OSQP 支持参数更新后的热启动
+PREFERRED_SOLVERS = ('OSQP', 'ECOS', 'CLARABEL', 'SCS')
+PROBLEM_CACHE_SIZE = 16
+
+_solver_name = None
+
+
+def _select_solver() -> str:
+    global _solver_name
+    if _solver_name is None:
+        installed = set(cp.installed_solvers())
+        _solver_name = next((name for name in PREFERRED_SOLVERS if name in installed), None)
+    return _solver_name
+
+
+class MeanVarianceProblem:
+    """参数化的均值-方差问题
+
+    结构由 (股票数 n, 因子数 k, 是否含换手惩罚) 决定，预期收益、风险载荷和权重上下界
+    都是 cp.Parameter，重复求解时跳过建模与规范化，只更新参数数值。风险厌恶系数预先乘进
+    载荷（sqrt(0.5·λ)·B），换手用辅助变量表示，使问题满足 DPP。
+    """
+
+    def __init__(self, n: int, k: int, with_turnover: bool = False):
+        self.w = cp.Variable(n)
+        self.mu = cp.Parameter(n)
+        self.loadings = cp.Parameter((n, k))
+        self.specific_std = cp.Parameter(n, nonneg=True)
+        self.lower = cp.Parameter(n)
+        self.upper = cp.Parameter(n)
+
+        objective = (self.mu @ self.w
+                     - cp.sum_squares(self.loadings.T @ self.w)
+                     - cp.sum_squares(cp.multiply(self.specific_std, self.w)))
+        constraints = [cp.sum(self.w) == 1, self.w >= self.lower, self.w <= self.upper]
+
+        self.previous = self.penalty = None
+        if with_turnover:
+            trades = cp.Variable(n, nonneg=True)
+            self.previous = cp.Parameter(n)
+            self.penalty = cp.Parameter(n, nonneg=True)
+            objective = objective - self.penalty @ trades
+            constraints += [self.w - self.previous <= trades, self.previous - self.w <= trades]
+
+        self.problem = cp.Problem(cp.Maximize(objective), constraints)
+        self.lock = threading.Lock()
+        self.solves = 0
+
+    def solve(self, mu: np.ndarray, loadings: np.ndarray, specific_std: np.ndarray,
+              lower: np.ndarray, upper: np.ndarray, previous: np.ndarray = None,
+              penalty: np.ndarray = None) -> Tuple[Optional[np.ndarray], Dict[str, Any]]:
+        """更新参数并求解，以上一次的解（或当前持仓）为初值热启动"""
+        solver = _select_solver()
+        with self.lock:
+            self.mu.value = mu
+            self.loadings.value = loadings
+            self.specific_std.value = specific_std
+            self.lower.value = lower
+            self.upper.value = upper
+            if self.previous is not None:
+                self.previous.value = previous
+                self.penalty.value = penalty
+                self.w.value = previous
+            warm_start = self.w.value is not None
+
+            started = time.perf_counter()
+            self.problem.solve(solver=solver, warm_start=True)
+            elapsed = time.perf_counter() - started
+            stats = self.problem.solver_stats
+            solve_seconds = stats.solve_time if stats is not None and stats.solve_time is not None else elapsed
+            info = {
+                'solver': solver or 'default',
+                'status': self.problem.status,
+                'cache_hit': self.solves > 0,
+                'warm_start': warm_start,
+                'compile_seconds': round(max(elapsed - solve_seconds, 0.0), 6),
+                'solve_seconds': round(solve_seconds, 6),
+                'iterations': stats.num_iters if stats is not None else None
+            }
+            self.solves += 1
+
+            if self.problem.status in ('infeasible', 'unbounded') or self.w.value is None:
+                return None, info
+            return np.array(self.w.value), info
+
+
+class ProblemCache:
+    """按 (n, k, 是否含换手惩罚) 缓存的参数化问题，LRU 淘汰"""
+
+    def __init__(self, max_size: int = PROBLEM_CACHE_SIZE):
+        self.max_size = max_size
+        self._problems: 'OrderedDict[Tuple[int, int, bool], MeanVarianceProblem]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, n: int, k: int, with_turnover: bool = False) -> MeanVarianceProblem:
+        key = (n, k, with_turnover)
+        with self._lock:
+            problem = self._problems.get(key)
+            if problem is not None:
+                self.hits += 1
+                self._problems.move_to_end(key)
+                return problem
+            self.misses += 1
+            problem = MeanVarianceProblem(n, k, with_turnover)
+            self._problems[key] = problem
+            while len(self._problems) > self.max_size:
+                self._problems.popitem(last=False)
+            return problem
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'size': len(self._problems), 'hits': self.hits, 'misses': self.misses}
+
+
+_problem_cache = None
+
+
+def get_problem_cache() -> ProblemCache:
+    """获取全局参数化问题缓存（延迟初始化），回测中不同引擎实例共用"""
+    global _problem_cache
+    if _problem_cache is None:
+        _problem_cache = ProblemCache()
+    return _problem_cache
 
 
 class PortfolioOptimizer:
@@ -22,9 +174,11 @@ class PortfolioOptimizer:
             'factor_neutral': self._factor_neutral_optimization,
             'black_litterman': self._black_litterman_optimization
         }
+        # 最近一次参数化求解的耗时信息（按线程保存）
+        self._solve_info = threading.local()
     
     def optimize_portfolio(self, expected_returns: pd.Series, 
-                          risk_model: pd.DataFrame = None,
+                          risk_model: RiskModel = None,
                           method: str = 'mean_variance',
                           constraints: Dict[str, Any] = None) -> Dict[str, Any]:
         """优化投资组合"""
@@ -35,6 +189,8 @@ class PortfolioOptimizer:
             # 获取风险模型
             if risk_model is None:
                 risk_model = self._estimate_risk_model(expected_returns.index.tolist())
+            elif isinstance(risk_model, FactorRiskModel) and risk_model.codes != expected_returns.index.tolist():
+                risk_model = risk_model.subset(expected_returns.index.tolist())
             
             # 检查优化方法
             if method not in self.optimization_methods:
@@ -42,6 +198,7 @@ class PortfolioOptimizer:
                 method = 'equal_weight'
             
             # 执行优化
+            self._solve_info.last = None
             optimization_func = self.optimization_methods[method]
             weights = optimization_func(expected_returns, risk_model, constraints)
             
@@ -63,6 +220,15 @@ class PortfolioOptimizer:
                 'total_stocks': int(len(weights)),
                 'non_zero_weights': int((weights > 0.001).sum())
             }
+            if getattr(self._solve_info, 'last', None):
+                result['solver'] = self._solve_info.last
+            if isinstance(risk_model, FactorRiskModel):
+                result['risk_model'] = {
+                    'type': 'factor',
+                    'trade_date': risk_model.trade_date.isoformat(),
+                    'factors': len(risk_model.factors),
+                    'missing_stocks': int(risk_model.meta.get('missing', 0))
+                }
             
             logger.info(f"组合优化完成: {method}, {len(weights)} 只股票")
             return result
@@ -72,67 +238,57 @@ class PortfolioOptimizer:
             return {'error': str(e)}
     
     def _mean_variance_optimization(self, expected_returns: pd.Series, 
-                                   risk_model: pd.DataFrame,
+                                   risk_model: RiskModel,
                                    constraints: Dict[str, Any] = None) -> pd.Series:
         """均值-方差优化"""
         try:
-            n = len(expected_returns)
-            
-            # 风险厌恶系数
-            risk_aversion = constraints.get('risk_aversion', 1.0) if constraints else 1.0
-            
-            # 定义优化变量
-            w = cp.Variable(n)
-            
-            # 目标函数：最大化 expected_return - 0.5 * risk_aversion * variance
-            portfolio_return = expected_returns.values @ w
-            portfolio_variance = cp.quad_form(w, risk_model.values)
-            objective = cp.Maximize(portfolio_return - 0.5 * risk_aversion * portfolio_variance)
-            
-            # 约束条件
-            constraints_list = [
-                cp.sum(w) == 1,  # 权重和为1
-                w >= 0  # 不允许做空
-            ]
-            
-            # 添加额外约束
-            if constraints:
-                # 最大权重约束
-                if 'max_weight' in constraints:
-                    max_weight = constraints['max_weight']
-                    constraints_list.append(w <= max_weight)
-                
-                # 最小权重约束
-                if 'min_weight' in constraints:
-                    min_weight = constraints['min_weight']
-                    constraints_list.append(w >= min_weight)
-                
-                # 最大集中度约束
-                if 'max_concentration' in constraints:
-                    max_conc = constraints['max_concentration']
-                    constraints_list.append(cp.norm(w, 'inf') <= max_conc)
-            
-            # 求解优化问题
-            problem = cp.Problem(objective, constraints_list)
-            problem.solve(solver=cp.ECOS)
-            
-            if problem.status not in ["infeasible", "unbounded"]:
-                weights = pd.Series(w.value, index=expected_returns.index)
-                # 清理极小的权重
-                weights[weights < 1e-6] = 0
-                # 重新归一化
-                weights = weights / weights.sum()
-                return weights
-            else:
-                logger.warning(f"均值-方差优化失败: {problem.status}")
-                return None
-                
+            return self._solve_mean_variance(expected_returns, risk_model, constraints)
         except Exception as e:
             logger.error(f"均值-方差优化失败: {e}")
             return None
     
+    def _solve_mean_variance(self, expected_returns: pd.Series, risk_model: RiskModel,
+                             constraints: Dict[str, Any] = None,
+                             previous_weights: np.ndarray = None,
+                             turnover_penalty: float = 0.0) -> Optional[pd.Series]:
+        """最大化 expected_return - 0.5 * risk_aversion * variance [- penalty * |w - previous|]
+        
+        使用缓存的参数化问题；max_weight、min_weight、max_concentration 统一折算为权重上下界。
+        """
+        constraints = constraints or {}
+        n = len(expected_returns)
+        risk_aversion = constraints.get('risk_aversion', 1.0)
+        loadings, specific_std = risk_factors(risk_model)
+        scale = np.sqrt(0.5 * risk_aversion)
+        
+        # 不允许做空；多头组合中最大集中度约束等价于权重上界
+        lower = np.full(n, max(constraints.get('min_weight', 0.0), 0.0))
+        upper = np.full(n, min(constraints.get('max_weight', 1.0),
+                               constraints.get('max_concentration', 1.0), 1.0))
+        
+        with_turnover = previous_weights is not None
+        problem = get_problem_cache().get(n, loadings.shape[1], with_turnover)
+        weights, info = problem.solve(
+            np.asarray(expected_returns.values, dtype=float), loadings * scale, specific_std * scale,
+            lower, upper,
+            previous=np.asarray(previous_weights, dtype=float) if with_turnover else None,
+            penalty=np.full(n, float(turnover_penalty)) if with_turnover else None
+        )
+        self._solve_info.last = info
+        
+        if weights is None:
+            logger.warning(f"均值-方差优化失败: {info['status']}")
+            return None
+        
+        weights = pd.Series(weights, index=expected_returns.index)
+        # 清理极小的权重
+        weights[weights < 1e-6] = 0
+        # 重新归一化
+        weights = weights / weights.sum()
+        return weights
+    
     def _risk_parity_optimization(self, expected_returns: pd.Series, 
-                                 risk_model: pd.DataFrame,
+                                 risk_model: RiskModel,
                                  constraints: Dict[str, Any] = None) -> pd.Series:
         """风险平价优化"""
         try:
@@ -141,10 +297,10 @@ class PortfolioOptimizer:
             def risk_parity_objective(weights):
                 """风险平价目标函数"""
                 weights = np.array(weights)
-                portfolio_var = np.dot(weights, np.dot(risk_model.values, weights))
                 
                 # 计算边际风险贡献
-                marginal_contrib = np.dot(risk_model.values, weights)
+                marginal_contrib = risk_dot(risk_model, weights)
+                portfolio_var = np.dot(weights, marginal_contrib)
                 risk_contrib = weights * marginal_contrib
                 
                 # 目标：最小化风险贡献的方差
@@ -188,7 +344,7 @@ class PortfolioOptimizer:
             return None
     
     def _equal_weight_optimization(self, expected_returns: pd.Series, 
-                                  risk_model: pd.DataFrame,
+                                  risk_model: RiskModel,
                                   constraints: Dict[str, Any] = None) -> pd.Series:
         """等权重优化"""
         try:
@@ -201,7 +357,7 @@ class PortfolioOptimizer:
             return None
     
     def _factor_neutral_optimization(self, expected_returns: pd.Series, 
-                                    risk_model: pd.DataFrame,
+                                    risk_model: RiskModel,
                                     constraints: Dict[str, Any] = None) -> pd.Series:
         """因子中性优化"""
         try:
@@ -215,7 +371,7 @@ class PortfolioOptimizer:
             return None
     
     def _black_litterman_optimization(self, expected_returns: pd.Series, 
-                                     risk_model: pd.DataFrame,
+                                     risk_model: RiskModel,
                                      constraints: Dict[str, Any] = None) -> pd.Series:
         """Black-Litterman优化"""
         try:
@@ -229,33 +385,40 @@ class PortfolioOptimizer:
             return None
     
     def _estimate_risk_model(self, ts_codes: List[str], 
-                            lookback_days: int = 252) -> pd.DataFrame:
-        """估计风险模型（协方差矩阵）"""
+                            lookback_days: int = 252, trade_date=None) -> RiskModel:
+        """估计风险模型：优先使用按交易日持久化的因子风险模型，没有因子数据时回退到历史价格协方差"""
+        try:
+            factor_model = get_risk_model_store().get(trade_date)
+            if factor_model is not None:
+                return factor_model.subset(ts_codes)
+        except Exception as e:
+            logger.warning(f"获取因子风险模型失败，改用历史价格估计: {e}")
+        
         try:
             # 获取历史价格数据
             end_date = datetime.now().date()
             start_date = end_date - pd.Timedelta(days=lookback_days + 50)
             
-            price_query = StockDailyHistory.query.filter(
-                StockDailyHistory.ts_code.in_(ts_codes),
-                StockDailyHistory.trade_date >= start_date,
-                StockDailyHistory.trade_date <= end_date
-            ).order_by(StockDailyHistory.ts_code, StockDailyHistory.trade_date)
+            # 透视表：日期为行，股票为列（优先读取列式面板存储）
+            price_pivot = get_panel_store().get_frame('close', ts_codes, start_date, end_date)
+            return self.risk_model_from_prices(price_pivot, ts_codes)
             
-            price_data = pd.read_sql(price_query.statement, db.engine)
+        except Exception as e:
+            logger.error(f"估计风险模型失败: {e}")
+            # 返回单位矩阵作为备选
+            return pd.DataFrame(np.eye(len(ts_codes)), index=ts_codes, columns=ts_codes)
+    
+    @staticmethod
+    def risk_model_from_prices(price_pivot: pd.DataFrame, ts_codes: List[str]) -> pd.DataFrame:
+        """由收盘价面板（日期 × 股票）估计协方差矩阵"""
+        try:
+            price_pivot = price_pivot.reindex(columns=[c for c in ts_codes if c in price_pivot.columns])
+            price_pivot = price_pivot.dropna(axis=1, how='all')
             
-            if price_data.empty:
+            if price_pivot.empty:
                 # 如果没有数据，使用单位矩阵
                 return pd.DataFrame(np.eye(len(ts_codes)), index=ts_codes, columns=ts_codes)
             
-            # 透视表：日期为行，股票为列
-            price_pivot = price_data.pivot_table(
-                index='trade_date',
-                columns='ts_code',
-                values='close',
-                aggfunc='first'
-            )
-            
             # 计算收益率
             returns = price_pivot.pct_change().dropna()
             
@@ -275,22 +438,15 @@ class PortfolioOptimizer:
             # 转换为DataFrame
             risk_model = pd.DataFrame(cov_matrix, index=returns.columns, columns=returns.columns)
             
-            # 确保包含所有股票（缺失的用0填充）
-            for ts_code in ts_codes:
-                if ts_code not in risk_model.index:
-                    # 添加缺失股票，与其他股票协方差为0，方差为市场平均方差
-                    avg_var = np.diag(risk_model).mean()
-                    
-                    # 扩展矩阵
-                    new_row = pd.Series(0, index=risk_model.columns, name=ts_code)
-                    new_col = pd.Series(0, index=list(risk_model.index) + [ts_code], name=ts_code)
-                    new_col[ts_code] = avg_var
-                    
-                    risk_model = pd.concat([risk_model, new_row.to_frame().T])
-                    risk_model[ts_code] = new_col
-            
-            # 重新排序以匹配输入顺序
-            risk_model = risk_model.reindex(index=ts_codes, columns=ts_codes, fill_value=0)
+            # 按输入顺序补齐缺失股票：与其他股票协方差为0，方差为市场平均方差
+            avg_var = float(np.diag(cov_matrix).mean())
+            risk_model = risk_model.reindex(index=ts_codes, columns=ts_codes, fill_value=0.0)
+            missing = ~pd.Index(ts_codes).isin(returns.columns)
+            if missing.any():
+                values = risk_model.values.copy()
+                positions = np.flatnonzero(missing)
+                values[positions, positions] = avg_var
+                risk_model = pd.DataFrame(values, index=ts_codes, columns=ts_codes)
             
             return risk_model
             
@@ -343,20 +499,23 @@ class PortfolioOptimizer:
     
     def _calculate_portfolio_stats(self, weights: pd.Series, 
                                   expected_returns: pd.Series,
-                                  risk_model: pd.DataFrame) -> Dict[str, float]:
+                                  risk_model: RiskModel) -> Dict[str, float]:
         """计算组合统计指标"""
         try:
             # 确保索引一致
             common_index = weights.index.intersection(expected_returns.index)
             weights = weights[common_index]
             expected_returns = expected_returns[common_index]
-            risk_model = risk_model.loc[common_index, common_index]
+            if isinstance(risk_model, FactorRiskModel):
+                risk_model = risk_model.subset(common_index.tolist())
+            else:
+                risk_model = risk_model.loc[common_index, common_index]
             
             # 组合预期收益率
             portfolio_return = np.dot(weights.values, expected_returns.values)
             
             # 组合风险（标准差）
-            portfolio_variance = np.dot(weights.values, np.dot(risk_model.values, weights.values))
+            portfolio_variance = np.dot(weights.values, risk_dot(risk_model, weights.values))
             portfolio_risk = np.sqrt(portfolio_variance)
             
             # 夏普比率（假设无风险利率为3%）
@@ -445,4 +604,56 @@ class PortfolioOptimizer:
             
         except Exception as e:
             logger.error(f"组合再平衡失败: {e}")
+            return {'error': str(e)}
+    
+    def rebalance_with_turnover_penalty(self, current_weights: pd.Series,
+                                        expected_returns: pd.Series,
+                                        risk_model: RiskModel = None,
+                                        transaction_cost: float = 0.001,
+                                        turnover_penalty: float = None,
+                                        constraints: Dict[str, Any] = None) -> Dict[str, Any]:
+        """带换手惩罚的再平衡：以当前持仓为起点求解目标权重，再生成交易指令
+        
+        目标为 expected_return - 0.5 * risk_aversion * variance - turnover_penalty * Σ|w - w_current|，
+        turnover_penalty 默认取单边交易成本。当前持有但不在预期收益中的股票按预期收益 0 参与优化。
+        """
+        try:
+            if expected_returns.empty:
+                return {'error': '预期收益率数据为空'}
+            
+            codes = list(expected_returns.index) + [
+                code for code in current_weights.index if code not in expected_returns.index
+            ]
+            expected = expected_returns.reindex(codes, fill_value=0.0)
+            current = current_weights.reindex(codes, fill_value=0.0)
+            
+            if risk_model is None:
+                risk_model = self._estimate_risk_model(codes)
+            elif isinstance(risk_model, FactorRiskModel):
+                risk_model = risk_model.subset(codes)
+            else:
+                risk_model = risk_model.reindex(index=codes, columns=codes, fill_value=0.0)
+            
+            penalty = transaction_cost if turnover_penalty is None else turnover_penalty
+            self._solve_info.last = None
+            target = self._solve_mean_variance(expected, risk_model, constraints,
+                                               previous_weights=current.values,
+                                               turnover_penalty=penalty)
+            if target is None:
+                return {'error': '换手惩罚优化失败'}
+            
+            result = self.rebalance_portfolio(current_weights, target, transaction_cost)
+            if 'error' in result:
+                return result
+            
+            result.update({
+                'target_weights': target[target > 0].to_dict(),
+                'turnover_penalty': float(penalty),
+                'portfolio_stats': self._calculate_portfolio_stats(target, expected, risk_model),
+                'solver': self._solve_info.last
+            })
+            return result
+            
+        except Exception as e:
+            logger.error(f"换手惩罚再平衡失败: {e}")
             return {'error': str(e)} 
\ No newline at end of file
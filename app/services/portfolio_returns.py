@@ -0,0 +1,186 @@
+"""
+组合收益率提供器
+风险计算、持仓监控与风险报告共用的 日期 × 股票 收盘价/收益率矩阵：
+
+- 全部持仓一次读取：优先列式面板存储的日线收盘价，缺失时用一条 SQL 批量读取
+  60 分钟K线并向量化聚合为日收盘价
+- 按 (组合, 截止日期, 回看天数) 缓存，持仓集合变化时命中失效；持仓增删或
+  ts_code / is_active 变化时由 PortfolioPosition 的 ORM 事件主动失效
+- 条目另有 TTL，保证盘后入库的当日日线能被及时读到
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+from typing import List, NamedTuple, Optional, Tuple
+
+import pandas as pd
+from loguru import logger
+from sqlalchemy import event, inspect
+
+from app.extensions import db
+from app.models.portfolio_position import PortfolioPosition
+from app.models.stock_minute_data import StockMinuteData
+from app.services.panel_store import get_panel_store
+
+
+DEFAULT_TTL = 300
+DEFAULT_MAX_ENTRIES = 64
+# 回看交易日数之外多取的自然日
+LOOKBACK_PADDING_DAYS = 30
+
+
+class PortfolioReturns(NamedTuple):
+    """收盘价矩阵（已前向填充）与日收益率矩阵，日期为索引、股票为列"""
+    prices: pd.DataFrame
+    returns: pd.DataFrame
+    as_of: date
+    source: str
+
+
+class _Entry(NamedTuple):
+    codes: Tuple[str, ...]
+    data: PortfolioReturns
+    loaded_at: float
+
+
+class PortfolioReturnsProvider:
+    """组合收益率矩阵的批量加载与缓存"""
+
+    def __init__(self, ttl: float = None, max_entries: int = DEFAULT_MAX_ENTRIES):
+        if ttl is None:
+            try:
+                from flask import current_app
+                ttl = current_app.config.get('PORTFOLIO_RETURNS_TTL', DEFAULT_TTL)
+            except RuntimeError:
+                ttl = DEFAULT_TTL
+        self.ttl = float(ttl)
+        self.max_entries = max_entries
+        self._cache: 'OrderedDict[Tuple[str, date, int], _Entry]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    def get(self, portfolio_id: str, codes: List[str], period_days: int = 252,
+            as_of: date = None) -> PortfolioReturns:
+        """读取组合持仓的收益率矩阵；持仓集合与缓存不一致或已过期时重新加载"""
+        as_of = as_of or datetime.now().date()
+        key = (portfolio_id, as_of, period_days)
+        code_key = tuple(sorted(set(codes)))
+
+        with self._lock:
+            entry = self._cache.get(key)
+            if (entry is not None and entry.codes == code_key
+                    and time.monotonic() - entry.loaded_at < self.ttl):
+                self._cache.move_to_end(key)
+                self.stats['hits'] += 1
+                return entry.data
+            self.stats['misses'] += 1
+
+        data = self.load(list(code_key), period_days, as_of)
+        with self._lock:
+            self._cache[key] = _Entry(code_key, data, time.monotonic())
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return data
+
+    def get_for_positions(self, portfolio_id: str, positions: List[PortfolioPosition],
+                          period_days: int = 252, as_of: date = None) -> PortfolioReturns:
+        return self.get(portfolio_id, [pos.ts_code for pos in positions], period_days, as_of)
+
+    def invalidate(self, portfolio_id: str = None):
+        """使某个组合（为空时全部组合）的缓存失效"""
+        with self._lock:
+            keys = [key for key in self._cache if portfolio_id is None or key[0] == portfolio_id]
+            for key in keys:
+                del self._cache[key]
+            if keys:
+                self.stats['invalidations'] += len(keys)
+
+    # ==================== 加载 ====================
+
+    def load(self, codes: List[str], period_days: int, as_of: date) -> PortfolioReturns:
+        end = datetime.now() if as_of >= datetime.now().date() else datetime.combine(as_of, datetime.max.time())
+        start = end - timedelta(days=period_days + LOOKBACK_PADDING_DAYS)
+        prices, source = self.load_prices(codes, start, end)
+        returns = prices.pct_change().dropna() if not prices.empty else pd.DataFrame()
+        return PortfolioReturns(prices, returns, as_of, source)
+
+    def load_prices(self, codes: List[str], start: datetime, end: datetime) -> Tuple[pd.DataFrame, str]:
+        """全部股票的日收盘价（日期 × 股票，前向填充）及数据来源"""
+        if not codes:
+            return pd.DataFrame(), 'empty'
+        try:
+            # 列式面板存储的日线收盘价，存储过期时内部回退到 SQL
+            prices = get_panel_store().get_frame('close', codes, start, end).dropna(axis=1, how='all')
+            if not prices.empty:
+                return prices.ffill(), 'daily'
+        except Exception as e:
+            logger.warning(f"读取日线面板失败，改用分钟数据: {e}")
+
+        return self._load_minute_closes(codes, start, end), 'minute'
+
+    @staticmethod
+    def _load_minute_closes(codes: List[str], start: datetime, end: datetime) -> pd.DataFrame:
+        """一条查询读取全部股票的 60 分钟K线，取每日最后一根的收盘价"""
+        try:
+            rows = db.session.query(
+                StockMinuteData.ts_code, StockMinuteData.datetime, StockMinuteData.close
+            ).filter(
+                StockMinuteData.ts_code.in_(codes),
+                StockMinuteData.period_type == '60min',
+                StockMinuteData.datetime >= start,
+                StockMinuteData.datetime <= end
+            ).order_by(StockMinuteData.datetime).all()
+            if not rows:
+                return pd.DataFrame()
+
+            frame = pd.DataFrame(rows, columns=['ts_code', 'datetime', 'close'])
+            frame['date'] = pd.to_datetime(frame['datetime']).dt.normalize()
+            frame['close'] = pd.to_numeric(frame['close'], errors='coerce')
+            closes = frame.groupby(['date', 'ts_code'])['close'].last().unstack('ts_code')
+            return closes.sort_index().ffill()
+        except Exception as e:
+            logger.error(f"批量读取分钟价格失败: {e}")
+            return pd.DataFrame()
+
+
+_portfolio_returns_provider: Optional[PortfolioReturnsProvider] = None
+
+
+def get_portfolio_returns_provider() -> PortfolioReturnsProvider:
+    """获取全局组合收益率提供器实例（延迟初始化）"""
+    global _portfolio_returns_provider
+    if _portfolio_returns_provider is None:
+        _portfolio_returns_provider = PortfolioReturnsProvider()
+    return _portfolio_returns_provider
+
+
+# ==================== 持仓变化时失效 ====================
+
+# 影响收益率矩阵列集合的字段；价格、市值等更新不影响缓存
+_HOLDING_FIELDS = ('portfolio_id', 'ts_code', 'is_active')
+
+
+def _invalidate_position(target: PortfolioPosition, previous_portfolio: str = None):
+    if _portfolio_returns_provider is None:
+        return
+    _portfolio_returns_provider.invalidate(target.portfolio_id)
+    if previous_portfolio and previous_portfolio != target.portfolio_id:
+        _portfolio_returns_provider.invalidate(previous_portfolio)
+
+
+@event.listens_for(PortfolioPosition, 'after_insert')
+@event.listens_for(PortfolioPosition, 'after_delete')
+def _on_position_added_or_removed(mapper, connection, target):
+    _invalidate_position(target)
+
+
+@event.listens_for(PortfolioPosition, 'after_update')
+def _on_position_updated(mapper, connection, target):
+    state = inspect(target)
+    if not any(state.attrs[name].history.has_changes() for name in _HOLDING_FIELDS):
+        return
+    deleted = state.attrs.portfolio_id.history.deleted
+    _invalidate_position(target, deleted[0] if deleted else None)
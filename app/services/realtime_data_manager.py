@@ -12,6 +12,9 @@ import logging
 from app.models.stock_minute_data import StockMinuteData
 from app.extensions import db
 from app.services.minute_data_sync_service import MinuteDataSyncService
+from app.services.live_bar_cache import get_live_bar_cache
+from app.services.bar_aggregator import BarAggregator, TARGET_PERIODS, get_bar_aggregator
+from app.services.minute_ingest_pipeline import upsert_minute_bars
 
 # 可选导入tushare
 try:
@@ -221,10 +224,11 @@ class RealtimeDataManager:
             
             # 批量插入数据
             StockMinuteData.bulk_insert(data_list)
+            get_live_bar_cache().ingest(data_list)
             
-            # 如果是1分钟数据，生成其他周期数据
+            # 如果是1分钟数据，在线聚合出其他周期中已收盘的K线
             if period_type == '1min':
-                self._generate_aggregated_data(ts_code, start_date_legacy, end_date_legacy)
+                self._store_bars(get_bar_aggregator().consume(data_list))
             
             logger.info(f"成功同步 {len(data_list)} 条 {ts_code} 的{period_type}数据")
             
@@ -371,11 +375,11 @@ class RealtimeDataManager:
     def aggregate_data(self, ts_code: str, source_period: str = '1min', target_period: str = '5min', 
                       start_date: str = None, end_date: str = None) -> Dict:
         """
-        数据聚合：将小周期数据聚合为大周期数据
+        数据聚合：将1分钟数据聚合为大周期数据（按交易时段对齐）
         
         Args:
             ts_code: 股票代码
-            source_period: 源周期
+            source_period: 源周期（仅支持1min）
             target_period: 目标周期
             start_date: 开始日期
             end_date: 结束日期
@@ -383,101 +387,83 @@ class RealtimeDataManager:
         Returns:
             聚合结果
         """
+        if source_period != '1min':
+            return {
+                'success': False,
+                'message': f'仅支持由1min数据聚合，不支持的源周期: {source_period}',
+                'data_count': 0
+            }
+        if target_period not in TARGET_PERIODS:
+            return {
+                'success': False,
+                'message': f'不支持的目标周期: {target_period}',
+                'data_count': 0
+            }
+        
+        result = self._replay_aggregation(ts_code, [target_period], start_date, end_date)
+        if result['success']:
+            result.update({
+                'message': f"成功聚合 {result['data_count']} 条 {target_period} 数据",
+                'source_period': source_period,
+                'target_period': target_period
+            })
+        return result
+    
+    def _replay_aggregation(self, ts_code: str, periods: List[str],
+                            start_date: str = None, end_date: str = None) -> Dict:
+        """从数据库读取一段1分钟数据，用独立的聚合器回放一遍，输出全部目标周期的K线"""
         try:
-            # 设置默认日期范围
+            # 设置默认日期范围（结束日期包含当天）
             if not end_date:
-                end_date = datetime.now()
+                end_time = datetime.now()
             else:
-                end_date = datetime.strptime(end_date, '%Y%m%d')
+                end_time = datetime.strptime(end_date, '%Y%m%d') + timedelta(days=1) - timedelta(seconds=1)
             
             if not start_date:
-                start_date = end_date - timedelta(days=7)
+                start_time = end_time - timedelta(days=7)
             else:
-                start_date = datetime.strptime(start_date, '%Y%m%d')
+                start_time = datetime.strptime(start_date, '%Y%m%d')
             
-            # 获取源数据
-            source_data = StockMinuteData.get_data_by_time_range(
-                ts_code, start_date, end_date, source_period
-            )
+            # 只取聚合需要的列
+            rows = db.session.query(
+                StockMinuteData.datetime, StockMinuteData.open, StockMinuteData.high,
+                StockMinuteData.low, StockMinuteData.close, StockMinuteData.volume, StockMinuteData.amount
+            ).filter(
+                StockMinuteData.ts_code == ts_code,
+                StockMinuteData.period_type == '1min',
+                StockMinuteData.datetime >= start_time,
+                StockMinuteData.datetime <= end_time
+            ).order_by(StockMinuteData.datetime.asc()).all()
             
-            if not source_data:
+            if not rows:
                 return {
                     'success': False,
-                    'message': f'没有找到 {ts_code} 的 {source_period} 数据',
+                    'message': f'没有找到 {ts_code} 的 1min 数据',
                     'data_count': 0
                 }
             
-            # 转换为DataFrame
-            df = pd.DataFrame([data.to_dict() for data in source_data])
-            df['datetime'] = pd.to_datetime(df['datetime'])
-            df.set_index('datetime', inplace=True)
-            
-            # 确定聚合频率
-            freq_map = {
-                '5min': '5T',
-                '15min': '15T',
-                '30min': '30T',
-                '60min': '60T'
-            }
+            aggregator = BarAggregator(periods)
+            source = ({
+                'ts_code': ts_code, 'datetime': row[0], 'open': row[1], 'high': row[2],
+                'low': row[3], 'close': row[4], 'volume': row[5], 'amount': row[6]
+            } for row in rows)
+            bars = aggregator.consume(source) + aggregator.flush()
+            self._store_bars(bars)
             
-            if target_period not in freq_map:
-                return {
-                    'success': False,
-                    'message': f'不支持的目标周期: {target_period}',
-                    'data_count': 0
-                }
-            
-            freq = freq_map[target_period]
-            
-            # 执行聚合
-            agg_data = df.resample(freq).agg({
-                'open': 'first',
-                'high': 'max',
-                'low': 'min',
-                'close': 'last',
-                'volume': 'sum',
-                'amount': 'sum'
-            }).dropna()
-            
-            # 计算技术指标
-            agg_data['pre_close'] = agg_data['close'].shift(1)
-            agg_data['change'] = agg_data['close'] - agg_data['pre_close']
-            agg_data['pct_chg'] = (agg_data['change'] / agg_data['pre_close'] * 100).fillna(0)
-            
-            # 转换为模型格式
-            aggregated_list = []
-            for dt, row in agg_data.iterrows():
-                if pd.notna(row['open']):  # 确保数据有效
-                    aggregated_list.append({
-                        'ts_code': ts_code,
-                        'datetime': dt.to_pydatetime(),
-                        'period_type': target_period,
-                        'open': row['open'],
-                        'high': row['high'],
-                        'low': row['low'],
-                        'close': row['close'],
-                        'volume': int(row['volume']),
-                        'amount': row['amount'],
-                        'pre_close': row['pre_close'] if pd.notna(row['pre_close']) else row['open'],
-                        'change': row['change'] if pd.notna(row['change']) else 0,
-                        'pct_chg': row['pct_chg'] if pd.notna(row['pct_chg']) else 0
-                    })
-            
-            # 批量插入聚合数据
-            if aggregated_list:
-                StockMinuteData.bulk_insert(aggregated_list)
-            
-            logger.info(f"成功聚合 {len(aggregated_list)} 条 {target_period} 数据")
+            period_counts = {period: 0 for period in periods}
+            for bar in bars:
+                period_counts[bar['period_type']] += 1
+            logger.info(f"{ts_code} 聚合 {len(rows)} 条1分钟数据: {period_counts}")
             
             return {
                 'success': True,
-                'message': f'成功聚合 {len(aggregated_list)} 条 {target_period} 数据',
-                'data_count': len(aggregated_list),
-                'source_period': source_period,
-                'target_period': target_period
+                'data_count': len(bars),
+                'source_count': len(rows),
+                'period_counts': period_counts
             }
             
         except Exception as e:
+            db.session.rollback()
             logger.error(f"数据聚合失败: {str(e)}")
             return {
                 'success': False,
@@ -485,19 +471,18 @@ class RealtimeDataManager:
                 'data_count': 0
             }
     
-    def _generate_aggregated_data(self, ts_code: str, start_date: str, end_date: str):
-        """生成所有周期的聚合数据"""
-        periods = ['5min', '15min', '30min', '60min']
-        
-        for period in periods:
-            try:
-                result = self.aggregate_data(ts_code, '1min', period, start_date, end_date)
-                if result['success']:
-                    logger.info(f"生成 {period} 聚合数据成功: {result['data_count']} 条")
-                else:
-                    logger.warning(f"生成 {period} 聚合数据失败: {result['message']}")
-            except Exception as e:
-                logger.error(f"生成 {period} 聚合数据异常: {str(e)}")
+    def _store_bars(self, bars: List[Dict]):
+        """按 (股票, 周期) 批量 upsert 聚合K线并写入实时K线缓存"""
+        if not bars:
+            return
+        grouped = {}
+        for bar in bars:
+            grouped.setdefault((bar['ts_code'], bar['period_type']), []).append(bar)
+        connection = db.session.connection()
+        for series in grouped.values():
+            upsert_minute_bars(connection, series)
+        db.session.commit()
+        get_live_bar_cache().ingest(bars)
     
     def check_data_quality(self, ts_code: str, period_type: str = '1min', hours: int = 24) -> Dict:
         """
@@ -534,10 +519,7 @@ class RealtimeDataManager:
             实时价格信息
         """
         try:
-            latest_data = StockMinuteData.query.filter_by(
-                ts_code=ts_code,
-                period_type='1min'
-            ).order_by(StockMinuteData.datetime.desc()).first()
+            latest_data = get_live_bar_cache().latest(ts_code, '1min')
             
             if not latest_data:
                 return {
@@ -550,16 +532,16 @@ class RealtimeDataManager:
                 'success': True,
                 'message': '获取成功',
                 'data': {
-                    'ts_code': latest_data.ts_code,
-                    'current_price': latest_data.close,
-                    'change': latest_data.change,
-                    'pct_chg': latest_data.pct_chg,
-                    'volume': latest_data.volume,
-                    'amount': latest_data.amount,
-                    'update_time': latest_data.datetime.isoformat(),
-                    'open': latest_data.open,
-                    'high': latest_data.high,
-                    'low': latest_data.low
+                    'ts_code': ts_code,
+                    'current_price': latest_data['close'],
+                    'change': latest_data['change'],
+                    'pct_chg': latest_data['pct_chg'],
+                    'volume': latest_data['volume'],
+                    'amount': latest_data['amount'],
+                    'update_time': latest_data['datetime'].isoformat(),
+                    'open': latest_data['open'],
+                    'high': latest_data['high'],
+                    'low': latest_data['low']
                 }
             }
             
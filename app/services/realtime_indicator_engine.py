@@ -12,12 +12,22 @@ from loguru import logger
 import json
 import math
 
+from sqlalchemy import func
+
 from app.models.stock_minute_data import StockMinuteData
 from app.models.realtime_indicator import RealtimeIndicator
+from app.services.streaming_indicators import get_streaming_indicator_engine, indicator_rows
 
 logger = logger.bind(name=__name__)
 
 
+def _finite_value(value):
+    if value is None:
+        return None
+    value = float(value)
+    return value if math.isfinite(value) else None
+
+
 class RealtimeIndicatorEngine:
     """实时技术指标计算引擎"""
     
@@ -218,114 +228,152 @@ class RealtimeIndicatorEngine:
                            lookback_days: int = 30) -> Dict:
         """
         计算指定股票的技术指标
+
+        首次计算时用回看窗口内的 K 线预热流式状态，之后只读取上次计算以来的新 K 线增量更新，
+        新 K 线的指标追加写入数据库，不再整段删除重算。
         
         Args:
             ts_code: 股票代码
             period_type: 周期类型
             indicators: 要计算的指标列表，None表示计算所有支持的指标
-            lookback_days: 回看天数
+            lookback_days: 回看天数（仅用于首次预热）
         
         Returns:
-            计算结果字典
+            计算结果字典，data 为各指标的最新值
         """
         try:
-            # 获取历史数据
-            end_time = datetime.now()
-            start_time = end_time - timedelta(days=lookback_days)
-            
-            data = StockMinuteData.get_data_range(
-                ts_code=ts_code,
-                period_type=period_type,
-                start_time=start_time,
-                end_time=end_time
-            )
-            
-            if not data:
-                return {'success': False, 'message': f'没有找到 {ts_code} 的数据'}
-            
-            # 转换为DataFrame
-            df = pd.DataFrame([d.to_dict() for d in data])
-            df['datetime'] = pd.to_datetime(df['datetime'])
-            df = df.sort_values('datetime').reset_index(drop=True)
-            
-            # 如果没有指定指标，计算所有支持的指标
             if indicators is None:
                 indicators = list(self.supported_indicators.keys())
-            
-            # 计算指标
-            results = {}
-            indicator_data = []
-            
-            for indicator in indicators:
-                if indicator in self.supported_indicators:
-                    try:
-                        indicator_result = self.supported_indicators[indicator](df)
-                        results[indicator] = indicator_result
-                        
-                        # 准备存储数据
-                        for i, row in df.iterrows():
-                            if indicator in indicator_result and i < len(indicator_result[indicator]):
-                                values = indicator_result[indicator][i]
-                                if values is not None:
-                                    # 处理单值和多值指标
-                                    if isinstance(values, (int, float)):
-                                        value1, value2, value3, value4 = values, None, None, None
-                                    elif isinstance(values, (list, tuple)):
-                                        value1 = values[0] if len(values) > 0 else None
-                                        value2 = values[1] if len(values) > 1 else None
-                                        value3 = values[2] if len(values) > 2 else None
-                                        value4 = values[3] if len(values) > 3 else None
-                                    else:
-                                        continue
-                                    
-                                    indicator_data.append({
-                                        'ts_code': ts_code,
-                                        'datetime': row['datetime'],
-                                        'period_type': period_type,
-                                        'indicator_name': indicator,
-                                        'value1': value1,
-                                        'value2': value2,
-                                        'value3': value3,
-                                        'value4': value4
-                                    })
-                    except Exception as e:
-                        logger.error(f"计算指标 {indicator} 失败: {str(e)}")
-                        results[indicator] = {'error': str(e)}
-            
-            # 存储指标数据到数据库
-            cleaned_indicator_data = []
-            if indicator_data:
-                # 删除旧数据
-                RealtimeIndicator.query.filter(
-                    RealtimeIndicator.ts_code == ts_code,
-                    RealtimeIndicator.period_type == period_type,
-                    RealtimeIndicator.datetime >= start_time
-                ).delete()
-                
-                cleaned_indicator_data = self._clean_indicator_data(indicator_data)
-                success, message = RealtimeIndicator.batch_insert(cleaned_indicator_data)
-                if not success:
-                    logger.error(f"存储指标数据失败: {message}")
-            
-            cleaned_results = self._clean_results_for_json(results)
-            
-            # 构建返回字典并清理整个字典
-            return_dict = {
+            indicators = [name for name in indicators if name in self.supported_indicators]
+
+            end_time = datetime.now()
+            start_time = end_time - timedelta(days=lookback_days)
+            engine = get_streaming_indicator_engine()
+            state = engine.get_state(ts_code, period_type)
+
+            # 状态不存在或已落后于回看窗口时重新预热
+            if state is None or state.last_datetime is None or state.last_datetime < start_time:
+                state = engine.reset(ts_code, period_type)
+                bars = self._load_bars(ts_code, period_type, start_time, end_time)
+                if not bars:
+                    return {'success': False, 'message': f'没有找到 {ts_code} 的数据'}
+            else:
+                # 包含最后一根 K 线，以便处理其后续修正
+                bars = self._load_bars(ts_code, period_type, state.last_datetime, end_time)
+
+            updates = engine.update_bars(ts_code, period_type, bars)
+            stored_records = self._store_updates(state, indicators, updates)
+            engine.maybe_snapshot()
+
+            return {
                 'success': True,
-                'data': cleaned_results,
-                'total_indicators': len(results),
-                'data_points': len(df),
-                'stored_records': len(cleaned_indicator_data)
+                'data': self._latest_values(state, indicators),
+                'total_indicators': len(indicators),
+                'data_points': state.count,
+                'new_bars': len(updates),
+                'stored_records': stored_records
             }
             
-            # 清理整个返回字典
-            final_result = self._clean_results_for_json(return_dict)
-            
-            return final_result
-            
         except Exception as e:
             logger.error(f"计算指标失败: {str(e)}")
             return {'success': False, 'message': str(e)}
+
+    def update_bar(self, ts_code: str, period_type: str, bar: Dict[str, Any],
+                   indicators: List[str] = None) -> Optional[Dict[str, Any]]:
+        """推入一根实时 K 线并写入其指标，返回各指标最新值；K 线被忽略时返回 None"""
+        indicators = indicators or list(self.supported_indicators.keys())
+        engine = get_streaming_indicator_engine()
+        values = engine.update_bar(ts_code, period_type, bar)
+        if values is None:
+            return None
+        state = engine.get_state(ts_code, period_type)
+        self._store_updates(state, indicators, [(bar['datetime'], values)])
+        engine.maybe_snapshot()
+        return self._latest_values(state, indicators)
+
+    def _load_bars(self, ts_code: str, period_type: str,
+                   start_time: datetime, end_time: datetime) -> List[Dict[str, Any]]:
+        """只查询指标计算需要的列"""
+        rows = db.session.query(
+            StockMinuteData.datetime,
+            StockMinuteData.high,
+            StockMinuteData.low,
+            StockMinuteData.close,
+            StockMinuteData.volume
+        ).filter(
+            StockMinuteData.ts_code == ts_code,
+            StockMinuteData.period_type == period_type,
+            StockMinuteData.datetime >= start_time,
+            StockMinuteData.datetime <= end_time
+        ).order_by(StockMinuteData.datetime.asc()).all()
+        return [
+            {'datetime': row[0], 'high': row[1], 'low': row[2], 'close': row[3], 'volume': row[4]}
+            for row in rows if row[3] is not None
+        ]
+
+    def _store_updates(self, state, indicators: List[str], updates: List) -> int:
+        """把新 K 线的指标追加写入数据库；已写入时间点的 K 线被修正时覆盖该时间点"""
+        if not updates:
+            return 0
+
+        if not state.stored_checked:
+            # 首次写入时核对数据库中各指标已有的最后时间，避免重复写入
+            stored = db.session.query(
+                RealtimeIndicator.indicator_name,
+                func.max(RealtimeIndicator.datetime)
+            ).filter(
+                RealtimeIndicator.ts_code == state.ts_code,
+                RealtimeIndicator.period_type == state.period_type
+            ).group_by(RealtimeIndicator.indicator_name).all()
+            state.stored_until = {name: last for name, last in stored if last is not None}
+            state.stored_checked = True
+
+        rows = []
+        revised = []
+        for bar_time, values in updates:
+            for row in indicator_rows(state.ts_code, state.period_type, bar_time, values, indicators):
+                last = state.stored_until.get(row['indicator_name'])
+                if last is None or bar_time > last:
+                    rows.append(row)
+                elif bar_time == last:
+                    revised.append(row)
+                    rows.append(row)
+
+        for row in revised:
+            RealtimeIndicator.query.filter(
+                RealtimeIndicator.ts_code == state.ts_code,
+                RealtimeIndicator.period_type == state.period_type,
+                RealtimeIndicator.indicator_name == row['indicator_name'],
+                RealtimeIndicator.datetime == row['datetime']
+            ).delete(synchronize_session=False)
+
+        if not rows:
+            return 0
+        success, message = RealtimeIndicator.batch_insert(rows)
+        if not success:
+            logger.error(f"存储指标数据失败: {message}")
+            return 0
+        for row in rows:
+            name = row['indicator_name']
+            if name not in state.stored_until or row['datetime'] > state.stored_until[name]:
+                state.stored_until[name] = row['datetime']
+        return len(rows)
+
+    def _latest_values(self, state, indicators: List[str]) -> Dict[str, Dict[str, Any]]:
+        """各指标的最新值，按子指标命名（如 MA5、EMA12）"""
+        results = {}
+        for name in indicators:
+            value = state.latest.get(name)
+            if name in ('MA', 'EMA'):
+                periods = self.default_params[name]['periods']
+                results[name] = {f'{name}{period}': _finite_value(item)
+                                 for period, item in zip(periods, value or [])
+                                 if state.count >= period}
+            elif isinstance(value, list):
+                results[name] = {name: [_finite_value(item) for item in value]}
+            else:
+                results[name] = {name: _finite_value(value)}
+        return results
     
     def _calculate_ma(self, df: pd.DataFrame) -> Dict:
         """计算移动平均线"""
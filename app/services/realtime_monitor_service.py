@@ -6,13 +6,13 @@
 import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
-from typing import List, Dict, Optional, Tuple
+from typing import List, Dict, Tuple
 import logging
-from sqlalchemy import func, desc, asc
+from sqlalchemy import func, asc
 
 from app.models.stock_minute_data import StockMinuteData
-from app.models.stock_basic import StockBasic
 from app.models.realtime_indicator import RealtimeIndicator
+from app.services.market_snapshot import get_snapshot_builder
 
 logger = logging.getLogger(__name__)
 
@@ -61,56 +61,31 @@ class RealtimeMonitorService:
                            period_type: str = '1min', limit: int = 50) -> Dict:
         """获取实时行情数据"""
         try:
-            # 如果没有指定股票代码，获取活跃股票
-            if not stock_codes:
-                stock_codes = self._get_active_stocks(limit)
-            
-            # 获取最新价格数据
-            end_time = datetime.now()
-            start_time = end_time - timedelta(hours=1)  # 最近1小时
+            # 未指定股票代码时取最近1小时有数据的股票
+            snapshot = get_snapshot_builder().build(stock_codes, period_type, period_hours=1)
+            if stock_codes:
+                snapshot = snapshot.set_index('ts_code').reindex(list(dict.fromkeys(stock_codes)))
+                snapshot = snapshot.dropna(subset=['close'])
+                snapshot = snapshot.reset_index()
+            else:
+                snapshot = snapshot.head(limit)
             
             quotes = []
-            for ts_code in stock_codes:
-                try:
-                    # 获取最新数据
-                    latest_data = StockMinuteData.query.filter(
-                        StockMinuteData.ts_code == ts_code,
-                        StockMinuteData.period_type == period_type,
-                        StockMinuteData.datetime >= start_time
-                    ).order_by(desc(StockMinuteData.datetime)).first()
-                    
-                    if not latest_data:
-                        continue
-                    
-                    # 获取前一交易日收盘价（用于计算涨跌幅）
-                    prev_close = self._get_previous_close(ts_code, latest_data.datetime, period_type)
-                    
-                    # 计算涨跌幅
-                    change_pct = 0.0
-                    if prev_close and prev_close > 0:
-                        change_pct = (latest_data.close - prev_close) / prev_close * 100
-                    
-                    # 计算成交量比
-                    volume_ratio = self._calculate_volume_ratio(ts_code, latest_data.datetime, period_type)
-                    
-                    quotes.append({
-                        'ts_code': ts_code,
-                        'name': self._get_stock_name(ts_code),
-                        'current_price': latest_data.close,
-                        'open_price': latest_data.open,
-                        'high_price': latest_data.high,
-                        'low_price': latest_data.low,
-                        'volume': latest_data.volume,
-                        'amount': latest_data.amount,
-                        'change_pct': change_pct,
-                        'volume_ratio': volume_ratio,
-                        'update_time': latest_data.datetime.isoformat(),
-                        'turnover_rate': self._calculate_turnover_rate(ts_code, latest_data.volume)
-                    })
-                    
-                except Exception as e:
-                    logger.error(f"获取 {ts_code} 行情数据失败: {str(e)}")
-                    continue
+            for row in snapshot.itertuples(index=False):
+                quotes.append({
+                    'ts_code': row.ts_code,
+                    'name': row.name,
+                    'current_price': row.close,
+                    'open_price': row.open,
+                    'high_price': row.high,
+                    'low_price': row.low,
+                    'volume': row.volume,
+                    'amount': row.amount,
+                    'change_pct': 0.0 if pd.isna(row.change_pct) else float(row.change_pct),
+                    'volume_ratio': float(row.volume_ratio),
+                    'update_time': row.datetime.isoformat(),
+                    'turnover_rate': float(row.turnover_rate)
+                })
             
             return {
                 'success': True,
@@ -129,59 +104,32 @@ class RealtimeMonitorService:
     def get_sector_performance(self, period_hours: int = 1) -> Dict:
         """获取板块表现"""
         try:
-            end_time = datetime.now()
-            start_time = end_time - timedelta(hours=period_hours)
+            all_codes = sorted({code for codes in self.sector_mapping.values() for code in codes})
+            snapshot = get_snapshot_builder().build(all_codes, '1min', period_hours)
+            snapshot = snapshot[snapshot['change_pct'].notna()].set_index('ts_code')
             
             sector_performance = []
             
             for sector_name, stock_codes in self.sector_mapping.items():
-                try:
-                    sector_changes = []
-                    sector_volumes = []
-                    sector_amounts = []
-                    
-                    for ts_code in stock_codes:
-                        # 获取最新数据
-                        latest_data = StockMinuteData.query.filter(
-                            StockMinuteData.ts_code == ts_code,
-                            StockMinuteData.datetime >= start_time
-                        ).order_by(desc(StockMinuteData.datetime)).first()
-                        
-                        if not latest_data:
-                            continue
-                        
-                        # 计算涨跌幅
-                        prev_close = self._get_previous_close(ts_code, latest_data.datetime, '1min')
-                        if prev_close and prev_close > 0:
-                            change_pct = (latest_data.close - prev_close) / prev_close * 100
-                            sector_changes.append(change_pct)
-                            sector_volumes.append(latest_data.volume)
-                            sector_amounts.append(latest_data.amount)
-                    
-                    if sector_changes:
-                        # 计算板块平均涨跌幅（等权重）
-                        avg_change = np.mean(sector_changes)
-                        total_volume = sum(sector_volumes)
-                        total_amount = sum(sector_amounts)
-                        
-                        # 计算上涨股票数量
-                        rising_count = sum(1 for change in sector_changes if change > 0)
-                        falling_count = sum(1 for change in sector_changes if change < 0)
-                        
-                        sector_performance.append({
-                            'sector_name': sector_name,
-                            'avg_change_pct': avg_change,
-                            'total_volume': total_volume,
-                            'total_amount': total_amount,
-                            'stock_count': len(sector_changes),
-                            'rising_count': rising_count,
-                            'falling_count': falling_count,
-                            'rising_ratio': rising_count / len(sector_changes) * 100 if sector_changes else 0
-                        })
-                        
-                except Exception as e:
-                    logger.error(f"计算板块 {sector_name} 表现失败: {str(e)}")
+                sector = snapshot.reindex(stock_codes).dropna(subset=['change_pct'])
+                if sector.empty:
                     continue
+                
+                changes = sector['change_pct'].to_numpy()
+                # 板块平均涨跌幅（等权重）
+                rising_count = int((changes > 0).sum())
+                falling_count = int((changes < 0).sum())
+                
+                sector_performance.append({
+                    'sector_name': sector_name,
+                    'avg_change_pct': float(changes.mean()),
+                    'total_volume': float(sector['volume'].sum()),
+                    'total_amount': float(sector['amount'].sum()),
+                    'stock_count': len(changes),
+                    'rising_count': rising_count,
+                    'falling_count': falling_count,
+                    'rising_ratio': rising_count / len(changes) * 100
+                })
             
             # 按涨跌幅排序
             sector_performance.sort(key=lambda x: x['avg_change_pct'], reverse=True)
@@ -206,68 +154,39 @@ class RealtimeMonitorService:
                         period_hours: int = 1) -> Dict:
         """检测异动股票"""
         try:
-            end_time = datetime.now()
-            start_time = end_time - timedelta(hours=period_hours)
+            snapshot = get_snapshot_builder().build(None, '1min', period_hours).head(200)
+            snapshot = snapshot[snapshot['change_pct'].notna()]
             
-            # 获取所有活跃股票
-            active_stocks = self._get_active_stocks(200)
+            # 异动条件：急涨急跌、放量、价格突破
+            change = snapshot['change_pct'].to_numpy()
+            surge = change >= change_threshold
+            plunge = change <= -change_threshold
+            heavy_volume = snapshot['volume_ratio'].to_numpy() >= volume_threshold
+            breakout = snapshot['breakout'].to_numpy(dtype=bool)
+            flagged = np.flatnonzero(surge | plunge | heavy_volume | breakout)
             
             anomalies = []
-            
-            for ts_code in active_stocks:
-                try:
-                    # 获取最新数据
-                    latest_data = StockMinuteData.query.filter(
-                        StockMinuteData.ts_code == ts_code,
-                        StockMinuteData.datetime >= start_time
-                    ).order_by(desc(StockMinuteData.datetime)).first()
-                    
-                    if not latest_data:
-                        continue
-                    
-                    # 计算涨跌幅
-                    prev_close = self._get_previous_close(ts_code, latest_data.datetime, '1min')
-                    if not prev_close or prev_close <= 0:
-                        continue
-                    
-                    change_pct = (latest_data.close - prev_close) / prev_close * 100
-                    
-                    # 计算成交量比
-                    volume_ratio = self._calculate_volume_ratio(ts_code, latest_data.datetime, '1min')
-                    
-                    # 检测异动条件
-                    anomaly_types = []
-                    
-                    # 价格异动
-                    if abs(change_pct) >= change_threshold:
-                        if change_pct > 0:
-                            anomaly_types.append('急涨')
-                        else:
-                            anomaly_types.append('急跌')
-                    
-                    # 成交量异动
-                    if volume_ratio >= volume_threshold:
-                        anomaly_types.append('放量')
-                    
-                    # 价格突破（简单判断）
-                    if self._check_price_breakout(ts_code, latest_data):
-                        anomaly_types.append('突破')
-                    
-                    if anomaly_types:
-                        anomalies.append({
-                            'ts_code': ts_code,
-                            'name': self._get_stock_name(ts_code),
-                            'current_price': latest_data.close,
-                            'change_pct': change_pct,
-                            'volume_ratio': volume_ratio,
-                            'anomaly_types': anomaly_types,
-                            'anomaly_score': self._calculate_anomaly_score(change_pct, volume_ratio),
-                            'update_time': latest_data.datetime.isoformat()
-                        })
-                        
-                except Exception as e:
-                    logger.error(f"检测 {ts_code} 异动失败: {str(e)}")
-                    continue
+            for i, row in zip(flagged, snapshot.iloc[flagged].itertuples(index=False)):
+                anomaly_types = []
+                if surge[i]:
+                    anomaly_types.append('急涨')
+                elif plunge[i]:
+                    anomaly_types.append('急跌')
+                if heavy_volume[i]:
+                    anomaly_types.append('放量')
+                if breakout[i]:
+                    anomaly_types.append('突破')
+                
+                anomalies.append({
+                    'ts_code': row.ts_code,
+                    'name': row.name,
+                    'current_price': row.close,
+                    'change_pct': float(row.change_pct),
+                    'volume_ratio': float(row.volume_ratio),
+                    'anomaly_types': anomaly_types,
+                    'anomaly_score': float(row.anomaly_score),
+                    'update_time': row.datetime.isoformat()
+                })
             
             # 按异动评分排序
             anomalies.sort(key=lambda x: x['anomaly_score'], reverse=True)
@@ -292,52 +211,16 @@ class RealtimeMonitorService:
     def get_market_sentiment(self, period_hours: int = 1) -> Dict:
         """获取市场情绪指标"""
         try:
-            end_time = datetime.now()
-            start_time = end_time - timedelta(hours=period_hours)
-            
-            # 获取所有活跃股票的数据
-            active_stocks = self._get_active_stocks(500)
-            
-            rising_stocks = 0
-            falling_stocks = 0
-            unchanged_stocks = 0
-            total_volume = 0
-            total_amount = 0
-            changes = []
+            snapshot = get_snapshot_builder().build(None, '1min', period_hours).head(500)
+            snapshot = snapshot[snapshot['change_pct'].notna()]
             
-            for ts_code in active_stocks:
-                try:
-                    # 获取最新数据
-                    latest_data = StockMinuteData.query.filter(
-                        StockMinuteData.ts_code == ts_code,
-                        StockMinuteData.datetime >= start_time
-                    ).order_by(desc(StockMinuteData.datetime)).first()
-                    
-                    if not latest_data:
-                        continue
-                    
-                    # 计算涨跌幅
-                    prev_close = self._get_previous_close(ts_code, latest_data.datetime, '1min')
-                    if not prev_close or prev_close <= 0:
-                        continue
-                    
-                    change_pct = (latest_data.close - prev_close) / prev_close * 100
-                    changes.append(change_pct)
-                    
-                    # 统计涨跌家数
-                    if change_pct > 0.1:
-                        rising_stocks += 1
-                    elif change_pct < -0.1:
-                        falling_stocks += 1
-                    else:
-                        unchanged_stocks += 1
-                    
-                    total_volume += latest_data.volume
-                    total_amount += latest_data.amount
-                    
-                except Exception as e:
-                    logger.error(f"处理 {ts_code} 市场情绪数据失败: {str(e)}")
-                    continue
+            changes = snapshot['change_pct'].to_numpy(dtype='float64')
+            # 统计涨跌家数
+            rising_stocks = int((changes > 0.1).sum())
+            falling_stocks = int((changes < -0.1).sum())
+            unchanged_stocks = len(changes) - rising_stocks - falling_stocks
+            total_volume = float(snapshot['volume'].sum())
+            total_amount = float(snapshot['amount'].sum())
             
             total_stocks = rising_stocks + falling_stocks + unchanged_stocks
             
@@ -352,8 +235,8 @@ class RealtimeMonitorService:
             falling_ratio = falling_stocks / total_stocks * 100
             
             # 计算市场强度指标
-            avg_change = np.mean(changes) if changes else 0
-            change_std = np.std(changes) if changes else 0
+            avg_change = float(np.mean(changes)) if len(changes) else 0
+            change_std = float(np.std(changes)) if len(changes) else 0
             
             # 计算情绪评分 (0-100)
             sentiment_score = min(100, max(0, 50 + avg_change * 5 + (rising_ratio - 50)))
@@ -445,136 +328,6 @@ class RealtimeMonitorService:
             logger.error(f"获取监控概览失败: {str(e)}")
             return {'success': False, 'message': str(e)}
     
-    def _get_active_stocks(self, limit: int = 100) -> List[str]:
-        """获取活跃股票列表"""
-        try:
-            # 获取最近1小时有数据的股票
-            recent_time = datetime.now() - timedelta(hours=1)
-            
-            active_stocks = StockMinuteData.query.filter(
-                StockMinuteData.datetime >= recent_time
-            ).with_entities(
-                StockMinuteData.ts_code
-            ).distinct().limit(limit).all()
-            
-            return [stock[0] for stock in active_stocks]
-            
-        except Exception as e:
-            logger.error(f"获取活跃股票失败: {str(e)}")
-            # 返回默认股票列表
-            return ['000001.SZ', '000002.SZ', '600000.SH', '600036.SH', '000858.SZ']
-    
-    def _get_previous_close(self, ts_code: str, current_time: datetime, period_type: str) -> Optional[float]:
-        """获取前一交易日收盘价"""
-        try:
-            # 简化处理：获取当前时间前1小时的数据作为基准
-            prev_time = current_time - timedelta(hours=1)
-            
-            prev_data = StockMinuteData.query.filter(
-                StockMinuteData.ts_code == ts_code,
-                StockMinuteData.period_type == period_type,
-                StockMinuteData.datetime <= prev_time
-            ).order_by(desc(StockMinuteData.datetime)).first()
-            
-            return prev_data.close if prev_data else None
-            
-        except Exception as e:
-            logger.error(f"获取 {ts_code} 前收盘价失败: {str(e)}")
-            return None
-    
-    def _calculate_volume_ratio(self, ts_code: str, current_time: datetime, period_type: str) -> float:
-        """计算成交量比"""
-        try:
-            # 获取最近20个周期的平均成交量
-            start_time = current_time - timedelta(hours=20)
-            
-            avg_volume = StockMinuteData.query.filter(
-                StockMinuteData.ts_code == ts_code,
-                StockMinuteData.period_type == period_type,
-                StockMinuteData.datetime >= start_time,
-                StockMinuteData.datetime < current_time
-            ).with_entities(
-                func.avg(StockMinuteData.volume)
-            ).scalar()
-            
-            if not avg_volume or avg_volume == 0:
-                return 1.0
-            
-            # 获取当前成交量
-            current_data = StockMinuteData.query.filter(
-                StockMinuteData.ts_code == ts_code,
-                StockMinuteData.period_type == period_type,
-                StockMinuteData.datetime == current_time
-            ).first()
-            
-            if not current_data:
-                return 1.0
-            
-            return current_data.volume / avg_volume
-            
-        except Exception as e:
-            logger.error(f"计算 {ts_code} 成交量比失败: {str(e)}")
-            return 1.0
-    
-    def _calculate_turnover_rate(self, ts_code: str, volume: float) -> float:
-        """计算换手率（简化版本）"""
-        try:
-            # 这里应该根据股票的流通股本计算，简化处理返回一个估算值
-            # 实际应用中需要获取股票的流通股本数据
-            return min(20.0, volume / 1000000 * 0.1)  # 简化计算
-            
-        except Exception as e:
-            logger.error(f"计算 {ts_code} 换手率失败: {str(e)}")
-            return 0.0
-    
-    def _get_stock_name(self, ts_code: str) -> str:
-        """获取股票名称"""
-        try:
-            stock_basic = StockBasic.query.filter_by(ts_code=ts_code).first()
-            return stock_basic.name if stock_basic else ts_code
-        except Exception as e:
-            logger.error(f"获取 {ts_code} 股票名称失败: {str(e)}")
-            return ts_code
-    
-    def _check_price_breakout(self, ts_code: str, latest_data) -> bool:
-        """检查价格突破（简化版本）"""
-        try:
-            # 获取最近20个周期的最高价和最低价
-            start_time = latest_data.datetime - timedelta(hours=20)
-            
-            price_data = StockMinuteData.query.filter(
-                StockMinuteData.ts_code == ts_code,
-                StockMinuteData.datetime >= start_time,
-                StockMinuteData.datetime < latest_data.datetime
-            ).with_entities(
-                func.max(StockMinuteData.high).label('max_high'),
-                func.min(StockMinuteData.low).label('min_low')
-            ).first()
-            
-            if not price_data or not price_data.max_high or not price_data.min_low:
-                return False
-            
-            # 检查是否突破最高价或最低价
-            return (latest_data.high > price_data.max_high * 1.01 or 
-                   latest_data.low < price_data.min_low * 0.99)
-            
-        except Exception as e:
-            logger.error(f"检查 {ts_code} 价格突破失败: {str(e)}")
-            return False
-    
-    def _calculate_anomaly_score(self, change_pct: float, volume_ratio: float) -> float:
-        """计算异动评分"""
-        try:
-            # 综合价格变动和成交量变动计算异动评分
-            price_score = min(50, abs(change_pct) * 5)  # 价格变动评分
-            volume_score = min(50, (volume_ratio - 1) * 10)  # 成交量变动评分
-            
-            return price_score + volume_score
-            
-        except Exception as e:
-            logger.error(f"计算异动评分失败: {str(e)}")
-            return 0.0
-    
     def _calculate_data_delay(self, latest_time: datetime) -> int:
         """计算数据延迟（分钟）"""
         try:
@@ -17,6 +17,9 @@ from app.models.trading_signal import TradingSignal
 from app.models.portfolio_position import PortfolioPosition
 from app.models.risk_alert import RiskAlert
 from app.extensions import db
+from app.services.realtime_risk_manager import RealtimeRiskManager
+from app.services.portfolio_returns import get_portfolio_returns_provider
+from app.services.scenario_engine import get_scenario_engine
 
 logger = logging.getLogger(__name__)
 
@@ -296,6 +299,17 @@ class RealtimeReportGenerator:
             sector = position.sector or '未分类'
             sector_exposure[sector] = sector_exposure.get(sector, 0) + (position.market_value or 0)
         
+        # 波动率与VaR（与风险计算共用组合收益率缓存）
+        var_metrics = {}
+        annual_volatility = None
+        returns = get_portfolio_returns_provider().get_for_positions(portfolio_id, positions).returns
+        if not returns.empty and total_value > 0:
+            risk_manager = RealtimeRiskManager()
+            weights = risk_manager._get_portfolio_weights(positions)
+            portfolio_returns = risk_manager._portfolio_returns(returns, weights)
+            annual_volatility = float(portfolio_returns.std() * np.sqrt(252))
+            var_metrics = get_scenario_engine().summarize(portfolio_returns.values)
+        
         return {
             'portfolio_id': portfolio_id,
             'risk_metrics': {
@@ -303,8 +317,10 @@ class RealtimeReportGenerator:
                 'total_pnl': total_pnl,
                 'concentration_risk': concentration_risk,
                 'position_count': len(positions),
-                'active_alerts': len(alerts)
+                'active_alerts': len(alerts),
+                'annual_volatility': annual_volatility
             },
+            'var_metrics': var_metrics,
             'sector_exposure': sector_exposure,
             'risk_alerts': [alert.to_dict() for alert in alerts[:10]],  # 最近10个预警
             'analysis_date': datetime.utcnow().isoformat()
@@ -673,70 +689,9 @@ class RealtimeReportGenerator:
             }
     
     def run_stress_test(self, portfolio_id: str, scenarios: List[Dict] = None) -> Dict[str, Any]:
-        """运行投资组合压力测试"""
+        """运行投资组合压力测试（由风险管理器的情景分析引擎计算）"""
         try:
-            # 获取组合持仓
-            positions = PortfolioPosition.get_portfolio_positions(portfolio_id)
-            
-            if not positions:
-                return {
-                    'success': False,
-                    'message': '组合中没有持仓数据'
-                }
-            
-            # 默认压力测试场景
-            if not scenarios:
-                scenarios = [
-                    {'name': '市场下跌10%', 'market_shock': -0.10},
-                    {'name': '市场下跌20%', 'market_shock': -0.20},
-                    {'name': '市场下跌30%', 'market_shock': -0.30},
-                    {'name': '波动率上升50%', 'volatility_shock': 0.50},
-                    {'name': '相关性上升至0.9', 'correlation_shock': 0.90}
-                ]
-            
-            # 计算原始组合价值
-            original_value = sum(pos.market_value or 0 for pos in positions)
-            
-            stress_results = []
-            
-            for scenario in scenarios:
-                scenario_result = {
-                    'scenario_name': scenario['name'],
-                    'original_value': original_value,
-                    'stressed_value': 0,
-                    'pnl_change': 0,
-                    'pnl_percentage': 0
-                }
-                
-                # 简化的压力测试计算
-                if 'market_shock' in scenario:
-                    shock = scenario['market_shock']
-                    stressed_value = original_value * (1 + shock)
-                    scenario_result['stressed_value'] = stressed_value
-                    scenario_result['pnl_change'] = stressed_value - original_value
-                    scenario_result['pnl_percentage'] = shock * 100
-                elif 'volatility_shock' in scenario:
-                    # 波动率冲击的简化处理
-                    vol_shock = scenario['volatility_shock']
-                    stressed_value = original_value * (1 - vol_shock * 0.1)  # 简化计算
-                    scenario_result['stressed_value'] = stressed_value
-                    scenario_result['pnl_change'] = stressed_value - original_value
-                    scenario_result['pnl_percentage'] = (stressed_value - original_value) / original_value * 100
-                
-                stress_results.append(scenario_result)
-            
-            return {
-                'success': True,
-                'data': {
-                    'portfolio_id': portfolio_id,
-                    'test_date': datetime.utcnow().isoformat(),
-                    'original_value': original_value,
-                    'scenarios': stress_results,
-                    'worst_case': min(stress_results, key=lambda x: x['pnl_percentage']),
-                    'best_case': max(stress_results, key=lambda x: x['pnl_percentage'])
-                },
-                'message': f'压力测试完成，测试了 {len(scenarios)} 个场景'
-            }
+            return RealtimeRiskManager().run_stress_test(portfolio_id, scenarios)
             
         except Exception as e:
             logger.error(f"压力测试失败: {str(e)}")
@@ -5,7 +5,7 @@
 
 import pandas as pd
 import numpy as np
-from datetime import datetime, timedelta
+from datetime import datetime
 from typing import List, Dict, Optional, Tuple
 import logging
 from sqlalchemy import func, desc, asc
@@ -15,9 +15,62 @@ from app.models.stock_basic import StockBasic
 from app.models.portfolio_position import PortfolioPosition
 from app.models.risk_alert import RiskAlert
 from app.extensions import db
+from app.services.live_bar_cache import get_live_bar_cache
+from app.services.factor_risk_model import get_risk_model_store
+from app.services.scenario_engine import get_scenario_engine
+from app.services.portfolio_returns import get_portfolio_returns_provider
 
 logger = logging.getLogger(__name__)
 
+# 大幅亏损预警的浮亏百分比阈值
+LARGE_LOSS_PCT = -15
+
+
+def evaluate_position_alerts(ts_code: str, current_price: Optional[float], avg_cost: Optional[float],
+                             stop_loss_price: Optional[float], take_profit_price: Optional[float],
+                             weight: Optional[float], position_weight_limit: float) -> List[Dict]:
+    """按单只持仓的价格、成本与权重（百分比）判断持仓预警，供定时监控与增量风险共用"""
+    alerts = []
+    
+    # 止损预警
+    if stop_loss_price and current_price and current_price <= stop_loss_price:
+        alerts.append({
+            'ts_code': ts_code,
+            'alert_type': 'stop_loss_triggered',
+            'alert_level': 'high',
+            'message': f'{ts_code} 触发止损，当前价格 {current_price}，止损价格 {stop_loss_price}'
+        })
+    
+    # 止盈预警
+    if take_profit_price and current_price and current_price >= take_profit_price:
+        alerts.append({
+            'ts_code': ts_code,
+            'alert_type': 'take_profit_triggered',
+            'alert_level': 'medium',
+            'message': f'{ts_code} 触发止盈，当前价格 {current_price}，止盈价格 {take_profit_price}'
+        })
+    
+    # 权重过大预警
+    if (weight or 0) > position_weight_limit * 100:
+        alerts.append({
+            'ts_code': ts_code,
+            'alert_type': 'position_concentration',
+            'alert_level': 'medium',
+            'message': f'{ts_code} 持仓权重过大: {weight:.1f}%'
+        })
+    
+    # 大幅亏损预警
+    pnl_pct = (current_price - avg_cost) / avg_cost * 100 if avg_cost and avg_cost > 0 else 0.0
+    if pnl_pct < LARGE_LOSS_PCT:
+        alerts.append({
+            'ts_code': ts_code,
+            'alert_type': 'large_loss',
+            'alert_level': 'high',
+            'message': f'{ts_code} 大幅亏损: {pnl_pct:.1f}%'
+        })
+    
+    return alerts
+
 
 class RealtimeRiskManager:
     """实时风险管理服务"""
@@ -45,24 +98,17 @@ class RealtimeRiskManager:
                     'message': '组合中没有持仓数据'
                 }
             
-            # 获取股票代码列表
-            stock_codes = [pos.ts_code for pos in positions]
-            
-            # 获取历史价格数据
-            end_date = datetime.now()
-            start_date = end_date - timedelta(days=period_days + 30)  # 多取一些数据
+            # 获取历史收益率（组合级缓存，持仓变化时失效）
+            returns = get_portfolio_returns_provider().get_for_positions(
+                portfolio_id, positions, period_days
+            ).returns
             
-            price_data = self._get_price_data(stock_codes, start_date, end_date)
-            
-            if price_data.empty:
+            if returns.empty:
                 return {
                     'success': False,
                     'message': '无法获取价格数据'
                 }
             
-            # 计算收益率
-            returns = price_data.pct_change().dropna()
-            
             # 计算组合权重
             weights = self._get_portfolio_weights(positions)
             
@@ -78,6 +124,9 @@ class RealtimeRiskManager:
             # 计算Beta值
             beta_metrics = self._calculate_portfolio_beta(returns, weights)
             
+            # 因子风险分解
+            factor_risk = self._calculate_factor_risk(weights)
+            
             # 组合结果
             result = {
                 'portfolio_id': portfolio_id,
@@ -88,6 +137,7 @@ class RealtimeRiskManager:
                 'var_metrics': var_metrics,
                 'correlation_metrics': correlation_matrix,
                 'beta_metrics': beta_metrics,
+                'factor_risk': factor_risk,
                 'risk_alerts': self._check_risk_thresholds(portfolio_id, risk_metrics, var_metrics)
             }
             
@@ -115,6 +165,10 @@ class RealtimeRiskManager:
             risk_positions = []
             alerts = []
             
+            # 个股波动率、VaR 与 Beta 由共享的收益率矩阵一次算出
+            returns = get_portfolio_returns_provider().get_for_positions(portfolio_id, positions).returns
+            position_stats = self._calculate_position_statistics(returns)
+            
             for position in positions:
                 # 更新当前价格
                 current_price = self._get_current_price(position.ts_code)
@@ -122,7 +176,7 @@ class RealtimeRiskManager:
                     position.update_market_data(current_price)
                 
                 # 检查持仓风险
-                position_risk = self._analyze_position_risk(position)
+                position_risk = self._analyze_position_risk(position, position_stats.get(position.ts_code))
                 risk_positions.append(position_risk)
                 
                 # 检查预警条件
@@ -330,46 +384,6 @@ class RealtimeRiskManager:
             logger.error(f"创建风险预警失败: {str(e)}")
             return {'success': False, 'message': str(e)}
     
-    def _get_price_data(self, stock_codes: List[str], start_date: datetime, end_date: datetime) -> pd.DataFrame:
-        """获取价格数据"""
-        try:
-            # 查询分钟数据，聚合为日数据
-            price_data = []
-            
-            for ts_code in stock_codes:
-                data = StockMinuteData.query.filter(
-                    StockMinuteData.ts_code == ts_code,
-                    StockMinuteData.period_type == '60min',  # 使用小时数据
-                    StockMinuteData.datetime >= start_date,
-                    StockMinuteData.datetime <= end_date
-                ).order_by(StockMinuteData.datetime).all()
-                
-                if data:
-                    df = pd.DataFrame([{
-                        'datetime': d.datetime,
-                        'close': d.close,
-                        'ts_code': d.ts_code
-                    } for d in data])
-                    
-                    # 按日期聚合
-                    df['date'] = df['datetime'].dt.date
-                    daily_data = df.groupby('date')['close'].last().reset_index()
-                    daily_data['ts_code'] = ts_code
-                    price_data.append(daily_data)
-            
-            if price_data:
-                # 合并所有股票数据
-                all_data = pd.concat(price_data, ignore_index=True)
-                # 透视表，日期为索引，股票为列
-                pivot_data = all_data.pivot(index='date', columns='ts_code', values='close')
-                return pivot_data.fillna(method='ffill')
-            
-            return pd.DataFrame()
-            
-        except Exception as e:
-            logger.error(f"获取价格数据失败: {str(e)}")
-            return pd.DataFrame()
-    
     def _get_portfolio_weights(self, positions: List[PortfolioPosition]) -> Dict[str, float]:
         """获取组合权重"""
         total_value = sum(pos.market_value or 0 for pos in positions)
@@ -386,10 +400,7 @@ class RealtimeRiskManager:
         """计算风险指标"""
         try:
             # 组合收益率
-            portfolio_returns = pd.Series(0, index=returns.index)
-            for ts_code, weight in weights.items():
-                if ts_code in returns.columns:
-                    portfolio_returns += returns[ts_code] * weight
+            portfolio_returns = self._portfolio_returns(returns, weights)
             
             # 基础统计
             annual_return = portfolio_returns.mean() * 252
@@ -422,26 +433,30 @@ class RealtimeRiskManager:
             logger.error(f"计算风险指标失败: {str(e)}")
             return {}
     
+    def _portfolio_returns(self, returns: pd.DataFrame, weights: Dict) -> pd.Series:
+        """组合收益率：收益面板与权重向量的矩阵乘积"""
+        weight_vector = pd.Series(weights, dtype=float).reindex(returns.columns).fillna(0.0)
+        return pd.Series(
+            get_scenario_engine().portfolio_returns(returns.values, weight_vector.values),
+            index=returns.index
+        )
+    
     def _calculate_var_cvar(self, returns: pd.DataFrame, weights: Dict) -> Dict:
-        """计算VaR和CVaR"""
+        """计算VaR和CVaR
+        
+        顶层 var_XX / cvar_XX 为历史模拟结果；methods 中给出历史模拟、过滤历史模拟
+        与蒙特卡洛三种方法的结果。
+        """
         try:
-            # 组合收益率
-            portfolio_returns = pd.Series(0, index=returns.index)
-            for ts_code, weight in weights.items():
-                if ts_code in returns.columns:
-                    portfolio_returns += returns[ts_code] * weight
+            engine = get_scenario_engine()
+            weight_vector = pd.Series(weights, dtype=float).reindex(returns.columns).fillna(0.0).values
+            methods = engine.var_report(returns.values, weight_vector)
             
-            var_metrics = {}
-            
-            for confidence in self.confidence_levels:
-                # VaR计算
-                var = np.percentile(portfolio_returns, (1 - confidence) * 100)
-                
-                # CVaR计算（条件VaR）
-                cvar = portfolio_returns[portfolio_returns <= var].mean()
-                
-                var_metrics[f'var_{int(confidence*100)}'] = var
-                var_metrics[f'cvar_{int(confidence*100)}'] = cvar
+            var_metrics = {
+                key: value for key, value in methods['historical'].items()
+                if key.startswith(('var_', 'cvar_'))
+            }
+            var_metrics['methods'] = methods
             
             return var_metrics
             
@@ -489,10 +504,7 @@ class RealtimeRiskManager:
             market_returns = returns.mean(axis=1)
             
             # 组合收益率
-            portfolio_returns = pd.Series(0, index=returns.index)
-            for ts_code, weight in weights.items():
-                if ts_code in returns.columns:
-                    portfolio_returns += returns[ts_code] * weight
+            portfolio_returns = self._portfolio_returns(returns, weights)
             
             # 计算Beta
             covariance = np.cov(portfolio_returns, market_returns)[0, 1]
@@ -510,6 +522,90 @@ class RealtimeRiskManager:
             logger.error(f"计算组合Beta失败: {str(e)}")
             return {'portfolio_beta': 1.0}
     
+    def run_stress_test(self, portfolio_id: str, scenarios: List[Dict] = None,
+                        period_days: int = 252) -> Dict:
+        """组合压力测试：市场冲击按 Beta 传导，波动率/相关性冲击重估蒙特卡洛 VaR"""
+        try:
+            positions = PortfolioPosition.get_portfolio_positions(portfolio_id)
+            
+            if not positions:
+                return {
+                    'success': False,
+                    'message': '组合中没有持仓数据'
+                }
+            
+            if not scenarios:
+                scenarios = [
+                    {'name': '市场下跌10%', 'market_shock': -0.10},
+                    {'name': '市场下跌20%', 'market_shock': -0.20},
+                    {'name': '市场下跌30%', 'market_shock': -0.30},
+                    {'name': '波动率上升50%', 'volatility_shock': 0.50},
+                    {'name': '相关性上升至0.9', 'correlation_shock': 0.90}
+                ]
+            
+            returns = get_portfolio_returns_provider().get_for_positions(
+                portfolio_id, positions, period_days
+            ).returns
+            
+            if returns.empty:
+                return {
+                    'success': False,
+                    'message': '无法获取价格数据'
+                }
+            
+            weights = pd.Series(self._get_portfolio_weights(positions), dtype=float)
+            weight_vector = weights.reindex(returns.columns).fillna(0.0).values
+            original_value = sum(pos.market_value or 0 for pos in positions)
+            
+            stress = get_scenario_engine().stress_test(
+                returns.values, weight_vector, scenarios, original_value, list(returns.columns)
+            )
+            stress_results = stress['scenarios']
+            
+            return {
+                'success': True,
+                'data': {
+                    'portfolio_id': portfolio_id,
+                    'test_date': datetime.now().isoformat(),
+                    'original_value': original_value,
+                    'scenarios': stress_results,
+                    'base_var': stress['base_var'],
+                    'monte_carlo_scenarios': stress['monte_carlo_scenarios'],
+                    'worst_case': min(stress_results, key=lambda x: x['pnl_percentage']),
+                    'best_case': max(stress_results, key=lambda x: x['pnl_percentage'])
+                },
+                'message': f'压力测试完成，测试了 {len(scenarios)} 个场景'
+            }
+            
+        except Exception as e:
+            logger.error(f"压力测试失败: {str(e)}")
+            return {'success': False, 'message': str(e)}
+    
+    def _calculate_factor_risk(self, weights: Dict) -> Dict:
+        """基于结构化因子风险模型的组合风险分解（年化），O(N·K)"""
+        try:
+            model = get_risk_model_store().get()
+            if model is None or not weights:
+                return {}
+            
+            codes = list(weights.keys())
+            w = np.array([weights[code] for code in codes], dtype=float)
+            decomposition = model.subset(codes).decompose(w)
+            top_contributions = sorted(decomposition['factor_contributions'].items(),
+                                       key=lambda item: abs(item[1]), reverse=True)[:10]
+            return {
+                'model_date': model.trade_date.isoformat(),
+                'annual_volatility': decomposition['total_risk'] * np.sqrt(252),
+                'factor_volatility': float(np.sqrt(max(decomposition['factor_variance'], 0.0) * 252)),
+                'specific_volatility': float(np.sqrt(decomposition['specific_variance'] * 252)),
+                'factor_share': decomposition['factor_share'],
+                'factor_exposures': decomposition['factor_exposures'],
+                'top_factor_contributions': dict(top_contributions)
+            }
+        except Exception as e:
+            logger.error(f"计算因子风险分解失败: {str(e)}")
+            return {}
+    
     def _calculate_sector_concentration(self, positions: List[PortfolioPosition]) -> float:
         """计算行业集中度"""
         try:
@@ -540,6 +636,10 @@ class RealtimeRiskManager:
     def _get_current_price(self, ts_code: str) -> Optional[float]:
         """获取当前价格"""
         try:
+            latest_bar = get_live_bar_cache().latest(ts_code, '1min')
+            if latest_bar is not None:
+                return latest_bar['close']
+            
             latest_data = StockMinuteData.query.filter_by(
                 ts_code=ts_code
             ).order_by(desc(StockMinuteData.datetime)).first()
@@ -550,9 +650,40 @@ class RealtimeRiskManager:
             logger.error(f"获取 {ts_code} 当前价格失败: {str(e)}")
             return None
     
-    def _analyze_position_risk(self, position: PortfolioPosition) -> Dict:
-        """分析单个持仓风险"""
+    def _calculate_position_statistics(self, returns: pd.DataFrame) -> Dict[str, Dict]:
+        """逐股年化波动率、历史模拟 VaR 与对等权市场的 Beta（按列向量化）"""
+        try:
+            if returns.empty:
+                return {}
+            
+            values = returns.values
+            market = values.mean(axis=1)
+            market_var = market.var()
+            centered = values - values.mean(axis=0)
+            betas = (centered.T @ (market - market.mean()) / (len(market) * market_var)
+                     if market_var > 0 else np.ones(values.shape[1]))
+            var_1d = np.quantile(values, 1 - self.confidence_levels[0], axis=0)
+            volatility = values.std(axis=0, ddof=1) * np.sqrt(252) if len(values) > 1 else np.zeros(values.shape[1])
+            
+            return {
+                ts_code: {
+                    'volatility': float(volatility[i]),
+                    'var_1d': float(var_1d[i]),
+                    'var_5d': float(var_1d[i] * np.sqrt(5)),
+                    'beta': float(betas[i])
+                }
+                for i, ts_code in enumerate(returns.columns)
+            }
+            
+        except Exception as e:
+            logger.error(f"计算个股风险统计失败: {str(e)}")
+            return {}
+    
+    def _analyze_position_risk(self, position: PortfolioPosition, stats: Dict = None) -> Dict:
+        """分析单个持仓风险（stats 为收益率矩阵算出的统计，持仓记录中缺失的字段以其补齐）"""
         try:
+            stats = stats or {}
+            
             # 计算基础指标
             pnl_percentage = position.calculate_pnl_percentage()
             
@@ -574,10 +705,10 @@ class RealtimeRiskManager:
                 'weight': position.weight,
                 'risk_level': risk_level,
                 'weight_risk': weight_risk,
-                'var_1d': position.var_1d,
-                'var_5d': position.var_5d,
-                'volatility': position.volatility,
-                'beta': position.beta
+                'var_1d': position.var_1d if position.var_1d is not None else stats.get('var_1d'),
+                'var_5d': position.var_5d if position.var_5d is not None else stats.get('var_5d'),
+                'volatility': position.volatility if position.volatility is not None else stats.get('volatility'),
+                'beta': position.beta if position.beta is not None else stats.get('beta')
             }
             
         except Exception as e:
@@ -586,48 +717,12 @@ class RealtimeRiskManager:
     
     def _check_position_alerts(self, position: PortfolioPosition) -> List[Dict]:
         """检查持仓预警"""
-        alerts = []
-        
         try:
-            # 止损预警
-            if position.is_stop_loss_triggered():
-                alerts.append({
-                    'ts_code': position.ts_code,
-                    'alert_type': 'stop_loss_triggered',
-                    'alert_level': 'high',
-                    'message': f'{position.ts_code} 触发止损，当前价格 {position.current_price}，止损价格 {position.stop_loss_price}'
-                })
-            
-            # 止盈预警
-            if position.is_take_profit_triggered():
-                alerts.append({
-                    'ts_code': position.ts_code,
-                    'alert_type': 'take_profit_triggered',
-                    'alert_level': 'medium',
-                    'message': f'{position.ts_code} 触发止盈，当前价格 {position.current_price}，止盈价格 {position.take_profit_price}'
-                })
-            
-            # 权重过大预警
-            if (position.weight or 0) > self.risk_thresholds['position_weight'] * 100:
-                alerts.append({
-                    'ts_code': position.ts_code,
-                    'alert_type': 'position_concentration',
-                    'alert_level': 'medium',
-                    'message': f'{position.ts_code} 持仓权重过大: {position.weight:.1f}%'
-                })
-            
-            # 大幅亏损预警
-            pnl_pct = position.calculate_pnl_percentage()
-            if pnl_pct < -15:
-                alerts.append({
-                    'ts_code': position.ts_code,
-                    'alert_type': 'large_loss',
-                    'alert_level': 'high',
-                    'message': f'{position.ts_code} 大幅亏损: {pnl_pct:.1f}%'
-                })
-            
-            return alerts
-            
+            return evaluate_position_alerts(
+                position.ts_code, position.current_price, position.avg_cost,
+                position.stop_loss_price, position.take_profit_price, position.weight,
+                self.risk_thresholds['position_weight']
+            )
         except Exception as e:
             logger.error(f"检查持仓预警失败: {str(e)}")
             return []
@@ -0,0 +1,279 @@
+"""
+情景分析与 VaR 引擎
+组合情景收益统一写成 情景 × 股票 的收益矩阵与权重向量的乘积：
+
+- 历史模拟：收益面板 R（T × N）直接作为情景，pnl = R · w
+- 过滤历史模拟（FHS）：按 EWMA 波动率把历史收益标准化，再按最新波动率放大，
+  保留历史的截面相关结构，同时反映当前的波动水平
+- 蒙特卡洛：相关抽样由协方差的 Cholesky 分解（或因子模型 B、特异波动率 s）给出，
+  pnl = Z · (L'w)。情景按块生成，内存只与块大小有关，可支持十万级以上情景
+
+压力测试复用同一引擎：市场冲击按个股 Beta 传导，波动率/相关性冲击修改协方差后
+重新做蒙特卡洛，得到压力情景下的 VaR/CVaR。
+"""
+
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+from loguru import logger
+
+from app.services.factor_risk_model import FactorRiskModel
+
+
+DEFAULT_CONFIDENCE_LEVELS = (0.95, 0.99)
+DEFAULT_SCENARIOS = 100000
+DEFAULT_CHUNK_SIZE = 20000
+# RiskMetrics 日频衰减系数
+DEFAULT_EWMA_DECAY = 0.94
+
+
+def covariance_root(covariance: np.ndarray) -> np.ndarray:
+    """协方差矩阵的平方根 L（L L' = Σ）；非正定时退化为特征分解"""
+    covariance = np.atleast_2d(np.asarray(covariance, dtype=float))
+    try:
+        return np.linalg.cholesky(covariance)
+    except np.linalg.LinAlgError:
+        eigval, eigvec = np.linalg.eigh(covariance)
+        return eigvec * np.sqrt(np.clip(eigval, 0.0, None))
+
+
+def stressed_covariance(covariance: np.ndarray, volatility_shock: float = 0.0,
+                        correlation_shock: Optional[float] = None) -> np.ndarray:
+    """施加波动率/相关性冲击后的协方差
+
+    volatility_shock 为波动率的相对变化（0.5 表示上升 50%）。correlation_shock 为目标平均
+    相关系数，取值下限为 -1/(n-1)：高于当前水平时向全 1 矩阵收缩；低于当前水平且目标
+    非负时向单位阵收缩，目标为负时向最小可行的等相关矩阵（相关系数 -1/(n-1)）收缩。
+    各情形都是半正定矩阵的凸组合，结果仍为合法的相关矩阵。
+    """
+    covariance = np.atleast_2d(np.asarray(covariance, dtype=float))
+    std = np.sqrt(np.clip(np.diag(covariance), 0.0, None))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        corr = covariance / np.outer(std, std)
+    corr = np.nan_to_num(corr)
+    np.fill_diagonal(corr, 1.0)
+
+    n = len(std)
+    if correlation_shock is not None and n > 1:
+        current = float(corr[np.triu_indices(n, k=1)].mean())
+        target = float(np.clip(correlation_shock, -1.0 / (n - 1), 1.0))
+        if target > current:
+            alpha = (target - current) / (1.0 - current) if current < 1.0 else 0.0
+            corr = (1.0 - alpha) * corr + alpha * np.ones((n, n))
+        elif target < current:
+            floor = 0.0 if target >= 0 else -1.0 / (n - 1)
+            beta = (current - target) / (current - floor)
+            anchor = (1.0 - floor) * np.eye(n) + floor * np.ones((n, n))
+            corr = (1.0 - beta) * corr + beta * anchor
+
+    std = std * (1.0 + volatility_shock)
+    return corr * np.outer(std, std)
+
+
+class ScenarioEngine:
+    """向量化的 VaR/CVaR 与压力测试引擎"""
+
+    def __init__(self, confidence_levels: Sequence[float] = DEFAULT_CONFIDENCE_LEVELS,
+                 n_scenarios: int = None, chunk_size: int = None, decay: float = None,
+                 seed: Optional[int] = None):
+        try:
+            from flask import current_app
+            config = current_app.config
+            n_scenarios = n_scenarios or config.get('VAR_MC_SCENARIOS', DEFAULT_SCENARIOS)
+            chunk_size = chunk_size or config.get('VAR_MC_CHUNK_SIZE', DEFAULT_CHUNK_SIZE)
+            decay = decay or config.get('VAR_EWMA_DECAY', DEFAULT_EWMA_DECAY)
+        except RuntimeError:
+            pass
+        self.confidence_levels = tuple(confidence_levels)
+        self.n_scenarios = int(n_scenarios or DEFAULT_SCENARIOS)
+        self.chunk_size = int(chunk_size or DEFAULT_CHUNK_SIZE)
+        self.decay = float(decay or DEFAULT_EWMA_DECAY)
+        self.seed = seed
+
+    # ==================== 基础 ====================
+
+    @staticmethod
+    def portfolio_returns(returns: np.ndarray, weights: np.ndarray) -> np.ndarray:
+        """情景 × 股票 收益矩阵与权重的乘积，缺失收益按 0 处理"""
+        return np.nan_to_num(np.asarray(returns, dtype=float)) @ np.asarray(weights, dtype=float)
+
+    def summarize(self, pnl: np.ndarray) -> Dict[str, float]:
+        """组合收益分布的 VaR（左尾分位数）与 CVaR（不超过 VaR 的平均收益）"""
+        pnl = np.asarray(pnl, dtype=float)
+        pnl = pnl[np.isfinite(pnl)]
+        metrics = {}
+        if len(pnl) == 0:
+            return metrics
+        for confidence in self.confidence_levels:
+            var = float(np.quantile(pnl, 1 - confidence))
+            tail = pnl[pnl <= var]
+            label = int(round(confidence * 100))
+            metrics[f'var_{label}'] = var
+            metrics[f'cvar_{label}'] = float(tail.mean()) if len(tail) else var
+        return metrics
+
+    # ==================== VaR ====================
+
+    def historical(self, returns: np.ndarray, weights: np.ndarray) -> Dict[str, Any]:
+        """历史模拟 VaR"""
+        pnl = self.portfolio_returns(returns, weights)
+        return dict(self.summarize(pnl), method='historical', scenarios=int(len(pnl)))
+
+    def ewma_volatility(self, returns: np.ndarray) -> np.ndarray:
+        """逐股 EWMA 波动率，第 t 行为用 t 之前数据对第 t 期的预测，共 T + 1 行（末行为下一期预测）"""
+        returns = np.nan_to_num(np.atleast_2d(np.asarray(returns, dtype=float)))
+        variance = np.empty((len(returns) + 1, returns.shape[1]))
+        variance[0] = returns.var(axis=0)
+        squared = returns ** 2
+        for t in range(len(returns)):
+            variance[t + 1] = self.decay * variance[t] + (1.0 - self.decay) * squared[t]
+        return np.sqrt(variance)
+
+    def filtered_historical(self, returns: np.ndarray, weights: np.ndarray) -> Dict[str, Any]:
+        """过滤历史模拟 VaR：r_t / σ_t · σ_{T+1}"""
+        returns = np.nan_to_num(np.atleast_2d(np.asarray(returns, dtype=float)))
+        volatility = self.ewma_volatility(returns)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            standardized = np.where(volatility[:-1] > 0, returns / volatility[:-1], 0.0)
+        pnl = (standardized * volatility[-1]) @ np.asarray(weights, dtype=float)
+        return dict(self.summarize(pnl), method='filtered_historical', scenarios=int(len(pnl)),
+                    decay=self.decay)
+
+    def monte_carlo(self, weights: np.ndarray, covariance: np.ndarray = None,
+                    mean: np.ndarray = None, factor_model: FactorRiskModel = None,
+                    n_scenarios: int = None, horizon_days: int = 1,
+                    dof: Optional[float] = None) -> Dict[str, Any]:
+        """蒙特卡洛 VaR
+
+        给出 factor_model 时按 B z_f + s ⊙ z_e 抽样（O(N·K)），否则对 covariance 做
+        Cholesky 分解。dof 不为空时使用单位方差的多元 t 分布刻画厚尾。情景分块生成，
+        每块只产生 块大小 × K（或 N）的随机数。
+        """
+        weights = np.asarray(weights, dtype=float)
+        if factor_model is not None:
+            exposure = factor_model.loadings().T @ weights
+            specific = np.sqrt(factor_model.specific_var) * weights
+        else:
+            exposure = covariance_root(covariance).T @ weights
+            specific = None
+
+        n_scenarios = int(n_scenarios or self.n_scenarios)
+        drift = float(np.asarray(mean, dtype=float) @ weights) * horizon_days if mean is not None else 0.0
+        scale = np.sqrt(horizon_days)
+        rng = np.random.default_rng(self.seed)
+
+        pnl = np.empty(n_scenarios)
+        chunks = 0
+        for start in range(0, n_scenarios, self.chunk_size):
+            size = min(self.chunk_size, n_scenarios - start)
+            draws = rng.standard_normal((size, len(exposure))) @ exposure
+            if specific is not None:
+                draws += rng.standard_normal((size, len(specific))) @ specific
+            if dof is not None and dof > 2:
+                draws *= np.sqrt((dof - 2.0) / rng.chisquare(dof, size))
+            pnl[start:start + size] = drift + scale * draws
+            chunks += 1
+
+        return dict(self.summarize(pnl), method='monte_carlo', scenarios=n_scenarios, chunks=chunks,
+                    horizon_days=horizon_days, distribution='t' if dof else 'normal')
+
+    def var_report(self, returns: np.ndarray, weights: np.ndarray,
+                   factor_model: FactorRiskModel = None) -> Dict[str, Dict[str, Any]]:
+        """三种方法的 VaR/CVaR；有因子模型时蒙特卡洛按因子分解抽样"""
+        returns = np.nan_to_num(np.atleast_2d(np.asarray(returns, dtype=float)))
+        report = {
+            'historical': self.historical(returns, weights),
+            'filtered_historical': self.filtered_historical(returns, weights)
+        }
+        mean = returns.mean(axis=0)
+        if factor_model is not None:
+            report['monte_carlo'] = self.monte_carlo(weights, mean=mean, factor_model=factor_model)
+        else:
+            covariance = np.atleast_2d(np.cov(returns, rowvar=False))
+            report['monte_carlo'] = self.monte_carlo(weights, covariance, mean)
+        return report
+
+    # ==================== 压力测试 ====================
+
+    def stress_test(self, returns: np.ndarray, weights: np.ndarray, scenarios: List[Dict[str, Any]],
+                    portfolio_value: float, codes: List[str] = None) -> Dict[str, Any]:
+        """压力测试
+
+        情景字段：market_shock（市场涨跌幅，按个股对等权市场的 Beta 传导）、asset_shocks
+        （{股票代码: 涨跌幅}）、volatility_shock、correlation_shock、horizon_days。
+        波动率/相关性冲击以压力协方差下蒙特卡洛的最高置信度 VaR 计入损益。
+        """
+        returns = np.nan_to_num(np.atleast_2d(np.asarray(returns, dtype=float)))
+        weights = np.asarray(weights, dtype=float)
+        mean = returns.mean(axis=0)
+        covariance = np.atleast_2d(np.cov(returns, rowvar=False))
+
+        market = returns.mean(axis=1)
+        market_var = market.var()
+        betas = ((returns - mean).T @ (market - market.mean()) / (len(market) * market_var)
+                 if market_var > 0 else np.ones(len(weights)))
+
+        level = int(round(max(self.confidence_levels) * 100))
+        base = self.monte_carlo(weights, covariance, mean)
+        code_index = {code: i for i, code in enumerate(codes or [])}
+
+        results = []
+        for scenario in scenarios:
+            pnl_pct = 0.0
+            details: Dict[str, Any] = {}
+
+            if 'market_shock' in scenario:
+                market_pnl = float(scenario['market_shock'] * (betas @ weights))
+                details['market_pnl_percentage'] = market_pnl * 100
+                pnl_pct += market_pnl
+
+            if scenario.get('asset_shocks'):
+                shocks = np.zeros(len(weights))
+                for code, shock in scenario['asset_shocks'].items():
+                    if code in code_index:
+                        shocks[code_index[code]] = shock
+                asset_pnl = float(shocks @ weights)
+                details['asset_pnl_percentage'] = asset_pnl * 100
+                pnl_pct += asset_pnl
+
+            if 'volatility_shock' in scenario or 'correlation_shock' in scenario:
+                stressed = self.monte_carlo(
+                    weights,
+                    stressed_covariance(covariance, scenario.get('volatility_shock', 0.0),
+                                        scenario.get('correlation_shock')),
+                    mean, horizon_days=int(scenario.get('horizon_days', 1))
+                )
+                details.update({
+                    f'stressed_var_{level}': stressed[f'var_{level}'],
+                    f'stressed_cvar_{level}': stressed[f'cvar_{level}'],
+                    f'base_var_{level}': base[f'var_{level}']
+                })
+                pnl_pct += stressed[f'var_{level}']
+
+            stressed_value = portfolio_value * (1 + pnl_pct)
+            results.append(dict({
+                'scenario_name': scenario.get('name', f'情景{len(results) + 1}'),
+                'original_value': portfolio_value,
+                'stressed_value': stressed_value,
+                'pnl_change': stressed_value - portfolio_value,
+                'pnl_percentage': pnl_pct * 100
+            }, **details))
+
+        return {
+            'scenarios': results,
+            'base_var': {key: value for key, value in base.items() if key.startswith(('var_', 'cvar_'))},
+            'monte_carlo_scenarios': base['scenarios']
+        }
+
+
+_scenario_engine = None
+
+
+def get_scenario_engine() -> ScenarioEngine:
+    """获取全局情景分析引擎实例（延迟初始化）"""
+    global _scenario_engine
+    if _scenario_engine is None:
+        _scenario_engine = ScenarioEngine()
+        logger.info(f"情景分析引擎已初始化: 蒙特卡洛 {_scenario_engine.n_scenarios} 个情景, "
+                    f"分块 {_scenario_engine.chunk_size}")
+    return _scenario_engine
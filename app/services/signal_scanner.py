@@ -0,0 +1,434 @@
+"""
+全市场交易信号扫描
+把股票池的K线和技术指标装配成右对齐面板（每列一只股票，最后一行是该股票自己的最新一根），
+八个策略都写成面板上的数组表达式，一次求值覆盖全部股票，触发的信号一次批量入库。
+
+策略规则与单股信号引擎原有实现一致：只看最近 20 根K线和最近两条指标记录，
+并要求回看窗口内至少有 50 根K线，因此每只股票只需要加载最近 50 根K线和 10 条指标记录。
+"""
+
+import json
+import time
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+from sqlalchemy import func
+
+from app.extensions import db
+from app.models.realtime_indicator import RealtimeIndicator
+from app.models.stock_minute_data import StockMinuteData
+from app.models.trading_signal import TradingSignal
+from app.services.live_bar_cache import BAR_FIELDS, get_live_bar_cache
+
+
+# 至少需要的K线数，也是每只股票加载的K线数
+MIN_BARS = 50
+# 每个指标加载的最近记录数（RSI 策略要求至少 10 条）
+INDICATOR_WINDOW = 10
+IN_CHUNK_SIZE = 500
+
+PRICE_FIELDS = ('open', 'high', 'low', 'close', 'volume')
+INDICATOR_NAMES = ('MA', 'EMA', 'MACD', 'RSI', 'BOLL')
+
+
+def _chunks(items: List[str], size: int = IN_CHUNK_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _right_aligned(codes: List[str], frame: pd.DataFrame, columns: List[str],
+                   window: int) -> Tuple[np.ndarray, np.ndarray]:
+    """长表转为 (window, 股票数, 字段数) 的右对齐面板，frame 需含 ts_code 和 pos（0 为最新）"""
+    panel = np.full((window, len(codes), len(columns)), np.nan)
+    count = np.zeros(len(codes), dtype=int)
+    if frame.empty:
+        return panel, count
+    index = {code: i for i, code in enumerate(codes)}
+    cols = frame['ts_code'].map(index).to_numpy()
+    pos = frame['pos'].to_numpy(dtype=int)
+    panel[window - 1 - pos, cols] = frame[columns].to_numpy(dtype='float64')
+    np.maximum.at(count, cols, pos + 1)
+    return panel, count
+
+
+class ScanPanels:
+    """股票池的右对齐K线与指标面板"""
+
+    def __init__(self, codes: List[str], prices: np.ndarray, last_time: np.ndarray, count: np.ndarray,
+                 indicators: Dict[str, Tuple[np.ndarray, np.ndarray]]):
+        self.codes = codes
+        self.last_time = last_time
+        self.count = count
+        self.open, self.high, self.low, self.close, self.volume = (prices[:, :, i] for i in range(len(PRICE_FIELDS)))
+        # 指标名 -> (values[窗口, 股票, 4], 记录数[股票])
+        self.indicators = indicators
+
+    def indicator(self, name: str) -> Tuple[np.ndarray, np.ndarray]:
+        empty = (np.full((INDICATOR_WINDOW, len(self.codes), 4), np.nan), np.zeros(len(self.codes), dtype=int))
+        return self.indicators.get(name, empty)
+
+    def select(self, mask: np.ndarray) -> 'ScanPanels':
+        """只保留 mask 为真的股票"""
+        codes = [code for code, keep in zip(self.codes, mask) if keep]
+        prices = np.stack([self.open, self.high, self.low, self.close, self.volume], axis=2)[:, mask]
+        indicators = {name: (values[:, mask], count[mask]) for name, (values, count) in self.indicators.items()}
+        return ScanPanels(codes, prices, self.last_time[mask], self.count[mask], indicators)
+
+
+# 策略: (名称, 方向, 触发掩码, 强度, 置信度, 目标价倍数, 止损价, 有效小时数, 使用的指标, 参数)
+SignalRule = Tuple[str, str, np.ndarray, float, float, float, np.ndarray, int, List[str], Dict[str, Any]]
+
+
+def _ma_crossover(p: ScanPanels) -> List[SignalRule]:
+    values, count = p.indicator('MA')
+    short, long_ = values[-1, :, 0], values[-1, :, 1]
+    prev_short, prev_long = values[-2, :, 0], values[-2, :, 1]
+    ready = count >= 2
+    with np.errstate(invalid='ignore'):
+        buy = ready & (prev_short <= prev_long) & (short > long_)
+        sell = ready & ~buy & (prev_short >= prev_long) & (short < long_)
+    params = {'short_ma': short, 'long_ma': long_}
+    return [
+        ('ma_crossover', 'BUY', buy, 0.7, 0.8, 1.05, p.close[-1] * 0.97, 4, ['MA'],
+         dict(params, crossover_type='golden_cross')),
+        ('ma_crossover', 'SELL', sell, -0.7, 0.8, 0.95, p.close[-1] * 1.03, 4, ['MA'],
+         dict(params, crossover_type='death_cross')),
+    ]
+
+
+def _rsi_divergence(p: ScanPanels) -> List[SignalRule]:
+    values, count = p.indicator('RSI')
+    rsi = values[-1, :, 0]
+    ready = count >= 10
+    with np.errstate(invalid='ignore'):
+        sell = ready & (rsi > 70)
+        buy = ready & (rsi < 30)
+    return [
+        ('rsi_divergence', 'SELL', sell, -0.6, 0.7, 0.96, p.close[-1] * 1.02, 2, ['RSI'],
+         {'rsi_value': rsi, 'condition': 'overbought'}),
+        ('rsi_divergence', 'BUY', buy, 0.6, 0.7, 1.04, p.close[-1] * 0.98, 2, ['RSI'],
+         {'rsi_value': rsi, 'condition': 'oversold'}),
+    ]
+
+
+def _macd_signal(p: ScanPanels) -> List[SignalRule]:
+    values, count = p.indicator('MACD')
+    macd, signal, hist = values[-1, :, 0], values[-1, :, 1], values[-1, :, 2]
+    prev_macd, prev_signal = values[-2, :, 0], values[-2, :, 1]
+    ready = count >= 3
+    with np.errstate(invalid='ignore'):
+        buy = ready & (prev_macd <= prev_signal) & (macd > signal)
+        sell = ready & ~buy & (prev_macd >= prev_signal) & (macd < signal)
+    params = {'macd': macd, 'signal': signal, 'histogram': hist}
+    return [
+        ('macd_signal', 'BUY', buy, 0.8, 0.85, 1.06, p.close[-1] * 0.96, 6, ['MACD'],
+         dict(params, crossover_type='bullish')),
+        ('macd_signal', 'SELL', sell, -0.8, 0.85, 0.94, p.close[-1] * 1.04, 6, ['MACD'],
+         dict(params, crossover_type='bearish')),
+    ]
+
+
+def _bollinger_breakout(p: ScanPanels) -> List[SignalRule]:
+    values, count = p.indicator('BOLL')
+    upper, middle, lower = values[-1, :, 0], values[-1, :, 1], values[-1, :, 2]
+    price = p.close[-1]
+    prev_price = np.where(p.count > 1, p.close[-2], price)
+    ready = count >= 1
+    with np.errstate(invalid='ignore'):
+        buy = ready & (prev_price <= upper) & (price > upper)
+        sell = ready & ~buy & (prev_price >= lower) & (price < lower)
+    params = {'upper_band': upper, 'middle_band': middle, 'lower_band': lower}
+    return [
+        ('bollinger_breakout', 'BUY', buy, 0.75, 0.8, 1.05, middle, 3, ['BOLL'],
+         dict(params, breakout_type='upper')),
+        ('bollinger_breakout', 'SELL', sell, -0.75, 0.8, 0.95, middle, 3, ['BOLL'],
+         dict(params, breakout_type='lower')),
+    ]
+
+
+def _volume_price_trend(p: ScanPanels) -> List[SignalRule]:
+    price, prev_price = p.close[-1], p.close[-2]
+    volume = p.volume[-1]
+    avg_volume = np.nanmean(p.volume[-20:], axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        surge = volume > avg_volume * 1.5
+        buy = surge & (price > prev_price * 1.02)
+        sell = surge & ~buy & (price < prev_price * 0.98)
+        params = {
+            'price_change_pct': (price - prev_price) / prev_price * 100,
+            'volume_ratio': volume / avg_volume,
+        }
+    indicators = ['VOLUME', 'PRICE']
+    return [
+        ('volume_price_trend', 'BUY', buy, 0.85, 0.9, 1.08, price * 0.95, 4, indicators,
+         dict(params, pattern='volume_breakout_up')),
+        ('volume_price_trend', 'SELL', sell, -0.85, 0.9, 0.92, price * 1.05, 4, indicators,
+         dict(params, pattern='volume_breakout_down')),
+    ]
+
+
+def _momentum_reversal(p: ScanPanels) -> List[SignalRule]:
+    price, price_5_ago = p.close[-1], p.close[-6]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        momentum = (price - price_5_ago) / price_5_ago * 100
+        declining = (np.diff(p.close[-5:], axis=0) < 0).sum(axis=0)
+        buy = (declining >= 3) & (momentum > 1)
+    return [
+        ('momentum_reversal', 'BUY', buy, 0.7, 0.75, 1.06, price * 0.96, 8, ['MOMENTUM'],
+         {'momentum_5d': momentum, 'declining_days': declining, 'reversal_type': 'bullish_reversal'}),
+    ]
+
+
+def _support_resistance(p: ScanPanels) -> List[SignalRule]:
+    resistance = np.nanmax(p.high[-20:], axis=0)
+    support = np.nanmin(p.low[-20:], axis=0)
+    price = p.close[-1]
+    with np.errstate(invalid='ignore'):
+        buy = price > resistance * 1.001
+        sell = ~buy & (price < support * 0.999)
+    params = {'resistance_level': resistance, 'support_level': support}
+    return [
+        ('support_resistance', 'BUY', buy, 0.8, 0.85, 1.05, resistance * 0.995, 6, ['SUPPORT_RESISTANCE'],
+         dict(params, breakout_type='resistance_breakout')),
+        ('support_resistance', 'SELL', sell, -0.8, 0.85, 0.95, support * 1.005, 6, ['SUPPORT_RESISTANCE'],
+         dict(params, breakout_type='support_breakdown')),
+    ]
+
+
+def _trend_following(p: ScanPanels) -> List[SignalRule]:
+    values, count = p.indicator('EMA')
+    ema = values[-1, :, 0]
+    price = p.close[-1]
+    ready = count >= 1
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ratio = price / ema
+        buy = ready & (ratio > 1.02)
+        sell = ready & (ratio < 0.98)
+    params = {'ema_value': ema, 'price_ema_ratio': ratio}
+    return [
+        ('trend_following', 'BUY', buy, 0.6, 0.7, 1.04, ema * 0.98, 4, ['EMA'],
+         dict(params, trend_type='uptrend')),
+        ('trend_following', 'SELL', sell, -0.6, 0.7, 0.96, ema * 1.02, 4, ['EMA'],
+         dict(params, trend_type='downtrend')),
+    ]
+
+
+STRATEGIES: Dict[str, Callable[[ScanPanels], List[SignalRule]]] = {
+    'ma_crossover': _ma_crossover,
+    'rsi_divergence': _rsi_divergence,
+    'macd_signal': _macd_signal,
+    'bollinger_breakout': _bollinger_breakout,
+    'volume_price_trend': _volume_price_trend,
+    'momentum_reversal': _momentum_reversal,
+    'support_resistance': _support_resistance,
+    'trend_following': _trend_following,
+}
+
+
+def _to_python(value):
+    if isinstance(value, (np.floating, float)):
+        return float(value)
+    if isinstance(value, np.integer):
+        return int(value)
+    return value
+
+
+def _emit(p: ScanPanels, rule: SignalRule, period_type: str) -> List[Dict[str, Any]]:
+    """把触发掩码展开成信号记录（只遍历触发的股票）"""
+    name, side, mask, strength, confidence, target_mult, stop, hours, indicators, params = rule
+    signals = []
+    for j in np.flatnonzero(mask):
+        current_time = pd.Timestamp(p.last_time[j]).to_pydatetime()
+        price = float(p.close[-1, j])
+        signals.append({
+            'ts_code': p.codes[j],
+            'datetime': current_time,
+            'period_type': period_type,
+            'strategy_name': name,
+            'signal_type': side,
+            'signal_strength': strength,
+            'confidence': confidence,
+            'trigger_price': price,
+            'target_price': price * target_mult,
+            'stop_loss_price': float(stop[j]),
+            'strategy_params': json.dumps({
+                key: _to_python(value[j] if isinstance(value, np.ndarray) else value)
+                for key, value in params.items()
+            }),
+            'indicators_used': json.dumps(indicators),
+            'expiry_time': current_time + timedelta(hours=hours)
+        })
+    return signals
+
+
+def evaluate_strategies(panels: ScanPanels, period_type: str,
+                        strategies: List[str] = None) -> Tuple[List[Dict[str, Any]], Dict[str, Dict[str, Any]]]:
+    """在面板上求值策略，返回 (信号列表, 各策略的信号数与耗时)"""
+    signals, by_strategy = [], {}
+    for name in strategies or list(STRATEGIES):
+        if name not in STRATEGIES:
+            continue
+        started = time.perf_counter()
+        emitted = []
+        try:
+            for rule in STRATEGIES[name](panels):
+                emitted.extend(_emit(panels, rule, period_type))
+        except Exception as e:
+            logger.error(f"策略 {name} 扫描失败: {e}")
+        by_strategy[name] = {
+            'signals': len(emitted),
+            'elapsed_ms': round((time.perf_counter() - started) * 1000, 3)
+        }
+        signals.extend(emitted)
+    return signals, by_strategy
+
+
+class SignalScanner:
+    """全市场信号扫描器"""
+
+    def scan(self, codes: List[str] = None, period_type: str = '1min', strategies: List[str] = None,
+             lookback_days: int = 5, save: bool = True) -> Dict[str, Any]:
+        """扫描股票池；codes 为空时扫描回看窗口内有K线的全部股票"""
+        timing = {}
+        started = time.perf_counter()
+        end_time = datetime.now()
+        start_time = end_time - timedelta(days=lookback_days)
+
+        if not codes:
+            codes = self._universe(period_type, start_time)
+        codes = list(dict.fromkeys(codes))
+        panels = self.load_panels(codes, period_type, start_time, end_time)
+        timing['load_ms'] = round((time.perf_counter() - started) * 1000, 3)
+
+        count = panels.count
+        eligible = count >= MIN_BARS
+        panels = panels.select(eligible)
+        signals, by_strategy = evaluate_strategies(panels, period_type, strategies)
+        timing['evaluate_ms'] = round(sum(item['elapsed_ms'] for item in by_strategy.values()), 3)
+
+        if save and signals:
+            save_started = time.perf_counter()
+            success, message = TradingSignal.batch_insert(signals)
+            if not success:
+                logger.error(f"保存信号失败: {message}")
+            timing['save_ms'] = round((time.perf_counter() - save_started) * 1000, 3)
+        timing['total_ms'] = round((time.perf_counter() - started) * 1000, 3)
+
+        logger.info(f"信号扫描完成: {len(codes)} 只股票, {int(eligible.sum())} 只数据充足, "
+                    f"{len(signals)} 个信号, 耗时 {timing['total_ms']}ms")
+        return {
+            'stocks_scanned': len(codes),
+            'stocks_eligible': int(eligible.sum()),
+            'insufficient_data': {code: int(n) for code, n, ok in zip(codes, count, eligible) if not ok},
+            'signals_generated': len(signals),
+            'strategies_used': list(by_strategy),
+            'by_strategy': by_strategy,
+            'timing': timing,
+            'signals': signals
+        }
+
+    def load_panels(self, codes: List[str], period_type: str, start_time: datetime,
+                    end_time: datetime) -> ScanPanels:
+        """装配右对齐面板：K线优先取实时K线缓存，其余股票用窗口函数每只只取最近 MIN_BARS 根"""
+        start_ns, end_ns = pd.Timestamp(start_time).value, pd.Timestamp(end_time).value
+        field_index = [BAR_FIELDS.index(field) for field in PRICE_FIELDS]
+        cache = get_live_bar_cache()
+
+        frames, remaining = [], []
+        for code in codes:
+            series = cache.get_series(code, period_type, limit=MIN_BARS, load=False)
+            if series is None:
+                remaining.append(code)
+                continue
+            times, values = series.tail(MIN_BARS)
+            keep = (times >= start_ns) & (times <= end_ns)
+            times, values = times[keep], values[keep][:, field_index]
+            frame = pd.DataFrame(values, columns=list(PRICE_FIELDS))
+            frame['ts_code'] = code
+            frame['datetime'] = pd.to_datetime(times)
+            frame['pos'] = np.arange(len(times))[::-1]
+            frames.append(frame)
+
+        columns = ['ts_code', 'datetime'] + list(PRICE_FIELDS) + ['rn']
+        for chunk in _chunks(remaining):
+            rn = func.row_number().over(
+                partition_by=StockMinuteData.ts_code, order_by=StockMinuteData.datetime.desc()
+            ).label('rn')
+            ranked = db.session.query(
+                StockMinuteData.ts_code, StockMinuteData.datetime, StockMinuteData.open, StockMinuteData.high,
+                StockMinuteData.low, StockMinuteData.close, StockMinuteData.volume, rn
+            ).filter(
+                StockMinuteData.ts_code.in_(chunk),
+                StockMinuteData.period_type == period_type,
+                StockMinuteData.datetime >= start_time,
+                StockMinuteData.datetime <= end_time
+            ).subquery()
+            rows = db.session.query(ranked).filter(ranked.c.rn <= MIN_BARS).all()
+            frame = pd.DataFrame(rows, columns=columns)
+            frame['pos'] = frame['rn'] - 1
+            frames.append(frame.drop(columns='rn'))
+
+        bars = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=columns[:-1] + ['pos'])
+        prices, count = _right_aligned(codes, bars, list(PRICE_FIELDS), MIN_BARS)
+        last_time = np.full(len(codes), np.datetime64('NaT'), dtype='datetime64[ns]')
+        latest = bars[bars['pos'] == 0]
+        if not latest.empty:
+            index = {code: i for i, code in enumerate(codes)}
+            last_time[latest['ts_code'].map(index).to_numpy()] = pd.to_datetime(latest['datetime']).to_numpy()
+
+        indicators = self._load_indicators(codes, period_type, start_time, end_time)
+        return ScanPanels(codes, prices, last_time, count, indicators)
+
+    def _load_indicators(self, codes: List[str], period_type: str, start_time: datetime,
+                         end_time: datetime) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+        """每只股票每个指标只取最近 INDICATOR_WINDOW 条记录"""
+        frames = []
+        columns = ['ts_code', 'indicator_name', 'value1', 'value2', 'value3', 'value4', 'rn']
+        for chunk in _chunks(codes):
+            rn = func.row_number().over(
+                partition_by=(RealtimeIndicator.ts_code, RealtimeIndicator.indicator_name),
+                order_by=RealtimeIndicator.datetime.desc()
+            ).label('rn')
+            ranked = db.session.query(
+                RealtimeIndicator.ts_code, RealtimeIndicator.indicator_name, RealtimeIndicator.value1,
+                RealtimeIndicator.value2, RealtimeIndicator.value3, RealtimeIndicator.value4, rn
+            ).filter(
+                RealtimeIndicator.ts_code.in_(chunk),
+                RealtimeIndicator.period_type == period_type,
+                RealtimeIndicator.indicator_name.in_(INDICATOR_NAMES),
+                RealtimeIndicator.datetime >= start_time,
+                RealtimeIndicator.datetime <= end_time
+            ).subquery()
+            rows = db.session.query(ranked).filter(ranked.c.rn <= INDICATOR_WINDOW).all()
+            frames.append(pd.DataFrame(rows, columns=columns))
+
+        indicators = {}
+        if not frames:
+            return indicators
+        frame = pd.concat(frames, ignore_index=True)
+        frame['pos'] = frame['rn'] - 1
+        for name, group in frame.groupby('indicator_name'):
+            indicators[name] = _right_aligned(codes, group, ['value1', 'value2', 'value3', 'value4'],
+                                              INDICATOR_WINDOW)
+        return indicators
+
+    def _universe(self, period_type: str, start_time: datetime) -> List[str]:
+        rows = db.session.query(StockMinuteData.ts_code).filter(
+            StockMinuteData.period_type == period_type,
+            StockMinuteData.datetime >= start_time
+        ).distinct().all()
+        return sorted(row[0] for row in rows)
+
+
+_signal_scanner = None
+
+
+def get_signal_scanner() -> SignalScanner:
+    """获取全局信号扫描器实例（延迟初始化）"""
+    global _signal_scanner
+    if _signal_scanner is None:
+        _signal_scanner = SignalScanner()
+    return _signal_scanner
@@ -19,6 +19,13 @@ class StockScoringEngine:
             'rank_ic': self._rank_ic_scoring
         }
     
+    def _get_ml_manager(self):
+        """获取模型管理器（延迟初始化，模型缓存全局共享）"""
+        if getattr(self, '_ml_manager', None) is None:
+            from app.services.ml_models import MLModelManager
+            self._ml_manager = MLModelManager()
+        return self._ml_manager
+    
     def calculate_factor_scores(self, trade_date: str, factor_list: List[str] = None,
                                ts_codes: List[str] = None) -> pd.DataFrame:
         """计算因子分数"""
@@ -241,21 +248,22 @@ class StockScoringEngine:
                 logger.warning("未提供模型ID")
                 return []
             
-            # 获取所有模型的预测结果
-            all_predictions = []
+            # 一次查询取出所有模型已保存的预测结果
+            pred_query = MLPredictions.query.filter(
+                MLPredictions.model_id.in_(model_ids),
+                MLPredictions.trade_date == trade_date
+            ).order_by(MLPredictions.model_id, MLPredictions.rank_score)
             
-            for model_id in model_ids:
-                pred_query = MLPredictions.query.filter(
-                    MLPredictions.model_id == model_id,
-                    MLPredictions.trade_date == trade_date
-                ).order_by(MLPredictions.rank_score)
-                
-                pred_data = pd.read_sql(pred_query.statement, db.engine)
-                
-                if not pred_data.empty:
-                    pred_data['model_id'] = model_id
-                    all_predictions.append(pred_data)
+            all_predictions = [pd.read_sql(pred_query.statement, db.engine)]
+            
+            # 没有保存预测结果的模型在共享特征矩阵上批量预测
+            saved_ids = set(all_predictions[0]['model_id'])
+            missing_ids = [model_id for model_id in model_ids if model_id not in saved_ids]
+            if missing_ids:
+                batch = self._get_ml_manager().predict_batch(missing_ids, trade_date)
+                all_predictions.extend(batch.values())
             
+            all_predictions = [pred_data for pred_data in all_predictions if not pred_data.empty]
             if not all_predictions:
                 logger.warning(f"未找到预测数据: {trade_date}")
                 return []
@@ -0,0 +1,486 @@
+"""
+流式技术指标引擎
+为每个 (股票, 周期) 维护滚动状态：收盘价环形缓冲区与各周期的滚动和、调整式 EMA 的
+分子分母、MACD 信号线、RSI 涨跌滚动和、KDJ/WR 的单调队列极值与 K/D 递推值、布林带的
+滚动和与平方和、ATR 真实波幅滚动和、OBV 累计值。每根新 K 线只做常数次运算即可得到全部
+指标，计算口径与 RealtimeIndicatorEngine 中按整段窗口计算的 pandas 实现一致。
+
+同一时间戳的 K 线再次到达时视为对最后一根 K 线的修正：先回退到上一根 K 线之后的状态，
+再重新应用。全部状态可以快照到文件，进程重启后恢复，从快照的最后时间继续增量计算。
+"""
+
+import os
+import copy
+import atexit
+import math
+import pickle
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple, Any
+from loguru import logger
+
+
+DEFAULT_STATE_PATH = 'data/indicator_state.pkl'
+
+DEFAULT_PARAMS = {
+    'MA': {'periods': [5, 10, 20, 30, 60]},
+    'EMA': {'periods': [12, 26]},
+    'MACD': {'fast': 12, 'slow': 26, 'signal': 9},
+    'RSI': {'period': 14},
+    'KDJ': {'k_period': 9, 'd_period': 3, 'j_period': 3},
+    'BOLL': {'period': 20, 'std_dev': 2},
+    'CCI': {'period': 14},
+    'WR': {'period': 14},
+    'ATR': {'period': 14},
+    'OBV': {}
+}
+
+INDICATOR_NAMES = tuple(DEFAULT_PARAMS)
+
+# 相对容差：滚动和相减的抵消误差低于此量级时视为平盘窗口（涨跌停封板时常见），
+# 方差按 mean² 比较，平均绝对偏差按 |mean| 比较
+FLAT_RTOL = 1e-10
+
+
+def _finite(value: Optional[float]) -> Optional[float]:
+    if value is None or math.isnan(value) or math.isinf(value):
+        return None
+    return value
+
+
+class _RollingSum:
+    """定长窗口滚动和（可选平方和）"""
+
+    __slots__ = ('window', 'values', 'total', 'total_sq', 'track_sq', 'pushes')
+
+    # 每推入这么多个值按窗口重新求和一次，消除增减累积的浮点误差
+    RESUM_EVERY = 1024
+
+    def __init__(self, window: int, track_sq: bool = False):
+        self.window = window
+        self.values = deque(maxlen=window)
+        self.total = 0.0
+        self.total_sq = 0.0
+        self.track_sq = track_sq
+        self.pushes = 0
+
+    def copy(self) -> '_RollingSum':
+        other = _RollingSum.__new__(_RollingSum)
+        other.window, other.total, other.total_sq = self.window, self.total, self.total_sq
+        other.track_sq, other.pushes = self.track_sq, self.pushes
+        other.values = deque(self.values, maxlen=self.window)
+        return other
+
+    def push(self, value: float):
+        if len(self.values) == self.window:
+            old = self.values[0]
+            self.total -= old
+            if self.track_sq:
+                self.total_sq -= old * old
+        self.values.append(value)
+        self.total += value
+        if self.track_sq:
+            self.total_sq += value * value
+        self.pushes += 1
+        if self.pushes % self.RESUM_EVERY == 0:
+            self.total = math.fsum(self.values)
+            if self.track_sq:
+                self.total_sq = math.fsum(x * x for x in self.values)
+
+    @property
+    def full(self) -> bool:
+        return len(self.values) == self.window
+
+    def mean(self) -> Optional[float]:
+        return self.total / self.window if self.full else None
+
+    def std(self) -> Optional[float]:
+        """样本标准差（ddof=1），与 pandas rolling.std 一致"""
+        if not self.full or self.window < 2:
+            return None
+        mean = self.total / self.window
+        variance = (self.total_sq - self.total * mean) / (self.window - 1)
+        if variance <= FLAT_RTOL * mean * mean:
+            return 0.0
+        return math.sqrt(variance)
+
+
+class _RollingExtreme:
+    """单调队列维护的滚动最大值或最小值，均摊 O(1)"""
+
+    __slots__ = ('window', 'is_max', 'queue', 'index')
+
+    def __init__(self, window: int, is_max: bool):
+        self.window = window
+        self.is_max = is_max
+        self.queue = deque()
+        self.index = -1
+
+    def copy(self) -> '_RollingExtreme':
+        other = _RollingExtreme.__new__(_RollingExtreme)
+        other.window, other.is_max, other.index = self.window, self.is_max, self.index
+        other.queue = deque(self.queue)
+        return other
+
+    def push(self, value: float):
+        self.index += 1
+        queue = self.queue
+        if self.is_max:
+            while queue and queue[-1][1] <= value:
+                queue.pop()
+        else:
+            while queue and queue[-1][1] >= value:
+                queue.pop()
+        queue.append((self.index, value))
+        if queue[0][0] <= self.index - self.window:
+            queue.popleft()
+
+    @property
+    def full(self) -> bool:
+        return self.index + 1 >= self.window
+
+    def value(self) -> Optional[float]:
+        return self.queue[0][1] if self.full else None
+
+
+class _AdjustedEMA:
+    """调整式 EMA（pandas ewm(span, adjust=True)）的递推形式"""
+
+    __slots__ = ('decay', 'numerator', 'denominator')
+
+    def __init__(self, span: int):
+        self.decay = 1.0 - 2.0 / (span + 1.0)
+        self.numerator = 0.0
+        self.denominator = 0.0
+
+    def copy(self) -> '_AdjustedEMA':
+        other = _AdjustedEMA.__new__(_AdjustedEMA)
+        other.decay, other.numerator, other.denominator = self.decay, self.numerator, self.denominator
+        return other
+
+    def push(self, value: float) -> float:
+        self.numerator = value + self.decay * self.numerator
+        self.denominator = 1.0 + self.decay * self.denominator
+        return self.numerator / self.denominator
+
+
+class IndicatorState:
+    """单个 (股票, 周期) 的指标滚动状态"""
+
+    def __init__(self, ts_code: str, period_type: str, params: Dict[str, Dict] = None):
+        self.ts_code = ts_code
+        self.period_type = period_type
+        self.params = params or DEFAULT_PARAMS
+        p = self.params
+
+        self.count = 0
+        self.last_datetime: Optional[datetime] = None
+        self.last_bar: Optional[Tuple[float, float, float, float]] = None
+        self.prev_close: Optional[float] = None
+        self.latest: Dict[str, Any] = {}
+        # 各指标已写入数据库的最后时间
+        self.stored_until: Dict[str, datetime] = {}
+        self.stored_checked = False
+        # 最后一根 K 线应用之前的状态，用于同一时间戳 K 线的修正
+        self._before_last: Optional['IndicatorState'] = None
+
+        self.ma = {period: _RollingSum(period) for period in p['MA']['periods']}
+        self.ema = {period: _AdjustedEMA(period) for period in p['EMA']['periods']}
+        self.macd_fast = _AdjustedEMA(p['MACD']['fast'])
+        self.macd_slow = _AdjustedEMA(p['MACD']['slow'])
+        self.macd_signal = _AdjustedEMA(p['MACD']['signal'])
+        self.rsi_gain = _RollingSum(p['RSI']['period'])
+        self.rsi_loss = _RollingSum(p['RSI']['period'])
+        self.kdj_high = _RollingExtreme(p['KDJ']['k_period'], is_max=True)
+        self.kdj_low = _RollingExtreme(p['KDJ']['k_period'], is_max=False)
+        self.k_prev = 50.0
+        self.d_prev = 50.0
+        self.boll = _RollingSum(p['BOLL']['period'], track_sq=True)
+        self.cci = _RollingSum(p['CCI']['period'])
+        self.wr_high = _RollingExtreme(p['WR']['period'], is_max=True)
+        self.wr_low = _RollingExtreme(p['WR']['period'], is_max=False)
+        self.atr = _RollingSum(p['ATR']['period'])
+        self.obv = 0.0
+
+    def snapshot_copy(self) -> 'IndicatorState':
+        """复制当前状态（各缓冲区长度固定，复制代价为常数）"""
+        state = copy.copy(self)
+        state._before_last = None
+        state.latest = dict(self.latest)
+        state.stored_until = dict(self.stored_until)
+        for name, value in self.__dict__.items():
+            if isinstance(value, (_RollingSum, _RollingExtreme, _AdjustedEMA)):
+                setattr(state, name, value.copy())
+            elif isinstance(value, dict) and name in ('ma', 'ema'):
+                setattr(state, name, {key: item.copy() for key, item in value.items()})
+        return state
+
+    def update(self, bar: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """应用一根 K 线，返回本根 K 线的全部指标值
+
+        早于最后时间的 K 线、以及与最后一根 K 线完全相同的重复 K 线被忽略并返回 None。
+        """
+        bar_time = bar['datetime']
+        if self.last_datetime is not None:
+            if bar_time < self.last_datetime:
+                return None
+            if bar_time == self.last_datetime:
+                if self._before_last is None or self._bar_key(bar) == self.last_bar:
+                    return None
+                before = self._before_last
+                stored_until, stored_checked = self.stored_until, self.stored_checked
+                self.__dict__.update(before.snapshot_copy().__dict__)
+                self._before_last = before
+                self.stored_until, self.stored_checked = stored_until, stored_checked
+                return self._apply(bar)
+        self._before_last = self.snapshot_copy()
+        return self._apply(bar)
+
+    @staticmethod
+    def _bar_key(bar: Dict[str, Any]) -> Tuple[float, float, float, float]:
+        return (float(bar['close']), float(bar['high']), float(bar['low']), float(bar.get('volume') or 0))
+
+    def _apply(self, bar: Dict[str, Any]) -> Dict[str, Any]:
+        p = self.params
+        close = float(bar['close'])
+        high = float(bar['high'])
+        low = float(bar['low'])
+        volume = float(bar.get('volume') or 0)
+        i = self.count
+        prev_close = self.prev_close
+        values: Dict[str, Any] = {}
+
+        # MA / EMA
+        ma_values = []
+        for period, rolling in self.ma.items():
+            rolling.push(close)
+            ma_values.append(rolling.mean())
+        values['MA'] = ma_values
+        values['EMA'] = [ema.push(close) for ema in self.ema.values()]
+
+        # MACD：EMA 从第一根 K 线开始递推，前 slow-1 根不输出
+        macd_line = self.macd_fast.push(close) - self.macd_slow.push(close)
+        signal_line = self.macd_signal.push(macd_line)
+        values['MACD'] = [macd_line, signal_line, macd_line - signal_line] \
+            if i >= p['MACD']['slow'] - 1 else None
+
+        # RSI：涨跌幅的简单滚动均值（首根 K 线涨跌记为 0）
+        delta = close - prev_close if prev_close is not None else 0.0
+        self.rsi_gain.push(delta if delta > 0 else 0.0)
+        self.rsi_loss.push(-delta if delta < 0 else 0.0)
+        rsi = None
+        if self.rsi_gain.full:
+            avg_gain, avg_loss = self.rsi_gain.mean(), self.rsi_loss.mean()
+            if avg_loss > 0:
+                rsi = 100 - 100 / (1 + avg_gain / avg_loss)
+            elif avg_gain > 0:
+                rsi = 100.0
+        values['RSI'] = rsi
+
+        # KDJ
+        self.kdj_high.push(high)
+        self.kdj_low.push(low)
+        kdj = None
+        if self.kdj_high.full:
+            highest, lowest = self.kdj_high.value(), self.kdj_low.value()
+            # 窗口内最高价等于最低价时 RSV 无定义，K/D 保持不变
+            if highest != lowest:
+                rsv = (close - lowest) / (highest - lowest) * 100
+                k_val = (2 / 3) * self.k_prev + (1 / 3) * rsv
+                d_val = (2 / 3) * self.d_prev + (1 / 3) * k_val
+                kdj = [k_val, d_val, 3 * k_val - 2 * d_val]
+                self.k_prev, self.d_prev = k_val, d_val
+        values['KDJ'] = kdj
+
+        # BOLL
+        self.boll.push(close)
+        boll = None
+        if self.boll.full:
+            middle, std = self.boll.mean(), self.boll.std()
+            width = std * p['BOLL']['std_dev']
+            boll = [middle + width, middle, middle - width]
+        values['BOLL'] = boll
+
+        # CCI：平均绝对偏差需要遍历固定长度窗口，均值也随之精确求和，
+        # 平盘窗口的偏差为 0 而不是滚动和残留的微小误差
+        typical = (high + low + close) / 3
+        self.cci.push(typical)
+        cci = None
+        if self.cci.full:
+            mean = math.fsum(self.cci.values) / self.cci.window
+            mad = sum(abs(x - mean) for x in self.cci.values) / self.cci.window
+            if mad <= FLAT_RTOL * abs(mean):
+                cci = 0.0
+            else:
+                cci = _finite((typical - mean) / (0.015 * mad))
+        values['CCI'] = cci
+
+        # WR
+        self.wr_high.push(high)
+        self.wr_low.push(low)
+        wr = None
+        if self.wr_high.full:
+            highest, lowest = self.wr_high.value(), self.wr_low.value()
+            wr = (highest - close) / (highest - lowest) * (-100) if highest != lowest else None
+        values['WR'] = wr
+
+        # ATR：真实波幅的简单滚动均值，首根 K 线取最高价与最低价之差
+        true_range = high - low
+        if prev_close is not None:
+            true_range = max(true_range, abs(high - prev_close), abs(low - prev_close))
+        self.atr.push(true_range)
+        values['ATR'] = self.atr.mean()
+
+        # OBV
+        if prev_close is not None:
+            if close > prev_close:
+                self.obv += volume
+            elif close < prev_close:
+                self.obv -= volume
+        values['OBV'] = self.obv
+
+        self.count += 1
+        self.prev_close = close
+        self.last_datetime = bar['datetime']
+        self.last_bar = (close, high, low, volume)
+        self.latest = values
+        return values
+
+
+def indicator_rows(ts_code: str, period_type: str, bar_time: datetime, values: Dict[str, Any],
+                   indicators: List[str]) -> List[Dict[str, Any]]:
+    """把一根 K 线的指标值转换为 RealtimeIndicator 行
+
+    多值指标依次写入 value1~value4：MA 为前四个周期，EMA 为各周期，
+    MACD 为 [MACD, Signal, Histogram]，KDJ 为 [K, D, J]，BOLL 为 [Upper, Middle, Lower]。
+    首个值尚未就绪的指标不写入。
+    """
+    rows = []
+    for name in indicators:
+        value = values.get(name)
+        if value is None:
+            continue
+        items = list(value[:4]) if isinstance(value, (list, tuple)) else [value]
+        items = [_finite(float(item)) if item is not None else None for item in items]
+        if not items or items[0] is None:
+            continue
+        items += [None] * (4 - len(items))
+        rows.append({
+            'ts_code': ts_code,
+            'datetime': bar_time,
+            'period_type': period_type,
+            'indicator_name': name,
+            'value1': items[0],
+            'value2': items[1],
+            'value3': items[2],
+            'value4': items[3]
+        })
+    return rows
+
+
+class StreamingIndicatorEngine:
+    """流式指标引擎：管理全部 (股票, 周期) 的滚动状态"""
+
+    def __init__(self, state_path: str = None, snapshot_interval: float = 60.0):
+        self.state_path = state_path
+        self.snapshot_interval = snapshot_interval
+        self.states: Dict[Tuple[str, str], IndicatorState] = {}
+        self._lock = threading.RLock()
+        self._last_snapshot = time.monotonic()
+        if state_path:
+            self.restore(state_path)
+
+    def get_state(self, ts_code: str, period_type: str) -> Optional[IndicatorState]:
+        return self.states.get((ts_code, period_type))
+
+    def reset(self, ts_code: str, period_type: str) -> IndicatorState:
+        with self._lock:
+            state = IndicatorState(ts_code, period_type)
+            self.states[(ts_code, period_type)] = state
+            return state
+
+    def update_bar(self, ts_code: str, period_type: str, bar: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """推入一根 K 线（需要 datetime/high/low/close/volume），返回本根 K 线的指标值"""
+        with self._lock:
+            state = self.states.get((ts_code, period_type))
+            if state is None:
+                state = self.reset(ts_code, period_type)
+            return state.update(bar)
+
+    def update_bars(self, ts_code: str, period_type: str,
+                    bars: List[Dict[str, Any]]) -> List[Tuple[datetime, Dict[str, Any]]]:
+        """按时间顺序推入多根 K 线，返回 [(时间, 指标值)]，被忽略的 K 线不在结果中"""
+        results = []
+        with self._lock:
+            for bar in bars:
+                values = self.update_bar(ts_code, period_type, bar)
+                if values is not None:
+                    results.append((bar['datetime'], values))
+        return results
+
+    def snapshot(self, path: str = None) -> Optional[str]:
+        """把全部状态写入快照文件（先写临时文件再替换）"""
+        path = path or self.state_path
+        if not path:
+            return None
+        with self._lock:
+            payload = {'saved_at': datetime.now(), 'states': self.states}
+            data = pickle.dumps(payload, protocol=pickle.HIGHEST_PROTOCOL)
+            self._last_snapshot = time.monotonic()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        logger.info(f"指标状态快照已保存: {len(self.states)} 个序列 -> {path}")
+        return path
+
+    def maybe_snapshot(self, force: bool = False):
+        """距离上次快照超过 snapshot_interval 秒（或 force）时保存快照"""
+        if not self.states:
+            return
+        if self.state_path and (force or time.monotonic() - self._last_snapshot >= self.snapshot_interval):
+            try:
+                self.snapshot()
+            except Exception as e:
+                logger.error(f"保存指标状态快照失败: {e}")
+
+    def restore(self, path: str = None) -> int:
+        """从快照恢复状态，返回恢复的序列数"""
+        path = path or self.state_path
+        if not path or not os.path.exists(path):
+            return 0
+        try:
+            with open(path, 'rb') as f:
+                payload = pickle.load(f)
+            with self._lock:
+                self.states = payload['states']
+                # 快照之后可能还写入过指标，首次使用时需要重新核对数据库中的写入位置
+                for state in self.states.values():
+                    state.stored_until = {}
+                    state.stored_checked = False
+            logger.info(f"指标状态已恢复: {len(self.states)} 个序列, 快照时间 {payload['saved_at']}")
+            return len(self.states)
+        except Exception as e:
+            logger.error(f"恢复指标状态快照失败: {path}, 错误: {e}")
+            return 0
+
+
+_streaming_engine = None
+
+
+def get_streaming_indicator_engine() -> StreamingIndicatorEngine:
+    """获取全局流式指标引擎实例（延迟初始化，启动时从快照恢复）"""
+    global _streaming_engine
+    if _streaming_engine is None:
+        try:
+            from flask import current_app
+            state_path = current_app.config.get('INDICATOR_STATE_PATH', DEFAULT_STATE_PATH)
+        except RuntimeError:
+            state_path = DEFAULT_STATE_PATH
+        _streaming_engine = StreamingIndicatorEngine(state_path)
+        # 进程正常退出时保存一次快照
+        atexit.register(_streaming_engine.maybe_snapshot, force=True)
+    return _streaming_engine
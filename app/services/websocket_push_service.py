@@ -1,50 +1,138 @@
 """
 WebSocket推送服务
-提供定时数据推送和事件触发推送功能
+事件驱动的推送管线：入库流程把新K线发布到行情事件总线，推送线程取走事件后只为
+websocket_events.room_subscriptions 中存在的房间计算增量数据，按房间合并后批量发送。
+
+- 行情、指标、信号按发生变化的股票计算，只推送新增部分；'全部'房间每轮最多计算
+  max_symbols_per_cycle 只，其余在本轮结束时一次性放回总线，按发送间隔在后续轮次处理
+- 监控、组合、风险预警、新闻在有订阅时按各自的最小间隔刷新
+- 每个房间有独立的发送间隔：发送耗时过长的房间（慢客户端）自动降频，未发出的消息
+  在发件箱中与后续消息合并，只保留每个键的最新值
 """
 
 import logging
 import threading
 import time
-from datetime import datetime, timedelta
-from typing import Dict, List, Any, Optional
-import json
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, List, Any, Optional, Tuple
 
-from app.extensions import db
-from app.models.stock_minute_data import StockMinuteData
-from app.models.realtime_indicator import RealtimeIndicator
 from app.models.trading_signal import TradingSignal
 from app.models.risk_alert import RiskAlert
-from app.services.realtime_data_manager import RealtimeDataManager
 from app.services.realtime_indicator_engine import RealtimeIndicatorEngine
-from app.services.realtime_trading_signal_engine import RealtimeTradingSignalEngine
 from app.services.realtime_monitor_service import RealtimeMonitorService
 from app.services.realtime_risk_manager import RealtimeRiskManager
-from app.websocket.websocket_events import (
-    broadcast_market_data, broadcast_indicators, broadcast_signals,
-    broadcast_monitor_data, broadcast_risk_alert, broadcast_portfolio_update,
-    broadcast_news, get_connection_stats
-)
+from app.services.live_bar_cache import get_live_bar_cache
+from app.services.event_bus import get_bar_event_bus
+from app.websocket.websocket_events import room_subscriptions, emit_to_room, get_connection_stats
 
 logger = logging.getLogger(__name__)
 
 
+# 各数据类型对应的客户端事件名
+EVENT_NAMES = {
+    'market_data': 'market_data_update',
+    'indicators': 'indicators_update',
+    'signals': 'signals_update',
+    'monitor': 'monitor_update',
+    'risk_alerts': 'risk_alert',
+    'portfolio': 'portfolio_update',
+    'news': 'news_update'
+}
+
+
+class RoomOutbox:
+    """按房间合并的发件箱
+
+    同一房间内相同键的消息只保留最新一条；每个房间按自己的发送间隔出队，
+    发送耗时超过 slow_threshold 时间隔加倍（不超过 max_interval），发送变快后逐步恢复。
+    """
+
+    def __init__(self, base_interval: float = 1.0, max_interval: float = 30.0,
+                 slow_threshold: float = 0.2, max_keys_per_room: int = 500):
+        self.base_interval = base_interval
+        self.max_interval = max_interval
+        self.slow_threshold = slow_threshold
+        self.max_keys_per_room = max_keys_per_room
+        self._rooms: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0
+        self.dropped = 0
+
+    def put(self, room: str, event: str, key: str, payload: Any):
+        with self._lock:
+            state = self._rooms.get(room)
+            if state is None:
+                state = {'event': event, 'messages': OrderedDict(),
+                         'interval': self.base_interval, 'next_send': 0.0, 'slow': False}
+                self._rooms[room] = state
+            messages = state['messages']
+            if key in messages:
+                self.coalesced += 1
+                messages.pop(key)
+            messages[key] = payload
+            while len(messages) > self.max_keys_per_room:
+                messages.popitem(last=False)
+                self.dropped += 1
+
+    def due(self, now: float) -> List[Tuple[str, str, List[Any]]]:
+        """取出到期房间的待发送消息"""
+        batches = []
+        with self._lock:
+            for room, state in self._rooms.items():
+                if state['messages'] and now >= state['next_send']:
+                    batches.append((room, state['event'], list(state['messages'].values())))
+                    state['messages'].clear()
+        return batches
+
+    def record_send(self, room: str, elapsed: float):
+        """根据发送耗时调整房间的发送间隔"""
+        with self._lock:
+            state = self._rooms.get(room)
+            if state is None:
+                return
+            if elapsed > self.slow_threshold:
+                state['interval'] = min(self.max_interval, state['interval'] * 2)
+                state['slow'] = True
+            else:
+                state['interval'] = max(self.base_interval, state['interval'] / 2)
+                state['slow'] = state['interval'] > self.base_interval
+            state['next_send'] = time.monotonic() + state['interval']
+
+    def discard_unsubscribed(self, active_rooms):
+        """丢弃已经没有订阅者的房间"""
+        with self._lock:
+            for room in [room for room in self._rooms if room not in active_rooms]:
+                del self._rooms[room]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'rooms': len(self._rooms),
+                'pending_messages': sum(len(state['messages']) for state in self._rooms.values()),
+                'slow_rooms': [room for room, state in self._rooms.items() if state['slow']],
+                'coalesced': self.coalesced,
+                'dropped': self.dropped
+            }
+
+
 class WebSocketPushService:
     """WebSocket推送服务"""
-    
+
     def __init__(self):
         """初始化推送服务"""
-        self.data_manager = RealtimeDataManager()
         self.indicator_engine = RealtimeIndicatorEngine()
-        self.signal_engine = RealtimeTradingSignalEngine()
         self.monitor_service = RealtimeMonitorService()
         self.risk_manager = RealtimeRiskManager()
-        
+
         self.is_running = False
         self.push_thread = None
-        self.push_interval = 30  # 推送间隔（秒）
-        
-        # 推送配置
+        self.app = None
+        self.push_interval = 1.0  # 批量发送间隔（秒）
+        self.push_period = '1min'  # 驱动推送的K线周期
+        self.max_symbols_per_cycle = 50  # '全部'房间每轮最多计算的股票数
+
+        # 推送配置：interval 为无K线事件驱动的数据类型的最小刷新间隔
         self.push_config = {
             'market_data': {'enabled': True, 'interval': 30},
             'indicators': {'enabled': True, 'interval': 60},
@@ -54,320 +142,326 @@ class WebSocketPushService:
             'portfolio': {'enabled': True, 'interval': 120},
             'news': {'enabled': False, 'interval': 300}
         }
-        
-        # 缓存上次推送时间
+
+        self.bus = get_bar_event_bus()
+        self.outbox = RoomOutbox(base_interval=self.push_interval)
+
+        # 上次推送时间与增量游标
         self.last_push_times = {}
-    
+        self._last_signal_id = None
+        self._last_alert_id = None
+        self._prices_changed_since = {}
+        self._deferred = set()  # 本轮'全部'房间未处理完、需放回总线的股票
+        self.stats = {'cycles': 0, 'bar_events': 0, 'batches_sent': 0, 'messages_sent': 0}
+
     def start_push_service(self):
         """启动推送服务"""
         if self.is_running:
             logger.warning("推送服务已在运行")
             return
-        
+
+        try:
+            from flask import current_app
+            self.app = current_app._get_current_object()
+        except RuntimeError:
+            self.app = None
+
         self.is_running = True
         self.push_thread = threading.Thread(target=self._push_loop, daemon=True)
         self.push_thread.start()
         logger.info("WebSocket推送服务已启动")
-    
+
     def stop_push_service(self):
         """停止推送服务"""
         self.is_running = False
+        self.bus.notify()
         if self.push_thread:
             self.push_thread.join(timeout=5)
         logger.info("WebSocket推送服务已停止")
-    
+
     def _push_loop(self):
-        """推送循环"""
+        """推送循环：等待K线事件或批量发送间隔到期"""
         while self.is_running:
             try:
-                current_time = datetime.now()
-                
-                # 检查各类数据是否需要推送
-                for data_type, config in self.push_config.items():
-                    if not config['enabled']:
-                        continue
-                    
-                    last_push = self.last_push_times.get(data_type)
-                    if (not last_push or 
-                        (current_time - last_push).total_seconds() >= config['interval']):
-                        
-                        self._push_data_type(data_type)
-                        self.last_push_times[data_type] = current_time
-                
-                # 等待下一次检查
-                time.sleep(10)  # 每10秒检查一次
-                
+                self.bus.wait(self.push_interval)
+                if not self.is_running:
+                    break
+                if self.app is not None:
+                    with self.app.app_context():
+                        self.run_cycle()
+                else:
+                    self.run_cycle()
             except Exception as e:
                 logger.error(f"推送循环错误: {e}")
-                time.sleep(30)  # 出错后等待30秒再继续
-    
-    def _push_data_type(self, data_type: str):
-        """推送指定类型的数据"""
-        try:
-            if data_type == 'market_data':
-                self._push_market_data()
-            elif data_type == 'indicators':
-                self._push_indicators()
-            elif data_type == 'signals':
-                self._push_signals()
-            elif data_type == 'monitor':
-                self._push_monitor_data()
-            elif data_type == 'risk_alerts':
-                self._push_risk_alerts()
-            elif data_type == 'portfolio':
-                self._push_portfolio_updates()
-            elif data_type == 'news':
-                self._push_news()
-                
-        except Exception as e:
-            logger.error(f"推送{data_type}数据失败: {e}")
-    
-    def _push_market_data(self):
-        """推送市场数据"""
-        try:
-            # 获取活跃股票列表
-            active_stocks = self.data_manager.get_active_stocks()
-            
-            for stock in active_stocks[:20]:  # 限制推送数量
-                ts_code = stock['ts_code']
-                
-                # 获取最新数据
-                latest_data = self.data_manager.get_latest_data(ts_code, '1min', 1)
-                if latest_data:
-                    market_data = {
-                        'ts_code': ts_code,
-                        'datetime': latest_data[0]['datetime'],
-                        'open': latest_data[0]['open'],
-                        'high': latest_data[0]['high'],
-                        'low': latest_data[0]['low'],
-                        'close': latest_data[0]['close'],
-                        'volume': latest_data[0]['volume'],
-                        'amount': latest_data[0]['amount'],
-                        'change_pct': self._calculate_change_pct(latest_data[0])
-                    }
-                    
-                    broadcast_market_data(ts_code, market_data)
-                    broadcast_market_data('all', market_data)  # 广播到全局房间
-            
-            logger.debug(f"推送市场数据完成，股票数量: {len(active_stocks)}")
-            
-        except Exception as e:
-            logger.error(f"推送市场数据失败: {e}")
-    
-    def _push_indicators(self):
-        """推送技术指标数据"""
-        try:
-            # 获取最新指标数据
-            latest_indicators = RealtimeIndicator.query.filter(
-                RealtimeIndicator.datetime >= datetime.now() - timedelta(minutes=5)
-            ).limit(50).all()
-            
-            # 按股票分组
-            indicators_by_stock = {}
-            for indicator in latest_indicators:
-                ts_code = indicator.ts_code
-                if ts_code not in indicators_by_stock:
-                    indicators_by_stock[ts_code] = []
-                
-                indicators_by_stock[ts_code].append({
-                    'indicator_name': indicator.indicator_name,
-                    'period_type': indicator.period_type,
-                    'value': indicator.value,
-                    'datetime': indicator.datetime.isoformat()
-                })
-            
-            # 推送指标数据
-            for ts_code, indicators in indicators_by_stock.items():
-                broadcast_indicators(ts_code, indicators)
-                broadcast_indicators('all', {
-                    'ts_code': ts_code,
-                    'indicators': indicators
-                })
-            
-            logger.debug(f"推送技术指标数据完成，股票数量: {len(indicators_by_stock)}")
-            
-        except Exception as e:
-            logger.error(f"推送技术指标数据失败: {e}")
-    
-    def _push_signals(self):
-        """推送交易信号"""
-        try:
-            # 获取最新信号
-            latest_signals = TradingSignal.query.filter(
-                TradingSignal.created_at >= datetime.now() - timedelta(minutes=10),
-                TradingSignal.status == 'active'
-            ).limit(20).all()
-            
-            # 按股票分组
-            signals_by_stock = {}
-            for signal in latest_signals:
-                ts_code = signal.ts_code
-                if ts_code not in signals_by_stock:
-                    signals_by_stock[ts_code] = []
-                
-                signals_by_stock[ts_code].append({
-                    'strategy_name': signal.strategy_name,
-                    'signal_type': signal.signal_type,
-                    'signal_strength': signal.signal_strength,
-                    'confidence': signal.confidence,
-                    'created_at': signal.created_at.isoformat(),
-                    'parameters': signal.parameters
-                })
-            
-            # 推送信号数据
-            for ts_code, signals in signals_by_stock.items():
-                broadcast_signals(ts_code, signals)
-                broadcast_signals('all', {
-                    'ts_code': ts_code,
-                    'signals': signals
-                })
-            
-            logger.debug(f"推送交易信号完成，股票数量: {len(signals_by_stock)}")
-            
-        except Exception as e:
-            logger.error(f"推送交易信号失败: {e}")
-    
-    def _push_monitor_data(self):
-        """推送监控数据"""
-        try:
-            # 获取监控数据
-            monitor_data = {
-                'market_overview': self.monitor_service.get_market_overview(),
-                'top_movers': self.monitor_service.get_top_movers(limit=10),
-                'anomalies': self.monitor_service.detect_anomalies(
-                    change_threshold=5.0, volume_threshold=3.0
-                ),
-                'sentiment': self.monitor_service.calculate_market_sentiment(period_hours=1)
+                time.sleep(self.push_interval)
+
+    def run_cycle(self):
+        """处理一轮事件：计算订阅房间的增量并发送到期的批次"""
+        events = self.bus.drain()
+        bars = {ts_code: bar for (ts_code, period_type), bar in events.items() if period_type == self.push_period}
+        self.stats['cycles'] += 1
+        self.stats['bar_events'] += len(bars)
+
+        rooms = set(room_subscriptions)
+        if bars:
+            for data_type in self._prices_changed_since:
+                self._prices_changed_since[data_type] = True
+
+        if rooms:
+            enabled = {data_type for data_type, config in self.push_config.items() if config['enabled']}
+            if bars:
+                if 'market_data' in enabled:
+                    self._collect_market_data(bars, rooms)
+                if 'indicators' in enabled:
+                    self._collect_indicators(bars, rooms)
+                if 'signals' in enabled:
+                    self._collect_signals(bars, rooms)
+            if 'monitor' in enabled:
+                self._collect_monitor_data(rooms)
+            if 'portfolio' in enabled:
+                self._collect_portfolio_updates(rooms)
+            if 'risk_alerts' in enabled:
+                self._collect_risk_alerts(rooms)
+            if 'news' in enabled:
+                self._collect_news(rooms)
+
+        # 各数据类型推迟的股票合并后放回一次，下一轮按发送间隔处理
+        if self._deferred:
+            self.bus.requeue((ts_code, self.push_period) for ts_code in self._deferred)
+            self._deferred = set()
+
+        self.outbox.discard_unsubscribed(rooms)
+        self._flush()
+
+    # ------------------------------------------------------------------ 增量计算
+
+    def _symbols_for(self, data_type: str, symbols, rooms) -> List[str]:
+        """有订阅者的股票：订阅了'全部'房间时取前 max_symbols_per_cycle 只，其余记入本轮推迟集合"""
+        symbols = list(symbols)
+        if f"{data_type}_all" in rooms:
+            self._deferred.update(symbols[self.max_symbols_per_cycle:])
+            return symbols[:self.max_symbols_per_cycle]
+        return [ts_code for ts_code in symbols if f"{data_type}_{ts_code}" in rooms]
+
+    def _enqueue(self, data_type: str, symbol: str, key: str, payload: Dict[str, Any], rooms):
+        """放入单只股票房间和'全部'房间"""
+        event = EVENT_NAMES[data_type]
+        for room in (f"{data_type}_{symbol}", f"{data_type}_all"):
+            if room in rooms:
+                self.outbox.put(room, event, key, payload)
+
+    def _collect_market_data(self, bars: Dict[str, Dict], rooms):
+        for ts_code in self._symbols_for('market_data', bars, rooms):
+            bar = bars.get(ts_code) or get_live_bar_cache().latest(ts_code, self.push_period, load=False)
+            if not bar:
+                continue
+            market_data = {
+                'ts_code': ts_code,
+                'datetime': bar['datetime'].isoformat() if hasattr(bar['datetime'], 'isoformat') else bar['datetime'],
+                'open': bar['open'],
+                'high': bar['high'],
+                'low': bar['low'],
+                'close': bar['close'],
+                'volume': bar['volume'],
+                'amount': bar['amount'],
+                'change_pct': self._calculate_change_pct(bar)
             }
-            
-            broadcast_monitor_data(monitor_data)
-            logger.debug("推送监控数据完成")
-            
-        except Exception as e:
-            logger.error(f"推送监控数据失败: {e}")
-    
-    def _push_risk_alerts(self):
-        """推送风险预警"""
-        try:
-            # 获取最新风险预警
-            latest_alerts = RiskAlert.query.filter(
-                RiskAlert.created_at >= datetime.now() - timedelta(minutes=10),
-                RiskAlert.status == 'active'
-            ).limit(10).all()
-            
-            for alert in latest_alerts:
-                alert_data = {
-                    'id': alert.id,
-                    'portfolio_id': alert.portfolio_id,
-                    'alert_type': alert.alert_type,
-                    'severity': alert.severity,
-                    'message': alert.message,
-                    'threshold_value': alert.threshold_value,
-                    'current_value': alert.current_value,
-                    'created_at': alert.created_at.isoformat()
-                }
-                
-                broadcast_risk_alert(alert_data)
-            
-            logger.debug(f"推送风险预警完成，预警数量: {len(latest_alerts)}")
-            
-        except Exception as e:
-            logger.error(f"推送风险预警失败: {e}")
-    
-    def _push_portfolio_updates(self):
-        """推送投资组合更新"""
-        try:
-            # 获取活跃投资组合
-            portfolio_ids = ['demo_portfolio']  # 可以从数据库获取
-            
-            for portfolio_id in portfolio_ids:
-                # 获取投资组合指标
-                portfolio_metrics = self.risk_manager.calculate_portfolio_risk(portfolio_id)
-                
-                portfolio_data = {
+            self._enqueue('market_data', ts_code, ts_code, {
+                'symbol': ts_code, 'data': market_data, 'timestamp': datetime.now().isoformat()
+            }, rooms)
+
+    def _collect_indicators(self, bars: Dict[str, Dict], rooms):
+        for ts_code in self._symbols_for('indicators', bars, rooms):
+            # 指标引擎增量计算，只处理上次计算之后的新K线
+            result = self.indicator_engine.calculate_indicators(ts_code, self.push_period)
+            if not result.get('success') or not result.get('new_bars'):
+                continue
+            self._enqueue('indicators', ts_code, ts_code, {
+                'symbol': ts_code, 'indicators': result['data'], 'timestamp': datetime.now().isoformat()
+            }, rooms)
+
+    def _collect_signals(self, bars: Dict[str, Dict], rooms):
+        symbols = self._symbols_for('signals', bars, rooms)
+        if not symbols:
+            return
+        query = TradingSignal.query.filter(
+            TradingSignal.ts_code.in_(symbols),
+            TradingSignal.status == 'ACTIVE'
+        )
+        if self._last_signal_id is not None:
+            query = query.filter(TradingSignal.id > self._last_signal_id)
+        else:
+            # 首次推送只取最近一批，之后按 id 增量读取
+            query = query.filter(TradingSignal.created_at >= datetime.now().replace(second=0, microsecond=0))
+
+        signals_by_stock = {}
+        for signal in query.order_by(TradingSignal.id.asc()).limit(200).all():
+            signals_by_stock.setdefault(signal.ts_code, []).append(signal.to_dict())
+            self._last_signal_id = max(self._last_signal_id or 0, signal.id)
+
+        for ts_code, signals in signals_by_stock.items():
+            self._enqueue('signals', ts_code, f"{ts_code}_{signals[-1]['id']}", {
+                'symbol': ts_code, 'signals': signals, 'timestamp': datetime.now().isoformat()
+            }, rooms)
+
+    def _due(self, data_type: str, event_driven: bool = False) -> bool:
+        """是否到了该数据类型的刷新时间；event_driven 时还要求期间有新K线"""
+        last_push = self.last_push_times.get(data_type)
+        if last_push and (datetime.now() - last_push).total_seconds() < self.push_config[data_type]['interval']:
+            return False
+        if event_driven:
+            changed = self._prices_changed_since.get(data_type, True)
+            if not changed:
+                return False
+            self._prices_changed_since[data_type] = False
+        self.last_push_times[data_type] = datetime.now()
+        return True
+
+    def _collect_monitor_data(self, rooms):
+        if 'monitor_all' not in rooms or not self._due('monitor', event_driven=True):
+            return
+        # 监控数据共用一份市场快照
+        monitor_data = {
+            'market_overview': self.monitor_service.get_monitor_overview(),
+            'anomalies': self.monitor_service.detect_anomalies(
+                change_threshold=5.0, volume_threshold=3.0
+            ),
+            'sentiment': self.monitor_service.get_market_sentiment(period_hours=1)
+        }
+        self.outbox.put('monitor_all', EVENT_NAMES['monitor'], 'monitor', {
+            'data': monitor_data, 'timestamp': datetime.now().isoformat()
+        })
+
+    def _collect_portfolio_updates(self, rooms):
+        portfolio_ids = [room[len('portfolio_'):] for room in rooms if room.startswith('portfolio_')]
+        if not portfolio_ids or not self._due('portfolio', event_driven=True):
+            return
+        for portfolio_id in portfolio_ids:
+            portfolio_metrics = self.risk_manager.calculate_portfolio_risk(portfolio_id)
+            self.outbox.put(f"portfolio_{portfolio_id}", EVENT_NAMES['portfolio'], portfolio_id, {
+                'portfolio_id': portfolio_id,
+                'data': {
                     'portfolio_id': portfolio_id,
                     'metrics': portfolio_metrics,
                     'updated_at': datetime.now().isoformat()
+                },
+                'timestamp': datetime.now().isoformat()
+            })
+
+    def _collect_risk_alerts(self, rooms):
+        if 'risk_alerts_all' not in rooms or not self._due('risk_alerts'):
+            return
+        query = RiskAlert.query.filter(RiskAlert.is_active == True)
+        if self._last_alert_id is not None:
+            query = query.filter(RiskAlert.id > self._last_alert_id)
+        alerts = query.order_by(RiskAlert.id.desc()).limit(10).all()
+        for alert in reversed(alerts):
+            self._last_alert_id = max(self._last_alert_id or 0, alert.id)
+            self.outbox.put('risk_alerts_all', EVENT_NAMES['risk_alerts'], str(alert.id), {
+                'alert': alert.to_dict(), 'timestamp': datetime.now().isoformat()
+            })
+        if self._last_alert_id is None:
+            self._last_alert_id = 0
+
+    def _collect_news(self, rooms):
+        if 'news_all' not in rooms or not self._due('news'):
+            return
+        # 模拟新闻数据（实际应用中可以对接新闻API）
+        news_data = [
+            {
+                'id': f'news_{int(time.time())}',
+                'title': '市场动态更新',
+                'content': '实时市场数据推送正常运行',
+                'source': '系统通知',
+                'published_at': datetime.now().isoformat(),
+                'category': 'system'
+            }
+        ]
+        self.outbox.put('news_all', EVENT_NAMES['news'], 'news', {
+            'news': news_data, 'timestamp': datetime.now().isoformat()
+        })
+
+    # ------------------------------------------------------------------ 发送
+
+    def _flush(self):
+        """发送到期房间的批次：单条消息原样发送，多条合并为一个批次"""
+        for room, event, payloads in self.outbox.due(time.monotonic()):
+            if len(payloads) == 1:
+                message = payloads[0]
+            else:
+                message = {
+                    'symbol': room.rsplit('_', 1)[-1],
+                    'batch': payloads,
+                    'count': len(payloads),
+                    'timestamp': datetime.now().isoformat()
                 }
-                
-                broadcast_portfolio_update(portfolio_id, portfolio_data)
-            
-            logger.debug(f"推送投资组合更新完成，组合数量: {len(portfolio_ids)}")
-            
-        except Exception as e:
-            logger.error(f"推送投资组合更新失败: {e}")
-    
-    def _push_news(self):
-        """推送新闻资讯"""
-        try:
-            # 模拟新闻数据（实际应用中可以对接新闻API）
-            news_data = [
-                {
-                    'id': f'news_{int(time.time())}',
-                    'title': '市场动态更新',
-                    'content': '实时市场数据推送正常运行',
-                    'source': '系统通知',
-                    'published_at': datetime.now().isoformat(),
-                    'category': 'system'
-                }
-            ]
-            
-            broadcast_news(news_data)
-            logger.debug("推送新闻资讯完成")
-            
-        except Exception as e:
-            logger.error(f"推送新闻资讯失败: {e}")
-    
+            started = time.monotonic()
+            try:
+                if emit_to_room(event, message, room):
+                    self.stats['batches_sent'] += 1
+                    self.stats['messages_sent'] += len(payloads)
+            except Exception as e:
+                logger.error(f"推送到房间 {room} 失败: {e}")
+            self.outbox.record_send(room, time.monotonic() - started)
+
     def _calculate_change_pct(self, current_data: Dict) -> float:
         """计算涨跌幅"""
         try:
             # 获取前一个交易日收盘价（简化处理）
             prev_close = current_data.get('open', current_data['close'])
             current_close = current_data['close']
-            
+
             if prev_close and prev_close != 0:
                 return round(((current_close - prev_close) / prev_close) * 100, 2)
             return 0.0
-            
+
         except Exception:
             return 0.0
-    
+
     def trigger_immediate_push(self, data_type: str, data: Any):
-        """触发立即推送"""
+        """触发立即推送（经发件箱合并后由推送线程发送，服务未运行时直接发送）"""
         try:
+            now = datetime.now().isoformat()
             if data_type == 'market_data':
                 symbol = data.get('ts_code', 'unknown')
-                broadcast_market_data(symbol, data)
-                broadcast_market_data('all', data)
-                
+                self._enqueue('market_data', symbol, symbol,
+                              {'symbol': symbol, 'data': data, 'timestamp': now}, set(room_subscriptions))
+
             elif data_type == 'signal':
                 symbol = data.get('ts_code', 'unknown')
-                broadcast_signals(symbol, [data])
-                broadcast_signals('all', {'ts_code': symbol, 'signals': [data]})
-                
+                self._enqueue('signals', symbol, f"{symbol}_{data.get('id', now)}",
+                              {'symbol': symbol, 'signals': [data], 'timestamp': now}, set(room_subscriptions))
+
             elif data_type == 'risk_alert':
-                broadcast_risk_alert(data)
-                
+                room = f"risk_alerts_{data.get('portfolio_id', 'all')}"
+                self.outbox.put(room, EVENT_NAMES['risk_alerts'], str(data.get('id', now)),
+                                {'alert': data, 'timestamp': now})
+
             elif data_type == 'monitor':
-                broadcast_monitor_data(data)
-                
+                self.outbox.put('monitor_all', EVENT_NAMES['monitor'], 'monitor', {'data': data, 'timestamp': now})
+
+            if self.is_running:
+                self.bus.notify()
+            else:
+                self._flush()
+
             logger.debug(f"立即推送{data_type}数据完成")
-            
+
         except Exception as e:
             logger.error(f"立即推送{data_type}数据失败: {e}")
-    
+
     def update_push_config(self, config: Dict[str, Any]):
         """更新推送配置"""
         try:
             for data_type, settings in config.items():
                 if data_type in self.push_config:
                     self.push_config[data_type].update(settings)
-            
+
             logger.info(f"推送配置已更新: {config}")
-            
+
         except Exception as e:
             logger.error(f"更新推送配置失败: {e}")
-    
+
     def get_push_status(self) -> Dict[str, Any]:
         """获取推送状态"""
         return {
@@ -375,12 +469,13 @@ class WebSocketPushService:
             'push_interval': self.push_interval,
             'push_config': self.push_config,
             'last_push_times': {
-                k: v.isoformat() if v else None 
+                k: v.isoformat() if v else None
                 for k, v in self.last_push_times.items()
             },
+            'pipeline': dict(self.stats, bus=self.bus.stats(), outbox=self.outbox.stats()),
             'connection_stats': get_connection_stats()
         }
 
 
 # 全局推送服务实例
-push_service = WebSocketPushService() 
\ No newline at end of file
+push_service = WebSocketPushService()
@@ -58,6 +58,21 @@ class DatabaseUtils:
             logger.error(f"MySQL数据库连接失败: {e}")
             raise e
 
+    @classmethod
+    def executemany_in_chunks(cls, conn, cursor, sql, rows, chunk_size=1000):
+        """
+        分块批量执行写入语句（executemany），每块提交一次
+        :param sql: 带占位符的写入语句，如 INSERT IGNORE ... VALUES (%s, ...)
+        :param rows: 参数元组列表
+        :param chunk_size: 每块的行数
+        :return: 受影响的行数
+        """
+        affected = 0
+        for i in range(0, len(rows), chunk_size):
+            affected += cursor.executemany(sql, rows[i:i + chunk_size]) or 0
+            conn.commit()
+        return affected
+
     @classmethod
     def get_sqlalchemy_engine(cls):
         """
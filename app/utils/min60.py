@@ -2,7 +2,6 @@ import baostock as bs
 import pandas as pd
 from db_utils import DatabaseUtils
 import time
-from datetime import datetime
 
 # 连接到MySQL数据库
 conn, cursor = DatabaseUtils.connect_to_mysql()
@@ -77,41 +76,26 @@ def main():
                 combined_data = pd.concat(data_list, ignore_index=True)
                 # time.sleep(0.05)  # 避免请求过于频繁
 
-                # 插入数据
-                for index, row in combined_data.iterrows():
-                    try:
-                        # 将时间字符串转换为datetime对象
-                        time_str = row['time'][:14]  # 取YYYYMMDDHHMMSS部分
-                        
-                        # 检查时间字符串格式并打印
-                        # print(f"Processing time string: {time_str}")
-                        
-                        # 解析完整的日期时间字符串
-                        year = time_str[:4]
-                        month = time_str[4:6]
-                        day = time_str[6:8]
-                        hour = time_str[8:10]
-                        minute = time_str[10:12]
-                        second = time_str[12:14]
-                        
-                        # 构建datetime字符串
-                        datetime_str = f"{year}-{month}-{day} {hour}:{minute}:{second}"
-                        timestamp = datetime.strptime(datetime_str, '%Y-%m-%d %H:%M:%S')
-                        # print(f"Generated datetime: {timestamp}")
-                        
-                        cursor.execute('''
-                        INSERT IGNORE INTO stock_60min_history (ts_code, timestamp, open, high, low, close, volume, amount)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s);
-                        ''', (row['code'], timestamp, row['open'], row['high'], row['low'], 
-                              row['close'], row['volume'], row['amount']))
-                        
-                    except Exception as e:
-                        print(f"Error processing row: {row}")
-                        print(f"Error details: {e}")
-                        continue
+                # 向量化解析时间（YYYYMMDDHHMMSSsss 取前14位），无法解析的行丢弃
+                combined_data['timestamp'] = pd.to_datetime(combined_data['time'].astype(str).str[:14],
+                                                            format='%Y%m%d%H%M%S', errors='coerce')
+                combined_data = combined_data.dropna(subset=['timestamp'])
+                columns = ['code', 'timestamp', 'open', 'high', 'low', 'close', 'volume', 'amount']
+                rows = [(code, timestamp.to_pydatetime(), *values) for code, timestamp, *values
+                        in combined_data[columns].itertuples(index=False, name=None)]
 
-                # 提交事务
-                conn.commit()
+                # 分块批量插入
+                start = time.time()
+                try:
+                    inserted = DatabaseUtils.executemany_in_chunks(conn, cursor, '''
+                    INSERT IGNORE INTO stock_60min_history (ts_code, timestamp, open, high, low, close, volume, amount)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s);
+                    ''', rows)
+                    elapsed = max(time.time() - start, 1e-6)
+                    print(f"写入 {len(rows)} 行（新增 {inserted}），{len(rows) / elapsed:.0f} 行/秒")
+                except Exception as e:
+                    conn.rollback()
+                    print(f"批量写入失败: {e}")
 
                 # 清空当前批次的数据列表，为下一个批次做准备
                 data_list.clear()
@@ -250,6 +250,15 @@ def broadcast_news(news):
             'timestamp': datetime.now().isoformat()
         }, room=room_name)
 
+def emit_to_room(event, data, room):
+    """向房间发送一条消息，房间无人订阅或 SocketIO 不可用时返回 False"""
+    if not SOCKETIO_AVAILABLE or socketio is None:
+        return False
+    if room not in room_subscriptions:
+        return False
+    socketio.emit(event, data, room=room)
+    return True
+
 # 获取连接统计信息
 def get_connection_stats():
     """获取连接统计信息"""
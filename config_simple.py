@@ -74,6 +74,53 @@ class Config:
     REALTIME_UPDATE_INTERVAL = 5  # 秒
     REALTIME_CACHE_TTL = 60  # 秒
     
+    # 列式面板存储配置
+    PANEL_STORE_PATH = 'data/panel_store'
+    
+    # 后台任务队列配置
+    JOB_STORE_PATH = 'data/jobs.db'
+    JOB_MAX_WORKERS = 2
+    JOB_MAX_PENDING = 20
+    
+    # 模型存储与缓存配置
+    MODEL_DIR = 'models'
+    MODEL_CACHE_MAX_MB = 512
+    
+    # 流式技术指标状态快照
+    INDICATOR_STATE_PATH = 'data/indicator_state.pkl'
+    
+    # 实时监控市场快照缓存时间（秒）
+    MONITOR_SNAPSHOT_TTL = 5
+    
+    # 实时K线缓存：每个序列保留的K线数与总内存上限
+    LIVE_BAR_CAPACITY = 240
+    LIVE_BAR_CACHE_MAX_MB = 128
+    
+    # 分钟数据批量同步：请求速率（次/秒）、抓取线程数、写库批大小与断点续传进度文件
+    MINUTE_SYNC_RATE_LIMIT = 10
+    MINUTE_SYNC_WORKERS = 4
+    MINUTE_SYNC_CHUNK_SIZE = 1000
+    MINUTE_SYNC_PROGRESS_PATH = 'data/minute_sync_progress.json'
+    
+    # 结构化因子风险模型：持久化目录、回看交易日数、指数加权半衰期与风格因子（逗号分隔，空为全部）
+    RISK_MODEL_DIR = 'data/risk_models'
+    RISK_MODEL_LOOKBACK_DAYS = 252
+    RISK_MODEL_HALF_LIFE = 90
+    RISK_MODEL_FACTORS = ''
+    
+    # 情景分析 VaR：蒙特卡洛情景数、分块大小与过滤历史模拟的 EWMA 衰减系数
+    VAR_MC_SCENARIOS = 100000
+    VAR_MC_CHUNK_SIZE = 20000
+    VAR_EWMA_DECAY = 0.94
+    
+    # 组合收益率矩阵缓存有效期（秒），持仓变化时立即失效
+    PORTFOLIO_RETURNS_TTL = 300
+    
+    # 盘中增量风险：驱动更新的K线周期、历史情景回看天数、增量更新多少次后全量重算
+    INCREMENTAL_RISK_BAR_PERIOD = '1min'
+    INCREMENTAL_RISK_LOOKBACK_DAYS = 252
+    INCREMENTAL_RISK_RESYNC_INTERVAL = 500
+    
     # 回测配置
     BACKTEST_MAX_STOCKS = 50
     BACKTEST_MAX_DAYS = 1000
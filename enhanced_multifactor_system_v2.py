@@ -13,7 +13,7 @@
 
 import pandas as pd
 import numpy as np
-from datetime import datetime, timedelta
+from datetime import datetime
 import warnings
 import json
 import os
@@ -44,6 +44,7 @@ from app.models import (
     StockCyqPerf, FactorDefinition, FactorValues, MLModelDefinition, 
     MLPredictions, StockBasic
 )
+from app.services.factor_backfill import FactorBackfillEngine
 
 class EnhancedMultifactorSystemV2:
     """增强多因子模型系统 V2.0"""
@@ -204,19 +205,22 @@ class EnhancedMultifactorSystemV2:
             print("🔢 计算历史因子数据...")
             
             # 获取可用的交易日期
-            dates_query = db.session.query(StockDailyHistory.trade_date).distinct().order_by(StockDailyHistory.trade_date.desc()).limit(60)
+            dates_query = db.session.query(StockDailyHistory.trade_date).distinct().order_by(StockDailyHistory.trade_date.desc()).limit(30)
             available_dates = [row[0] for row in dates_query.all()]
             
             if not available_dates:
                 print("⚠️  没有找到历史价格数据，使用现有因子数据")
                 return
             
-            print(f"   📅 找到 {len(available_dates)} 个交易日")
-            print(f"   📅 日期范围: {min(available_dates)} 至 {max(available_dates)}")
+            start_date, end_date = min(available_dates), max(available_dates)
+            print(f"   📅 日期范围: {start_date} 至 {end_date}")
             
-            # 批量计算因子
-            for trade_date in available_dates[-30:]:  # 计算最近30个交易日
-                self._calculate_factors_for_date(trade_date)
+            # 按 (日期块 × 因子) 并行批量计算最近30个交易日
+            summary = FactorBackfillEngine().run(
+                start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'),
+                factor_ids=[f for f in self.builtin_factors if f in FactorBackfillEngine.default_factor_ids()]
+            )
+            print(f"   📊 计算了 {summary['rows']} 个因子值, 耗时 {summary['seconds']}s")
             
             print("✅ 历史因子数据计算完成")
             
@@ -224,113 +228,6 @@ class EnhancedMultifactorSystemV2:
             print(f"⚠️  历史因子计算失败: {e}")
             print("   继续使用现有因子数据...")
     
-    def _calculate_factors_for_date(self, trade_date):
-        """计算指定日期的因子数据"""
-        try:
-            # 获取该日期的股票数据
-            stocks_data = db.session.query(StockDailyHistory).filter_by(trade_date=trade_date).all()
-            
-            if not stocks_data:
-                return
-            
-            calculated_count = 0
-            for stock in stocks_data:
-                ts_code = stock.ts_code
-                
-                # 计算技术因子
-                factors = self._calculate_technical_factors(ts_code, trade_date)
-                
-                # 保存因子值
-                for factor_id, factor_value in factors.items():
-                    if factor_value is not None and not np.isnan(factor_value):
-                        existing = FactorValues.query.filter_by(
-                            ts_code=ts_code,
-                            trade_date=trade_date,
-                            factor_id=factor_id
-                        ).first()
-                        
-                        if not existing:
-                            factor_val = FactorValues(
-                                ts_code=ts_code,
-                                trade_date=trade_date,
-                                factor_id=factor_id,
-                                factor_value=float(factor_value)
-                            )
-                            db.session.add(factor_val)
-                            calculated_count += 1
-            
-            if calculated_count > 0:
-                db.session.commit()
-                print(f"   📊 {trade_date}: 计算了 {calculated_count} 个因子值")
-            
-        except Exception as e:
-            db.session.rollback()
-            print(f"   ❌ {trade_date}: 计算失败 - {e}")
-    
-    def _calculate_technical_factors(self, ts_code: str, trade_date) -> Dict[str, float]:
-        """计算技术因子"""
-        factors = {}
-        
-        try:
-            # 获取历史数据（最近30天）
-            end_date = trade_date
-            start_date = end_date - timedelta(days=60)
-            
-            hist_data = db.session.query(StockDailyHistory).filter(
-                StockDailyHistory.ts_code == ts_code,
-                StockDailyHistory.trade_date >= start_date,
-                StockDailyHistory.trade_date <= end_date
-            ).order_by(StockDailyHistory.trade_date).all()
-            
-            if len(hist_data) < 20:
-                return factors
-            
-            # 转换为DataFrame
-            df = pd.DataFrame([{
-                'trade_date': row.trade_date,
-                'close': float(row.close),
-                'volume': float(row.vol) if row.vol else 0,
-                'pct_change': float(row.pct_chg) if row.pct_chg else 0
-            } for row in hist_data])
-            
-            df = df.sort_values('trade_date').reset_index(drop=True)
-            
-            if len(df) < 20:
-                return factors
-            
-            # 计算各种因子
-            current_idx = len(df) - 1
-            
-            # 动量因子
-            if current_idx >= 5:
-                factors['momentum_5d'] = (df.iloc[current_idx]['close'] - df.iloc[current_idx-5]['close']) / df.iloc[current_idx-5]['close']
-            
-            if current_idx >= 20:
-                factors['momentum_20d'] = (df.iloc[current_idx]['close'] - df.iloc[current_idx-20]['close']) / df.iloc[current_idx-20]['close']
-            
-            # 波动率因子
-            if len(df) >= 20:
-                returns = df['pct_change'].iloc[-20:] / 100.0
-                factors['volatility_20d'] = returns.std()
-            
-            # 量比因子
-            if len(df) >= 20:
-                current_volume = df.iloc[current_idx]['volume']
-                avg_volume = df['volume'].iloc[-20:].mean()
-                if avg_volume > 0:
-                    factors['volume_ratio_20d'] = current_volume / avg_volume
-            
-            # 价格相对均线
-            if len(df) >= 20:
-                current_price = df.iloc[current_idx]['close']
-                ma20 = df['close'].iloc[-20:].mean()
-                factors['price_to_ma20'] = (current_price / ma20) - 1
-            
-        except Exception as e:
-            print(f"   ⚠️  {ts_code} 技术因子计算失败: {e}")
-        
-        return factors
-    
     def _create_and_train_models(self):
         """创建和训练模型"""
         try:
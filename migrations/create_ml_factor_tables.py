@@ -5,7 +5,7 @@
 from app import create_app
 from app.extensions import db
 from app.models import (
-    FactorDefinition, FactorValues, MLModelDefinition, MLPredictions,
+    FactorDefinition, FactorValues, FactorWatermark, MLModelDefinition, MLPredictions,
     StockIncomeStatement, StockBalanceSheet
 )
 
@@ -22,6 +22,9 @@ def create_tables():
             print("创建因子值表...")
             FactorValues.__table__.create(db.engine, checkfirst=True)
             
+            print("创建因子水位表...")
+            FactorWatermark.__table__.create(db.engine, checkfirst=True)
+            
             # 创建机器学习相关表
             print("创建ML模型定义表...")
             MLModelDefinition.__table__.create(db.engine, checkfirst=True)
@@ -54,6 +57,9 @@ def drop_tables():
             print("删除因子值表...")
             FactorValues.__table__.drop(db.engine, checkfirst=True)
             
+            print("删除因子水位表...")
+            FactorWatermark.__table__.drop(db.engine, checkfirst=True)
+            
             print("删除ML模型定义表...")
             MLModelDefinition.__table__.drop(db.engine, checkfirst=True)
             
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+因子计算内核基准测试
+对比逐只股票循环实现与面板化向量内核的耗时，并校验两者结果一致
+用法: python scripts/benchmark_factor_kernels.py --stocks 5000 --days 260
+"""
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+# 添加项目根目录到路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.services import factor_kernels
+
+
+def make_synthetic_data(n_stocks: int, n_days: int, seed: int = 42):
+    """生成模拟日线和资金流向数据"""
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range('2023-01-02', periods=n_days)
+    codes = [f'{i:06d}.SZ' for i in range(n_stocks)]
+
+    returns = rng.normal(0, 0.02, size=(n_days, n_stocks))
+    close = 10 * np.exp(np.cumsum(returns, axis=0))
+    vol = rng.integers(1_000, 100_000, size=(n_days, n_stocks))
+
+    index = pd.MultiIndex.from_product([dates, codes], names=['trade_date', 'ts_code'])
+    history = pd.DataFrame({
+        'close': close.ravel(),
+        'vol': vol.ravel()
+    }, index=index).reset_index()
+
+    moneyflow = pd.DataFrame(index=index).reset_index()
+    for field in factor_kernels.MONEYFLOW_FIELDS:
+        moneyflow[field] = rng.uniform(100, 10_000, size=len(moneyflow))
+    moneyflow['net_mf_amount'] = rng.normal(0, 1_000, size=len(moneyflow))
+
+    return history.sort_values(['ts_code', 'trade_date'], ignore_index=True), \
+        moneyflow.sort_values(['ts_code', 'trade_date'], ignore_index=True)
+
+
+# ==================== 原逐只股票循环实现（对照组） ====================
+
+def loop_history_factor(history: pd.DataFrame, factor_id: str) -> pd.DataFrame:
+    df = history.copy()
+    df['trade_date'] = pd.to_datetime(df['trade_date'])
+
+    result_list = []
+    for ts_code in df['ts_code'].unique():
+        stock_data = df[df['ts_code'] == ts_code].sort_values('trade_date')
+        if factor_id.startswith('momentum_'):
+            period = int(factor_id.split('_')[1].replace('d', ''))
+            value = stock_data['close'].pct_change(period)
+        elif factor_id.startswith('volatility_'):
+            period = int(factor_id.split('_')[1].replace('d', ''))
+            value = stock_data['close'].pct_change().rolling(period).std()
+        elif factor_id.startswith('volume_ratio_'):
+            period = int(factor_id.split('_')[2].replace('d', ''))
+            value = stock_data['vol'] / stock_data['vol'].rolling(period).mean()
+        else:
+            period = int(factor_id.split('ma')[1])
+            value = stock_data['close'] / stock_data['close'].rolling(period).mean() - 1
+        stock_data = stock_data.assign(factor_value=value)
+        result_list.append(stock_data[['ts_code', 'trade_date', 'factor_value']])
+
+    result = pd.concat(result_list, ignore_index=True)
+    result['factor_id'] = factor_id
+    return result[factor_kernels.FACTOR_COLUMNS].dropna()
+
+
+def loop_money_flow_momentum(moneyflow: pd.DataFrame, factor_id: str) -> pd.DataFrame:
+    df = moneyflow.copy()
+    df['trade_date'] = pd.to_datetime(df['trade_date'])
+
+    result_list = []
+    for ts_code in df['ts_code'].unique():
+        stock_data = df[df['ts_code'] == ts_code].sort_values('trade_date')
+        stock_data = stock_data.assign(factor_value=stock_data['net_mf_amount'].rolling(5).sum())
+        result_list.append(stock_data[['ts_code', 'trade_date', 'factor_value']])
+
+    result = pd.concat(result_list, ignore_index=True)
+    result['factor_id'] = factor_id
+    return result[factor_kernels.FACTOR_COLUMNS].dropna()
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def compare(loop_result: pd.DataFrame, kernel_result: pd.DataFrame) -> float:
+    """返回两种实现因子值的最大绝对误差"""
+    merged = loop_result.merge(kernel_result, on=['ts_code', 'trade_date', 'factor_id'],
+                               suffixes=('_loop', '_kernel'), how='outer')
+    if merged[['factor_value_loop', 'factor_value_kernel']].isna().any().any():
+        return float('inf')
+    return float((merged['factor_value_loop'] - merged['factor_value_kernel']).abs().max())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='因子计算内核基准测试')
+    parser.add_argument('--stocks', type=int, default=1000, help='股票数量')
+    parser.add_argument('--days', type=int, default=260, help='交易日数量')
+    args = parser.parse_args()
+
+    history, moneyflow = make_synthetic_data(args.stocks, args.days)
+    print(f"📊 模拟数据: {args.stocks} 只股票 × {args.days} 个交易日 = {len(history)} 行")
+    print(f"{'因子':<22}{'循环(s)':>10}{'向量(s)':>10}{'加速比':>10}{'最大误差':>12}")
+
+    cases = [(factor_id, history, loop_history_factor, factor_kernels.compute_panel_factor)
+             for factor_id in ['momentum_1d', 'momentum_5d', 'momentum_20d',
+                               'volatility_20d', 'volume_ratio_20d', 'price_to_ma20']]
+    cases.append(('money_flow_momentum', moneyflow, loop_money_flow_momentum,
+                  factor_kernels.compute_panel_factor))
+
+    total_loop = total_kernel = 0.0
+    for factor_id, data, loop_func, kernel_func in cases:
+        loop_result, loop_time = timed(loop_func, data, factor_id)
+        kernel_result, kernel_time = timed(kernel_func, data, factor_id)
+        total_loop += loop_time
+        total_kernel += kernel_time
+        error = compare(loop_result, kernel_result)
+        print(f"{factor_id:<22}{loop_time:>10.3f}{kernel_time:>10.3f}"
+              f"{loop_time / kernel_time:>9.1f}x{error:>12.2e}")
+
+    print(f"{'合计':<22}{total_loop:>10.3f}{total_kernel:>10.3f}{total_loop / total_kernel:>9.1f}x")
+
+
+if __name__ == '__main__':
+    main()
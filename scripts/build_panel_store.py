@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+列式面板存储维护脚本
+build:  从数据库全量构建日线行情、每日指标、复权因子面板
+append: 追加存储最新交易日之后的数据（建议在每日数据同步完成后运行）
+status: 查看各表存储的交易日范围和新鲜度
+用法:
+    python scripts/build_panel_store.py build [--tables history basic]
+    python scripts/build_panel_store.py append
+    python scripts/build_panel_store.py status
+"""
+
+import os
+import sys
+import argparse
+
+# 添加项目根目录到路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app
+from app.services.panel_store import PanelStore, TABLE_SPECS
+
+
+def main():
+    parser = argparse.ArgumentParser(description='列式面板存储维护')
+    parser.add_argument('mode', choices=['build', 'append', 'status'], help='运行模式')
+    parser.add_argument('--tables', nargs='*', choices=list(TABLE_SPECS), help='处理的表，默认全部')
+    parser.add_argument('--root', help='存储目录，默认使用配置 PANEL_STORE_PATH')
+    parser.add_argument('--chunk-days', type=int, default=250, help='构建时每次读取的交易日数')
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        store = PanelStore(root=args.root)
+        tables = args.tables or list(TABLE_SPECS)
+
+        if args.mode == 'build':
+            summary = store.build(tables, chunk_days=args.chunk_days)
+            for table, stats in summary.items():
+                print(f"✅ {table}: {stats['dates']} 个交易日 × {stats['codes']} 只股票, 耗时 {stats['seconds']}s")
+        elif args.mode == 'append':
+            summary = store.append(tables)
+            for table, stats in summary.items():
+                if 'appended_dates' in stats:
+                    print(f"✅ {table}: 追加 {stats['appended_dates']} 个交易日")
+                else:
+                    print(f"✅ {table}: 重建 {stats['dates']} 个交易日 × {stats['codes']} 只股票")
+        else:
+            for table in tables:
+                last = store.last_date(table)
+                if last is None:
+                    print(f"⚪ {table}: 未构建")
+                else:
+                    state = '最新' if store.is_fresh(table) else '已过期'
+                    print(f"{'✅' if state == '最新' else '⚠️ '} {table}: 最新交易日 {last:%Y-%m-%d} ({state})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+因子日常更新脚本
+incremental: 按因子水位增量计算新交易日的因子值
+backfill:    补齐指定日期区间内缺失的因子值
+batch:       多进程并行重算指定日期区间的因子值，支持断点续跑
+用法:
+    python scripts/update_factors.py incremental [--trade-date 2024-06-14]
+    python scripts/update_factors.py backfill --start 2024-01-01 --end 2024-06-14
+    python scripts/update_factors.py batch --start 2020-01-01 --end 2024-06-14 --workers 8
+"""
+
+import os
+import sys
+import argparse
+
+# 添加项目根目录到路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app
+from app.services.factor_incremental import IncrementalFactorEngine
+from app.services.factor_backfill import FactorBackfillEngine, DEFAULT_CHUNK_DAYS, DEFAULT_CHECKPOINT_PATH
+
+DEFAULT_STATE_PATH = 'data/factor_incremental_state.pkl'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='因子增量计算与缺口回补')
+    parser.add_argument('mode', choices=['incremental', 'backfill', 'batch'], help='运行模式')
+    parser.add_argument('--trade-date', help='增量计算截止日期，默认最新交易日')
+    parser.add_argument('--start', help='回补开始日期')
+    parser.add_argument('--end', help='回补结束日期')
+    parser.add_argument('--factors', nargs='*', help='回补的因子ID，默认全部内置因子')
+    parser.add_argument('--state', default=DEFAULT_STATE_PATH, help='滚动状态快照文件')
+    parser.add_argument('--workers', type=int, help='batch 模式的工作进程数')
+    parser.add_argument('--chunk-days', type=int, default=DEFAULT_CHUNK_DAYS, help='batch 模式每个任务的交易日数')
+    parser.add_argument('--checkpoint', default=DEFAULT_CHECKPOINT_PATH, help='batch 模式的检查点文件')
+    args = parser.parse_args()
+
+    if args.mode in ('backfill', 'batch') and (not args.start or not args.end):
+        parser.error(f'{args.mode} 模式需要 --start 和 --end')
+
+    app = create_app()
+    with app.app_context():
+        if args.mode == 'batch':
+            engine = FactorBackfillEngine(max_workers=args.workers, chunk_days=args.chunk_days,
+                                          checkpoint_path=args.checkpoint)
+            summary = engine.run(args.start, args.end, factor_ids=args.factors)
+            print(f"✅ 批量回补完成: {summary['completed']}/{summary['tasks'] - summary['skipped']} 个任务, "
+                  f"{summary['rows']} 条, 耗时 {summary['seconds']}s, "
+                  f"写入 {summary['writer']['rows_per_second']} 条/秒")
+            if summary['failed']:
+                print(f"⚠️  {len(summary['failed'])} 个任务失败，重新运行将从检查点继续")
+            return
+
+        engine = IncrementalFactorEngine(state_path=args.state)
+
+        if args.mode == 'incremental':
+            result = engine.update(args.trade_date)
+            if result.empty:
+                print("✅ 因子已是最新，无需计算")
+            else:
+                print(f"✅ 增量计算完成: {len(result)} 条, "
+                      f"日期 {result['trade_date'].min():%Y-%m-%d} ~ {result['trade_date'].max():%Y-%m-%d}")
+        else:
+            stats = engine.backfill(args.start, args.end, factor_ids=args.factors)
+            print(f"✅ 回补完成: {stats['filled_rows']} 条")
+            for factor_id, days in stats['factors'].items():
+                print(f"   {factor_id}: {days} 个交易日")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+在线K线聚合器测试脚本
+逐根消费 1 分钟K线，与原 RealtimeDataManager.aggregate_data 的 pandas resample 聚合结果逐根对比
+"""
+
+import sys
+import os
+
+import numpy as np
+import pandas as pd
+
+# 添加项目根目录到Python路径
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from app.services.bar_aggregator import BarAggregator, TARGET_PERIODS, session_offset, offset_to_time
+
+RTOL = 1e-12
+FIELDS = ['open', 'high', 'low', 'close', 'volume', 'amount', 'pre_close', 'change', 'pct_chg']
+
+
+def make_minutes(days: int = 3, seed: int = 0) -> pd.DataFrame:
+    """生成若干交易日的 1 分钟K线（按起始时间标记，9:30-11:29、13:00-14:59）"""
+    rng = np.random.default_rng(seed)
+    stamps = []
+    for day in pd.bdate_range('2024-03-04', periods=days):
+        stamps.extend(pd.date_range(day + pd.Timedelta('9h30min'), periods=120, freq='min'))
+        stamps.extend(pd.date_range(day + pd.Timedelta('13h'), periods=120, freq='min'))
+    n = len(stamps)
+    close = 12.3 * np.cumprod(1 + rng.normal(0, 0.002, n))
+    open_ = np.concatenate([[close[0]], close[:-1]])
+    return pd.DataFrame({
+        'ts_code': '000001.SZ',
+        'datetime': stamps,
+        'open': open_,
+        'high': np.maximum(open_, close) * (1 + rng.uniform(0, 0.002, n)),
+        'low': np.minimum(open_, close) * (1 - rng.uniform(0, 0.002, n)),
+        'close': close,
+        'volume': rng.integers(100, 10000, n),
+        'amount': rng.uniform(1e4, 1e6, n)
+    })
+
+
+def baseline(df: pd.DataFrame, freq: str) -> pd.DataFrame:
+    """原实现：按自然时间 resample 后 dropna，前收盘价取上一根收盘价"""
+    agg_data = df.set_index('datetime').resample(freq).agg({
+        'open': 'first',
+        'high': 'max',
+        'low': 'min',
+        'close': 'last',
+        'volume': 'sum',
+        'amount': 'sum'
+    }).dropna()
+    agg_data['pre_close'] = agg_data['close'].shift(1).fillna(agg_data['open'])
+    agg_data['change'] = agg_data['close'] - agg_data['pre_close']
+    agg_data['pct_chg'] = (agg_data['change'] / agg_data['pre_close'] * 100).fillna(0)
+    return agg_data
+
+
+def session_baseline(df: pd.DataFrame, minutes: int) -> pd.DataFrame:
+    """在交易分钟时间轴上运行原实现：午休被压缩掉，区间按交易分钟序号切分"""
+    stamps = pd.to_datetime(df['datetime'])
+    offsets = [session_offset(moment) for moment in stamps.dt.to_pydatetime()]
+    session = df.assign(datetime=stamps.dt.normalize() + pd.to_timedelta(offsets, unit='min'))
+    result = baseline(session, f'{minutes}min')
+    result.index = [offset_to_time(moment, (moment.hour * 60 + moment.minute))
+                    for moment in result.index.to_pydatetime()]
+    return result
+
+
+def aggregate(df: pd.DataFrame, chunk: int = 0) -> pd.DataFrame:
+    """在线聚合；chunk > 0 时按实时同步的方式分批喂入"""
+    aggregator = BarAggregator()
+    records = df.to_dict('records')
+    bars = []
+    step = chunk or len(records)
+    for start in range(0, len(records), step):
+        bars.extend(aggregator.consume(records[start:start + step]))
+    bars.extend(aggregator.flush())
+    return pd.DataFrame(bars)
+
+
+def relative_error(expected: pd.DataFrame, actual: pd.DataFrame) -> float:
+    """成交额等字段量级较大，求和顺序不同带来的舍入误差按相对误差衡量"""
+    expected = expected.to_numpy(dtype=float)
+    actual = actual.to_numpy(dtype=float)
+    return float((np.abs(expected - actual) / np.maximum(np.abs(expected), 1.0)).max())
+
+
+def compare(name: str, expected: pd.DataFrame, actual: pd.DataFrame) -> bool:
+    actual = actual.set_index('datetime').sort_index()
+    same_index = list(expected.index) == list(actual.index)
+    diff = relative_error(expected[FIELDS], actual[FIELDS]) if same_index else float('nan')
+    ok = same_index and diff <= RTOL
+    status = "✅" if ok else "❌"
+    print(f"   {status} {name}: {len(expected)}/{len(actual)} 根, 最大相对误差 {diff:.2e}")
+    return ok
+
+
+def test_clock_aligned_periods():
+    """测试 5/15/30 分钟：交易时段与自然时间对齐，应与原实现完全一致"""
+    print("\n🧪 测试 5/15/30 分钟聚合与原 resample 实现一致...")
+    df = make_minutes()
+    bars = aggregate(df)
+    results = [compare(period, baseline(df, period), bars[bars['period_type'] == period])
+               for period in ('5min', '15min', '30min')]
+    return all(results)
+
+
+def test_session_aligned_periods():
+    """测试全部周期：与交易分钟时间轴上的 resample 一致，60 分钟K线每天四根"""
+    print("\n🧪 测试按交易时段对齐的聚合...")
+    df = make_minutes()
+    bars = aggregate(df)
+    results = [compare(period, session_baseline(df, minutes), bars[bars['period_type'] == period])
+               for period, minutes in TARGET_PERIODS.items()]
+
+    hourly = bars[bars['period_type'] == '60min']
+    starts = sorted({moment.strftime('%H:%M') for moment in hourly['datetime']})
+    ok = starts == ['09:30', '10:30', '13:00', '14:00'] and len(hourly) == 4 * 3
+    status = "✅" if ok else "❌"
+    print(f"   {status} 60min 起始时间: {starts}")
+    return all(results) and ok
+
+
+def test_incremental_feed():
+    """测试分批喂入与一次性回放结果一致，迟到数据被丢弃"""
+    print("\n🧪 测试分批喂入与迟到数据...")
+    df = make_minutes(days=2, seed=1)
+    whole = aggregate(df).sort_values(['period_type', 'datetime'], ignore_index=True)
+    chunked = aggregate(df, chunk=7).sort_values(['period_type', 'datetime'], ignore_index=True)
+    same = whole['datetime'].equals(chunked['datetime']) and \
+        relative_error(whole[FIELDS], chunked[FIELDS]) <= RTOL
+    status = "✅" if same else "❌"
+    print(f"   {status} 分批喂入 {len(chunked)} 根, 一次回放 {len(whole)} 根")
+
+    aggregator = BarAggregator(['5min'])
+    records = df.to_dict('records')
+    emitted = aggregator.consume(records[:12])
+    aggregator.consume([records[3]])
+    late_ok = len(emitted) == 2 and aggregator.stats()['late_bars'] == 1
+    status = "✅" if late_ok else "❌"
+    print(f"   {status} 迟到数据计数: {aggregator.stats()['late_bars']}")
+    return bool(same) and late_ok
+
+
+def main():
+    """主测试函数"""
+    print("🚀 开始在线K线聚合器测试")
+    print("=" * 50)
+
+    test_results = [test_clock_aligned_periods(), test_session_aligned_periods(), test_incremental_feed()]
+    passed = sum(test_results)
+    total = len(test_results)
+    print(f"\n🎯 总体结果: {passed}/{total} 项测试通过")
+    return passed == total
+
+
+if __name__ == '__main__':
+    success = main()
+    sys.exit(0 if success else 1)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+面板因子内核测试脚本
+对比 factor_kernels 的 日期 × 股票 面板实现与原逐只股票循环实现的计算结果
+"""
+
+import sys
+import os
+
+import numpy as np
+import pandas as pd
+
+# 添加项目根目录到Python路径
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from app.services.factor_kernels import compute_panel_factor, MONEYFLOW_FIELDS, CYQ_FIELDS
+
+TOLERANCE = 1e-10
+
+
+def make_history(n_stocks: int = 30, n_days: int = 120, seed: int = 0) -> pd.DataFrame:
+    """生成日线长表，部分股票上市较晚（前段无数据），部分股票中途停牌数日"""
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range('2024-01-02', periods=n_days)
+    rows = []
+    for i in range(n_stocks):
+        start = rng.integers(0, 40) if i % 3 == 0 else 0
+        close = 10 * np.cumprod(1 + rng.normal(0, 0.02, n_days))
+        vol = rng.uniform(1e4, 1e6, n_days)
+        suspended = set(range(60, 65)) if i % 4 == 1 else set()
+        for t in range(start, n_days):
+            if t in suspended:
+                continue
+            rows.append({'ts_code': f'{i:06d}.SZ', 'trade_date': dates[t], 'close': close[t], 'vol': vol[t]})
+    return pd.DataFrame(rows).sample(frac=1.0, random_state=seed)
+
+
+def make_fields(fields, n_stocks: int = 20, n_days: int = 60, seed: int = 1) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range('2024-01-02', periods=n_days)
+    frame = pd.DataFrame([(f'{i:06d}.SH', d) for i in range(n_stocks) for d in dates],
+                         columns=['ts_code', 'trade_date'])
+    for field in fields:
+        frame[field] = rng.uniform(1.0, 100.0, len(frame))
+    return frame
+
+
+def baseline(df: pd.DataFrame, factor_id: str, compute) -> pd.DataFrame:
+    """原实现：逐只股票按日期排序后计算，最后 dropna"""
+    df = df.copy()
+    df['trade_date'] = pd.to_datetime(df['trade_date'])
+    result_list = []
+    for ts_code in df['ts_code'].unique():
+        stock_data = df[df['ts_code'] == ts_code].sort_values('trade_date').copy()
+        stock_data['factor_value'] = compute(stock_data)
+        result_list.append(stock_data[['ts_code', 'trade_date', 'factor_value']])
+    result = pd.concat(result_list, ignore_index=True)
+    result['factor_id'] = factor_id
+    return result[['ts_code', 'trade_date', 'factor_id', 'factor_value']].dropna()
+
+
+def compare(name: str, expected: pd.DataFrame, actual: pd.DataFrame) -> bool:
+    keys = ['ts_code', 'trade_date']
+    expected = expected.sort_values(keys, ignore_index=True)
+    actual = actual.sort_values(keys, ignore_index=True)
+    actual['trade_date'] = pd.to_datetime(actual['trade_date'])
+    merged = expected.merge(actual, on=keys, how='outer', suffixes=('_base', '_panel'), indicator=True)
+    missing = int((merged['_merge'] != 'both').sum())
+    diff = float((merged['factor_value_base'] - merged['factor_value_panel']).abs().max())
+    ok = missing == 0 and diff <= TOLERANCE
+    status = "✅" if ok else "❌"
+    print(f"   {status} {name}: {len(expected)} 行, 行差异 {missing}, 最大误差 {diff:.2e}")
+    return ok
+
+
+def test_history_factors():
+    """测试价格/成交量类面板因子"""
+    print("\n🧪 测试价格/成交量类面板因子...")
+    df = make_history()
+    cases = {
+        'momentum_1d': lambda s: s['close'].pct_change(1),
+        'momentum_5d': lambda s: s['close'].pct_change(5),
+        'momentum_20d': lambda s: s['close'].pct_change(20),
+        'volatility_20d': lambda s: s['close'].pct_change().rolling(20).std(),
+        'volume_ratio_20d': lambda s: s['vol'] / s['vol'].rolling(20).mean(),
+        'price_to_ma20': lambda s: s['close'] / s['close'].rolling(20).mean() - 1,
+    }
+    results = [compare(factor_id, baseline(df, factor_id, compute), compute_panel_factor(df, factor_id))
+               for factor_id, compute in cases.items()]
+    return all(results)
+
+
+def test_moneyflow_and_cyq_factors():
+    """测试资金流与筹码类面板因子"""
+    print("\n🧪 测试资金流与筹码类面板因子...")
+    moneyflow = make_fields(MONEYFLOW_FIELDS + ['net_mf_amount'])
+    cyq = make_fields(CYQ_FIELDS + ['winner_rate'], seed=2)
+    cases = {
+        'money_flow_strength': (moneyflow, lambda s: (
+            (s['buy_lg_amount'] + s['buy_elg_amount']) - (s['sell_lg_amount'] + s['sell_elg_amount'])
+        ) / (s['buy_sm_amount'] + s['buy_md_amount'] + s['buy_lg_amount'] + s['buy_elg_amount'])),
+        'big_order_ratio': (moneyflow, lambda s: (
+            s['buy_lg_amount'] + s['sell_lg_amount'] + s['buy_elg_amount'] + s['sell_elg_amount']
+        ) / s[MONEYFLOW_FIELDS].sum(axis=1)),
+        'money_flow_momentum': (moneyflow, lambda s: s['net_mf_amount'].rolling(5).sum()),
+        'chip_concentration': (cyq, lambda s: (s['cost_95pct'] - s['cost_5pct']) / s['cost_50pct']),
+        'winner_rate_change': (cyq, lambda s: s['winner_rate'].diff(5)),
+    }
+    results = [compare(factor_id, baseline(df, factor_id, compute), compute_panel_factor(df, factor_id))
+               for factor_id, (df, compute) in cases.items()]
+    return all(results)
+
+
+def main():
+    """主测试函数"""
+    print("🚀 开始面板因子内核测试")
+    print("=" * 50)
+
+    test_results = [test_history_factors(), test_moneyflow_and_cyq_factors()]
+    passed = sum(test_results)
+    total = len(test_results)
+    print(f"\n🎯 总体结果: {passed}/{total} 项测试通过")
+    return passed == total
+
+
+if __name__ == '__main__':
+    success = main()
+    sys.exit(0 if success else 1)
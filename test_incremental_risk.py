@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+盘中增量风险测试脚本
+随机推进价格与持仓数量，对比 PortfolioRiskState 的秩一更新结果与从头重算结果，
+并与原 RealtimeRiskManager 按组合收益序列计算的波动率、VaR/CVaR 对比
+"""
+
+import sys
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+# 添加项目根目录到Python路径
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from app.services.incremental_risk import PortfolioRiskState
+
+CONFIDENCE_LEVELS = (0.95, 0.99)
+RTOL = 1e-9
+
+
+def make_portfolio(n_stocks: int = 15, n_days: int = 252, seed: int = 0):
+    """持仓（轻量对象即可）与历史日收益"""
+    rng = np.random.default_rng(seed)
+    codes = [f'{i:06d}.SZ' for i in range(n_stocks)]
+    market = rng.normal(0.0003, 0.012, n_days)
+    returns = pd.DataFrame(np.outer(market, rng.uniform(0.5, 1.5, n_stocks))
+                           + rng.normal(0, 0.015, (n_days, n_stocks)), columns=codes)
+    positions = [SimpleNamespace(ts_code=code, position_size=float(rng.integers(1, 50) * 100),
+                                 current_price=float(rng.uniform(5, 80)), avg_cost=float(rng.uniform(5, 80)),
+                                 stop_loss_price=None, take_profit_price=None)
+                 for code in codes]
+    return positions, returns
+
+
+def build_state(positions, returns: pd.DataFrame) -> PortfolioRiskState:
+    return PortfolioRiskState('P001', positions, returns.cov().to_numpy(), returns.to_numpy(),
+                              CONFIDENCE_LEVELS)
+
+
+def random_walk(state: PortfolioRiskState, steps: int, seed: int = 1):
+    """随机逐笔更新：大部分为价格变动，少量为加减仓"""
+    rng = np.random.default_rng(seed)
+    for _ in range(steps):
+        code = state.codes[rng.integers(len(state.codes))]
+        i = state.index[code]
+        if rng.random() < 0.9:
+            state.update_price(code, state.prices[i] * (1 + rng.normal(0, 0.003)))
+        else:
+            state.update_quantity(code, float(max(state.quantities[i] + rng.integers(-10, 11) * 100, 0)))
+
+
+def relative_error(expected, actual) -> float:
+    expected = np.asarray(expected, dtype=float)
+    actual = np.asarray(actual, dtype=float)
+    return float((np.abs(expected - actual) / np.maximum(np.abs(expected).max(), 1e-12)).max())
+
+
+def current_positions(state: PortfolioRiskState):
+    return [SimpleNamespace(ts_code=code, position_size=state.quantities[i], current_price=state.prices[i],
+                            avg_cost=state.avg_cost[i], stop_loss_price=None, take_profit_price=None)
+            for i, code in enumerate(state.codes)]
+
+
+def baseline_metrics(returns: pd.DataFrame, weights: dict) -> dict:
+    """原实现：按权重合成组合收益序列，std 年化，np.percentile 取 VaR"""
+    portfolio_returns = pd.Series(0, index=returns.index)
+    for ts_code, weight in weights.items():
+        if ts_code in returns.columns:
+            portfolio_returns += returns[ts_code] * weight
+    metrics = {'annual_volatility': portfolio_returns.std() * np.sqrt(252)}
+    for confidence in CONFIDENCE_LEVELS:
+        var = np.percentile(portfolio_returns, (1 - confidence) * 100)
+        metrics[f'var_{int(confidence*100)}'] = var
+        metrics[f'cvar_{int(confidence*100)}'] = portfolio_returns[portfolio_returns <= var].mean()
+    return metrics
+
+
+def test_rank_one_matches_resync():
+    """测试连续秩一更新后与从头重算一致"""
+    print("\n🧪 测试秩一更新与重算一致...")
+    positions, returns = make_portfolio()
+    state = build_state(positions, returns)
+    random_walk(state, 5000)
+    fresh = build_state(current_positions(state), returns)
+    checks = {
+        '组合方差': (fresh.variance, state.variance),
+        'Σv': (fresh.cov_values, state.cov_values),
+        '情景盈亏': (fresh.scenario_pnl, state.scenario_pnl),
+        '组合市值': (fresh.total_value, state.total_value),
+    }
+    ok = True
+    for name, (expected, actual) in checks.items():
+        error = relative_error(expected, actual)
+        case_ok = error <= RTOL
+        status = "✅" if case_ok else "❌"
+        print(f"   {status} {name}: 相对误差 {error:.2e}")
+        ok = ok and case_ok
+    return ok
+
+
+def test_metrics_match_baseline():
+    """测试增量状态给出的波动率与历史 VaR/CVaR 与原实现一致"""
+    print("\n🧪 测试风险指标与原实现一致...")
+    positions, returns = make_portfolio(seed=2)
+    state = build_state(positions, returns)
+    random_walk(state, 1000, seed=3)
+    weights = dict(zip(state.codes, state.values / state.total_value))
+    expected = baseline_metrics(returns, weights)
+    metrics = state.metrics()
+    actual = dict(metrics['historical'], annual_volatility=metrics['annual_volatility'])
+    ok = True
+    for key, value in expected.items():
+        error = abs(actual[key] - value) / abs(value)
+        case_ok = error <= RTOL
+        status = "✅" if case_ok else "❌"
+        print(f"   {status} {key}: 原实现 {value:.6f}, 增量 {actual[key]:.6f}")
+        ok = ok and case_ok
+    return ok
+
+
+def test_invalid_updates():
+    """测试未知股票与非正价格被忽略，状态不变"""
+    print("\n🧪 测试无效更新...")
+    positions, returns = make_portfolio(n_stocks=5, seed=4)
+    state = build_state(positions, returns)
+    variance = state.variance
+    accepted = [state.update_price('999999.SH', 10.0), state.update_price(state.codes[0], 0.0),
+                state.update_price(state.codes[0], -1.0), state.update_quantity('999999.SH', 100)]
+    ok = not any(accepted) and state.variance == variance
+    status = "✅" if ok else "❌"
+    print(f"   {status} 被接受的更新: {sum(accepted)}")
+    return ok
+
+
+def main():
+    """主测试函数"""
+    print("🚀 开始盘中增量风险测试")
+    print("=" * 50)
+
+    test_results = [test_rank_one_matches_resync(), test_metrics_match_baseline(), test_invalid_updates()]
+    passed = sum(test_results)
+    total = len(test_results)
+    print(f"\n🎯 总体结果: {passed}/{total} 项测试通过")
+    return passed == total
+
+
+if __name__ == '__main__':
+    success = main()
+    sys.exit(0 if success else 1)
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+情景分析与 VaR 引擎测试脚本
+历史模拟与原 RealtimeRiskManager._calculate_var_cvar 对比，蒙特卡洛与正态解析解对比，
+并检查压力协方差的合法性
+"""
+
+import sys
+import os
+from statistics import NormalDist
+
+import numpy as np
+import pandas as pd
+
+# 添加项目根目录到Python路径
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from app.services.scenario_engine import ScenarioEngine, stressed_covariance
+from app.services.factor_risk_model import FactorRiskModel
+
+CONFIDENCE_LEVELS = (0.95, 0.99)
+MC_RTOL = 0.02
+
+
+def make_returns(n_days: int = 500, n_stocks: int = 8, seed: int = 0) -> np.ndarray:
+    """单因子结构的日收益面板"""
+    rng = np.random.default_rng(seed)
+    market = rng.normal(0.0003, 0.012, n_days)
+    betas = rng.uniform(0.6, 1.4, n_stocks)
+    return np.outer(market, betas) + rng.normal(0, 0.015, (n_days, n_stocks))
+
+
+def baseline_var_cvar(returns: pd.DataFrame, weights: dict) -> dict:
+    """原实现：按列加权得到组合收益，np.percentile 取分位数"""
+    portfolio_returns = pd.Series(0, index=returns.index)
+    for ts_code, weight in weights.items():
+        if ts_code in returns.columns:
+            portfolio_returns += returns[ts_code] * weight
+    var_metrics = {}
+    for confidence in CONFIDENCE_LEVELS:
+        var = np.percentile(portfolio_returns, (1 - confidence) * 100)
+        cvar = portfolio_returns[portfolio_returns <= var].mean()
+        var_metrics[f'var_{int(confidence*100)}'] = var
+        var_metrics[f'cvar_{int(confidence*100)}'] = cvar
+    return var_metrics
+
+
+def normal_var_cvar(mean: float, std: float) -> dict:
+    """正态分布下 VaR/CVaR 的解析解"""
+    metrics = {}
+    for confidence in CONFIDENCE_LEVELS:
+        tail = 1 - confidence
+        z = NormalDist().inv_cdf(tail)
+        label = int(round(confidence * 100))
+        metrics[f'var_{label}'] = mean + std * z
+        metrics[f'cvar_{label}'] = mean - std * NormalDist().pdf(z) / tail
+    return metrics
+
+
+def compare_metrics(name: str, expected: dict, actual: dict, rtol: float) -> bool:
+    errors = {key: abs(actual[key] - value) / abs(value) for key, value in expected.items()}
+    worst = max(errors.values())
+    ok = worst <= rtol
+    status = "✅" if ok else "❌"
+    print(f"   {status} {name}: 最大相对误差 {worst:.2e}")
+    return ok
+
+
+def test_historical_matches_baseline():
+    """测试历史模拟 VaR/CVaR 与原实现一致"""
+    print("\n🧪 测试历史模拟 VaR/CVaR...")
+    returns = make_returns()
+    codes = [f'{i:06d}.SZ' for i in range(returns.shape[1])]
+    weights = np.random.default_rng(1).dirichlet(np.ones(len(codes)))
+    expected = baseline_var_cvar(pd.DataFrame(returns, columns=codes), dict(zip(codes, weights)))
+    actual = ScenarioEngine(CONFIDENCE_LEVELS).historical(returns, weights)
+    return compare_metrics('历史模拟', expected, actual, 1e-12)
+
+
+def test_monte_carlo_matches_normal():
+    """测试蒙特卡洛 VaR 与正态解析解一致（协方差与因子模型两种抽样）"""
+    print("\n🧪 测试蒙特卡洛 VaR...")
+    rng = np.random.default_rng(2)
+    n_stocks, n_factors = 12, 3
+    exposures = rng.normal(0, 1, (n_stocks, n_factors))
+    factor_cov = np.diag(rng.uniform(1e-5, 4e-5, n_factors))
+    specific_var = rng.uniform(1e-4, 3e-4, n_stocks)
+    model = FactorRiskModel('2024-06-28', [f'{i:06d}.SH' for i in range(n_stocks)],
+                            [f'f{k}' for k in range(n_factors)], exposures, factor_cov, specific_var)
+    covariance = model.covariance().to_numpy()
+    weights = rng.dirichlet(np.ones(n_stocks))
+    mean = rng.normal(0.0005, 0.0002, n_stocks)
+
+    engine = ScenarioEngine(CONFIDENCE_LEVELS, n_scenarios=400000, chunk_size=50000, seed=3)
+    results = []
+    for horizon in (1, 5):
+        expected = normal_var_cvar(float(mean @ weights) * horizon,
+                                   np.sqrt(model.portfolio_variance(weights) * horizon))
+        dense = engine.monte_carlo(weights, covariance, mean, horizon_days=horizon)
+        factor = engine.monte_carlo(weights, mean=mean, factor_model=model, horizon_days=horizon)
+        results.append(compare_metrics(f'协方差抽样 {horizon} 日', expected, dense, MC_RTOL))
+        results.append(compare_metrics(f'因子模型抽样 {horizon} 日', expected, factor, MC_RTOL))
+
+    t_dist = engine.monte_carlo(weights, covariance, dof=5)
+    heavier = t_dist['var_99'] < normal_var_cvar(0.0, np.sqrt(model.portfolio_variance(weights)))['var_99']
+    status = "✅" if heavier else "❌"
+    print(f"   {status} t 分布(自由度 5) 99% VaR 尾部更厚: {t_dist['var_99']:.5f}")
+    return all(results) and heavier
+
+
+def test_stressed_covariance():
+    """测试相关性冲击：结果半正定、平均相关系数达到目标（负目标截断到 -1/(n-1)），波动率按比例放大"""
+    print("\n🧪 测试压力协方差...")
+    covariance = np.cov(make_returns(n_stocks=10), rowvar=False)
+    n = len(covariance)
+    ok = True
+    for target in (0.9, 0.3, 0.0, -0.05, -0.5):
+        stressed = stressed_covariance(covariance, volatility_shock=0.5, correlation_shock=target)
+        std = np.sqrt(np.diag(stressed))
+        corr = stressed / np.outer(std, std)
+        mean_corr = float(corr[np.triu_indices(n, k=1)].mean())
+        min_eig = float(np.linalg.eigvalsh(corr).min())
+        expected = max(target, -1.0 / (n - 1))
+        case_ok = (min_eig >= -1e-10 and abs(mean_corr - expected) < 1e-10
+                   and np.allclose(std, 1.5 * np.sqrt(np.diag(covariance))))
+        status = "✅" if case_ok else "❌"
+        print(f"   {status} 目标 {target:+.2f}: 平均相关 {mean_corr:+.4f}, 最小特征值 {min_eig:.2e}")
+        ok = ok and case_ok
+    return ok
+
+
+def test_market_shock():
+    """测试市场冲击：Beta 均为 1 时组合损益等于冲击幅度，与原实现一致"""
+    print("\n🧪 测试市场冲击...")
+    market = np.random.default_rng(4).normal(0, 0.01, 250)
+    returns = np.column_stack([market] * 4)
+    weights = np.full(4, 0.25)
+    engine = ScenarioEngine(CONFIDENCE_LEVELS, n_scenarios=20000, seed=5)
+    result = engine.stress_test(returns, weights, [{'name': '市场下跌10%', 'market_shock': -0.10}], 1e6)
+    scenario = result['scenarios'][0]
+    ok = abs(scenario['pnl_percentage'] + 10.0) < 1e-9 and abs(scenario['stressed_value'] - 9e5) < 1e-3
+    status = "✅" if ok else "❌"
+    print(f"   {status} 损益 {scenario['pnl_percentage']:.4f}%, 压力后市值 {scenario['stressed_value']:.2f}")
+    return ok
+
+
+def main():
+    """主测试函数"""
+    print("🚀 开始情景分析与 VaR 引擎测试")
+    print("=" * 50)
+
+    test_results = [
+        test_historical_matches_baseline(),
+        test_monte_carlo_matches_normal(),
+        test_stressed_covariance(),
+        test_market_shock()
+    ]
+    passed = sum(test_results)
+    total = len(test_results)
+    print(f"\n🎯 总体结果: {passed}/{total} 项测试通过")
+    return passed == total
+
+
+if __name__ == '__main__':
+    success = main()
+    sys.exit(0 if success else 1)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+流式技术指标测试脚本
+逐根 K 线推进 IndicatorState，与 RealtimeIndicatorEngine 按整段窗口计算的 pandas 实现逐值对比，
+数据中包含涨跌停封板形成的平盘区间
+"""
+
+import sys
+import os
+import math
+
+import numpy as np
+import pandas as pd
+
+# 添加项目根目录到Python路径
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from app.services.realtime_indicator_engine import RealtimeIndicatorEngine
+from app.services.streaming_indicators import IndicatorState
+
+RTOL = 1e-7
+ATOL = 1e-7
+
+
+def make_bars(n: int = 400, price: float = 10.37, seed: int = 0) -> pd.DataFrame:
+    """随机游走分钟K线，中间插入一段一字封板（开高低收相同）"""
+    rng = np.random.default_rng(seed)
+    close = price * np.cumprod(1 + rng.normal(0, 0.003, n))
+    high = close * (1 + rng.uniform(0, 0.004, n))
+    low = close * (1 - rng.uniform(0, 0.004, n))
+    flat = slice(n // 2, n // 2 + 40)
+    close[flat] = high[flat] = low[flat] = round(close[n // 2 - 1] * 1.1, 2)
+    return pd.DataFrame({
+        'datetime': pd.date_range('2024-01-02 09:31', periods=n, freq='min'),
+        'open': close, 'high': high, 'low': low, 'close': close,
+        'volume': rng.uniform(1e3, 1e5, n)
+    })
+
+
+def _missing(value) -> bool:
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+
+def _baseline_series(engine: RealtimeIndicatorEngine, df: pd.DataFrame) -> dict:
+    """按流式输出的结构整理 pandas 实现的结果：{指标: 每根K线的值}"""
+    n = len(df)
+    ma = engine._calculate_ma(df)
+    ema = engine._calculate_ema(df)
+    series = {
+        'MA': [[ma[f'MA{p}'][i] for p in engine.default_params['MA']['periods']] for i in range(n)],
+        'EMA': [[ema[f'EMA{p}'][i] for p in engine.default_params['EMA']['periods']] for i in range(n)],
+    }
+    for name in ('MACD', 'RSI', 'KDJ', 'BOLL', 'CCI', 'WR', 'ATR', 'OBV'):
+        series[name] = engine.supported_indicators[name](df)[name]
+    return series
+
+
+def _compare_value(expected, actual) -> bool:
+    if isinstance(expected, (list, tuple)) or isinstance(actual, (list, tuple)):
+        if expected is None or actual is None:
+            return False
+        return all(_compare_value(e, a) for e, a in zip(expected, actual))
+    if _missing(expected) or _missing(actual):
+        return _missing(expected) and _missing(actual)
+    return bool(np.isclose(actual, expected, rtol=RTOL, atol=ATOL))
+
+
+def _flat_windows(df: pd.DataFrame, window: int) -> np.ndarray:
+    """典型价格在整个窗口内不变的K线"""
+    typical = (df['high'] + df['low'] + df['close']) / 3
+    return (typical.rolling(window).max() == typical.rolling(window).min()).to_numpy()
+
+
+def compare_indicators(df: pd.DataFrame, warmup: int = 60) -> dict:
+    """返回每个指标在预热期之后的不一致K线数
+
+    平盘窗口的 CCI：pandas 实现的平均绝对偏差恰好为 0 时得到 0/0 = NaN，残留舍入误差时得到 0，
+    流式实现统一返回 0，这两种情况都视为一致。
+    """
+    engine = RealtimeIndicatorEngine()
+    expected = _baseline_series(engine, df)
+    flat_cci = _flat_windows(df, engine.default_params['CCI']['period'])
+    state = IndicatorState('000001.SZ', '1min')
+    mismatches = {name: 0 for name in expected}
+    for i, row in enumerate(df.to_dict('records')):
+        values = state.update(row)
+        if i < warmup:
+            continue
+        for name, baseline_values in expected.items():
+            if name == 'CCI' and flat_cci[i] and values[name] == 0.0:
+                continue
+            if not _compare_value(baseline_values[i], values[name]):
+                mismatches[name] += 1
+    return mismatches
+
+
+def test_streaming_matches_pandas():
+    """测试随机游走与封板区间上的逐值一致性"""
+    print("\n🧪 测试流式指标与 pandas 实现一致...")
+    ok = True
+    for price, seed in ((10.37, 0), (3.01, 1), (1234.5, 2)):
+        mismatches = compare_indicators(make_bars(price=price, seed=seed))
+        bad = {name: count for name, count in mismatches.items() if count}
+        status = "✅" if not bad else "❌"
+        print(f"   {status} 价格 {price}: 不一致 {bad or '无'}")
+        ok = ok and not bad
+    return ok
+
+
+def test_flat_window():
+    """测试一字板窗口：CCI 为 0，布林带宽度为 0"""
+    print("\n🧪 测试平盘窗口...")
+    df = make_bars()
+    state = IndicatorState('000001.SZ', '1min')
+    values = None
+    for row in df.iloc[:df.index[len(df) // 2 + 39] + 1].to_dict('records'):
+        values = state.update(row)
+    upper, middle, lower = values['BOLL']
+    ok = values['CCI'] == 0.0 and upper == lower
+    status = "✅" if ok else "❌"
+    print(f"   {status} CCI = {values['CCI']}, BOLL 宽度 = {upper - lower}")
+    return ok
+
+
+def main():
+    """主测试函数"""
+    print("🚀 开始流式技术指标测试")
+    print("=" * 50)
+
+    test_results = [test_streaming_matches_pandas(), test_flat_window()]
+    passed = sum(test_results)
+    total = len(test_results)
+    print(f"\n🎯 总体结果: {passed}/{total} 项测试通过")
+    return passed == total
+
+
+if __name__ == '__main__':
+    success = main()
+    sys.exit(0 if success else 1)